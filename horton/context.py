@@ -30,6 +30,10 @@
    environment variable ``HORTONDATA``, it is assumed that the data is located
    in a directory called ``data``. If the data directory does not exist, an
    error is raised.
+
+   The number of threads used by the compiled code to compute integrals can be
+   set with the environment variable ``HORTONNTHREAD`` or by changing the
+   ``nthread`` attribute of the context object. It defaults to one.
 '''
 
 
@@ -68,6 +72,10 @@ class Context(object):
                         'include/python%i.%i' % (sys.version_info.major, sys.version_info.minor))
         if not os.path.isdir(self.data_dir):
             raise IOError('Can not find the data files. The directory %s does not exist.' % self.data_dir)
+        # Determine the default number of threads for the compiled code
+        self.nthread = int(os.getenv('HORTONNTHREAD', '1'))
+        if self.nthread < 1:
+            raise ValueError('HORTONNTHREAD must be a strictly positive integer.')
 
     def get_fn(self, filename):
         '''Return the full path to the given filename in the data directory.'''
@@ -23,4 +23,5 @@
 
 from horton.gbasis.cext import *
 from horton.gbasis.gobasis import *
+from horton.gbasis.intcache import *
 from horton.gbasis.iobas import *
@@ -21,6 +21,7 @@
 
 #include <cmath>
 #include <stdexcept>
+#include <vector>
 #include "horton/gbasis/boys.h"
 
 
@@ -69,49 +70,80 @@ double boys_function(long m, double t) {
     }
 }
 
+/*
+    The same data as in boys_fn_data, transposed such that row i contains the values at
+    grid point i for all orders. The Taylor expansions for all orders at one value of t
+    then use contiguous memory, which is friendly for caches and vectorization. Values
+    beyond the size of the original arrays are zero and never used.
+*/
+#define BOYS_TABLE_WIDTH (BOYS_MAX_DATA + 2)
+
+static std::vector<double> make_boys_table() {
+    const long nrow = boys_sizes[BOYS_MAX_DATA];
+    std::vector<double> result(nrow*BOYS_TABLE_WIDTH, 0.0);
+    for (long m=0; m <= BOYS_MAX_DATA; m++) {
+        for (long i=0; i < boys_sizes[m]; i++) {
+            result[i*BOYS_TABLE_WIDTH + m] = boys_fn_data[m][i];
+        }
+    }
+    return result;
+}
+
+static const std::vector<double> boys_table = make_boys_table();
+
+
 void boys_function_array(long mmax, double t, double *output) {
-    // for (long m=0; m <= mmax; m++) {
-    //   output[m] = boys_function(m, t);
-    // }
-    // return;
+    boys_function_batch(mmax, 1, &t, output);
+}
+
 
-    if (mmax < 0 || mmax > BOYS_MAX_M || t < 0) {
+void boys_function_batch(long mmax, long npoint, const double* t, double* output) {
+    if (mmax < 0 || mmax > BOYS_MAX_M) {
         throw std::domain_error("Arguments to Boys function are outside the valid domain.");
     }
-    // Precompute terms in taylor series without coefficients, if needed.
-    const int i = static_cast<int>((round(t*BOYS_RESOLUTION)));
-    double xs[6];
-    if (i < (boys_sizes[mmax]-1)) {
-        // The if clause relies on the fact that the size of the pre-computed
-        // Boys function arrays increases with m.
-        const double t_delta = (i - t*BOYS_RESOLUTION)/BOYS_RESOLUTION;
+    const double* table = &boys_table[0];
+    for (long ipoint=0; ipoint < npoint; ipoint++) {
+        const double tp = t[ipoint];
+        if (tp < 0) {
+            throw std::domain_error("Arguments to Boys function are outside the valid domain.");
+        }
+        double* out = output + ipoint*(mmax + 1);
+        const int i = static_cast<int>((round(tp*BOYS_RESOLUTION)));
+        if (i >= (boys_sizes[mmax]-1)) {
+            // Asymptotic form for all orders.
+            double tail = SQRT_PI_D2/sqrt(tp);
+            out[0] = tail;
+            for (long m=1; m <= mmax; m++) {
+                tail *= 0.5*(2*m-1)/tp;
+                out[m] = tail;
+            }
+            continue;
+        }
+        // Terms in the Taylor series without coefficients.
+        const double t_delta = (i - tp*BOYS_RESOLUTION)/BOYS_RESOLUTION;
+        double xs[6];
         xs[0] = t_delta;
         xs[1] = xs[0]*(t_delta/2.0);
         xs[2] = xs[1]*(t_delta/3.0);
         xs[3] = xs[2]*(t_delta/4.0);
         xs[4] = xs[3]*(t_delta/5.0);
         xs[5] = xs[4]*(t_delta/6.0);
-    }
-    // Start the computation of the approximation of the Boys function and its
-    // derivative for large values of t, if needed.
-    double tail = NAN;
-    if (i >= (boys_sizes[0]-1)) {
-        tail = SQRT_PI_D2/sqrt(t);
-    }
-    // Compute the Boys function and all the requested derivatives.
-    for (long m=0; m <= mmax; m++) {
-        if (i >= (boys_sizes[m]-1)) {
-            if (m > 0) tail *= 0.5*(2*m-1)/t;
-            output[m] = tail;
-        } else {
-            output[m] =
-                boys_fn_data[m][i] +
-                boys_fn_data[m+1][i]*xs[0] +
-                boys_fn_data[m+2][i]*xs[1] +
-                boys_fn_data[m+3][i]*xs[2] +
-                boys_fn_data[m+4][i]*xs[3] +
-                boys_fn_data[m+5][i]*xs[4] +
-                boys_fn_data[m+6][i]*xs[5];
+        const double* row = table + i*BOYS_TABLE_WIDTH;
+        long mbegin = 0;
+        if (i >= (boys_sizes[0]-1)) {
+            // The pre-computed arrays are shorter for low orders, which use the
+            // asymptotic form. This relies on the fact that the size of the arrays
+            // increases with m.
+            double tail = SQRT_PI_D2/sqrt(tp);
+            while (i >= (boys_sizes[mbegin]-1)) {
+                if (mbegin > 0) tail *= 0.5*(2*mbegin-1)/tp;
+                out[mbegin] = tail;
+                mbegin++;
+            }
+        }
+        for (long m=mbegin; m <= mmax; m++) {
+            out[m] = row[m] + row[m+1]*xs[0] + row[m+2]*xs[1] + row[m+3]*xs[2] +
+                     row[m+4]*xs[3] + row[m+5]*xs[4] + row[m+6]*xs[5];
         }
     }
 }
@@ -53,4 +53,22 @@ double boys_function(long m, double t);
  */
 void boys_function_array(long mmax, double t, double *output);
 
+/** @brief
+        Compute the boys function for a range of orders and many arguments in one go.
+
+    @param mmax
+        The highest value of the order. All orders from zero up to this value
+        (inclusive) are computed.
+
+    @param npoint
+        The number of arguments.
+
+    @param t
+        The rescaled distances between the two centers, shape (npoint,).
+
+    @param output
+        The output array, shape (npoint, mmax+1).
+ */
+void boys_function_batch(long mmax, long npoint, const double* t, double* output);
+
 #endif  // HORTON_GBASIS_BOYS_H_
@@ -32,6 +32,7 @@ from cython.operator cimport dereference as deref
 cimport boys
 cimport cartpure
 cimport common
+cimport esp
 cimport gbasis
 cimport ints
 cimport fns
@@ -39,9 +40,11 @@ cimport iter_gb
 cimport iter_pow
 cimport cholesky
 cimport gbw
+cimport packed
 
 import atexit
 
+from horton.context import context
 from horton.log import log, biblio
 from horton.cext import compute_grid_nucpot
 
@@ -60,6 +63,11 @@ __all__ = [
     'GOBasis',
     # gbw (testing)
     'get_2index_slice', 'compute_diagonal', 'select_2index',
+    # packed
+    'get_packed_size', 'get_packed_nbasis', 'pack_four_index', 'unpack_four_index',
+    'contract_packed',
+    # esp
+    'ScreenedAttraction',
     # ints
     'GB2OverlapIntegral', 'GB2KineticIntegral',
     'GB2ErfAttractionIntegral',
@@ -108,6 +116,27 @@ cdef check_shape(array, shape, name):
             name, i, array.shape[i], i, si))
 
 
+cdef long get_nthread(nthread) except -1:
+    """Return the number of threads to be used by the C++ code.
+
+    Parameters
+    ----------
+    nthread : int or None
+        The requested number of threads. When None, ``context.nthread`` is used.
+
+    Raises
+    ------
+    ValueError
+        When the number of threads is not strictly positive.
+    """
+    if nthread is None:
+        nthread = context.nthread
+    if nthread < 1:
+        raise ValueError('The number of threads must be strictly positive. Got {}.'.format(
+            nthread))
+    return nthread
+
+
 cdef prepare_array(array, shape, name):
     """Check array shape or initialize it if None.
 
@@ -136,6 +165,36 @@ cdef prepare_array(array, shape, name):
     return array
 
 
+cdef prepare_four_index(array, long nbasis, bint use_packed):
+    """Check the array for four-center integrals or initialize it if None.
+
+    Parameters
+    ----------
+    array
+        Array to be checked (or initialized if None).
+    nbasis
+        The number of basis functions.
+    use_packed
+        When True, the array must have the packed format, see ``pack_four_index``.
+
+    Returns
+    -------
+    array
+
+    Raises
+    ------
+    TypeError
+        When the shape of the array is not correct or when it is not C-contiguous.
+    """
+    if use_packed:
+        array = prepare_array(array, (packed.get_packed_size(nbasis),), 'output')
+    else:
+        array = prepare_array(array, (nbasis, nbasis, nbasis, nbasis), 'output')
+    if not array.flags['C_CONTIGUOUS']:
+        raise TypeError('Array \'output\' must be C-contiguous.')
+    return array
+
+
 #
 # boys wrappers (for testing only)
 #
@@ -145,10 +204,29 @@ def boys_function(long m, double t):
     return boys.boys_function(m, t)
 
 
-def boys_function_array(long mmax, double t):
-    cdef np.ndarray[double] output = np.zeros(mmax+1)
-    boys.boys_function_array(mmax, t, &output[0])
-    return output
+def boys_function_array(long mmax, t):
+    """Compute the Boys function for all orders up to mmax.
+
+    Parameters
+    ----------
+    mmax : int
+        The highest order.
+    t : float or np.ndarray, shape=(npoint,)
+        The argument(s) of the Boys function.
+
+    Returns
+    -------
+    output : np.ndarray, shape=(mmax+1,) or (npoint, mmax+1)
+        The Boys function for all orders (and all arguments).
+    """
+    cdef double[::1] ts = np.array(t, dtype=float, ndmin=1)
+    check_shape(np.asarray(ts), (-1,), 't')
+    cdef double[:, ::1] output = np.zeros((ts.shape[0], mmax+1))
+    if ts.shape[0] > 0:
+        boys.boys_function_batch(mmax, ts.shape[0], &ts[0], &output[0, 0])
+    if np.ndim(t) == 0:
+        return np.asarray(output[0])
+    return np.asarray(output)
 
 
 #
@@ -508,6 +586,31 @@ cdef class GBasis:
         def __get__(self):
             return self._this.get_max_shell_type()
 
+    property grid_tolerance:
+        '''Tolerance for the screening of shells on grids.
+
+           Grid routines (e.g. ``compute_grid_density_dm``,
+           ``compute_grid_density_fock`` and ``compute_grid_orbitals_exp``) skip
+           shells whose basis functions and their first and second derivatives are
+           (approximately) smaller than this tolerance in a grid point. Screening
+           is disabled when set to zero.
+        '''
+        def __get__(self):
+            return self._this.get_grid_tolerance()
+
+        def __set__(self, double tolerance):
+            if tolerance < 0:
+                raise ValueError('The grid tolerance must not be negative.')
+            self._this.set_grid_tolerance(tolerance)
+
+    property shell_extents:
+        '''Radius of each shell beyond which it is neglected on grids.'''
+        def __get__(self):
+            cdef np.npy_intp* shape = [self.nshell]
+            tmp = np.PyArray_SimpleNewFromData(1, shape, np.NPY_DOUBLE,
+                        <void*> self._this.get_shell_extents())
+            return tmp.copy()
+
     def _log_init(self):
         '''Write a summary of the basis to the screen logger'''
         if log.do_medium:
@@ -602,6 +705,7 @@ cdef class GBasis:
         # create the basis set object
         basis = self.__class__(new_centers, new_shell_map, new_nprims,
                                new_shell_types, new_alphas, new_con_coeffs)
+        basis.grid_tolerance = self.grid_tolerance
         # return stuff
         return basis, ibasis_list
 
@@ -839,7 +943,78 @@ cdef class GOBasis(GBasis):
             &xyz[0], &center[0], &output[0, 0])
         return np.asarray(output)
 
-    def compute_electron_repulsion(self, double[:, :, :, ::1] output=None):
+    def compute_multipole_moments(self, long lmax, double[::1] center not None,
+                                  double[:, :, ::1] output=None):
+        """Compute all Cartesian (multipole) moment integrals up to a given order.
+
+        The result is the same as calling ``compute_multipole_moment`` for every row of
+        ``get_cartesian_powers(lmax)`` (and ``compute_overlap`` for l=0), but all moments
+        are computed in a single pass over the pairs of shells.
+
+        Parameters
+        ----------
+        lmax : int
+            The highest order of the moments.
+        center : np.ndarray, shape = (3,)
+            The center [C_x, C_y, C_z] around which the moment integrals are computed.
+        output : np.ndarray, shape = (ncart_cumul(lmax), nbasis, nbasis), dtype=float
+            Output array. When not given, it is allocated and returned.
+
+        Returns
+        -------
+        output : np.ndarray, shape = (ncart_cumul(lmax), nbasis, nbasis), dtype=float
+            The moment integrals, in the order of ``get_cartesian_powers(lmax)``.
+        """
+        check_shape(center, (3,), 'center')
+        result = self.compute_multipole_moments_centers(
+            lmax, np.asarray(center).reshape(1, 3),
+            None if output is None else np.asarray(output)[None])
+        return result[0]
+
+    def compute_multipole_moments_centers(self, long lmax, double[:, ::1] centers not None,
+                                          double[:, :, :, ::1] output=None):
+        """Compute all Cartesian (multipole) moment integrals up to a given order, for
+        several centers.
+
+        Parameters
+        ----------
+        lmax : int
+            The highest order of the moments.
+        centers : np.ndarray, shape = (ncenter, 3)
+            The centers around which the moment integrals are computed, e.g. the
+            positions of the atoms.
+        output : np.ndarray, shape = (ncenter, ncart_cumul(lmax), nbasis, nbasis), dtype=float
+            Output array. When not given, it is allocated and returned.
+
+        Returns
+        -------
+        output : np.ndarray, shape = (ncenter, ncart_cumul(lmax), nbasis, nbasis), dtype=float
+            The moment integrals for every center, in the order of
+            ``get_cartesian_powers(lmax)``.
+        """
+        # type checking
+        if lmax < 0:
+            raise ValueError('The order of the multipole moments can not be negative.')
+        check_shape(centers, (-1, 3), 'centers')
+        ncenter = centers.shape[0]
+        nmoment = ((lmax + 1)*(lmax + 2)*(lmax + 3))/6
+        output = prepare_array(output, (ncenter, nmoment, self.nbasis, self.nbasis), 'output')
+        # actual job
+        if ncenter > 0:
+            (<gbasis.GOBasis*>self._this).compute_multipole_moments(
+                lmax, &centers[0, 0], ncenter, &output[0, 0, 0, 0])
+        return np.asarray(output)
+
+    def _log_screening(self, long nskip, double screening_threshold):
+        """Report how many shell quartets were skipped by the Schwarz screening."""
+        if log.do_medium and screening_threshold > 0:
+            npair = (self.nshell*(self.nshell + 1))/2
+            nquartet = (npair*(npair + 1))/2
+            log('Schwarz screening (threshold=%.1e) skipped %i out of %i shell quartets.'
+                % (screening_threshold, nskip, nquartet))
+
+    def compute_electron_repulsion(self, output=None, double screening_threshold=0.0,
+                                   nthread=None, bint packed=False):
         r'''Compute electron-electron repulsion integrals.
 
         The potential has the following form:
@@ -850,7 +1025,18 @@ cdef class GOBasis(GBasis):
         Parameters
         ----------
         output
-            A Four-index object, optional.
+            A Four-index object, optional. When packed is True, a one-dimensional
+            array with ``get_packed_size(nbasis)`` elements.
+        screening_threshold : float
+            Shell quartets whose Schwarz upper bound is below this threshold are
+            skipped and their integrals are set to zero. The default (zero) disables
+            the screening.
+        nthread : int
+            The number of threads. The result does not depend on it. When not given,
+            ``context.nthread`` is used.
+        packed : bool
+            When True, only the symmetry-unique integrals are stored, see
+            :py:func:`pack_four_index`.
 
         Returns
         -------
@@ -858,13 +1044,19 @@ cdef class GOBasis(GBasis):
 
         Keywords: :index:`ERI`, :index:`four-center integrals`
         '''
+        cdef double[::1] flat_output
         biblio.cite('valeev2014',
                     'the efficient implementation of four-center electron repulsion integrals')
-        output = prepare_array(output, (self.nbasis, self.nbasis, self.nbasis, self.nbasis), 'output')
-        (<gbasis.GOBasis*>self._this).compute_electron_repulsion(&output[0, 0, 0, 0])
+        output = prepare_four_index(output, self.nbasis, packed)
+        flat_output = output.reshape(-1)
+        nskip = (<gbasis.GOBasis*>self._this).compute_electron_repulsion(
+            &flat_output[0], screening_threshold, get_nthread(nthread), packed)
+        self._log_screening(nskip, screening_threshold)
         return np.asarray(output)
 
-    def compute_erf_repulsion(self, double mu=0.0, double[:, :, :, ::1] output=None):
+    def compute_erf_repulsion(self, double mu=0.0, output=None,
+                              double screening_threshold=0.0, nthread=None,
+                              bint packed=False):
         r"""Compute short-range electron repulsion integrals.
 
         The potential has the following form:
@@ -877,7 +1069,18 @@ cdef class GOBasis(GBasis):
         mu : float
             Parameter for the erf(mu r)/r potential. Default is zero.
         output
-            A Four-index object, optional.
+            A Four-index object, optional. When packed is True, a one-dimensional
+            array with ``get_packed_size(nbasis)`` elements.
+        screening_threshold : float
+            Shell quartets whose Schwarz upper bound is below this threshold are
+            skipped and their integrals are set to zero. The default (zero) disables
+            the screening.
+        nthread : int
+            The number of threads. The result does not depend on it. When not given,
+            ``context.nthread`` is used.
+        packed : bool
+            When True, only the symmetry-unique integrals are stored, see
+            :py:func:`pack_four_index`.
 
         Returns
         -------
@@ -885,16 +1088,21 @@ cdef class GOBasis(GBasis):
 
         Keywords: :index:`ERI`, :index:`four-center integrals`
         """
+        cdef double[::1] flat_output
         biblio.cite('valeev2014',
                  'the efficient implementation of four-center electron repulsion integrals')
         biblio.cite('ahlrichs2006',
                  'the methodology to implement various types of four-center integrals.')
-        output = prepare_array(output, (self.nbasis, self.nbasis, self.nbasis, self.nbasis), 'output')
-        (<gbasis.GOBasis*>self._this).compute_erf_repulsion(&output[0, 0, 0, 0], mu)
+        output = prepare_four_index(output, self.nbasis, packed)
+        flat_output = output.reshape(-1)
+        nskip = (<gbasis.GOBasis*>self._this).compute_erf_repulsion(
+            &flat_output[0], mu, screening_threshold, get_nthread(nthread), packed)
+        self._log_screening(nskip, screening_threshold)
         return np.asarray(output)
 
-    def compute_gauss_repulsion(self, double c=1.0, double alpha=1.0,
-                                double[:, :, :, ::1] output=None):
+    def compute_gauss_repulsion(self, double c=1.0, double alpha=1.0, output=None,
+                                double screening_threshold=0.0, nthread=None,
+                                bint packed=False):
         r"""Compute gaussian repulsion four-center integrals.
 
         The potential has the following form:
@@ -909,7 +1117,18 @@ cdef class GOBasis(GBasis):
         alpha : float
             Exponential parameter of the gaussian.
         output
-            A Four-index object, optional.
+            A Four-index object, optional. When packed is True, a one-dimensional
+            array with ``get_packed_size(nbasis)`` elements.
+        screening_threshold : float
+            Shell quartets whose Schwarz upper bound is below this threshold are
+            skipped and their integrals are set to zero. The default (zero) disables
+            the screening.
+        nthread : int
+            The number of threads. The result does not depend on it. When not given,
+            ``context.nthread`` is used.
+        packed : bool
+            When True, only the symmetry-unique integrals are stored, see
+            :py:func:`pack_four_index`.
 
         Returns
         -------
@@ -917,6 +1136,7 @@ cdef class GOBasis(GBasis):
 
         Keywords: :index:`ERI`, :index:`four-center integrals`
         """
+        cdef double[::1] flat_output
         biblio.cite('valeev2014',
                  'the efficient implementation of four-center electron repulsion integrals')
         biblio.cite('ahlrichs2006',
@@ -925,11 +1145,16 @@ cdef class GOBasis(GBasis):
                  'four-center integrals with a Gaussian interaction potential.')
         biblio.cite('toulouse2004',
                  'four-center integrals with a Gaussian interaction potential.')
-        output = prepare_array(output, (self.nbasis, self.nbasis, self.nbasis, self.nbasis), 'output')
-        (<gbasis.GOBasis*>self._this).compute_gauss_repulsion(&output[0, 0, 0, 0], c, alpha)
+        output = prepare_four_index(output, self.nbasis, packed)
+        flat_output = output.reshape(-1)
+        nskip = (<gbasis.GOBasis*>self._this).compute_gauss_repulsion(
+            &flat_output[0], c, alpha, screening_threshold, get_nthread(nthread), packed)
+        self._log_screening(nskip, screening_threshold)
         return np.asarray(output)
 
-    def compute_ralpha_repulsion(self, double alpha=-1.0, double[:, :, :, ::1] output=None):
+    def compute_ralpha_repulsion(self, double alpha=-1.0, output=None,
+                                 double screening_threshold=0.0, nthread=None,
+                                 bint packed=False):
         r"""Compute r^alpha repulsion four-center integrals.
 
         The potential has the following form:
@@ -937,14 +1162,26 @@ cdef class GOBasis(GBasis):
         .. math::
             v = r^{\alpha}
 
-        with :math:`\alpha > -3`.
+        with :math:`\alpha > -3`. The Schwarz screening is only rigorous for
+        :math:`-3 < \alpha < 0`, for which the potential is positive definite.
 
         Parameters
         ----------
         alpha : float
             The power of r in the interaction potential.
         output
-            A Four-index object, optional.
+            A Four-index object, optional. When packed is True, a one-dimensional
+            array with ``get_packed_size(nbasis)`` elements.
+        screening_threshold : float
+            Shell quartets whose Schwarz upper bound is below this threshold are
+            skipped and their integrals are set to zero. The default (zero) disables
+            the screening.
+        nthread : int
+            The number of threads. The result does not depend on it. When not given,
+            ``context.nthread`` is used.
+        packed : bool
+            When True, only the symmetry-unique integrals are stored, see
+            :py:func:`pack_four_index`.
 
         Returns
         -------
@@ -952,15 +1189,325 @@ cdef class GOBasis(GBasis):
 
         Keywords: :index:`ERI`, :index:`four-center integrals`
         """
+        cdef double[::1] flat_output
         biblio.cite('valeev2014',
                  'the efficient implementation of four-center electron repulsion integrals')
         biblio.cite('ahlrichs2006',
                  'the methodology to implement various types of four-center integrals.')
-        output = prepare_array(output, (self.nbasis, self.nbasis, self.nbasis, self.nbasis), 'output')
-        (<gbasis.GOBasis*>self._this).compute_ralpha_repulsion(&output[0, 0, 0, 0], alpha)
+        output = prepare_four_index(output, self.nbasis, packed)
+        flat_output = output.reshape(-1)
+        nskip = (<gbasis.GOBasis*>self._this).compute_ralpha_repulsion(
+            &flat_output[0], alpha, screening_threshold, get_nthread(nthread), packed)
+        self._log_screening(nskip, screening_threshold)
         return np.asarray(output)
 
-    def _compute_cholesky(self, GB4Integral gb4int, double threshold=1e-8):
+    def _log_direct(self, long nskip, double screening_threshold):
+        """Report how many shell quartets were skipped in an integral-direct contraction."""
+        if log.do_high and screening_threshold > 0:
+            npair = (self.nshell*(self.nshell + 1))/2
+            nquartet = (npair*(npair + 1))/2
+            log('Density-weighted screening (threshold=%.1e) skipped %i out of %i shell '
+                'quartets.' % (screening_threshold, nskip, nquartet))
+
+    def compute_electron_repulsion_direct(self, double[:, ::1] dm not None,
+                                          double[:, ::1] coulomb=None,
+                                          double[:, ::1] exchange=None,
+                                          double screening_threshold=0.0, nthread=None):
+        r"""Contract electron repulsion integrals with a density matrix.
+
+        The integrals are recomputed and immediately contracted, such that the memory
+        usage is only proportional to the square of the number of basis functions. See
+        ``compute_electron_repulsion`` for the definition of the integrals.
+
+        Parameters
+        ----------
+        dm
+            The density matrix.
+        coulomb
+            Output for the Coulomb-type contraction, optional.
+        exchange
+            Output for the exchange-type contraction, optional.
+        screening_threshold : float
+            Shell quartets are skipped when the product of their Schwarz upper bound
+            and the largest relevant density matrix element is below this threshold.
+            The default (zero) disables the screening.
+        nthread : int
+            The number of threads. When not given, ``context.nthread`` is used.
+
+        Returns
+        -------
+        coulomb : np.ndarray, shape=(nbasis, nbasis)
+            The contraction ``np.einsum('abcd,bd->ac', op, dm)``.
+        exchange : np.ndarray, shape=(nbasis, nbasis)
+            The contraction ``np.einsum('abcd,cb->ad', op, dm)``.
+
+        Keywords: :index:`ERI`, :index:`four-center integrals`, :index:`integral-direct`
+        """
+        biblio.cite('valeev2014',
+                    'the efficient implementation of four-center electron repulsion integrals')
+        check_shape(dm, (self.nbasis, self.nbasis), 'dm')
+        coulomb = prepare_array(coulomb, (self.nbasis, self.nbasis), 'coulomb')
+        exchange = prepare_array(exchange, (self.nbasis, self.nbasis), 'exchange')
+        nskip = (<gbasis.GOBasis*>self._this).compute_electron_repulsion_direct(
+            &dm[0, 0], &coulomb[0, 0], &exchange[0, 0], screening_threshold,
+            get_nthread(nthread))
+        self._log_direct(nskip, screening_threshold)
+        return np.asarray(coulomb), np.asarray(exchange)
+
+    def compute_erf_repulsion_direct(self, double[:, ::1] dm not None, double mu=0.0,
+                                     double[:, ::1] coulomb=None,
+                                     double[:, ::1] exchange=None,
+                                     double screening_threshold=0.0, nthread=None):
+        r"""Contract short-range electron repulsion integrals with a density matrix.
+
+        See ``compute_erf_repulsion`` for the definition of the integrals and
+        ``compute_electron_repulsion_direct`` for more details.
+
+        Parameters
+        ----------
+        mu : float
+            Parameter for the erf(mu r)/r potential. Default is zero.
+        dm
+            The density matrix.
+        coulomb
+            Output for the Coulomb-type contraction, optional.
+        exchange
+            Output for the exchange-type contraction, optional.
+        screening_threshold : float
+            Shell quartets are skipped when the product of their Schwarz upper bound
+            and the largest relevant density matrix element is below this threshold.
+            The default (zero) disables the screening.
+        nthread : int
+            The number of threads. When not given, ``context.nthread`` is used.
+
+        Returns
+        -------
+        coulomb : np.ndarray, shape=(nbasis, nbasis)
+            The contraction ``np.einsum('abcd,bd->ac', op, dm)``.
+        exchange : np.ndarray, shape=(nbasis, nbasis)
+            The contraction ``np.einsum('abcd,cb->ad', op, dm)``.
+
+        Keywords: :index:`ERI`, :index:`four-center integrals`, :index:`integral-direct`
+        """
+        biblio.cite('valeev2014',
+                 'the efficient implementation of four-center electron repulsion integrals')
+        biblio.cite('ahlrichs2006',
+                 'the methodology to implement various types of four-center integrals.')
+        check_shape(dm, (self.nbasis, self.nbasis), 'dm')
+        coulomb = prepare_array(coulomb, (self.nbasis, self.nbasis), 'coulomb')
+        exchange = prepare_array(exchange, (self.nbasis, self.nbasis), 'exchange')
+        nskip = (<gbasis.GOBasis*>self._this).compute_erf_repulsion_direct(
+            &dm[0, 0], &coulomb[0, 0], &exchange[0, 0], mu, screening_threshold,
+            get_nthread(nthread))
+        self._log_direct(nskip, screening_threshold)
+        return np.asarray(coulomb), np.asarray(exchange)
+
+    def compute_gauss_repulsion_direct(self, double[:, ::1] dm not None, double c=1.0,
+                                       double alpha=1.0, double[:, ::1] coulomb=None,
+                                       double[:, ::1] exchange=None,
+                                       double screening_threshold=0.0, nthread=None):
+        r"""Contract gaussian repulsion four-center integrals with a density matrix.
+
+        See ``compute_gauss_repulsion`` for the definition of the integrals and
+        ``compute_electron_repulsion_direct`` for more details.
+
+        Parameters
+        ----------
+        c : float
+            Coefficient of the gaussian.
+        alpha : float
+            Exponential parameter of the gaussian.
+        dm
+            The density matrix.
+        coulomb
+            Output for the Coulomb-type contraction, optional.
+        exchange
+            Output for the exchange-type contraction, optional.
+        screening_threshold : float
+            Shell quartets are skipped when the product of their Schwarz upper bound
+            and the largest relevant density matrix element is below this threshold.
+            The default (zero) disables the screening.
+        nthread : int
+            The number of threads. When not given, ``context.nthread`` is used.
+
+        Returns
+        -------
+        coulomb : np.ndarray, shape=(nbasis, nbasis)
+            The contraction ``np.einsum('abcd,bd->ac', op, dm)``.
+        exchange : np.ndarray, shape=(nbasis, nbasis)
+            The contraction ``np.einsum('abcd,cb->ad', op, dm)``.
+
+        Keywords: :index:`ERI`, :index:`four-center integrals`, :index:`integral-direct`
+        """
+        biblio.cite('valeev2014',
+                 'the efficient implementation of four-center electron repulsion integrals')
+        biblio.cite('ahlrichs2006',
+                 'the methodology to implement various types of four-center integrals.')
+        biblio.cite('gill1996',
+                 'four-center integrals with a Gaussian interaction potential.')
+        biblio.cite('toulouse2004',
+                 'four-center integrals with a Gaussian interaction potential.')
+        check_shape(dm, (self.nbasis, self.nbasis), 'dm')
+        coulomb = prepare_array(coulomb, (self.nbasis, self.nbasis), 'coulomb')
+        exchange = prepare_array(exchange, (self.nbasis, self.nbasis), 'exchange')
+        nskip = (<gbasis.GOBasis*>self._this).compute_gauss_repulsion_direct(
+            &dm[0, 0], &coulomb[0, 0], &exchange[0, 0], c, alpha, screening_threshold,
+            get_nthread(nthread))
+        self._log_direct(nskip, screening_threshold)
+        return np.asarray(coulomb), np.asarray(exchange)
+
+    def compute_ralpha_repulsion_direct(self, double[:, ::1] dm not None,
+                                        double alpha=-1.0, double[:, ::1] coulomb=None,
+                                        double[:, ::1] exchange=None,
+                                        double screening_threshold=0.0, nthread=None):
+        r"""Contract r^alpha repulsion four-center integrals with a density matrix.
+
+        See ``compute_ralpha_repulsion`` for the definition of the integrals and
+        ``compute_electron_repulsion_direct`` for more details. The screening is only
+        rigorous for :math:`-3 < \alpha < 0`.
+
+        Parameters
+        ----------
+        alpha : float
+            The power of r in the interaction potential.
+        dm
+            The density matrix.
+        coulomb
+            Output for the Coulomb-type contraction, optional.
+        exchange
+            Output for the exchange-type contraction, optional.
+        screening_threshold : float
+            Shell quartets are skipped when the product of their Schwarz upper bound
+            and the largest relevant density matrix element is below this threshold.
+            The default (zero) disables the screening.
+        nthread : int
+            The number of threads. When not given, ``context.nthread`` is used.
+
+        Returns
+        -------
+        coulomb : np.ndarray, shape=(nbasis, nbasis)
+            The contraction ``np.einsum('abcd,bd->ac', op, dm)``.
+        exchange : np.ndarray, shape=(nbasis, nbasis)
+            The contraction ``np.einsum('abcd,cb->ad', op, dm)``.
+
+        Keywords: :index:`ERI`, :index:`four-center integrals`, :index:`integral-direct`
+        """
+        biblio.cite('valeev2014',
+                 'the efficient implementation of four-center electron repulsion integrals')
+        biblio.cite('ahlrichs2006',
+                 'the methodology to implement various types of four-center integrals.')
+        check_shape(dm, (self.nbasis, self.nbasis), 'dm')
+        coulomb = prepare_array(coulomb, (self.nbasis, self.nbasis), 'coulomb')
+        exchange = prepare_array(exchange, (self.nbasis, self.nbasis), 'exchange')
+        nskip = (<gbasis.GOBasis*>self._this).compute_ralpha_repulsion_direct(
+            &dm[0, 0], &coulomb[0, 0], &exchange[0, 0], alpha, screening_threshold,
+            get_nthread(nthread))
+        self._log_direct(nskip, screening_threshold)
+        return np.asarray(coulomb), np.asarray(exchange)
+
+    def compute_electron_repulsion_three_center(self, GOBasis aux not None,
+                                                double[:, :, ::1] output=None,
+                                                nthread=None):
+        r"""Compute three-center electron repulsion integrals with an auxiliary basis.
+
+        Parameters
+        ----------
+        aux : GOBasis
+            The auxiliary basis, e.g. a fitting basis loaded with
+            :py:func:`horton.gbasis.gobasis.get_gobasis`.
+        output
+            A three-index object with shape (aux.nbasis, nbasis, nbasis), optional.
+        nthread : int
+            The number of threads. The result does not depend on it. When not given,
+            ``context.nthread`` is used.
+
+        Returns
+        -------
+        output : np.ndarray, shape=(aux.nbasis, nbasis, nbasis), dtype=float
+            The integrals (ab|P) in chemist's notation, stored as ``output[P, a, b]``.
+
+        Keywords: :index:`ERI`, :index:`three-center integrals`
+        """
+        biblio.cite('valeev2014',
+                    'the efficient implementation of four-center electron repulsion integrals')
+        output = prepare_array(output, (aux.nbasis, self.nbasis, self.nbasis), 'output')
+        (<gbasis.GOBasis*>self._this).compute_electron_repulsion_three_center(
+            &output[0, 0, 0], <gbasis.GOBasis*>aux._this, get_nthread(nthread))
+        return np.asarray(output)
+
+    def compute_electron_repulsion_two_center(self, double[:, ::1] output=None):
+        r"""Compute two-center electron repulsion integrals.
+
+        These integrals are the Coulomb metric of density fitting, when this basis is
+        the auxiliary basis.
+
+        Parameters
+        ----------
+        output
+            A Two-index object, optional.
+
+        Returns
+        -------
+        output : np.ndarray, shape=(nbasis, nbasis), dtype=float
+            The integrals (P|Q).
+
+        Keywords: :index:`ERI`, :index:`two-center integrals`
+        """
+        biblio.cite('valeev2014',
+                    'the efficient implementation of four-center electron repulsion integrals')
+        output = prepare_array(output, (self.nbasis, self.nbasis), 'output')
+        (<gbasis.GOBasis*>self._this).compute_electron_repulsion_two_center(&output[0, 0])
+        return np.asarray(output)
+
+    def compute_electron_repulsion_ri(self, GOBasis aux not None, double threshold=1e-10,
+                                      nthread=None):
+        r"""Compute density-fitted (resolution of the identity) repulsion integrals.
+
+        The electron repulsion integrals are approximated as
+
+        .. math::
+            (ab|cd) \approx \sum_{PQ} (ab|P) [\mathbf{V}^{-1}]_{PQ} (Q|cd)
+                    = \sum_k B_{k,ab} B_{k,cd}
+
+        where :math:`V_{PQ} = (P|Q)` is the Coulomb metric of the auxiliary basis.
+        The vectors :math:`B_k` have the same layout as Cholesky vectors. Hence,
+        they can be used in :py:class:`horton.meanfield.observable.RDirectTerm`
+        (RI-J) and :py:class:`horton.meanfield.observable.RExchangeTerm` (RI-K) and
+        their unrestricted counterparts.
+
+        Parameters
+        ----------
+        aux : GOBasis
+            The auxiliary basis, e.g. a fitting basis loaded with
+            :py:func:`horton.gbasis.gobasis.get_gobasis`.
+        threshold : float
+            Eigenvectors of the Coulomb metric whose eigenvalue is below this
+            threshold are discarded, to avoid numerical issues with (nearly) linearly
+            dependent auxiliary basis functions.
+        nthread : int
+            The number of threads used to compute the three-center integrals. When
+            not given, ``context.nthread`` is used.
+
+        Returns
+        -------
+        array : np.ndarray, shape(nvec, nbasis, nbasis), dtype=float
+            The fitted three-index vectors.
+
+        Keywords: :index:`ERI`, :index:`RI`, :index:`density fitting`
+        """
+        three_center = self.compute_electron_repulsion_three_center(aux, nthread=nthread)
+        metric = aux.compute_electron_repulsion_two_center()
+        evals, evecs = np.linalg.eigh(metric)
+        mask = evals > threshold
+        if log.do_medium:
+            log('Density fitting with %i auxiliary basis functions, %i discarded.'
+                % (aux.nbasis, aux.nbasis - mask.sum()))
+        # Canonical orthonormalization of the auxiliary basis in the Coulomb metric.
+        transform = evecs[:, mask]/np.sqrt(evals[mask])
+        return np.tensordot(transform, three_center, axes=(0, 0))
+
+    def _compute_cholesky(self, GB4Integral gb4int, double threshold=1e-8, nthread=None,
+                          filename=None):
         """Apply the Cholesky code to a given type of four-center integrals.
 
         Parameters
@@ -969,11 +1516,19 @@ cdef class GOBasis(GBasis):
             The object that can carry out four-center integrals.
         threshold
             The cutoff for the Cholesky decomposition.
+        nthread : int
+            The number of threads used to compute the integrals. The result does not
+            depend on it. When not given, ``context.nthread`` is used.
+        filename : str
+            When given, the Cholesky vectors are written to this (raw binary) file
+            while they are computed, instead of keeping them in memory.
 
         Returns
         -------
         array : np.ndarray, shape(nvec, nbasis, nbasis), dtype=float
-            The Cholesky-decomposed four-center integrals
+            The Cholesky-decomposed four-center integrals. When a filename is given,
+            this is a read-only ``np.memmap`` of the file, which is only loaded in
+            memory as far as it is accessed.
         """
         cdef gbw.GB4IntegralWrapper* gb4w = NULL
         cdef vector[double]* vectors = NULL
@@ -985,9 +1540,22 @@ cdef class GOBasis(GBasis):
 
         try:
             gb4w = new gbw.GB4IntegralWrapper(<gbasis.GOBasis*> self._this,
-                                              <ints.GB4Integral*> gb4int._this)
+                                              <ints.GB4Integral*> gb4int._this,
+                                              get_nthread(nthread))
+            if filename is not None:
+                if isinstance(filename, unicode):
+                    filename = filename.encode('utf-8')
+                nvec = cholesky.cholesky(gb4w, <char*> filename, threshold)
+                if nvec == 0:
+                    # An empty file cannot be mapped.
+                    return np.zeros((0, self.nbasis, self.nbasis))
+                return np.memmap(filename, dtype=np.double, mode='r',
+                                 shape=(nvec, self.nbasis, self.nbasis))
             vectors = new vector[double]()
             nvec = cholesky.cholesky(gb4w, vectors, threshold)
+            if nvec == 0:
+                del vectors
+                return np.zeros((0, self.nbasis, self.nbasis))
             dims[0] = <np.npy_intp> nvec
             dims[1] = <np.npy_intp> self.nbasis
             dims[2] = <np.npy_intp> self.nbasis
@@ -999,24 +1567,35 @@ cdef class GOBasis(GBasis):
 
         return result
 
-    def compute_electron_repulsion_cholesky(self, double threshold=1e-8):
+    def compute_electron_repulsion_cholesky(self, double threshold=1e-8, nthread=None,
+                                            filename=None):
         r"""Compute Cholesky decomposition of electron repulsion four-center integrals.
 
         Parameters
         ----------
         threshold
             The cutoff for the Cholesky decomposition.
+        nthread : int
+            The number of threads used to compute the integrals. The result does not
+            depend on it. When not given, ``context.nthread`` is used.
+        filename : str
+            When given, the Cholesky vectors are written to this file while they are
+            computed, such that they do not need to fit in memory.
 
         Returns
         -------
         array : np.ndarray, shape(nvec, nbasis, nbasis), dtype=float
-            The Cholesky-decomposed four-center integrals
+            The Cholesky-decomposed four-center integrals. When a filename is given,
+            this is a read-only ``np.memmap``, which can be passed on to
+            :py:class:`horton.meanfield.observable.RDirectTerm` and related classes.
 
         Keywords: :index:`ERI`, :index:`four-center integrals`
         """
-        return self._compute_cholesky(GB4ElectronRepulsionIntegralLibInt(self.max_shell_type))
+        return self._compute_cholesky(GB4ElectronRepulsionIntegralLibInt(self.max_shell_type),
+                                      threshold, nthread, filename)
 
-    def compute_erf_repulsion_cholesky(self, double mu=0.0, double threshold=1e-8):
+    def compute_erf_repulsion_cholesky(self, double mu=0.0, double threshold=1e-8,
+                                       nthread=None, filename=None):
         r"""Compute Cholesky decomposition of Erf repulsion four-center integrals.
 
         The potential has the following form:
@@ -1030,18 +1609,28 @@ cdef class GOBasis(GBasis):
             Parameter for the erf(mu r)/r potential. Default is zero.
         threshold
             The cutoff for the Cholesky decomposition.
+        nthread : int
+            The number of threads used to compute the integrals. The result does not
+            depend on it. When not given, ``context.nthread`` is used.
+        filename : str
+            When given, the Cholesky vectors are written to this file while they are
+            computed, such that they do not need to fit in memory.
 
         Returns
         -------
         array : np.ndarray, shape(nvec, nbasis, nbasis), dtype=float
-            The Cholesky-decomposed four-center integrals
+            The Cholesky-decomposed four-center integrals. When a filename is given,
+            this is a read-only ``np.memmap``, which can be passed on to
+            :py:class:`horton.meanfield.observable.RDirectTerm` and related classes.
 
         Keywords: :index:`ERI`, :index:`four-center integrals`
         """
-        return self._compute_cholesky(GB4ErfIntegralLibInt(self.max_shell_type, mu))
+        return self._compute_cholesky(GB4ErfIntegralLibInt(self.max_shell_type, mu),
+                                      threshold, nthread, filename)
 
     def compute_gauss_repulsion_cholesky(self, double c=1.0, double alpha=1.0,
-                                         double threshold=1e-8):
+                                         double threshold=1e-8, nthread=None,
+                                         filename=None):
         r"""Compute Cholesky decomposition of Gauss repulsion four-center integrals.
 
         The potential has the following form:
@@ -1057,17 +1646,27 @@ cdef class GOBasis(GBasis):
             Exponential parameter of the gaussian.
         threshold
             The cutoff for the Cholesky decomposition.
+        nthread : int
+            The number of threads used to compute the integrals. The result does not
+            depend on it. When not given, ``context.nthread`` is used.
+        filename : str
+            When given, the Cholesky vectors are written to this file while they are
+            computed, such that they do not need to fit in memory.
 
         Returns
         -------
         array : np.ndarray, shape(nvec, nbasis, nbasis), dtype=float
-            The Cholesky-decomposed four-center integrals
+            The Cholesky-decomposed four-center integrals. When a filename is given,
+            this is a read-only ``np.memmap``, which can be passed on to
+            :py:class:`horton.meanfield.observable.RDirectTerm` and related classes.
 
         Keywords: :index:`ERI`, :index:`four-center integrals`
         """
-        return self._compute_cholesky(GB4GaussIntegralLibInt(self.max_shell_type, c, alpha))
+        return self._compute_cholesky(GB4GaussIntegralLibInt(self.max_shell_type, c, alpha),
+                                      threshold, nthread, filename)
 
-    def compute_ralpha_repulsion_cholesky(self, double alpha=-1.0, double threshold=1e-8):
+    def compute_ralpha_repulsion_cholesky(self, double alpha=-1.0, double threshold=1e-8,
+                                          nthread=None, filename=None):
         r"""Compute Cholesky decomposition of ralpha repulsion four-center integrals.
 
         The potential has the following form:
@@ -1082,18 +1681,28 @@ cdef class GOBasis(GBasis):
             The power of r in the interaction potential.
         threshold
             The cutoff for the Cholesky decomposition.
+        nthread : int
+            The number of threads used to compute the integrals. The result does not
+            depend on it. When not given, ``context.nthread`` is used.
+        filename : str
+            When given, the Cholesky vectors are written to this file while they are
+            computed, such that they do not need to fit in memory.
 
         Returns
         -------
         array : np.ndarray, shape(nvec, nbasis, nbasis), dtype=float
-            The Cholesky-decomposed four-center integrals
+            The Cholesky-decomposed four-center integrals. When a filename is given,
+            this is a read-only ``np.memmap``, which can be passed on to
+            :py:class:`horton.meanfield.observable.RDirectTerm` and related classes.
 
         Keywords: :index:`ERI`, :index:`four-center integrals`
         """
-        return self._compute_cholesky(GB4RAlphaIntegralLibInt(self.max_shell_type, alpha))
+        return self._compute_cholesky(GB4RAlphaIntegralLibInt(self.max_shell_type, alpha),
+                                      threshold, nthread, filename)
 
     def compute_grid_orbitals_exp(self, orb, double[:, ::1] points not None,
-                                  long[::1] iorbs not None, double[:, ::1] output=None):
+                                  long[::1] iorbs not None, double[:, ::1] output=None,
+                                  nthread=None):
         r"""Compute the orbitals on a grid for a given set of expansion coefficients.
 
         **Warning:** the results are added to the output array!
@@ -1110,6 +1719,8 @@ cdef class GOBasis(GBasis):
         output : np.ndarray, shape=(npoint, n), dtype=float
             An output array. The results are added to this array. When not given, an
             output array is allocated.
+        nthread : int
+            The number of threads. When not given, ``context.nthread`` is used.
 
         Returns
         -------
@@ -1127,11 +1738,12 @@ cdef class GOBasis(GBasis):
         # compute
         (<gbasis.GOBasis*>self._this).compute_grid1_exp(
             nfn, &coeffs[0, 0], npoint, &points[0, 0],
-            norb, &iorbs[0], &output[0, 0])
+            norb, &iorbs[0], &output[0, 0], get_nthread(nthread))
         return np.asarray(output)
 
     def compute_grid_orb_gradient_exp(self, orb, double[:, ::1] points not None,
-                                      long[::1] iorbs not None, double[:, :, ::1] output=None):
+                                      long[::1] iorbs not None, double[:, :, ::1] output=None,
+                                      nthread=None):
         r"""Compute the orbital gradient on a grid for a given set of expansion coefficients.
 
         **Warning:** the results are added to the output array!
@@ -1147,6 +1759,8 @@ cdef class GOBasis(GBasis):
         output : np.ndarray, shape=(npoint, n, 3), dtype=float
             An output array. The results are added to this array. When not given, an
             output array is allocated.
+        nthread : int
+            The number of threads. When not given, ``context.nthread`` is used.
 
         Returns
         -------
@@ -1164,12 +1778,12 @@ cdef class GOBasis(GBasis):
         # compute
         (<gbasis.GOBasis*>self._this).compute_grid1_grad_exp(
             nfn, &coeffs[0, 0], npoint, &points[0, 0],
-            norb, &iorbs[0], &output[0, 0, 0])
+            norb, &iorbs[0], &output[0, 0, 0], get_nthread(nthread))
         return np.asarray(output)
 
     def _compute_grid1_dm(self, double[:, ::1] dm not None, double[:, ::1] points not None,
                           GB1DMGridFn grid_fn not None, double[:, ::1] output not None,
-                          double epsilon=0):
+                          double epsilon=0, nthread=None):
         """Compute some density function on a grid for a given density matrix.
 
         **Warning:** the results are added to the output array! This may be useful to
@@ -1188,6 +1802,8 @@ cdef class GOBasis(GBasis):
         epsilon : float
             Allow errors on the density of this magnitude for the sake of
             efficiency. Some grid_fn implementations may ignore this.
+        nthread : int
+            The number of threads. When not given, ``context.nthread`` is used.
         """
         # Check the array shapes
         check_shape(dm, (self.nbasis, self.nbasis,), 'dm')
@@ -1199,11 +1815,11 @@ cdef class GOBasis(GBasis):
         # Go!
         (<gbasis.GOBasis*>self._this).compute_grid1_dm(
             &dm[0, 0], npoint, &points[0, 0], grid_fn._this, &output[0, 0], epsilon,
-            &dmmaxrow[0])
+            &dmmaxrow[0], get_nthread(nthread))
 
     def compute_grid_density_dm(self, double[:, ::1] dm not None,
                                 double[:, ::1] points not None, double[::1] output=None,
-                                double epsilon=0):
+                                double epsilon=0, nthread=None):
         """Compute the electron density on a grid for a given density matrix.
 
         **Warning:** the results are added to the output array! This may be useful to
@@ -1220,6 +1836,8 @@ cdef class GOBasis(GBasis):
         epsilon : float
             Allow errors on the density of this magnitude for the sake of
             efficiency. Some grid_fn implementations may ignore this.
+        nthread : int
+            The number of threads. When not given, ``context.nthread`` is used.
 
         Returns
         -------
@@ -1229,11 +1847,12 @@ cdef class GOBasis(GBasis):
         if output is None:
             output = np.zeros(points.shape[0])
         self._compute_grid1_dm(dm, points, GB1DMGridDensityFn(self.max_shell_type),
-                               output[:, None], epsilon)
+                               output[:, None], epsilon, nthread)
         return np.asarray(output)
 
     def compute_grid_gradient_dm(self, double[:, ::1] dm not None,
-                                 double[:, ::1] points not None, double[:, ::1] output=None):
+                                 double[:, ::1] points not None, double[:, ::1] output=None,
+                                 nthread=None):
         """Compute the electron density gradient on a grid for a given density matrix.
 
         **Warning:** the results are added to the output array! This may be useful to
@@ -1247,6 +1866,8 @@ cdef class GOBasis(GBasis):
             Cartesian grid points.
         output : np.ndarray, shape=(npoint, 3), dtype=float
             Output array. When not given, it is allocated and returned.
+        nthread : int
+            The number of threads. When not given, ``context.nthread`` is used.
 
         Returns
         -------
@@ -1255,11 +1876,13 @@ cdef class GOBasis(GBasis):
         """
         if output is None:
             output = np.zeros((points.shape[0], 3), float)
-        self._compute_grid1_dm(dm, points, GB1DMGridGradientFn(self.max_shell_type), output)
+        self._compute_grid1_dm(dm, points, GB1DMGridGradientFn(self.max_shell_type), output,
+                               nthread=nthread)
         return np.asarray(output)
 
     def compute_grid_gga_dm(self, double[:, ::1] dm not None,
-                            double[:, ::1] points not None, double[:, ::1] output=None):
+                            double[:, ::1] points not None, double[:, ::1] output=None,
+                            nthread=None):
         """Compute the electron density and gradient on a grid for a given density matrix.
 
         **Warning:** the results are added to the output array! This may be useful to
@@ -1274,6 +1897,8 @@ cdef class GOBasis(GBasis):
         output : np.ndarray, shape=(npoint, 4), dtype=float
             Output array. When not given, it is allocated and returned. The first column
             contains the density. The last three columns contain the gradient.
+        nthread : int
+            The number of threads. When not given, ``context.nthread`` is used.
 
         Returns
         -------
@@ -1282,11 +1907,13 @@ cdef class GOBasis(GBasis):
         """
         if output is None:
             output = np.zeros((points.shape[0], 4), float)
-        self._compute_grid1_dm(dm, points, GB1DMGridGGAFn(self.max_shell_type), output)
+        self._compute_grid1_dm(dm, points, GB1DMGridGGAFn(self.max_shell_type), output,
+                               nthread=nthread)
         return np.asarray(output)
 
     def compute_grid_kinetic_dm(self, double[:, ::1] dm not None,
-                                double[:, ::1] points not None, double[::1] output=None):
+                                double[:, ::1] points not None, double[::1] output=None,
+                                nthread=None):
         """Compute the kinetic energy density on a grid for a given density matrix.
 
         **Warning:** the results are added to the output array! This may be useful to
@@ -1300,6 +1927,8 @@ cdef class GOBasis(GBasis):
             Cartesian grid points.
         output : np.ndarray, shape=(npoint,), dtype=float
             Output array. When not given, it is allocated and returned.
+        nthread : int
+            The number of threads. When not given, ``context.nthread`` is used.
 
         Returns
         -------
@@ -1308,11 +1937,13 @@ cdef class GOBasis(GBasis):
         """
         if output is None:
             output = np.zeros((points.shape[0],), float)
-        self._compute_grid1_dm(dm, points, GB1DMGridKineticFn(self.max_shell_type), output[:, None])
+        self._compute_grid1_dm(dm, points, GB1DMGridKineticFn(self.max_shell_type), output[:, None],
+                               nthread=nthread)
         return np.asarray(output)
 
     def compute_grid_hessian_dm(self, double[:, ::1] dm not None,
-                                double[:, ::1] points not None, double[:, ::1] output=None):
+                                double[:, ::1] points not None, double[:, ::1] output=None,
+                                nthread=None):
         """Compute the electron density Hessian on a grid for a given density matrix.
 
         **Warning:** the results are added to the output array! This may be useful to
@@ -1334,6 +1965,8 @@ cdef class GOBasis(GBasis):
             * 3: element (1, 1) of the Hessian
             * 4: element (1, 2) of the Hessian
             * 5: element (2, 2) of the Hessian
+        nthread : int
+            The number of threads. When not given, ``context.nthread`` is used.
 
         Returns
         -------
@@ -1342,11 +1975,13 @@ cdef class GOBasis(GBasis):
         """
         if output is None:
             output = np.zeros((points.shape[0], 6), float)
-        self._compute_grid1_dm(dm, points, GB1DMGridHessianFn(self.max_shell_type), output)
+        self._compute_grid1_dm(dm, points, GB1DMGridHessianFn(self.max_shell_type), output,
+                               nthread=nthread)
         return np.asarray(output)
 
     def compute_grid_mgga_dm(self, double[:, ::1] dm not None,
-                             double[:, ::1] points not None, double[:, ::1] output=None):
+                             double[:, ::1] points not None, double[:, ::1] output=None,
+                             nthread=None):
         """Compute the MGGA quantities for a given density matrix.
 
         **Warning:** the results are added to the output array! This may be useful to
@@ -1371,6 +2006,8 @@ cdef class GOBasis(GBasis):
             * 3: gradient z
             * 4: laplacian
             * 5: kinetic energy density
+        nthread : int
+            The number of threads. When not given, ``context.nthread`` is used.
 
         Returns
         -------
@@ -1379,11 +2016,149 @@ cdef class GOBasis(GBasis):
         """
         if output is None:
             output = np.zeros((points.shape[0], 6), float)
-        self._compute_grid1_dm(dm, points, GB1DMGridMGGAFn(self.max_shell_type), output)
+        self._compute_grid1_dm(dm, points, GB1DMGridMGGAFn(self.max_shell_type), output,
+                               nthread=nthread)
+        return np.asarray(output)
+
+    def _compute_grid1_dm_multi(self, double[:, :, ::1] dms not None,
+                                double[:, ::1] points not None,
+                                GB1DMGridFn grid_fn not None,
+                                double[:, :, ::1] output not None, double epsilon=0,
+                                nthread=None):
+        """Compute some density function on a grid for several density matrices.
+
+        **Warning:** the results are added to the output array!
+
+        This gives the same result as calling ``_compute_grid1_dm`` for every density
+        matrix, but the basis functions are evaluated only once on the grid.
+
+        Parameters
+        ----------
+        dms : np.ndarray, shape=(ndm, nbasis, nbasis), dtype=float
+            Density matrices, assumed to be symmetric.
+        points : np.ndarray, shape=(npoint, 3), dtype=float
+            Cartesian grid points.
+        grid_fn : GB1DMGridFn
+            Implements the function to be evaluated on the grid.
+        output : np.ndarray, shape=(npoint, ndm, n), dtype=float
+            Output array. The last dimension depends on grid_fn.
+        epsilon : float
+            Allow errors on the density of this magnitude for the sake of
+            efficiency. Some grid_fn implementations may ignore this.
+        nthread : int
+            The number of threads. When not given, ``context.nthread`` is used.
+        """
+        # Check the array shapes
+        check_shape(dms, (-1, self.nbasis, self.nbasis,), 'dms')
+        ndm = dms.shape[0]
+        check_shape(points, (-1, 3), 'points')
+        npoint = points.shape[0]
+        check_shape(output, (npoint, ndm, grid_fn.dim_output), 'output')
+        if npoint == 0 or ndm == 0:
+            return
+        # Get the maximum of the absolute value over the rows
+        cdef double[:, ::1] dmmaxrows = np.ascontiguousarray(np.abs(dms).max(axis=1))
+        # Go!
+        (<gbasis.GOBasis*>self._this).compute_grid1_dm_multi(
+            ndm, &dms[0, 0, 0], npoint, &points[0, 0], grid_fn._this, &output[0, 0, 0],
+            epsilon, &dmmaxrows[0, 0], get_nthread(nthread))
+
+    def compute_grid_density_dm_multi(self, double[:, :, ::1] dms not None,
+                                      double[:, ::1] points not None,
+                                      double[:, ::1] output=None, double epsilon=0,
+                                      nthread=None):
+        """Compute the electron densities of several density matrices on a grid.
+
+        **Warning:** the results are added to the output array!
+
+        Parameters
+        ----------
+        dms : np.ndarray, shape=(ndm, nbasis, nbasis), dtype=float
+            Density matrices, assumed to be symmetric.
+        points : np.ndarray, shape=(npoint, 3), dtype=float
+            Cartesian grid points.
+        output : np.ndarray, shape=(npoint, ndm), dtype=float
+            Output array. When not given, it is allocated and returned.
+        epsilon : float
+            Allow errors on the density of this magnitude for the sake of
+            efficiency.
+        nthread : int
+            The number of threads. When not given, ``context.nthread`` is used.
+
+        Returns
+        -------
+        output : np.ndarray, shape=(npoint, ndm), dtype=float
+            The output array.
+        """
+        if output is None:
+            output = np.zeros((points.shape[0], dms.shape[0]))
+        self._compute_grid1_dm_multi(dms, points, GB1DMGridDensityFn(self.max_shell_type),
+                                     output[:, :, None], epsilon, nthread)
+        return np.asarray(output)
+
+    def compute_grid_gga_dm_multi(self, double[:, :, ::1] dms not None,
+                                  double[:, ::1] points not None,
+                                  double[:, :, ::1] output=None, nthread=None):
+        """Compute the GGA quantities of several density matrices on a grid.
+
+        **Warning:** the results are added to the output array!
+
+        Parameters
+        ----------
+        dms : np.ndarray, shape=(ndm, nbasis, nbasis), dtype=float
+            Density matrices, assumed to be symmetric.
+        points : np.ndarray, shape=(npoint, 3), dtype=float
+            Cartesian grid points.
+        output : np.ndarray, shape=(npoint, ndm, 4), dtype=float
+            Output array. When not given, it is allocated and returned. The columns are
+            assigned as in ``compute_grid_gga_dm``.
+        nthread : int
+            The number of threads. When not given, ``context.nthread`` is used.
+
+        Returns
+        -------
+        output : np.ndarray, shape=(npoint, ndm, 4), dtype=float
+            The output array.
+        """
+        if output is None:
+            output = np.zeros((points.shape[0], dms.shape[0], 4))
+        self._compute_grid1_dm_multi(dms, points, GB1DMGridGGAFn(self.max_shell_type),
+                                     output, nthread=nthread)
+        return np.asarray(output)
+
+    def compute_grid_mgga_dm_multi(self, double[:, :, ::1] dms not None,
+                                   double[:, ::1] points not None,
+                                   double[:, :, ::1] output=None, nthread=None):
+        """Compute the MGGA quantities of several density matrices on a grid.
+
+        **Warning:** the results are added to the output array!
+
+        Parameters
+        ----------
+        dms : np.ndarray, shape=(ndm, nbasis, nbasis), dtype=float
+            Density matrices, assumed to be symmetric.
+        points : np.ndarray, shape=(npoint, 3), dtype=float
+            Cartesian grid points.
+        output : np.ndarray, shape=(npoint, ndm, 6), dtype=float
+            Output array. When not given, it is allocated and returned. The columns are
+            assigned as in ``compute_grid_mgga_dm``.
+        nthread : int
+            The number of threads. When not given, ``context.nthread`` is used.
+
+        Returns
+        -------
+        output : np.ndarray, shape=(npoint, ndm, 6), dtype=float
+            The output array.
+        """
+        if output is None:
+            output = np.zeros((points.shape[0], dms.shape[0], 6))
+        self._compute_grid1_dm_multi(dms, points, GB1DMGridMGGAFn(self.max_shell_type),
+                                     output, nthread=nthread)
         return np.asarray(output)
 
     def compute_grid_hartree_dm(self, double[:, ::1] dm not None,
-                                double[:, ::1] points not None, double[::1] output=None):
+                                double[:, ::1] points not None, double[::1] output=None,
+                                double screening_threshold=0.0, nthread=None):
         """Compute the Hartree potential on a grid for a given density matrix.
 
         **Warning:** the results are added to the output array! This may be useful to
@@ -1397,6 +2172,13 @@ cdef class GOBasis(GBasis):
             Cartesian grid points.
         output : np.ndarray, shape=(npoint,), dtype=float
             Output array. When not given, it is allocated and returned.
+        screening_threshold : float
+            When positive, negligible primitive pairs are skipped and distant ones are
+            replaced by multipole expansions. Each of these approximations introduces
+            an error below this threshold. The default, zero, evaluates all integrals
+            directly.
+        nthread : int
+            The number of threads. When not given, ``context.nthread`` is used.
 
         Returns
         -------
@@ -1406,16 +2188,20 @@ cdef class GOBasis(GBasis):
         # type checking
         check_shape(dm, (self.nbasis, self.nbasis), 'dm')
         check_shape(points, (-1, 3), 'points')
+        if screening_threshold < 0:
+            raise ValueError('The screening threshold can not be negative.')
         npoint = points.shape[0]
         output = prepare_array(output, (npoint,), 'output')
         # compute
         (<gbasis.GOBasis*>self._this).compute_grid2_dm(
-            &dm[0, 0], npoint, &points[0, 0], &output[0])
+            &dm[0, 0], npoint, &points[0, 0], &output[0], screening_threshold,
+            get_nthread(nthread))
         return np.asarray(output)
 
     def compute_grid_esp_dm(self, double[:, ::1] dm not None,
                             double[:, ::1] coordinates not None, double[::1] charges not None,
-                            double[:, ::1] points not None, double[::1] output=None):
+                            double[:, ::1] points not None, double[::1] output=None,
+                            double screening_threshold=0.0, nthread=None):
         """Compute the electrostatic potential on a grid for a given density matrix.
 
         **Warning:** the results are added to the output array! This may be useful to
@@ -1433,13 +2219,18 @@ cdef class GOBasis(GBasis):
             Cartesian grid points.
         output : np.ndarray, shape=(npoint,), dtype=float
             Output array. When not given, it is allocated and returned.
+        screening_threshold : float
+            See ``compute_grid_hartree_dm``.
+        nthread : int
+            The number of threads. When not given, ``context.nthread`` is used.
 
         Returns
         -------
         output : np.ndarray, shape=(npoint,), dtype=float
             The output array.
         """
-        output = self.compute_grid_hartree_dm(dm, points, output)
+        output = self.compute_grid_hartree_dm(dm, points, output, screening_threshold,
+                                              nthread)
         cdef np.ndarray[ndim=1, dtype=double] tmp = np.asarray(output)
         tmp *= -1
         compute_grid_nucpot(coordinates, charges, points, output)
@@ -1447,7 +2238,7 @@ cdef class GOBasis(GBasis):
 
     def _compute_grid1_fock(self, double[:, ::1] points not None, double[::1] weights not None,
                             double[:, :] pots not None, GB1DMGridFn grid_fn not None,
-                            double[:, ::1] fock=None):
+                            double[:, ::1] fock=None, nthread=None):
         """Compute a Fock operator from a some sort of potential.
 
         **Warning:** the results are added to the Fock operator!
@@ -1465,6 +2256,8 @@ cdef class GOBasis(GBasis):
             Implements the function to be evaluated on the grid.
         fock : np.ndarray, shape=(nbasis, nbasis), dtype=float
             Output two-index object.
+        nthread : int
+            The number of threads. When not given, ``context.nthread`` is used.
         """
         fock = prepare_array(fock, (self.nbasis, self.nbasis), 'fock')
         check_shape(points, (-1, 3), 'points')
@@ -1480,12 +2273,12 @@ cdef class GOBasis(GBasis):
             pot_stride *= (pots.strides[1]/8)
         (<gbasis.GOBasis*>self._this).compute_grid1_fock(
             npoint, &points[0, 0], &weights[0], pot_stride, &pots[0, 0], grid_fn._this,
-            &fock[0, 0])
+            &fock[0, 0], get_nthread(nthread))
         return fock
 
     def compute_grid_density_fock(self, double[:, ::1] points not None,
                                   double[::1] weights not None, double[:] pots not None,
-                                  double[:, ::1] fock=None):
+                                  double[:, ::1] fock=None, nthread=None):
         """Compute a Fock operator from a density potential.
 
         **Warning:** the results are added to the Fock operator!
@@ -1500,18 +2293,21 @@ cdef class GOBasis(GBasis):
             Derivative of the energy toward the density at all grid points.
         fock : np.ndarray, shape=(nbasis, nbasis), dtype=float
             Output two-index object, optional.
+        nthread : int
+            The number of threads. When not given, ``context.nthread`` is used.
 
         Returns
         -------
         fock
         """
         fock = self._compute_grid1_fock(
-            points, weights, pots[:, None], GB1DMGridDensityFn(self.max_shell_type), fock)
+            points, weights, pots[:, None], GB1DMGridDensityFn(self.max_shell_type), fock,
+            nthread)
         return np.asarray(fock)
 
     def compute_grid_gradient_fock(self, double[:, ::1] points not None,
                                    double[::1] weights not None, double[:, :] pots not None,
-                                   double[:, ::1] fock=None):
+                                   double[:, ::1] fock=None, nthread=None):
         """Compute a Fock operator from a density gradient potential.
 
         **Warning:** the results are added to the Fock operator!
@@ -1527,18 +2323,21 @@ cdef class GOBasis(GBasis):
             points.
         fock : np.ndarray, shape=(nbasis, nbasis), dtype=float
             Output two-index object, optional.
+        nthread : int
+            The number of threads. When not given, ``context.nthread`` is used.
 
         Returns
         -------
         fock
         """
         fock = self._compute_grid1_fock(
-            points, weights, pots, GB1DMGridGradientFn(self.max_shell_type), fock)
+            points, weights, pots, GB1DMGridGradientFn(self.max_shell_type), fock,
+            nthread)
         return np.asarray(fock)
 
     def compute_grid_gga_fock(self, double[:, ::1] points not None,
                               double[::1] weights not None, double[:, :] pots not None,
-                              double[:, ::1] fock=None):
+                              double[:, ::1] fock=None, nthread=None):
         """Compute a Fock operator from GGA potential data.
 
         **Warning:** the results are added to the Fock operator!
@@ -1554,18 +2353,21 @@ cdef class GOBasis(GBasis):
             grid points.
         fock : np.ndarray, shape=(nbasis, nbasis), dtype=float
             Output two-index object, optional.
+        nthread : int
+            The number of threads. When not given, ``context.nthread`` is used.
 
         Returns
         -------
         fock
         """
         fock = self._compute_grid1_fock(
-            points, weights, pots, GB1DMGridGGAFn(self.max_shell_type), fock)
+            points, weights, pots, GB1DMGridGGAFn(self.max_shell_type), fock,
+            nthread)
         return np.asarray(fock)
 
     def compute_grid_kinetic_fock(self, double[:, ::1] points not None,
                                   double[::1] weights not None, double[:] pots not None,
-                                  double[:, ::1] fock=None):
+                                  double[:, ::1] fock=None, nthread=None):
         """Compute a Fock operator from a kientic-energy-density potential.
 
         **Warning:** the results are added to the Fock operator!
@@ -1580,18 +2382,21 @@ cdef class GOBasis(GBasis):
             Derivative of the energy toward the kinetic energy density at all grid points.
         fock : np.ndarray, shape=(nbasis, nbasis), dtype=float
             Output two-index object, optional.
+        nthread : int
+            The number of threads. When not given, ``context.nthread`` is used.
 
         Returns
         -------
         fock
         """
         fock = self._compute_grid1_fock(
-            points, weights, pots[:, None], GB1DMGridKineticFn(self.max_shell_type), fock)
+            points, weights, pots[:, None], GB1DMGridKineticFn(self.max_shell_type), fock,
+            nthread)
         return np.asarray(fock)
 
     def compute_grid_hessian_fock(self, double[:, ::1] points not None,
                                   double[::1] weights not None, double[:, :] pots not None,
-                                  double[:, ::1] fock=None):
+                                  double[:, ::1] fock=None, nthread=None):
         """Compute a Fock operator from a density hessian potential.
 
         **Warning:** the results are added to the Fock operator!
@@ -1615,18 +2420,21 @@ cdef class GOBasis(GBasis):
 
         fock : np.ndarray, shape=(nbasis, nbasis), dtype=float
             Output two-index object, optional.
+        nthread : int
+            The number of threads. When not given, ``context.nthread`` is used.
 
         Returns
         -------
         fock
         """
         fock = self._compute_grid1_fock(
-            points, weights, pots, GB1DMGridHessianFn(self.max_shell_type), fock)
+            points, weights, pots, GB1DMGridHessianFn(self.max_shell_type), fock,
+            nthread)
         return np.asarray(fock)
 
     def compute_grid_mgga_fock(self, double[:, ::1] points not None,
                                double[::1] weights not None, double[:, :] pots not None,
-                               double[:, ::1] fock=None):
+                               double[:, ::1] fock=None, nthread=None):
         """Compute a Fock operator from MGGA potential data.
 
         **Warning:** the results are added to the Fock operator!
@@ -1650,15 +2458,163 @@ cdef class GOBasis(GBasis):
 
         fock : np.ndarray, shape=(nbasis, nbasis), dtype=float
             Output two-index object, optional.
+        nthread : int
+            The number of threads. When not given, ``context.nthread`` is used.
 
         Returns
         -------
         fock
         """
         fock = self._compute_grid1_fock(
-            points, weights, pots, GB1DMGridMGGAFn(self.max_shell_type), fock)
+            points, weights, pots, GB1DMGridMGGAFn(self.max_shell_type), fock,
+            nthread)
         return np.asarray(fock)
 
+    def compute_grid_density_fock_multi(self, double[:, ::1] points not None,
+                                        double[::1] weights not None,
+                                        double[:, ::1] pots not None,
+                                        double[:, :, ::1] focks=None, nthread=None):
+        """Compute Fock operators from several density potentials at once.
+
+        **Warning:** the results are added to the Fock operators!
+
+        This gives the same result as calling ``compute_grid_density_fock`` for
+        every column of ``pots``, but the basis functions are evaluated only once
+        on the grid.
+
+        Parameters
+        ----------
+        points : np.ndarray, shape=(npoint, 3), dtype=float
+            Cartesian grid points.
+        weights : np.ndarray, shape=(npoint,), dtype=float
+            Integration weights.
+        pots : np.ndarray, shape=(npoint, nop), dtype=float
+            Derivatives of the energy toward the density at all grid points, one column
+            for each operator.
+        focks : np.ndarray, shape=(nop, nbasis, nbasis), dtype=float
+            Output two-index objects, optional.
+        nthread : int
+            The number of threads. When not given, ``context.nthread`` is used.
+
+        Returns
+        -------
+        focks
+        """
+        check_shape(points, (-1, 3), 'points')
+        npoint = points.shape[0]
+        check_shape(weights, (npoint,), 'weights')
+        check_shape(pots, (npoint, -1), 'pots')
+        nop = pots.shape[1]
+        focks = prepare_array(focks, (nop, self.nbasis, self.nbasis), 'focks')
+        if npoint > 0 and nop > 0:
+            (<gbasis.GOBasis*>self._this).compute_grid1_density_fock_multi(
+                npoint, &points[0, 0], &weights[0], nop, &pots[0, 0], &focks[0, 0, 0],
+                get_nthread(nthread))
+        return np.asarray(focks)
+
+    def _compute_grid1_fock_multi(self, double[:, ::1] points not None,
+                                  double[::1] weights not None,
+                                  double[:, :, ::1] pots not None,
+                                  GB1DMGridFn grid_fn not None,
+                                  double[:, :, ::1] focks=None, nthread=None):
+        """Compute Fock operators from several potentials at once.
+
+        **Warning:** the results are added to the Fock operators!
+
+        This gives the same result as calling ``_compute_grid1_fock`` for every
+        potential, but the basis functions are evaluated only once on the grid.
+
+        Parameters
+        ----------
+        points : np.ndarray, shape=(npoint, 3), dtype=float
+            Cartesian grid points.
+        weights : np.ndarray, shape=(npoint,), dtype=float
+            Integration weights.
+        pots : np.ndarray, shape=(npoint, nfock, n), dtype=float
+            Derivatives of the energy toward the density-related quantities at all grid
+            points, for each Fock operator. The last dimension depends on grid_fn.
+        grid_fn : GB1DMGridFn
+            Implements the function to be evaluated on the grid.
+        focks : np.ndarray, shape=(nfock, nbasis, nbasis), dtype=float
+            Output two-index objects, optional.
+        nthread : int
+            The number of threads. When not given, ``context.nthread`` is used.
+
+        Returns
+        -------
+        focks
+        """
+        check_shape(points, (-1, 3), 'points')
+        npoint = points.shape[0]
+        check_shape(weights, (npoint,), 'weights')
+        check_shape(pots, (npoint, -1, grid_fn.dim_output), 'pots')
+        nfock = pots.shape[1]
+        focks = prepare_array(focks, (nfock, self.nbasis, self.nbasis), 'focks')
+        if npoint > 0 and nfock > 0:
+            (<gbasis.GOBasis*>self._this).compute_grid1_fock_multi(
+                nfock, npoint, &points[0, 0], &weights[0], &pots[0, 0, 0], grid_fn._this,
+                &focks[0, 0, 0], get_nthread(nthread))
+        return np.asarray(focks)
+
+    def compute_grid_gga_fock_multi(self, double[:, ::1] points not None,
+                                    double[::1] weights not None,
+                                    double[:, :, ::1] pots not None,
+                                    double[:, :, ::1] focks=None, nthread=None):
+        """Compute Fock operators from several sets of GGA potential data at once.
+
+        **Warning:** the results are added to the Fock operators!
+
+        Parameters
+        ----------
+        points : np.ndarray, shape=(npoint, 3), dtype=float
+            Cartesian grid points.
+        weights : np.ndarray, shape=(npoint,), dtype=float
+            Integration weights.
+        pots : np.ndarray, shape=(npoint, nfock, 4), dtype=float
+            Derivatives of the energy toward GGA ingredients (density and gradient) at
+            all grid points, for each Fock operator.
+        focks : np.ndarray, shape=(nfock, nbasis, nbasis), dtype=float
+            Output two-index objects, optional.
+        nthread : int
+            The number of threads. When not given, ``context.nthread`` is used.
+
+        Returns
+        -------
+        focks
+        """
+        return self._compute_grid1_fock_multi(
+            points, weights, pots, GB1DMGridGGAFn(self.max_shell_type), focks, nthread)
+
+    def compute_grid_mgga_fock_multi(self, double[:, ::1] points not None,
+                                     double[::1] weights not None,
+                                     double[:, :, ::1] pots not None,
+                                     double[:, :, ::1] focks=None, nthread=None):
+        """Compute Fock operators from several sets of MGGA potential data at once.
+
+        **Warning:** the results are added to the Fock operators!
+
+        Parameters
+        ----------
+        points : np.ndarray, shape=(npoint, 3), dtype=float
+            Cartesian grid points.
+        weights : np.ndarray, shape=(npoint,), dtype=float
+            Integration weights.
+        pots : np.ndarray, shape=(npoint, nfock, 6), dtype=float
+            Derivatives of the energy toward density, gradient, Laplacian and kinetic
+            energy density at all grid points, for each Fock operator. The columns are
+            assigned as in ``compute_grid_mgga_fock``.
+        focks : np.ndarray, shape=(nfock, nbasis, nbasis), dtype=float
+            Output two-index objects, optional.
+        nthread : int
+            The number of threads. When not given, ``context.nthread`` is used.
+
+        Returns
+        -------
+        focks
+        """
+        return self._compute_grid1_fock_multi(
+            points, weights, pots, GB1DMGridMGGAFn(self.max_shell_type), focks, nthread)
+
 
 #
 # gbw wrappers
@@ -1680,7 +2636,7 @@ def select_2index(GOBasis gobasis, long index0, long index2):
         gb4int = new ints.GB4ElectronRepulsionIntegralLibInt(
                             gobasis.max_shell_type)
         gb4w = new gbw.GB4IntegralWrapper((<gbasis.GOBasis* > gobasis._this),
-                            <ints.GB4Integral*> gb4int)
+                            <ints.GB4Integral*> gb4int, 1)
         gb4w.select_2index(index0, index2, &pbegin0, &pend0, &pbegin2, &pend2)
     finally:
         if gb4int is not NULL:
@@ -1691,7 +2647,7 @@ def select_2index(GOBasis gobasis, long index0, long index2):
 
 
 def compute_diagonal(GOBasis gobasis, np.ndarray[double, ndim=2] diagonal not
-        None):
+        None, long nthread=1):
     cdef ints.GB4ElectronRepulsionIntegralLibInt* gb4int = NULL
     cdef gbw.GB4IntegralWrapper* gb4w = NULL
     cdef np.ndarray[double, ndim=2] output
@@ -1701,7 +2657,7 @@ def compute_diagonal(GOBasis gobasis, np.ndarray[double, ndim=2] diagonal not
         gb4int = new ints.GB4ElectronRepulsionIntegralLibInt(
                             gobasis.max_shell_type)
         gb4w = new gbw.GB4IntegralWrapper((<gbasis.GOBasis* > gobasis._this),
-                            <ints.GB4Integral*> gb4int)
+                            <ints.GB4Integral*> gb4int, nthread)
         gb4w.compute_diagonal(&output[0, 0])
 
     finally:
@@ -1711,7 +2667,7 @@ def compute_diagonal(GOBasis gobasis, np.ndarray[double, ndim=2] diagonal not
             del gb4w
 
 def get_2index_slice(GOBasis gobasis, long index0, long index2,
-                        np.ndarray[double, ndim=2] slice not None):
+                        np.ndarray[double, ndim=2] slice not None, long nthread=1):
     cdef ints.GB4ElectronRepulsionIntegralLibInt* gb4int = NULL
     cdef gbw.GB4IntegralWrapper* gb4w = NULL
     assert slice.flags['C_CONTIGUOUS']
@@ -1727,7 +2683,7 @@ def get_2index_slice(GOBasis gobasis, long index0, long index2,
         gb4int = new ints.GB4ElectronRepulsionIntegralLibInt(
                             gobasis.max_shell_type)
         gb4w = new gbw.GB4IntegralWrapper((<gbasis.GOBasis* > gobasis._this),
-                            <ints.GB4Integral*> gb4int)
+                            <ints.GB4Integral*> gb4int, nthread)
         gb4w.select_2index(index0, index2, &pbegin0, &pend0, &pbegin2, &pend2)
         gb4w.compute()
         output = gb4w.get_2index_slice(index0, index2)
@@ -1744,6 +2700,228 @@ def get_2index_slice(GOBasis gobasis, long index0, long index2,
             del gb4w
 
 
+#
+# packed wrappers
+#
+
+
+def get_packed_size(long nbasis):
+    """Return the number of elements of a packed four-index object.
+
+    Parameters
+    ----------
+    nbasis : int
+        The number of basis functions.
+    """
+    return packed.get_packed_size(nbasis)
+
+
+def get_packed_nbasis(long size):
+    """Return the number of basis functions of a packed four-index object.
+
+    Parameters
+    ----------
+    size : int
+        The number of elements in the packed array.
+
+    Raises
+    ------
+    TypeError
+        When the size does not correspond to a packed four-index object.
+    """
+    npair = int(round((np.sqrt(8*size + 1) - 1)/2))
+    nbasis = int(round((np.sqrt(8*npair + 1) - 1)/2))
+    if packed.get_packed_size(nbasis) != size:
+        raise TypeError('A packed four-index object can not have {} elements.'.format(size))
+    return nbasis
+
+
+def pack_four_index(double[:, :, :, ::1] dense not None, double[::1] output=None):
+    """Store only the symmetry-unique elements of a four-index object.
+
+    Only the elements (pq|rs) in chemist's notation with p >= q, r >= s and pq >= rs
+    are kept, where pq = p*(p+1)/2 + q. The element (pq|rs) is stored at position
+    pq*(pq+1)/2 + rs. This reduces the memory usage by a factor of eight.
+
+    Parameters
+    ----------
+    dense : np.ndarray, shape=(nbasis, nbasis, nbasis, nbasis)
+        The four-index object in physicist's notation, with eight-fold symmetry.
+    output : np.ndarray, shape=(get_packed_size(nbasis),)
+        The packed output, optional.
+
+    Returns
+    -------
+    output
+    """
+    cdef long nbasis = dense.shape[0]
+    check_shape(np.asarray(dense), (nbasis, nbasis, nbasis, nbasis), 'dense')
+    output = prepare_array(output, (packed.get_packed_size(nbasis),), 'output')
+    packed.pack_four_index(&dense[0, 0, 0, 0], nbasis, &output[0])
+    return np.asarray(output)
+
+
+def unpack_four_index(double[::1] packed_array not None,
+                      double[:, :, :, ::1] output=None):
+    """Convert a packed four-index object back to the dense storage.
+
+    Parameters
+    ----------
+    packed_array : np.ndarray, shape=(get_packed_size(nbasis),)
+        The packed four-index object, see ``pack_four_index``.
+    output : np.ndarray, shape=(nbasis, nbasis, nbasis, nbasis)
+        The dense output in physicist's notation, optional.
+
+    Returns
+    -------
+    output
+    """
+    cdef long nbasis = get_packed_nbasis(packed_array.shape[0])
+    output = prepare_array(output, (nbasis, nbasis, nbasis, nbasis), 'output')
+    packed.unpack_four_index(&packed_array[0], nbasis, &output[0, 0, 0, 0])
+    return np.asarray(output)
+
+
+def contract_packed(double[::1] packed_array not None, double[:, ::1] dm not None,
+                    bint coulomb=True, bint exchange=True, nthread=None):
+    """Contract a packed four-index object with a density matrix.
+
+    Parameters
+    ----------
+    packed_array : np.ndarray, shape=(get_packed_size(nbasis),)
+        The packed four-index object, see ``pack_four_index``.
+    dm : np.ndarray, shape=(nbasis, nbasis)
+        The density matrix.
+    coulomb : bool
+        When True, the Coulomb-type contraction is computed, i.e.
+        ``einsum('abcd,bd->ac', op, dm)`` for the corresponding dense object.
+    exchange : bool
+        When True, the exchange-type contraction is computed, i.e.
+        ``einsum('abcd,cb->ad', op, dm)`` for the corresponding dense object.
+    nthread : int
+        The number of threads. The result depends (only through rounding errors) on
+        it. When not given, ``context.nthread`` is used.
+
+    Returns
+    -------
+    coulomb, exchange : np.ndarray, shape=(nbasis, nbasis)
+        The requested contractions. None is returned for the other one.
+    """
+    cdef long nbasis = dm.shape[0]
+    cdef double[:, ::1] coulomb_output = None
+    cdef double[:, ::1] exchange_output = None
+    cdef double* coulomb_ptr = NULL
+    cdef double* exchange_ptr = NULL
+    check_shape(np.asarray(packed_array), (packed.get_packed_size(nbasis),), 'packed_array')
+    check_shape(np.asarray(dm), (nbasis, nbasis), 'dm')
+    if coulomb:
+        coulomb_output = np.zeros((nbasis, nbasis))
+        coulomb_ptr = &coulomb_output[0, 0]
+    if exchange:
+        exchange_output = np.zeros((nbasis, nbasis))
+        exchange_ptr = &exchange_output[0, 0]
+    packed.contract_packed(&packed_array[0], nbasis, &dm[0, 0], coulomb_ptr, exchange_ptr,
+                           get_nthread(nthread))
+    return (None if coulomb_output is None else np.asarray(coulomb_output),
+            None if exchange_output is None else np.asarray(exchange_output))
+
+
+#
+# esp wrappers
+#
+
+
+cdef class ScreenedAttraction:
+    """Screened attraction integrals of many point charges at fixed positions.
+
+    Distant point charges are grouped in cubic cells and their interaction with the
+    orbital basis is computed with multipole expansions. Nearby point charges are
+    treated exactly. Only the positions of the point charges are fixed when this
+    object is created, such that the integrals can be computed efficiently for
+    charges that change frequently, e.g. the environment in a QM/MM calculation. The
+    centers of the orbital basis may not change afterwards.
+    """
+    cdef esp.ScreenedAttraction* _this
+    # make an additional reference to the basis to avoid deallocation
+    cdef GOBasis _obasis
+
+    def __cinit__(self, GOBasis obasis not None, double[:, ::1] coordinates not None,
+                  double threshold=1e-8, double cell_size=5.0):
+        """Initialize a ScreenedAttraction object.
+
+        Parameters
+        ----------
+        obasis : GOBasis
+            The orbital basis.
+        coordinates : np.ndarray, shape=(ncharge, 3)
+            Cartesian coordinates of the point charges.
+        threshold : float
+            The error allowed for each multipole expansion of (a cell of) point
+            charges, in every matrix element.
+        cell_size : float
+            The edge of the cubic cells in which the point charges are grouped.
+        """
+        check_shape(coordinates, (-1, 3), 'coordinates')
+        if threshold <= 0:
+            raise ValueError('The screening threshold must be strictly positive. Got {}.'
+                             .format(threshold))
+        if cell_size <= 0:
+            raise ValueError('The cell size must be strictly positive. Got {}.'
+                             .format(cell_size))
+        cdef long ncharge = coordinates.shape[0]
+        cdef double* centers_ptr = NULL
+        if ncharge > 0:
+            centers_ptr = &coordinates[0, 0]
+        self._obasis = obasis
+        self._this = new esp.ScreenedAttraction(
+            <gbasis.GOBasis*>obasis._this, centers_ptr, ncharge, threshold, cell_size)
+
+    def __dealloc__(self):
+        del self._this
+
+    property ncharge:
+        def __get__(self):
+            return self._this.get_ncharge()
+
+    property ncell:
+        def __get__(self):
+            return self._this.get_ncell()
+
+    property nexact:
+        """The number of atom-charge combinations treated exactly in the last call."""
+        def __get__(self):
+            return self._this.get_nexact()
+
+    def compute(self, double[::1] charges not None, double[:, ::1] output=None,
+                nthread=None):
+        """Compute the attraction integrals of the point charges.
+
+        Parameters
+        ----------
+        charges : np.ndarray, shape=(ncharge,)
+            The values of the point charges.
+        output : np.ndarray, shape=(nbasis, nbasis)
+            Two-index object, optional.
+        nthread : int
+            The number of threads. The result does not depend on it. When not
+            given, ``context.nthread`` is used.
+
+        Returns
+        -------
+        output
+            The same integrals as ``GOBasis.compute_nuclear_attraction``, up to the
+            screening errors.
+        """
+        cdef long nbasis = self._obasis.nbasis
+        check_shape(charges, (self._this.get_ncharge(),), 'charges')
+        output = prepare_array(output, (nbasis, nbasis), 'output')
+        cdef double* charges_ptr = NULL
+        if charges.shape[0] > 0:
+            charges_ptr = &charges[0]
+        self._this.compute(charges_ptr, &output[0, 0], get_nthread(nthread))
+        return np.asarray(output)
+
+
 #
 # ints wrappers (for testing only)
 #
@@ -18,11 +18,90 @@
 //
 //--
 
+#include <fcntl.h>
+#include <sys/mman.h>
+#include <unistd.h>
+#include <algorithm>
+#include <atomic>
+#include <cerrno>
 #include <cstddef>
 #include <cstring>
 #include <cmath>
 #include <stdexcept>
+#include <string>
+#include <vector>
 #include "horton/gbasis/cholesky.h"
+#include "horton/gbasis/parallel.h"
+
+// Number of elements of a 2-index object that are processed together in the
+// matrix-matrix product of subtract_past_vectors.
+#define CHOLESKY_CHUNK 256
+
+VectorCholeskyStorage::VectorCholeskyStorage(std::vector<double>* vectors, long size)
+    : CholeskyStorage(size), vectors(vectors) {
+  if (!vectors->empty()) {
+    throw std::domain_error("The std::vector for the Cholesky vectors must be empty.");
+  }
+  // The typical number of vectors is a small multiple of nbasis.
+  vectors->reserve(static_cast<long>(sqrt(size))*size);
+}
+
+double* VectorCholeskyStorage::resize(long nvec) {
+  // Grow in blocks of at least half the current number of vectors.
+  if (static_cast<long>(vectors->capacity()) < nvec*size) {
+    vectors->reserve((nvec + nvec/2)*size);
+  }
+  vectors->resize(nvec*size);
+  return vectors->data();
+}
+
+
+FileCholeskyStorage::FileCholeskyStorage(const char* filename, long size)
+    : CholeskyStorage(size), mapped(NULL), nvec(0), nvec_alloc(0) {
+  fd = open(filename, O_RDWR | O_CREAT | O_TRUNC, 0644);
+  if (fd == -1) {
+    throw std::runtime_error(std::string("Could not open ") + filename + ": " +
+                             strerror(errno));
+  }
+}
+
+FileCholeskyStorage::~FileCholeskyStorage() {
+  if (mapped != NULL) {
+    munmap(mapped, nvec_alloc*size*sizeof(double));
+  }
+  // Remove the unused part of the last block. Errors can not be reported here.
+  if (ftruncate(fd, nvec*size*sizeof(double)) != 0) {}
+  close(fd);
+}
+
+double* FileCholeskyStorage::resize(long new_nvec) {
+  if (new_nvec > nvec_alloc) {
+    // The file grows in blocks, such that remapping is rare. (The first block
+    // is as large as the vectors in the file are long, which is typically a
+    // fraction of the final number of vectors.)
+    long new_nvec_alloc = std::max(
+        new_nvec, nvec_alloc + std::max(nvec_alloc/2, static_cast<long>(sqrt(size))));
+    if (mapped != NULL) {
+      munmap(mapped, nvec_alloc*size*sizeof(double));
+      mapped = NULL;
+    }
+    if (ftruncate(fd, new_nvec_alloc*size*sizeof(double)) != 0) {
+      throw std::runtime_error(std::string("Could not enlarge the file with Cholesky "
+                               "vectors: ") + strerror(errno));
+    }
+    void* result = mmap(NULL, new_nvec_alloc*size*sizeof(double),
+                        PROT_READ | PROT_WRITE, MAP_SHARED, fd, 0);
+    if (result == MAP_FAILED) {
+      throw std::runtime_error(std::string("Could not map the file with Cholesky "
+                               "vectors: ") + strerror(errno));
+    }
+    mapped = static_cast<double*>(result);
+    nvec_alloc = new_nvec_alloc;
+  }
+  nvec = new_nvec;
+  return mapped;
+}
+
 
 /**
     Find the maximum diagonal error, used several times in the cholesky routine.
@@ -46,8 +125,77 @@ double find_maxdiag(double* diagerr, long nbasis, long begin1, long end1,
 }
 
 
+/**
+    Subtract the contributions of all past Cholesky vectors from a set of slices.
+
+    For each candidate pivot s, with 2-index position pivots[s], the following is
+    computed: residuals[s, i] -= sum_l vectors[l, i]*vectors[l, pivots[s]]. This is
+    a matrix-matrix product, which is carried out in chunks of the 2-index i, such
+    that a chunk of all slices stays in cache while looping over the past vectors.
+    Chunks are distributed over threads and the summation order does not depend on
+    the number of threads.
+*/
+void subtract_past_vectors(double* residuals, long nsub, const long* pivots,
+    const double* vectors, long nvec, long size, long nthread)
+{
+  if (nvec == 0) return;
+  // Gather the elements of the past vectors at the pivots.
+  std::vector<double> factors(nvec*nsub);
+  for (long l = 0; l < nvec; l++) {
+    for (long s = 0; s < nsub; s++) {
+      factors[l*nsub + s] = vectors[l*size + pivots[s]];
+    }
+  }
+
+  const long nchunk = (size + CHOLESKY_CHUNK - 1)/CHOLESKY_CHUNK;
+  std::atomic<long> next_chunk(0);
+  run_in_threads(nthread, [&](long ithread) {
+    std::vector<double> sums(nsub*CHOLESKY_CHUNK);
+    long ichunk;
+    while ((ichunk = next_chunk++) < nchunk) {
+      const long begin = ichunk*CHOLESKY_CHUNK;
+      const long n = std::min(size - begin, static_cast<long>(CHOLESKY_CHUNK));
+      std::fill(sums.begin(), sums.end(), 0.0);
+      for (long l = 0; l < nvec; l++) {
+        const double* vector = vectors + l*size + begin;
+        for (long s = 0; s < nsub; s++) {
+          const double factor = factors[l*nsub + s];
+          double* sum = &sums[s*CHOLESKY_CHUNK];
+          for (long i = 0; i < n; i++) {
+            sum[i] += factor*vector[i];
+          }
+        }
+      }
+      for (long s = 0; s < nsub; s++) {
+        for (long i = 0; i < n; i++) {
+          residuals[s*size + begin + i] -= sums[s*CHOLESKY_CHUNK + i];
+        }
+      }
+    }
+  });
+}
+
+
 long cholesky(GB4IntegralWrapper* gbw4, std::vector<double>* vectors,
     double threshold)
+{
+  long nbasis = gbw4->get_nbasis();
+  VectorCholeskyStorage storage(vectors, nbasis*nbasis);
+  return cholesky(gbw4, &storage, threshold);
+}
+
+
+long cholesky(GB4IntegralWrapper* gbw4, const char* filename,
+    double threshold)
+{
+  long nbasis = gbw4->get_nbasis();
+  FileCholeskyStorage storage(filename, nbasis*nbasis);
+  return cholesky(gbw4, &storage, threshold);
+}
+
+
+long cholesky(GB4IntegralWrapper* gbw4, CholeskyStorage* storage,
+    double threshold)
 {
   if (threshold <= 0) {
     // The algorithm below may go crazy with a non-positive threshold.
@@ -55,14 +203,15 @@ long cholesky(GB4IntegralWrapper* gbw4, std::vector<double>* vectors,
   }
 
   long nbasis = gbw4->get_nbasis();
-  double* diagonal = new double[nbasis*nbasis];  // allocate 2 index object
-  double* diagerr = new double[nbasis*nbasis];   //  "
-  double* slice = NULL;                          //  "
-  double* pastvector_sum = new double[nbasis*nbasis];
-  // storage for 2-index cholesky vectors, start with allocation of 15% of the
-  // full 4-center matrix
-//  std::vector<double>* vectors = new std::vector<double>;
-  vectors->reserve(nbasis*nbasis*nbasis*nbasis*0.15);
+  long size = nbasis*nbasis;
+  long nthread = gbw4->get_nthread();
+  double* diagonal = new double[size];  // allocate 2 index object
+  double* diagerr = new double[size];   //  "
+  double* slice = NULL;                 //  "
+  // Slices for all candidate pivots in the selected pair of shells, from which
+  // the contributions of past Cholesky vectors are subtracted.
+  std::vector<double> residuals;
+  std::vector<long> pivots;
 
   /*
     In some future version, we'll introduce a mask to only compute integrals
@@ -76,7 +225,7 @@ long cholesky(GB4IntegralWrapper* gbw4, std::vector<double>* vectors,
     we start with zero Cholesky vectors).
   */
   gbw4->compute_diagonal(diagonal);
-  memcpy(diagerr, diagonal, sizeof(double)*nbasis*nbasis);
+  memcpy(diagerr, diagonal, sizeof(double)*size);
 
   /*
     This is extra stuff in the wrapper we'll need in future:
@@ -97,8 +246,9 @@ long cholesky(GB4IntegralWrapper* gbw4, std::vector<double>* vectors,
                                 index1, index2);
 
   // std::cout << "initial maxdiag " << maxdiag << " " << index1 << " " << index2 << std::endl;
-  unsigned long nvec=0;
-  do {
+  long nvec=0;
+  // No vectors are needed when all diagonal elements are below the threshold.
+  while (maxdiag > threshold) {
     // call wrapper to let it select a pair of shells for the given variables
     // index1 and index2.
     long begin1;
@@ -111,43 +261,51 @@ long cholesky(GB4IntegralWrapper* gbw4, std::vector<double>* vectors,
     // gbw4->compute(mask);
     gbw4->compute();
 
-    do {
-      // Get the the slice of computed four-center integrals that correspond
-      // to the pair index1,index2.
-      slice = gbw4->get_2index_slice(index1, index2);
+    // Subtract the contributions of all past vectors from the slices of all
+    // candidate pivots in this pair of shells at once. (All pivots selected in
+    // the loop below belong to this pair of shells.)
+    const long nsub2 = end2 - begin2;
+    const long nsub = (end1 - begin1)*nsub2;
+    residuals.resize(nsub*size);
+    pivots.resize(nsub);
+    for (long i1 = begin1; i1 < end1; i1++) {
+      for (long i2 = begin2; i2 < end2; i2++) {
+        const long isub = (i1 - begin1)*nsub2 + (i2 - begin2);
+        pivots[isub] = i1*nbasis + i2;
+        slice = gbw4->get_2index_slice(i1, i2);
+        memcpy(&residuals[isub*size], slice, sizeof(double)*size);
+      }
+    }
+    subtract_past_vectors(&residuals[0], nsub, &pivots[0],
+                          storage->resize(nvec), nvec, size, nthread);
+    const long nvec_begin = nvec;
 
-      // construct new cholesky vector
-      memset(pastvector_sum, 0, sizeof(double)*nbasis*nbasis);
-      maxdiag = 1.0 / sqrt(maxdiag);
+    do {
+      // Make room for the new vector. (The storage allocates blocks of vectors.)
+      double* past = storage->resize(nvec + 1);
+      double* current = past + nvec*size;
 
-      // compute sum of past Ls
-      for (unsigned long l = 0; l < nvec; l++) {
-        double factor = (*vectors)[l*nbasis*nbasis + index1*nbasis + index2];
-        for (long i = nbasis*nbasis-1; i >= 0; i--) {
-          pastvector_sum[i] += factor*(*vectors)[l*nbasis*nbasis + i];
+      // The residual of the selected pivot still contains the contributions of
+      // the vectors that were added for this pair of shells.
+      const long isub = (index1 - begin1)*nsub2 + (index2 - begin2);
+      const double* residual = &residuals[isub*size];
+      memset(current, 0, sizeof(double)*size);
+      for (long l = nvec_begin; l < nvec; l++) {
+        const double factor = past[l*size + index1*nbasis + index2];
+        for (long i = 0; i < size; i++) {
+          current[i] += factor*past[l*size + i];
         }
-        /*
-        cblas_daxpy(nbasis*nbasis,
-                    (*vectors)[(l*nbasis*nbasis) + index1*nbasis + index2],
-                    &(*vectors)[l*nbasis*nbasis], 1, pastvector_sum, 1);
-        */
       }
 
       // compute current L
-      for (long i = 0; i < nbasis; i++) {
-        for (long j = 0; j < nbasis; j++) {
-          vectors->push_back(maxdiag * (slice[i*nbasis + j] -
-                             pastvector_sum[i*nbasis + j]));
-        }
+      maxdiag = 1.0 / sqrt(maxdiag);
+      for (long i = 0; i < size; i++) {
+        current[i] = maxdiag*(residual[i] - current[i]);
       }
 
       // update diagerr
-      for (long i=0; i<nbasis; i++){
-        for (long j=0; j<nbasis; j++){
-          diagerr[i*nbasis + j] -=
-              (*vectors)[(nvec*nbasis*nbasis) + i*nbasis + j] *
-              (*vectors)[(nvec*nbasis*nbasis) + i*nbasis + j];
-        }
+      for (long i = 0; i < size; i++) {
+        diagerr[i] -= current[i]*current[i];
       }
 
       // We've just added one vector.
@@ -166,15 +324,11 @@ long cholesky(GB4IntegralWrapper* gbw4, std::vector<double>* vectors,
                            index1, index2);
 
     // std::cout << "shell maxdiag " << maxdiag << " " << index1 << " " << index2 << std::endl;
-  } while (maxdiag > threshold);
-
-  // Concatenate results array. Not efficient! Who cares?
-//  *uninit_result = &((*vectors)[0]);
+  }
 
   // Free vectors
   delete[] diagonal;
   delete[] diagerr;
-  delete[] pastvector_sum;
 
   return nvec;
 }
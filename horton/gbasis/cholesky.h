@@ -26,6 +26,103 @@
 #include <vector>
 #include "horton/gbasis/gbw.h"
 
+/**
+    @brief
+        Growable storage for Cholesky vectors.
+
+    Vectors are stored contiguously, one after the other. Room for new vectors is
+    allocated in blocks.
+*/
+class CholeskyStorage {
+    public:
+        /**
+            @brief
+                Construct the storage.
+
+            @param size
+                The number of elements in one vector (nbasis*nbasis).
+        */
+        explicit CholeskyStorage(long size) : size(size) {}
+        virtual ~CholeskyStorage() {}
+
+        /**
+            @brief
+                Make the storage hold nvec vectors.
+
+            Existing vectors are preserved. New vectors are not initialized.
+
+            @param nvec
+                The new number of vectors.
+
+            @return
+                A pointer to the first element of the first vector. The pointer
+                becomes invalid after the next call to resize.
+        */
+        virtual double* resize(long nvec) = 0;
+
+    protected:
+        long size;  //!< The number of elements in one vector.
+};
+
+
+/**
+    @brief
+        Storage for Cholesky vectors in memory, using an std::vector.
+*/
+class VectorCholeskyStorage : public CholeskyStorage {
+    public:
+        /**
+            @brief
+                Construct the storage.
+
+            @param vectors
+                The std::vector to which the Cholesky vectors are written. It
+                must be empty initially.
+
+            @param size
+                The number of elements in one vector (nbasis*nbasis).
+        */
+        VectorCholeskyStorage(std::vector<double>* vectors, long size);
+        virtual double* resize(long nvec);
+
+    private:
+        std::vector<double>* vectors;
+};
+
+
+/**
+    @brief
+        Storage for Cholesky vectors in a memory-mapped file.
+
+    The file contains the vectors as raw (native) double precision numbers in C
+    order. It is enlarged in blocks while vectors are added, such that only the
+    vectors in use by the decomposition need to reside in memory. When the
+    storage is destroyed, the file is truncated to the actual number of vectors.
+*/
+class FileCholeskyStorage : public CholeskyStorage {
+    public:
+        /**
+            @brief
+                Construct the storage. The file is created or overwritten.
+
+            @param filename
+                The file to which the Cholesky vectors are written.
+
+            @param size
+                The number of elements in one vector (nbasis*nbasis).
+        */
+        FileCholeskyStorage(const char* filename, long size);
+        virtual ~FileCholeskyStorage();
+        virtual double* resize(long nvec);
+
+    private:
+        int fd;             // file descriptor
+        double* mapped;     // memory-mapped contents of the file
+        long nvec;          // number of vectors in use
+        long nvec_alloc;    // number of vectors for which the file is large enough
+};
+
+
 /**
     @brief
         Computes Cholesky vectors for a four-index object
@@ -35,11 +132,15 @@
     a pair of shells at a time. (This is because most implementations of a
     four-center work like that.)
 
+    All candidate pivots within the selected pair of shells are corrected for the
+    previous Cholesky vectors in one blocked matrix-matrix product, which uses the
+    same number of threads as gbw4.
+
     @param gbw4
         A wrapper around a definition of the 4-center integral. See gbw.h
 
-    @param vectors
-        An output pointer. The Cholesky vectors will be added to this std::vector.
+    @param storage
+        The storage to which the Cholesky vectors are written.
 
     @param threshold
         A threshold for the error on the (double) diagonal of the four-center
@@ -47,7 +148,32 @@
         generated such that the error on the diagonal falls below this
         threshold.
 */
+long cholesky(GB4IntegralWrapper* gbw4, CholeskyStorage* storage,
+    double threshold);
+
+/**
+    @brief
+        Computes Cholesky vectors for a four-index object, stored in memory.
+
+    See above for the parameters.
+
+    @param vectors
+        An output pointer. The Cholesky vectors will be added to this std::vector,
+        which must be empty initially.
+*/
 long cholesky(GB4IntegralWrapper* gbw4, std::vector<double>* vectors,
     double threshold);
 
+/**
+    @brief
+        Computes Cholesky vectors for a four-index object, stored in a file.
+
+    See above for the parameters.
+
+    @param filename
+        The file to which the vectors are written, see FileCholeskyStorage.
+*/
+long cholesky(GB4IntegralWrapper* gbw4, const char* filename,
+    double threshold);
+
 #endif
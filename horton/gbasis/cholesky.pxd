@@ -23,4 +23,5 @@ from libcpp.vector cimport vector
 cimport gbw
 
 cdef extern from "horton/gbasis/cholesky.h":
-    long cholesky(gbw.GB4IntegralWrapper* gbw4, vector[double]* vectors, double threshold)
+    long cholesky(gbw.GB4IntegralWrapper* gbw4, vector[double]* vectors, double threshold) except +
+    long cholesky(gbw.GB4IntegralWrapper* gbw4, const char* filename, double threshold) except +
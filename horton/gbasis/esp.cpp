@@ -0,0 +1,952 @@
+// HORTON: Helpful Open-source Research TOol for N-fermion systems.
+// Copyright (C) 2011-2017 The HORTON Development Team
+//
+// This file is part of HORTON.
+//
+// HORTON is free software; you can redistribute it and/or
+// modify it under the terms of the GNU General Public License
+// as published by the Free Software Foundation; either version 3
+// of the License, or (at your option) any later version.
+//
+// HORTON is distributed in the hope that it will be useful,
+// but WITHOUT ANY WARRANTY; without even the implied warranty of
+// MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+// GNU General Public License for more details.
+//
+// You should have received a copy of the GNU General Public License
+// along with this program; if not, see <http://www.gnu.org/licenses/>
+//
+//--
+
+
+#include <algorithm>
+#include <array>
+#include <atomic>
+#include <cmath>
+#include <cstdlib>
+#include <stdexcept>
+#include <vector>
+#include "horton/gbasis/cartpure.h"
+#include "horton/gbasis/common.h"
+#include "horton/gbasis/esp.h"
+#include "horton/gbasis/fns.h"
+#include "horton/gbasis/ints.h"
+#include "horton/gbasis/parallel.h"
+
+//! The number of Cartesian multipole moments up to ESP_MULTIPOLE_ORDER.
+#define ESP_NMOMENT (((ESP_MULTIPOLE_ORDER+1)*(ESP_MULTIPOLE_ORDER+2)*(ESP_MULTIPOLE_ORDER+3))/6)
+
+
+namespace {
+
+/*
+    Powers of the Cartesian multipole moments, sorted by increasing order. The
+    potential of a charge distribution with moments M_tuv around a center C is
+        sum_tuv M_tuv (-1)^(t+u+v)/(t! u! v!) d^(t+u+v)/dx^t dy^u dz^v 1/|r - C|
+*/
+struct MomentTable {
+  long xyz[ESP_NMOMENT][3];
+  double prefactor[ESP_NMOMENT];
+
+  MomentTable() {
+    long imoment = 0;
+    for (long order=0; order <= ESP_MULTIPOLE_ORDER; order++) {
+      for (long t=order; t >= 0; t--) {
+        for (long u=order-t; u >= 0; u--) {
+          long v = order - t - u;
+          xyz[imoment][0] = t;
+          xyz[imoment][1] = u;
+          xyz[imoment][2] = v;
+          prefactor[imoment] = ((order % 2 == 0) ? 1.0 : -1.0)/
+                               (factorial(t)*factorial(u)*factorial(v));
+          imoment++;
+        }
+      }
+    }
+  }
+
+  static double factorial(long n) {
+    double result = 1.0;
+    for (long i=2; i <= n; i++) result *= i;
+    return result;
+  }
+};
+
+const MomentTable moment_table;
+
+
+//! A primitive pair whose potential is not negligible.
+struct ESPPrimPair {
+  long iprim0, iprim1;
+  double extent;  //!< Radius around the expansion center beyond which the tail is negligible.
+};
+
+
+/*
+    Charge distribution of the significant primitive pairs in one shell pair. The
+    primitive pairs are sorted by decreasing extent. For each position in this list,
+    the multipole expansion of all following primitive pairs is precomputed, together
+    with the spread and the absolute charge of these primitive pairs.
+*/
+struct ESPShellPair {
+  long ishell0, ishell1;
+  std::vector<ESPPrimPair> prims;
+  double center[3];  //!< Center of the multipole expansion.
+  double extent;     //!< Largest extent of the primitive pairs.
+  std::vector<double> spreads;  //!< Radii used to estimate the truncation error.
+  std::vector<double> charges;  //!< Upper bounds for the absolute charges.
+  std::vector<double> moments;  //!< Shape (nprim + 1, ESP_NMOMENT).
+};
+
+
+/*
+    All shell pairs assigned to one atom. One-center pairs are expanded around the atom,
+    which is exact for grid points outside the extent of their primitives. Their
+    primitive pairs are sorted by decreasing extent, and the multipole moments of all
+    primitive pairs beyond a given position are precomputed. All other shell pairs
+    have their own multipole expansion.
+*/
+struct ESPGroup {
+  double center[3];
+  std::vector<ESPShellPair> local_pairs;
+  std::vector<double> local_extents;
+  std::vector<double> local_moments;  //!< Shape (nlocal + 1, ESP_NMOMENT).
+  std::vector<ESPShellPair> pairs;
+  double extent;   //!< Largest extent of all pairs.
+  double spread;   //!< Radius used to estimate the truncation error of the other pairs.
+  double charge;   //!< Upper bound for the absolute charge of the other pairs.
+  double moments[ESP_NMOMENT];  //!< Multipole expansion of all pairs.
+};
+
+
+double binomial(long n, long k) {
+  double result = 1.0;
+  for (long i=1; i <= k; i++) result = result*(n - k + i)/i;
+  return result;
+}
+
+
+/*
+    Contraction of a block of two-index integrals with the density matrix. The block
+    (ishell0, ishell1) is also used for the transposed block (ishell1, ishell0).
+*/
+double dot_block(const double* work, const double* dm, long nbasis, long ibasis0,
+                 long ibasis1, long n0, long n1) {
+  double result = 0.0;
+  for (long i0=0; i0 < n0; i0++) {
+    for (long i1=0; i1 < n1; i1++) {
+      double d = dm[(ibasis0 + i0)*nbasis + ibasis1 + i1];
+      if (ibasis0 != ibasis1) d += dm[(ibasis1 + i1)*nbasis + ibasis0 + i0];
+      result += d*work[i0*n1 + i1];
+    }
+  }
+  return result;
+}
+
+
+/*
+    Cartesian derivatives of 1/|delta| up to ESP_MULTIPOLE_ORDER, in the order of the
+    moment table. This uses the recursion of McMurchie and Davidson for the Coulomb
+    potential of a point charge.
+*/
+void coulomb_derivatives(const double* delta, double* output) {
+  const long lmax = ESP_MULTIPOLE_ORDER;
+  double work[lmax+1][lmax+1][lmax+1][lmax+1];
+  double rinv2 = 1.0/(delta[0]*delta[0] + delta[1]*delta[1] + delta[2]*delta[2]);
+  double base = sqrt(rinv2);
+  for (long n=0; n <= lmax; n++) {
+    work[n][0][0][0] = base;
+    base *= -(2*n + 1)*rinv2;
+  }
+  for (long n=lmax-1; n >= 0; n--) {
+    for (long order=1; order <= lmax-n; order++) {
+      for (long t=order; t >= 0; t--) {
+        for (long u=order-t; u >= 0; u--) {
+          long v = order - t - u;
+          double result;
+          if (t > 0) {
+            result = delta[0]*work[n+1][t-1][u][v];
+            if (t > 1) result += (t - 1)*work[n+1][t-2][u][v];
+          } else if (u > 0) {
+            result = delta[1]*work[n+1][t][u-1][v];
+            if (u > 1) result += (u - 1)*work[n+1][t][u-2][v];
+          } else {
+            result = delta[2]*work[n+1][t][u][v-1];
+            if (v > 1) result += (v - 1)*work[n+1][t][u][v-2];
+          }
+          work[n][t][u][v] = result;
+        }
+      }
+    }
+  }
+  for (long imoment=0; imoment < ESP_NMOMENT; imoment++) {
+    const long* xyz = moment_table.xyz[imoment];
+    output[imoment] = work[0][xyz[0]][xyz[1]][xyz[2]];
+  }
+}
+
+
+//! Potential of a multipole expansion whose moments include the prefactors.
+double multipole_potential(const double* moments, const double* center,
+                           const double* point) {
+  double delta[3] = {point[0] - center[0], point[1] - center[1], point[2] - center[2]};
+  double deriv[ESP_NMOMENT];
+  coulomb_derivatives(delta, deriv);
+  double result = 0.0;
+  for (long imoment=0; imoment < ESP_NMOMENT; imoment++) {
+    result += moments[imoment]*deriv[imoment];
+  }
+  return result;
+}
+
+
+/*
+    Test if the truncation error of a multipole expansion is below the threshold at a
+    distance d from its center. The error is estimated from the spread and the
+    absolute charge of the distribution.
+*/
+bool truncation_ok(double d, double spread, double charge, double threshold) {
+  if (d <= spread) return false;
+  return charge*pow(spread/d, ESP_MULTIPOLE_ORDER + 1)/(d - spread) < threshold;
+}
+
+
+/*
+    Radius beyond which the potential of a primitive pair differs by less than the
+    threshold from that of its multipole expansion. The pair density behaves as
+    charge*(gamma r^2)^(l/2) exp(-gamma r^2) at a distance r from its center.
+*/
+double tail_extent(double charge, double gamma, long l, double threshold) {
+  double x = std::max(1.0, log(charge/threshold));
+  double r_sq = x/gamma;
+  for (long i=0; i < 3; i++) {
+    r_sq = (x + 0.5*l*log(std::max(1.0, gamma*r_sq)))/gamma;
+  }
+  return sqrt(r_sq);
+}
+
+
+/*
+    Add moments around center to moments around new_center:
+        (r - new_center)^m = sum_k binom(m, k) (r - center)^k (center - new_center)^(m-k)
+*/
+void translate_moments(const double* moments, const double* center,
+                       const double* new_center, double* output) {
+  const double delta[3] = {center[0] - new_center[0], center[1] - new_center[1],
+                           center[2] - new_center[2]};
+  for (long imoment=0; imoment < ESP_NMOMENT; imoment++) {
+    const long* m = moment_table.xyz[imoment];
+    for (long jmoment=0; jmoment < ESP_NMOMENT; jmoment++) {
+      const long* k = moment_table.xyz[jmoment];
+      if ((k[0] > m[0]) || (k[1] > m[1]) || (k[2] > m[2])) continue;
+      double factor = 1.0;
+      for (long i=0; i < 3; i++) {
+        factor *= binomial(m[i], k[i])*pow(delta[i], m[i] - k[i]);
+      }
+      output[imoment] += factor*moments[jmoment];
+    }
+  }
+}
+
+//! Multipole moments of some primitive pairs of a shell pair, contracted with the 1RDM.
+class PairMoments {
+ public:
+  PairMoments(GOBasis* obasis, const double* dm)
+      : obasis(obasis), dm(dm), integral(obasis->get_max_shell_type(), xyz, center) {}
+
+  void compute(long ishell0, long ishell1, const std::vector<ESPPrimPair>& prims,
+               const double* new_center, double* output) {
+    const long shell_type0 = obasis->shell_types[ishell0];
+    const long shell_type1 = obasis->shell_types[ishell1];
+    const double* r0 = obasis->centers + 3*obasis->shell_map[ishell0];
+    const double* r1 = obasis->centers + 3*obasis->shell_map[ishell1];
+    std::copy(new_center, new_center + 3, center);
+    for (long imoment=0; imoment < ESP_NMOMENT; imoment++) {
+      std::copy(moment_table.xyz[imoment], moment_table.xyz[imoment] + 3, xyz);
+      integral.reset(shell_type0, shell_type1, r0, r1);
+      for (size_t k=0; k < prims.size(); k++) {
+        const long iprim0 = prims[k].iprim0;
+        const long iprim1 = prims[k].iprim1;
+        integral.add(obasis->con_coeffs[iprim0]*obasis->con_coeffs[iprim1],
+                     obasis->alphas[iprim0], obasis->alphas[iprim1],
+                     obasis->get_scales(iprim0), obasis->get_scales(iprim1));
+      }
+      integral.cart_to_pure();
+      output[imoment] = dot_block(integral.get_work(), dm, obasis->get_nbasis(),
+                                  obasis->get_basis_offsets()[ishell0],
+                                  obasis->get_basis_offsets()[ishell1],
+                                  get_shell_nbasis(shell_type0),
+                                  get_shell_nbasis(shell_type1));
+    }
+  }
+
+ private:
+  GOBasis* obasis;
+  const double* dm;
+  long xyz[3] = {0, 0, 0};
+  double center[3] = {0.0, 0.0, 0.0};
+  GB2MomentIntegral integral;
+};
+
+
+//! Direct evaluation of the potential of some primitive pairs of a shell pair.
+double direct_potential(GOBasis* obasis, const double* dm, GB2DMGridHartreeFn* grid_fn,
+                        const ESPShellPair& pair, const double* point, double d) {
+  const long shell_type0 = obasis->shell_types[pair.ishell0];
+  const long shell_type1 = obasis->shell_types[pair.ishell1];
+  grid_fn->reset(shell_type0, shell_type1,
+                 obasis->centers + 3*obasis->shell_map[pair.ishell0],
+                 obasis->centers + 3*obasis->shell_map[pair.ishell1], point);
+  for (size_t k=0; k < pair.prims.size(); k++) {
+    // Only primitive pairs whose extent reaches the grid point are included.
+    if (pair.prims[k].extent < d) continue;
+    const long iprim0 = pair.prims[k].iprim0;
+    const long iprim1 = pair.prims[k].iprim1;
+    grid_fn->add(obasis->con_coeffs[iprim0]*obasis->con_coeffs[iprim1],
+                 obasis->alphas[iprim0], obasis->alphas[iprim1],
+                 obasis->get_scales(iprim0), obasis->get_scales(iprim1));
+  }
+  grid_fn->cart_to_pure();
+  return dot_block(grid_fn->get_work(), dm, obasis->get_nbasis(),
+                   obasis->get_basis_offsets()[pair.ishell0],
+                   obasis->get_basis_offsets()[pair.ishell1],
+                   get_shell_nbasis(shell_type0), get_shell_nbasis(shell_type1));
+}
+
+}  // namespace
+
+
+void compute_grid_hartree_screened(GOBasis* obasis, const double* dm, long npoint,
+                                   const double* points, double* output, double threshold,
+                                   long nthread) {
+  if (nthread < 1) {
+    throw std::domain_error("The number of threads must be strictly positive.");
+  }
+  if (threshold <= 0) {
+    throw std::domain_error("The screening threshold must be strictly positive.");
+  }
+  const long nbasis = obasis->get_nbasis();
+  const long max_shell_type = obasis->get_max_shell_type();
+  const long* basis_offsets = obasis->get_basis_offsets();
+  const long* prim_offsets = obasis->get_prim_offsets();
+
+  // A) For every pure function, the sum of the absolute values of its coefficients in
+  //    terms of Cartesian functions. This bounds the pure functions in terms of the
+  //    Cartesian ones.
+  std::vector<std::vector<double> > pure_factors(max_shell_type + 1);
+  for (long l=0; l <= max_shell_type; l++) {
+    long ncart = get_shell_nbasis(l);
+    pure_factors[l].assign(2*l + 1, 0.0);
+    std::vector<double> cart(ncart), pure(2*l + 1);
+    for (long icart=0; icart < ncart; icart++) {
+      std::fill(cart.begin(), cart.end(), 0.0);
+      cart[icart] = 1.0;
+      cart_to_pure_low(&cart[0], &pure[0], l, 1, 1);
+      for (long ipure=0; ipure <= 2*l; ipure++) pure_factors[l][ipure] += fabs(pure[ipure]);
+    }
+  }
+
+  // B) Select the significant primitive pairs of each shell pair, estimate their
+  //    extents and compute the multipole moments.
+  std::vector<ESPGroup> groups(obasis->ncenter);
+  // Extents and moments of the primitive pairs of one-center shell pairs, per atom.
+  std::vector<std::vector<std::pair<double, long> > > local_order(obasis->ncenter);
+  std::vector<std::vector<double> > local_prim_moments(obasis->ncenter);
+  PairMoments pair_moments(obasis, dm);
+  for (long icenter=0; icenter < obasis->ncenter; icenter++) {
+    std::copy(obasis->centers + 3*icenter, obasis->centers + 3*icenter + 3,
+              groups[icenter].center);
+  }
+  for (long ishell0=0; ishell0 < obasis->nshell; ishell0++) {
+    const long shell_type0 = obasis->shell_types[ishell0];
+    const long l0 = abs(shell_type0);
+    const long n0 = get_shell_nbasis(shell_type0);
+    const long ibasis0 = basis_offsets[ishell0];
+    const long icenter0 = obasis->shell_map[ishell0];
+    const double* r0 = obasis->centers + 3*icenter0;
+    for (long ishell1=0; ishell1 <= ishell0; ishell1++) {
+      const long shell_type1 = obasis->shell_types[ishell1];
+      const long l1 = abs(shell_type1);
+      const long n1 = get_shell_nbasis(shell_type1);
+      const long ibasis1 = basis_offsets[ishell1];
+      const long icenter1 = obasis->shell_map[ishell1];
+      const double* r1 = obasis->centers + 3*icenter1;
+
+      // Weight of the density matrix block, such that the absolute value of the
+      // pair density is bounded by this weight times the product of the largest
+      // Cartesian primitives.
+      double weight = 0.0;
+      for (long i0=0; i0 < n0; i0++) {
+        for (long i1=0; i1 < n1; i1++) {
+          double d = dm[(ibasis0 + i0)*nbasis + ibasis1 + i1];
+          if (ibasis0 != ibasis1) d += dm[(ibasis1 + i1)*nbasis + ibasis0 + i0];
+          double f0 = (shell_type0 < 0) ? pure_factors[l0][i0] : 1.0;
+          double f1 = (shell_type1 < 0) ? pure_factors[l1][i1] : 1.0;
+          weight += fabs(d)*f0*f1;
+        }
+      }
+      if (weight == 0.0) continue;
+
+      // Estimate the absolute charge of each primitive pair and keep those whose
+      // potential can exceed the threshold somewhere.
+      ESPShellPair pair;
+      pair.ishell0 = ishell0;
+      pair.ishell1 = ishell1;
+      double total_charge = 0.0;
+      std::fill(pair.center, pair.center + 3, 0.0);
+      std::vector<double> charges, gammas, gpt_centers;
+      const double r01_sq = dist_sq(r0, r1);
+      const long end0 = prim_offsets[ishell0] + obasis->nprims[ishell0];
+      const long end1 = prim_offsets[ishell1] + obasis->nprims[ishell1];
+      for (long iprim0=prim_offsets[ishell0]; iprim0 < end0; iprim0++) {
+        const double alpha0 = obasis->alphas[iprim0];
+        const double* scales0 = obasis->get_scales(iprim0);
+        const double scale0 = *std::max_element(scales0, scales0 + get_shell_nbasis(l0));
+        for (long iprim1=prim_offsets[ishell1]; iprim1 < end1; iprim1++) {
+          const double alpha1 = obasis->alphas[iprim1];
+          const double* scales1 = obasis->get_scales(iprim1);
+          const double scale1 = *std::max_element(scales1, scales1 + get_shell_nbasis(l1));
+          const double gamma = alpha0 + alpha1;
+          const double gamma_inv = 1.0/gamma;
+          double gpt_center[3];
+          compute_gpt_center(alpha0, r0, alpha1, r1, gamma_inv, gpt_center);
+          const double q = sqrt((l0 + l1 + 1)*gamma_inv);
+          double charge = weight*fabs(obasis->con_coeffs[iprim0]*obasis->con_coeffs[iprim1])*
+                          scale0*scale1*pow(M_PI*gamma_inv, 1.5)*
+                          exp(-alpha0*alpha1*gamma_inv*r01_sq)*
+                          pow(sqrt(dist_sq(gpt_center, r0)) + q, l0)*
+                          pow(sqrt(dist_sq(gpt_center, r1)) + q, l1);
+          // The potential of a Gaussian charge distribution is the largest in its
+          // center.
+          if (2*sqrt(gamma/M_PI)*charge < threshold) continue;
+          ESPPrimPair prim = {iprim0, iprim1, tail_extent(charge, gamma, l0 + l1, threshold)};
+          pair.prims.push_back(prim);
+          charges.push_back(charge);
+          gammas.push_back(gamma);
+          gpt_centers.insert(gpt_centers.end(), gpt_center, gpt_center + 3);
+          total_charge += charge;
+          for (long i=0; i < 3; i++) pair.center[i] += charge*gpt_center[i];
+        }
+      }
+      if (pair.prims.size() == 0) continue;
+
+      if ((icenter0 == icenter1) && (l0 + l1 <= ESP_MULTIPOLE_ORDER)) {
+        // A one-center pair: every primitive pair is a polynomial of degree l0 + l1
+        // times a spherical Gaussian around the atom. Its multipole expansion around
+        // the atom is exact beyond the extent of the Gaussian tail.
+        ESPGroup& group = groups[icenter0];
+        std::copy(r0, r0 + 3, pair.center);
+        pair.extent = 0.0;
+        std::vector<ESPPrimPair> prims(1);
+        for (size_t k=0; k < pair.prims.size(); k++) {
+          pair.extent = std::max(pair.extent, pair.prims[k].extent);
+          prims[0] = pair.prims[k];
+          std::vector<double>& moments = local_prim_moments[icenter0];
+          local_order[icenter0].push_back(std::make_pair(prims[0].extent,
+                                                         moments.size()/ESP_NMOMENT));
+          moments.resize(moments.size() + ESP_NMOMENT);
+          pair_moments.compute(ishell0, ishell1, prims, r0,
+                               &moments[moments.size() - ESP_NMOMENT]);
+        }
+        group.local_pairs.push_back(pair);
+        continue;
+      }
+
+      // Any other pair is expanded around the charge-weighted average of the Gaussian
+      // product centers. It is assigned to the nearest of both atoms.
+      for (long i=0; i < 3; i++) pair.center[i] /= total_charge;
+      const long nprim = pair.prims.size();
+      std::vector<std::pair<double, long> > order(nprim);
+      std::vector<double> spreads(nprim);
+      for (long k=0; k < nprim; k++) {
+        double offset = sqrt(dist_sq(&gpt_centers[3*k], pair.center));
+        pair.prims[k].extent += offset;
+        // Each primitive pair has no multipole moments beyond order l0 + l1 around
+        // its own center.
+        spreads[k] = offset + sqrt((l0 + l1)/(2*gammas[k]));
+        order[k] = std::make_pair(pair.prims[k].extent, k);
+      }
+      std::sort(order.begin(), order.end(), std::greater<std::pair<double, long> >());
+      std::vector<ESPPrimPair> unsorted_prims(pair.prims);
+      pair.spreads.assign(nprim + 1, 0.0);
+      pair.charges.assign(nprim + 1, 0.0);
+      pair.moments.assign((nprim + 1)*ESP_NMOMENT, 0.0);
+      std::vector<ESPPrimPair> prims(1);
+      double moments[ESP_NMOMENT];
+      for (long k=nprim-1; k >= 0; k--) {
+        const long kold = order[k].second;
+        pair.prims[k] = unsorted_prims[kold];
+        pair.spreads[k] = std::max(pair.spreads[k + 1], spreads[kold]);
+        pair.charges[k] = pair.charges[k + 1] + charges[kold];
+        prims[0] = pair.prims[k];
+        pair_moments.compute(ishell0, ishell1, prims, pair.center, moments);
+        for (long imoment=0; imoment < ESP_NMOMENT; imoment++) {
+          pair.moments[k*ESP_NMOMENT + imoment] =
+              pair.moments[(k + 1)*ESP_NMOMENT + imoment] + moments[imoment];
+        }
+      }
+      pair.extent = pair.prims[0].extent;
+      long icenter = icenter0;
+      if (dist_sq(pair.center, r1) < dist_sq(pair.center, r0)) icenter = icenter1;
+      groups[icenter].pairs.push_back(pair);
+    }
+  }
+
+  // C) Sort the primitive pairs of the one-center shell pairs by decreasing extent and
+  //    add their moments from the back. Then combine all multipole expansions of a
+  //    group.
+  for (long icenter=0; icenter < obasis->ncenter; icenter++) {
+    ESPGroup& group = groups[icenter];
+    std::vector<std::pair<double, long> >& order = local_order[icenter];
+    std::sort(order.begin(), order.end(), std::greater<std::pair<double, long> >());
+    const long nlocal = order.size();
+    group.local_extents.resize(nlocal);
+    group.local_moments.assign((nlocal + 1)*ESP_NMOMENT, 0.0);
+    for (long ilocal=nlocal-1; ilocal >= 0; ilocal--) {
+      group.local_extents[ilocal] = order[ilocal].first;
+      const double* moments = &local_prim_moments[icenter][order[ilocal].second*ESP_NMOMENT];
+      for (long imoment=0; imoment < ESP_NMOMENT; imoment++) {
+        group.local_moments[ilocal*ESP_NMOMENT + imoment] =
+            group.local_moments[(ilocal + 1)*ESP_NMOMENT + imoment] + moments[imoment];
+      }
+    }
+    group.extent = (nlocal > 0) ? group.local_extents[0] : 0.0;
+    group.spread = 0.0;
+    group.charge = 0.0;
+    std::copy(&group.local_moments[0], &group.local_moments[0] + ESP_NMOMENT, group.moments);
+    for (size_t ipair=0; ipair < group.pairs.size(); ipair++) {
+      ESPShellPair& pair = group.pairs[ipair];
+      translate_moments(&pair.moments[0], pair.center, group.center, group.moments);
+      double offset = sqrt(dist_sq(pair.center, group.center));
+      group.extent = std::max(group.extent, offset + pair.extent);
+      group.spread = std::max(group.spread, offset + pair.spreads[0]);
+      group.charge += pair.charges[0];
+      for (size_t i=0; i < pair.moments.size(); i++) {
+        pair.moments[i] *= moment_table.prefactor[i % ESP_NMOMENT];
+      }
+    }
+    for (long imoment=0; imoment < ESP_NMOMENT; imoment++) {
+      group.moments[imoment] *= moment_table.prefactor[imoment];
+      for (long ilocal=0; ilocal < nlocal; ilocal++) {
+        group.local_moments[ilocal*ESP_NMOMENT + imoment] *= moment_table.prefactor[imoment];
+      }
+    }
+  }
+
+  // D) Evaluate the potential. Blocks of grid points are distributed statically over
+  //    the threads. Each point is computed by one thread, always in the same order.
+  const long nblock_total = (npoint + GB1_BLOCK_SIZE - 1)/GB1_BLOCK_SIZE;
+  run_in_threads(nthread, [&](long ithread) {
+    GB2DMGridHartreeFn grid_fn = GB2DMGridHartreeFn(max_shell_type);
+    for (long iblock=ithread; iblock < nblock_total; iblock += nthread) {
+      long end = std::min((iblock + 1)*GB1_BLOCK_SIZE, npoint);
+      for (long ipoint=iblock*GB1_BLOCK_SIZE; ipoint < end; ipoint++) {
+        const double* point = points + 3*ipoint;
+        double result = 0.0;
+        for (size_t igroup=0; igroup < groups.size(); igroup++) {
+          const ESPGroup& group = groups[igroup];
+          if (group.local_pairs.empty() && group.pairs.empty()) continue;
+          double d = sqrt(dist_sq(group.center, point));
+          if ((d > group.extent) &&
+              truncation_ok(d, group.spread, group.charge, threshold)) {
+            result += multipole_potential(group.moments, group.center, point);
+            continue;
+          }
+          // One-center pairs: the primitive pairs whose extent does not reach the
+          // point are included in one multipole expansion.
+          const std::vector<double>& extents = group.local_extents;
+          long nlocal = extents.size();
+          long ncut = std::upper_bound(extents.begin(), extents.end(), d,
+                                       std::greater<double>()) - extents.begin();
+          if (ncut < nlocal) {
+            result += multipole_potential(&group.local_moments[ncut*ESP_NMOMENT],
+                                          group.center, point);
+          }
+          for (size_t ipair=0; (ncut > 0) && (ipair < group.local_pairs.size()); ipair++) {
+            const ESPShellPair& pair = group.local_pairs[ipair];
+            if (pair.extent < d) continue;
+            result += direct_potential(obasis, dm, &grid_fn, pair, point, d);
+          }
+          // Other pairs: the primitive pairs whose extent does not reach the point are
+          // included in a multipole expansion, when its truncation error is small.
+          for (size_t ipair=0; ipair < group.pairs.size(); ipair++) {
+            const ESPShellPair& pair = group.pairs[ipair];
+            double d_pair = sqrt(dist_sq(pair.center, point));
+            const long nprim = pair.prims.size();
+            long ncut = 0;
+            while ((ncut < nprim) && (pair.prims[ncut].extent >= d_pair)) ncut++;
+            if ((ncut < nprim) &&
+                truncation_ok(d_pair, pair.spreads[ncut], pair.charges[ncut], threshold)) {
+              result += multipole_potential(&pair.moments[ncut*ESP_NMOMENT], pair.center,
+                                            point);
+              if (ncut > 0) {
+                result += direct_potential(obasis, dm, &grid_fn, pair, point, d_pair);
+              }
+            } else {
+              result += direct_potential(obasis, dm, &grid_fn, pair, point, 0.0);
+            }
+          }
+        }
+        output[ipoint] += result;
+      }
+    }
+  });
+}
+
+
+namespace {
+
+/*
+    Terms in the Taylor expansion around an atom A of the potential of a multipole
+    expansion around a cell center C. With moments N_n = sum_c q_c (R_c - C)^n:
+        sum_c q_c d^m/dA^m 1/|R_c - A|
+            = sum_n N_n/n! d^(m+n)/dx^(m+n) 1/|x| at x = C - A
+    All terms up to a total order ESP_MULTIPOLE_ORDER are included.
+*/
+struct TranslationTable {
+  std::vector<long> im, in, imn;
+  std::vector<double> factor;
+
+  TranslationTable() {
+    for (long imoment=0; imoment < ESP_NMOMENT; imoment++) {
+      const long* m = moment_table.xyz[imoment];
+      for (long jmoment=0; jmoment < ESP_NMOMENT; jmoment++) {
+        const long* n = moment_table.xyz[jmoment];
+        if (m[0] + m[1] + m[2] + n[0] + n[1] + n[2] > ESP_MULTIPOLE_ORDER) continue;
+        long kmoment = 0;
+        while ((moment_table.xyz[kmoment][0] != m[0] + n[0]) ||
+               (moment_table.xyz[kmoment][1] != m[1] + n[1]) ||
+               (moment_table.xyz[kmoment][2] != m[2] + n[2])) {
+          kmoment++;
+        }
+        im.push_back(imoment);
+        in.push_back(jmoment);
+        imn.push_back(kmoment);
+        factor.push_back(fabs(moment_table.prefactor[jmoment]));
+      }
+    }
+  }
+};
+
+const TranslationTable translation_table;
+
+
+//! Largest sum of absolute coefficients of a pure function in Cartesian functions.
+double pure_factor(long shell_type) {
+  if (shell_type >= -1) return 1.0;
+  const long l = -shell_type;
+  const long ncart = get_shell_nbasis(l);
+  std::vector<double> cart(ncart*ncart, 0.0), pure((2*l + 1)*ncart);
+  for (long icart=0; icart < ncart; icart++) cart[icart*ncart + icart] = 1.0;
+  cart_to_pure_low(&cart[0], &pure[0], l, 1, ncart);
+  double result = 0.0;
+  for (long ipure=0; ipure <= 2*l; ipure++) {
+    double total = 0.0;
+    for (long icart=0; icart < ncart; icart++) total += fabs(pure[ipure*ncart + icart]);
+    result = std::max(result, total);
+  }
+  return result;
+}
+
+}  // namespace
+
+
+ScreenedAttraction::ScreenedAttraction(GOBasis* obasis, const double* centers,
+                                       long ncharge, double threshold, double cell_size)
+    : obasis(obasis), ncharge(ncharge), threshold(threshold),
+      centers(centers, centers + 3*ncharge),
+      basis_centers(obasis->centers, obasis->centers + 3*obasis->ncenter), nexact(0) {
+  if (ncharge < 0) {
+    throw std::domain_error("The number of charges can not be negative.");
+  }
+  if (threshold <= 0) {
+    throw std::domain_error("The screening threshold must be strictly positive.");
+  }
+  if (cell_size <= 0) {
+    throw std::domain_error("The cell size must be strictly positive.");
+  }
+  obasis->init_shell_pairs();
+  const long nshell = obasis->nshell;
+  const long max_shell_type = obasis->get_max_shell_type();
+
+  // A) Sort the point charges by cell. Each cell is centered at the average position
+  //    of its point charges.
+  std::vector<std::pair<std::array<long, 3>, long> > keys(ncharge);
+  for (long icharge=0; icharge < ncharge; icharge++) {
+    for (long i=0; i < 3; i++) {
+      keys[icharge].first[i] = static_cast<long>(floor(centers[3*icharge + i]/cell_size));
+    }
+    keys[icharge].second = icharge;
+  }
+  std::sort(keys.begin(), keys.end());
+  for (long icharge=0; icharge < ncharge; icharge++) {
+    if ((icharge == 0) || (keys[icharge].first != keys[icharge - 1].first)) {
+      cell_offsets.push_back(icharge);
+    }
+    cell_charges.push_back(keys[icharge].second);
+  }
+  cell_offsets.push_back(ncharge);
+  const long ncell = cell_offsets.size() - 1;
+  cell_centers.assign(3*ncell, 0.0);
+  cell_radii.assign(ncell, 0.0);
+  for (long icell=0; icell < ncell; icell++) {
+    double* center = &cell_centers[3*icell];
+    for (long k=cell_offsets[icell]; k < cell_offsets[icell + 1]; k++) {
+      for (long i=0; i < 3; i++) center[i] += centers[3*cell_charges[k] + i];
+    }
+    for (long i=0; i < 3; i++) center[i] /= cell_offsets[icell + 1] - cell_offsets[icell];
+    for (long k=cell_offsets[icell]; k < cell_offsets[icell + 1]; k++) {
+      cell_radii[icell] = std::max(cell_radii[icell],
+                                   sqrt(dist_sq(center, &centers[3*cell_charges[k]])));
+    }
+  }
+
+  // B) Square roots of the largest diagonal overlap integral of each shell. Due to the
+  //    Cauchy-Schwarz inequality, the product of two such numbers bounds the absolute
+  //    charge of all products of basis functions of two shells.
+  std::vector<double> shell_norms(nshell);
+  GB2OverlapIntegral overlap = GB2OverlapIntegral(max_shell_type);
+  for (long ishell=0; ishell < nshell; ishell++) {
+    const long shell_type = obasis->shell_types[ishell];
+    const double* r = obasis->centers + 3*obasis->shell_map[ishell];
+    overlap.reset(shell_type, shell_type, r, r);
+    const prim_pair_t* pairs = obasis->get_prim_pairs(ishell, ishell, NULL);
+    for (long ipair=0; ipair < obasis->nprims[ishell]*obasis->nprims[ishell]; ipair++) {
+      overlap.add_pair(pairs + ipair);
+    }
+    overlap.cart_to_pure();
+    const long n = get_shell_nbasis(shell_type);
+    double largest = 0.0;
+    for (long i=0; i < n; i++) largest = std::max(largest, overlap.get_work()[i*n + i]);
+    shell_norms[ishell] = sqrt(largest);
+  }
+
+  // C) Assign every shell pair to the nearest of both atoms and estimate the extent,
+  //    the spread and the absolute charge of its primitive pairs around that atom, as
+  //    for the Hartree potential.
+  groups.resize(obasis->ncenter);
+  for (long icenter=0; icenter < obasis->ncenter; icenter++) {
+    Group& group = groups[icenter];
+    std::copy(obasis->centers + 3*icenter, obasis->centers + 3*icenter + 3, group.center);
+    group.extent = 0.0;
+    group.spread = 0.0;
+    group.charge = 0.0;
+  }
+  long xyz[3] = {0, 0, 0};
+  double origin[3] = {0.0, 0.0, 0.0};
+  GB2MomentIntegral integral = GB2MomentIntegral(max_shell_type, xyz, origin);
+  for (long ishell0=0; ishell0 < nshell; ishell0++) {
+    const long shell_type0 = obasis->shell_types[ishell0];
+    const long l0 = abs(shell_type0);
+    const double* r0 = obasis->centers + 3*obasis->shell_map[ishell0];
+    for (long ishell1=0; ishell1 <= ishell0; ishell1++) {
+      if (obasis->get_shell_pair_magnitudes()[ishell0*nshell + ishell1] == 0) continue;
+      const long shell_type1 = obasis->shell_types[ishell1];
+      const long l1 = abs(shell_type1);
+      const double* r1 = obasis->centers + 3*obasis->shell_map[ishell1];
+      const prim_pair_t* pairs = obasis->get_prim_pairs(ishell0, ishell1, NULL);
+      const long npair = obasis->nprims[ishell0]*obasis->nprims[ishell1];
+
+      // Absolute charges of the primitive pairs and their weighted average center.
+      std::vector<double> charges(npair);
+      double total_charge = 0.0;
+      double center[3] = {0.0, 0.0, 0.0};
+      const double factor = pure_factor(shell_type0)*pure_factor(shell_type1);
+      for (long ipair=0; ipair < npair; ipair++) {
+        const prim_pair_t* pair = pairs + ipair;
+        const double scale0 = *std::max_element(pair->scales0,
+                                                pair->scales0 + get_shell_nbasis(l0));
+        const double scale1 = *std::max_element(pair->scales1,
+                                                pair->scales1 + get_shell_nbasis(l1));
+        const double q = sqrt((l0 + l1 + 1)*pair->gamma_inv);
+        charges[ipair] = factor*fabs(pair->coeff)*pair->prefac*scale0*scale1*
+                         pow(M_PI*pair->gamma_inv, 1.5)*
+                         pow(sqrt(dist_sq(pair->gpt_center, r0)) + q, l0)*
+                         pow(sqrt(dist_sq(pair->gpt_center, r1)) + q, l1);
+        total_charge += charges[ipair];
+        for (long i=0; i < 3; i++) center[i] += charges[ipair]*pair->gpt_center[i];
+      }
+      if (total_charge == 0.0) continue;
+      for (long i=0; i < 3; i++) center[i] /= total_charge;
+      long icenter = obasis->shell_map[ishell0];
+      if (dist_sq(center, r1) < dist_sq(center, r0)) icenter = obasis->shell_map[ishell1];
+      Group& group = groups[icenter];
+      for (long ipair=0; ipair < npair; ipair++) {
+        const prim_pair_t* pair = pairs + ipair;
+        const double offset = sqrt(dist_sq(pair->gpt_center, group.center));
+        group.extent = std::max(group.extent, offset +
+            tail_extent(charges[ipair], 1.0/pair->gamma_inv, l0 + l1, threshold));
+        group.spread = std::max(group.spread, offset +
+            sqrt(0.5*(l0 + l1)*pair->gamma_inv));
+      }
+      group.charge = std::max(group.charge, shell_norms[ishell0]*shell_norms[ishell1]);
+
+      // Moment integrals around the atom.
+      const long n0 = get_shell_nbasis(shell_type0);
+      const long n1 = get_shell_nbasis(shell_type1);
+      group.shell_pairs.push_back(ishell0);
+      group.shell_pairs.push_back(ishell1);
+      group.offsets.push_back(moments.size());
+      std::copy(group.center, group.center + 3, origin);
+      for (long imoment=0; imoment < ESP_NMOMENT; imoment++) {
+        std::copy(moment_table.xyz[imoment], moment_table.xyz[imoment] + 3, xyz);
+        integral.reset(shell_type0, shell_type1, r0, r1);
+        for (long ipair=0; ipair < npair; ipair++) {
+          integral.add_pair(pairs + ipair);
+        }
+        integral.cart_to_pure();
+        const double* work = integral.get_work();
+        for (long i=0; i < n0*n1; i++) {
+          moments.push_back(moment_table.prefactor[imoment]*work[i]);
+        }
+      }
+    }
+  }
+}
+
+
+void ScreenedAttraction::compute(const double* charges, double* output, long nthread) {
+  if (nthread < 1) {
+    throw std::domain_error("The number of threads must be strictly positive.");
+  }
+  // The shell pairs are assigned to the atoms at their original positions.
+  if (!std::equal(basis_centers.begin(), basis_centers.end(), obasis->centers)) {
+    throw std::domain_error("The centers of the orbital basis have changed.");
+  }
+  obasis->init_shell_pairs();
+  const long nbasis = obasis->get_nbasis();
+  const long max_shell_type = obasis->get_max_shell_type();
+  const long* basis_offsets = obasis->get_basis_offsets();
+  std::fill(output, output + nbasis*nbasis, 0.0);
+
+  // A) Multipole moments and absolute charges of the cells.
+  const long ncell = cell_radii.size();
+  std::vector<double> cell_moments(ncell*ESP_NMOMENT, 0.0);
+  std::vector<double> cell_abs_charges(ncell, 0.0);
+  for (long icell=0; icell < ncell; icell++) {
+    const double* center = &cell_centers[3*icell];
+    double* cell_moment = &cell_moments[icell*ESP_NMOMENT];
+    for (long k=cell_offsets[icell]; k < cell_offsets[icell + 1]; k++) {
+      const long icharge = cell_charges[k];
+      const double q = charges[icharge];
+      cell_abs_charges[icell] += fabs(q);
+      double powers[3][ESP_MULTIPOLE_ORDER + 1];
+      for (long i=0; i < 3; i++) {
+        powers[i][0] = 1.0;
+        for (long n=1; n <= ESP_MULTIPOLE_ORDER; n++) {
+          powers[i][n] = powers[i][n - 1]*(centers[3*icharge + i] - center[i]);
+        }
+      }
+      for (long imoment=0; imoment < ESP_NMOMENT; imoment++) {
+        const long* n = moment_table.xyz[imoment];
+        cell_moment[imoment] += q*powers[0][n[0]]*powers[1][n[1]]*powers[2][n[2]];
+      }
+    }
+  }
+
+  // B) Every group is handled by one thread. The groups write disjoint blocks of the
+  //    output, such that the result does not depend on the number of threads.
+  const long ngroup = groups.size();
+  std::vector<long> nexacts(nthread, 0);
+  std::atomic<long> next_group(0);
+  run_in_threads(nthread, [&](long ithread) {
+    std::vector<double> exact_charges, exact_centers, block;
+    long igroup;
+    while ((igroup = next_group++) < ngroup) {
+      const Group& group = groups[igroup];
+      if (group.shell_pairs.empty()) continue;
+
+      // Derivatives of the potential of the distant point charges at the atom, and the
+      // point charges that must be treated exactly.
+      double taylor[ESP_NMOMENT] = {0.0};
+      double deriv[ESP_NMOMENT];
+      exact_charges.clear();
+      exact_centers.clear();
+      for (long icell=0; icell < ncell; icell++) {
+        const double* center = &cell_centers[3*icell];
+        const double d = sqrt(dist_sq(center, group.center));
+        const double radius = cell_radii[icell];
+        if ((d > group.extent + radius) &&
+            truncation_ok(d, group.spread + radius,
+                          group.charge*cell_abs_charges[icell], threshold)) {
+          const double delta[3] = {center[0] - group.center[0],
+                                   center[1] - group.center[1],
+                                   center[2] - group.center[2]};
+          coulomb_derivatives(delta, deriv);
+          const double* cell_moment = &cell_moments[icell*ESP_NMOMENT];
+          for (size_t k=0; k < translation_table.im.size(); k++) {
+            taylor[translation_table.im[k]] += translation_table.factor[k]*
+                                               cell_moment[translation_table.in[k]]*
+                                               deriv[translation_table.imn[k]];
+          }
+          continue;
+        }
+        for (long k=cell_offsets[icell]; k < cell_offsets[icell + 1]; k++) {
+          const long icharge = cell_charges[k];
+          const double q = charges[icharge];
+          if (q == 0.0) continue;
+          const double* r = &centers[3*icharge];
+          const double d_charge = sqrt(dist_sq(r, group.center));
+          if ((d_charge > group.extent) &&
+              truncation_ok(d_charge, group.spread, group.charge*fabs(q), threshold)) {
+            const double delta[3] = {r[0] - group.center[0], r[1] - group.center[1],
+                                     r[2] - group.center[2]};
+            coulomb_derivatives(delta, deriv);
+            for (long imoment=0; imoment < ESP_NMOMENT; imoment++) {
+              taylor[imoment] += q*deriv[imoment];
+            }
+          } else {
+            exact_charges.push_back(q);
+            exact_centers.insert(exact_centers.end(), r, r + 3);
+          }
+        }
+      }
+      const long nexact_group = exact_charges.size();
+      nexacts[ithread] += nexact_group;
+      GB2NuclearAttractionIntegral integral = GB2NuclearAttractionIntegral(
+          max_shell_type, (nexact_group > 0) ? &exact_charges[0] : NULL,
+          (nexact_group > 0) ? &exact_centers[0] : NULL, nexact_group);
+
+      // Contract the Taylor expansion with the moment integrals and add the exact
+      // contributions.
+      for (size_t ipair=0; ipair < group.offsets.size(); ipair++) {
+        const long ishell0 = group.shell_pairs[2*ipair];
+        const long ishell1 = group.shell_pairs[2*ipair + 1];
+        const long shell_type0 = obasis->shell_types[ishell0];
+        const long shell_type1 = obasis->shell_types[ishell1];
+        const long n0 = get_shell_nbasis(shell_type0);
+        const long n1 = get_shell_nbasis(shell_type1);
+        block.assign(n0*n1, 0.0);
+        const double* pair_moments = &moments[group.offsets[ipair]];
+        for (long imoment=0; imoment < ESP_NMOMENT; imoment++) {
+          for (long i=0; i < n0*n1; i++) {
+            block[i] -= taylor[imoment]*pair_moments[imoment*n0*n1 + i];
+          }
+        }
+        if (nexact_group > 0) {
+          integral.reset(shell_type0, shell_type1,
+                         obasis->centers + 3*obasis->shell_map[ishell0],
+                         obasis->centers + 3*obasis->shell_map[ishell1]);
+          const prim_pair_t* pairs = obasis->get_prim_pairs(ishell0, ishell1, NULL);
+          const long npair = obasis->nprims[ishell0]*obasis->nprims[ishell1];
+          for (long k=0; k < npair; k++) {
+            integral.add_pair(pairs + k);
+          }
+          integral.cart_to_pure();
+          const double* work = integral.get_work();
+          for (long i=0; i < n0*n1; i++) block[i] += work[i];
+        }
+        const long ibasis0 = basis_offsets[ishell0];
+        const long ibasis1 = basis_offsets[ishell1];
+        for (long i0=0; i0 < n0; i0++) {
+          for (long i1=0; i1 < n1; i1++) {
+            output[(ibasis0 + i0)*nbasis + ibasis1 + i1] = block[i0*n1 + i1];
+            output[(ibasis1 + i1)*nbasis + ibasis0 + i0] = block[i0*n1 + i1];
+          }
+        }
+      }
+    }
+  });
+  nexact = 0;
+  for (long ithread=0; ithread < nthread; ithread++) nexact += nexacts[ithread];
+}
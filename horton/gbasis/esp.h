@@ -0,0 +1,197 @@
+// HORTON: Helpful Open-source Research TOol for N-fermion systems.
+// Copyright (C) 2011-2017 The HORTON Development Team
+//
+// This file is part of HORTON.
+//
+// HORTON is free software; you can redistribute it and/or
+// modify it under the terms of the GNU General Public License
+// as published by the Free Software Foundation; either version 3
+// of the License, or (at your option) any later version.
+//
+// HORTON is distributed in the hope that it will be useful,
+// but WITHOUT ANY WARRANTY; without even the implied warranty of
+// MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+// GNU General Public License for more details.
+//
+// You should have received a copy of the GNU General Public License
+// along with this program; if not, see <http://www.gnu.org/licenses/>
+//
+//--
+
+
+// UPDATELIBDOCTITLE: Screened electrostatics with multipole expansions
+
+#ifndef HORTON_GBASIS_ESP_H_
+#define HORTON_GBASIS_ESP_H_
+
+#include <vector>
+#include "horton/gbasis/gbasis.h"
+
+//! The highest order of the Cartesian multipole expansions.
+#define ESP_MULTIPOLE_ORDER 4
+
+/*
+    The Hartree potential of a density matrix is a sum of contributions from shell
+    pairs. The screened evaluation uses three approximations, each of which may
+    introduce an error up to a given threshold:
+
+    1. Primitive pairs whose potential is everywhere smaller than the threshold (taking
+       into account the corresponding block of the density matrix) are neglected.
+
+    2. Shell pairs on a single atom, whose angular momenta add up to at most
+       ESP_MULTIPOLE_ORDER, have an exact multipole expansion around that atom. It is
+       used for all primitive pairs whose Gaussian tail does not reach the grid point.
+       The primitive pairs are sorted by extent such that this expansion is a suffix
+       sum, computed once for each atom.
+
+    3. The primitive pairs of other shell pairs are expanded in the same way around the
+       charge-weighted average of their Gaussian product centers. Shell pairs are also
+       grouped by their nearest atom. At grid points far from such a group, one
+       multipole expansion of the whole group is used.
+
+    The extent of a primitive pair follows from the decay of its Gaussian tail, as in
+    the continuous fast multipole method. A truncated multipole expansion at a distance
+    d from its center is only used when Q (R/d)^(L+1)/(d - R) is below the threshold,
+    where Q bounds the absolute charge, R is the spread of the charges that have
+    moments beyond order L and L is ESP_MULTIPOLE_ORDER.
+*/
+
+/** @brief
+        Adds the Hartree potential of a density matrix on a set of grid points, using
+        screening and multipole expansions.
+
+    @param obasis
+        The orbital basis.
+
+    @param dm
+        The density matrix, assumed to be symmetric, shape (nbasis, nbasis).
+
+    @param npoint
+        The number of grid points.
+
+    @param points
+        The Cartesian coordinates of the grid points, shape (npoint, 3).
+
+    @param output
+        The potential is added to this array, shape (npoint,).
+
+    @param threshold
+        The error allowed for each neglected primitive pair and each multipole
+        expansion. This must be strictly positive.
+
+    @param nthread
+        The number of threads. The result does not depend on the number of threads.
+ */
+void compute_grid_hartree_screened(GOBasis* obasis, const double* dm, long npoint,
+                                   const double* points, double* output, double threshold,
+                                   long nthread);
+
+
+/*
+    The attraction integrals of many point charges, e.g. the environment in a QM/MM
+    calculation, are computed with the same multipole expansions. The shell pairs are
+    grouped per atom and their multipole moment integrals around that atom are computed
+    once. The point charges are put in cubic cells. For every group, the interaction
+    with one cell is treated in one of three ways, in order of preference:
+
+    1. The multipole expansion of the cell is translated to a Taylor expansion of its
+       potential around the atom, which is contracted with the moment integrals. The
+       expansion is truncated at a total order of ESP_MULTIPOLE_ORDER.
+
+    2. Each point charge in the cell is expanded around the atom separately.
+
+    3. Point charges within the extent of the Gaussian tails, or too close to the atom
+       for the multipole expansion, are treated exactly.
+
+    Only the positions of the point charges are fixed when the object is created. The
+    charges are given every time the integrals are computed and the choices above
+    are made with these charges. The error estimates are the same as for the Hartree
+    potential, with R the sum of the spreads of the group and the cell.
+*/
+
+/** @brief
+        Screened nuclear attraction integrals for many point charges at fixed positions.
+  */
+class ScreenedAttraction {
+ public:
+  /** @brief
+          Prepare the screened evaluation of the attraction integrals.
+
+      @param obasis
+          The orbital basis, which must outlive this object. Its centers may not
+          change afterwards.
+
+      @param centers
+          The positions of the point charges, shape (ncharge, 3).
+
+      @param ncharge
+          The number of point charges.
+
+      @param threshold
+          The error allowed for each multipole expansion. This must be strictly
+          positive.
+
+      @param cell_size
+          The edge of the cubic cells in which the point charges are grouped. This must
+          be strictly positive.
+    */
+  ScreenedAttraction(GOBasis* obasis, const double* centers, long ncharge,
+                     double threshold, double cell_size);
+
+  /** @brief
+          Compute the attraction integrals, with the same conventions as
+          GOBasis::compute_nuclear_attraction.
+
+      @param charges
+          The values of the point charges, shape (ncharge,).
+
+      @param output
+          The integrals are written to this array, shape (nbasis, nbasis).
+
+      @param nthread
+          The number of threads. The result does not depend on the number of threads.
+
+      An exception is thrown when the centers of the orbital basis have changed since
+      this object was created.
+    */
+  void compute(const double* charges, double* output, long nthread);
+
+  //! The number of point charges.
+  long get_ncharge() const { return ncharge; }
+
+  //! The number of cells that contain point charges.
+  long get_ncell() const { return cell_radii.size(); }
+
+  /** @brief
+          The number of combinations of an atom and a point charge that were treated
+          exactly in the last call to compute.
+    */
+  long get_nexact() const { return nexact; }
+
+ private:
+  //! Shell pairs assigned to one atom.
+  struct Group {
+    double center[3];
+    double extent;  //!< Point charges closer than this are treated exactly.
+    double spread;  //!< Radius used to estimate the truncation error.
+    double charge;  //!< Upper bound for the absolute charge of one basis pair.
+    std::vector<long> shell_pairs;  //!< Pairs (ishell0, ishell1), with ishell1 <= ishell0.
+    std::vector<long> offsets;      //!< Positions of the moment integrals of each pair.
+  };
+
+  GOBasis* obasis;
+  long ncharge;
+  double threshold;
+  std::vector<double> centers;
+  std::vector<double> basis_centers;  //!< Centers of the orbital basis, shape (ncenter, 3).
+  std::vector<long> cell_offsets;  //!< Ranges in cell_charges for each cell.
+  std::vector<long> cell_charges;  //!< Indexes of the point charges, sorted by cell.
+  std::vector<double> cell_centers;
+  std::vector<double> cell_radii;
+  std::vector<Group> groups;
+  //! Moment integrals of each shell pair, shape (nmoment, n0, n1), with prefactors.
+  std::vector<double> moments;
+  long nexact;
+};
+
+#endif  // HORTON_GBASIS_ESP_H_
@@ -0,0 +1,32 @@
+# -*- coding: utf-8 -*-
+# HORTON: Helpful Open-source Research TOol for N-fermion systems.
+# Copyright (C) 2011-2017 The HORTON Development Team
+#
+# This file is part of HORTON.
+#
+# HORTON is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 3
+# of the License, or (at your option) any later version.
+#
+# HORTON is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, see <http://www.gnu.org/licenses/>
+#
+# --
+
+
+cimport gbasis
+
+cdef extern from "horton/gbasis/esp.h":
+    cdef cppclass ScreenedAttraction:
+        ScreenedAttraction(gbasis.GOBasis* obasis, double* centers, long ncharge,
+                           double threshold, double cell_size) except +
+        void compute(double* charges, double* output, long nthread) except +
+        long get_ncharge()
+        long get_ncell()
+        long get_nexact()
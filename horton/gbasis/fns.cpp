@@ -27,6 +27,7 @@
 #include <cstdlib>
 #include <cstring>
 #include <stdexcept>
+#include <vector>
 #include "horton/moments.h"
 #include "horton/gbasis/boys.h"
 #include "horton/gbasis/cartpure.h"
@@ -104,13 +105,14 @@ void GB1ExpGridOrbitalFn::add(double coeff, double alpha0, const double* scales0
 
 void GB1ExpGridOrbitalFn::compute_point_from_exp(double* work_basis, double* coeffs,
                                                  long nbasis, double* output) {
-  for (long i=0; i < norb; i++) {
-    long iorb = iorbs[i];
-    for (long ibasis=0; ibasis < nbasis; ibasis++) {
+  for (long ibasis=0; ibasis < nbasis; ibasis++) {
+    // Basis functions of shells that do not reach `point` are zero.
+    if (work_basis[ibasis] == 0.0) continue;
+    for (long i=0; i < norb; i++) {
       // Just evaluate the contribution of each basis function to an orbital.
       // The values of the basis functions at `point` (see reset method) are available in
       // work_basis.
-      output[i] += coeffs[ibasis*nfn + iorb]*work_basis[ibasis];
+      output[i] += coeffs[ibasis*nfn + iorbs[i]]*work_basis[ibasis];
     }
   }
 }
@@ -165,6 +167,9 @@ void GB1ExpGridOrbGradientFn::compute_point_from_exp(double* work_basis, double*
     double g_x = 0, g_y = 0, g_z = 0;
     long iorb = iorbs[i];
     for (long ibasis=0; ibasis < nbasis; ibasis++) {
+      // Basis functions of shells that do not reach the grid point are zero.
+      if (work_basis[ibasis*3+0] == 0.0 && work_basis[ibasis*3+1] == 0.0 &&
+          work_basis[ibasis*3+2] == 0.0) continue;
       g_x += coeffs[ibasis*nfn + iorb]*work_basis[ibasis*3+0];
       g_y += coeffs[ibasis*nfn + iorb]*work_basis[ibasis*3+1];
       g_z += coeffs[ibasis*nfn + iorb]*work_basis[ibasis*3+2];
@@ -176,6 +181,196 @@ void GB1ExpGridOrbGradientFn::compute_point_from_exp(double* work_basis, double*
 }
 
 
+/*
+    GB1DMGridFn
+*/
+
+// Number of rows of the 1RDM or the Fock matrix that are kept in cache by the block
+// kernels below.
+#define GB1_TILE_SIZE 32
+
+static void block_axpy(const double* factors, long stride, const double* x, long n,
+                       double* y) {
+  // y[i, :] += factors[i*stride]*x for i in 0, 1, 2, 3. Each element of x is loaded once
+  // for four rows of y.
+  double f0 = factors[0];
+  double f1 = factors[stride];
+  double f2 = factors[2*stride];
+  double f3 = factors[3*stride];
+  double* y0 = y;
+  double* y1 = y + n;
+  double* y2 = y + 2*n;
+  double* y3 = y + 3*n;
+  for (long i=0; i < n; i++) {
+    double tmp = x[i];
+    y0[i] += f0*tmp;
+    y1[i] += f1*tmp;
+    y2[i] += f2*tmp;
+    y3[i] += f3*tmp;
+  }
+}
+
+static void block_dm_product(const double* work, const double* dmt, long nbasis,
+                             long nblock, double* result) {
+  // result[ipoint, ibasis0] = sum_ibasis1 work[ipoint, ibasis1]*dmt[ibasis1, ibasis0]
+  // where dmt is the transpose of the 1RDM. A tile of rows of dmt is reused for all grid
+  // points in the block, and each row of dmt is used for four grid points at once.
+  memset(result, 0, nblock*nbasis*sizeof(double));
+  for (long tile0=0; tile0 < nbasis; tile0 += GB1_TILE_SIZE) {
+    long tile1 = tile0 + GB1_TILE_SIZE;
+    if (tile1 > nbasis) tile1 = nbasis;
+    long ipoint = 0;
+    for (; ipoint + 4 <= nblock; ipoint += 4) {
+      for (long ibasis1=tile0; ibasis1 < tile1; ibasis1++) {
+        block_axpy(work + ipoint*nbasis + ibasis1, nbasis, dmt + ibasis1*nbasis, nbasis,
+                   result + ipoint*nbasis);
+      }
+    }
+    for (; ipoint < nblock; ipoint++) {
+      double* row = result + ipoint*nbasis;
+      for (long ibasis1=tile0; ibasis1 < tile1; ibasis1++) {
+        double factor = work[ipoint*nbasis + ibasis1];
+        const double* dmtrow = dmt + ibasis1*nbasis;
+        for (long ibasis0=0; ibasis0 < nbasis; ibasis0++) {
+          row[ibasis0] += factor*dmtrow[ibasis0];
+        }
+      }
+    }
+  }
+}
+
+static void block_fock_product(const double* left, const double* right, long nbasis,
+                               long nblock, double* fock) {
+  // fock[ibasis0, ibasis1] += sum_ipoint left[ipoint, ibasis0]*right[ipoint, ibasis1]
+  // A tile of rows of the Fock matrix is updated for all grid points in the block, and
+  // each row of right is used for four rows of the Fock matrix at once.
+  for (long tile0=0; tile0 < nbasis; tile0 += GB1_TILE_SIZE) {
+    long tile1 = tile0 + GB1_TILE_SIZE;
+    if (tile1 > nbasis) tile1 = nbasis;
+    for (long ipoint=0; ipoint < nblock; ipoint++) {
+      const double* row = right + ipoint*nbasis;
+      long ibasis0 = tile0;
+      for (; ibasis0 + 4 <= tile1; ibasis0 += 4) {
+        block_axpy(left + ipoint*nbasis + ibasis0, 1, row, nbasis, fock + ibasis0*nbasis);
+      }
+      for (; ibasis0 < tile1; ibasis0++) {
+        double factor = left[ipoint*nbasis + ibasis0];
+        double* fockrow = fock + ibasis0*nbasis;
+        for (long ibasis1=0; ibasis1 < nbasis; ibasis1++) {
+          fockrow[ibasis1] += factor*row[ibasis1];
+        }
+      }
+    }
+  }
+}
+
+void GB1DMGridFn::compute_block_from_dm(double* work_block, double* dm, long nbasis,
+                                        long nblock, double* output, double epsilon,
+                                        double* dmmaxrow) {
+  const GB1DMGridTerm* terms;
+  long nterm = get_dm_terms(&terms);
+  long nwork = nbasis*dim_work;
+  if (nterm == 0) {
+    // Fall back to the point-by-point evaluation.
+    std::vector<double> work_basis(nwork);
+    for (long ipoint=0; ipoint < nblock; ipoint++) {
+      for (long ibasis=0; ibasis < nbasis; ibasis++) {
+        for (long k=0; k < dim_work; k++) {
+          work_basis[ibasis*dim_work + k] = work_block[(k*nblock + ipoint)*nbasis + ibasis];
+        }
+      }
+      compute_point_from_dm(&work_basis[0], dm, nbasis, output + ipoint*dim_output,
+                            epsilon, dmmaxrow);
+    }
+    return;
+  }
+
+  // Contract the 1RDM with all work components that need it, one matrix product each.
+  std::vector<double> dmt(nbasis*nbasis);
+  for (long ibasis0=0; ibasis0 < nbasis; ibasis0++) {
+    for (long ibasis1=0; ibasis1 < nbasis; ibasis1++) {
+      dmt[ibasis1*nbasis + ibasis0] = dm[ibasis0*nbasis + ibasis1];
+    }
+  }
+  std::vector<double> work_dm(nblock*nwork);
+  std::vector<bool> done(dim_work, false);
+  for (long iterm=0; iterm < nterm; iterm++) {
+    long k = terms[iterm].iwork0;
+    if (done[k]) continue;
+    block_dm_product(work_block + k*nblock*nbasis, &dmt[0], nbasis, nblock,
+                     &work_dm[k*nblock*nbasis]);
+    done[k] = true;
+  }
+
+  // Add each term to the output with a row-wise dot product.
+  for (long iterm=0; iterm < nterm; iterm++) {
+    const GB1DMGridTerm& term = terms[iterm];
+    const double* left = work_block + term.iwork1*nblock*nbasis;
+    const double* right = &work_dm[term.iwork0*nblock*nbasis];
+    for (long ipoint=0; ipoint < nblock; ipoint++) {
+      double tmp = 0.0;
+      for (long ibasis=0; ibasis < nbasis; ibasis++) {
+        tmp += left[ipoint*nbasis + ibasis]*right[ipoint*nbasis + ibasis];
+      }
+      output[ipoint*dim_output + term.ioutput] += term.coeff*tmp;
+    }
+  }
+}
+
+void GB1DMGridFn::compute_fock_from_block(double* pots, double* work_block, long nbasis,
+                                          long nblock, double* fock) {
+  const GB1DMGridTerm* terms;
+  long nterm = get_dm_terms(&terms);
+  long nwork = nbasis*dim_work;
+  if (nterm == 0) {
+    // Fall back to the point-by-point evaluation.
+    std::vector<double> work_basis(nwork);
+    for (long ipoint=0; ipoint < nblock; ipoint++) {
+      for (long ibasis=0; ibasis < nbasis; ibasis++) {
+        for (long k=0; k < dim_work; k++) {
+          work_basis[ibasis*dim_work + k] = work_block[(k*nblock + ipoint)*nbasis + ibasis];
+        }
+      }
+      compute_fock_from_pot(pots + ipoint*dim_output, &work_basis[0], nbasis, fock);
+    }
+    return;
+  }
+
+  // Each term contributes
+  //     0.5*coeff*pot*(work[a, iwork1] work[b, iwork0] + work[a, iwork0] work[b, iwork1])
+  // to fock[a, b]. The iwork1 components, multiplied by the potential, are first summed
+  // per iwork0 component, which typically leaves only a few distinct components.
+  std::vector<double> work_pot(nblock*nwork, 0.0);
+  std::vector<bool> used(dim_work, false);
+  for (long iterm=0; iterm < nterm; iterm++) {
+    const GB1DMGridTerm& term = terms[iterm];
+    const double* src = work_block + term.iwork1*nblock*nbasis;
+    double* dst = &work_pot[term.iwork0*nblock*nbasis];
+    for (long ipoint=0; ipoint < nblock; ipoint++) {
+      double factor = 0.5*term.coeff*pots[ipoint*dim_output + term.ioutput];
+      for (long ibasis=0; ibasis < nbasis; ibasis++) {
+        dst[ipoint*nbasis + ibasis] += factor*src[ipoint*nbasis + ibasis];
+      }
+    }
+    used[term.iwork0] = true;
+  }
+
+  // One matrix product per work component, followed by symmetrization.
+  std::vector<double> half(nbasis*nbasis, 0.0);
+  for (long k=0; k < dim_work; k++) {
+    if (!used[k]) continue;
+    block_fock_product(&work_pot[k*nblock*nbasis], work_block + k*nblock*nbasis, nbasis,
+                       nblock, &half[0]);
+  }
+  for (long ibasis0=0; ibasis0 < nbasis; ibasis0++) {
+    for (long ibasis1=0; ibasis1 < nbasis; ibasis1++) {
+      fock[ibasis0*nbasis + ibasis1] += half[ibasis0*nbasis + ibasis1] +
+                                        half[ibasis1*nbasis + ibasis0];
+    }
+  }
+}
+
+
 /*
     GB1DMGridDensityFn
 */
@@ -269,6 +464,38 @@ void GB1DMGridDensityFn::compute_fock_from_pot(double* pot, double* work_basis,
   }
 }
 
+long GB1DMGridDensityFn::get_dm_terms(const GB1DMGridTerm** terms) {
+  // The density is sum_ab phi_a dm_ab phi_b.
+  static const GB1DMGridTerm dm_terms[] = {
+    {0, 0, 0, 1.0}
+  };
+  *terms = dm_terms;
+  return 1;
+}
+
+void GB1DMGridDensityFn::compute_block_from_dm(double* work_block, double* dm,
+                                               long nbasis, long nblock, double* output,
+                                               double epsilon, double* dmmaxrow) {
+  // The epsilon argument allows one to skip grid points where the density is low. The
+  // same upper bound as in compute_point_from_dm is used. Basis functions are set to
+  // zero in such points, such that nothing is added to the output.
+  if (epsilon > 0) {
+    for (long ipoint=0; ipoint < nblock; ipoint++) {
+      double* work_basis = work_block + ipoint*nbasis;
+      double absmax_basis = 0.0;
+      double rho_upper = 0.0;
+      for (long ibasis=0; ibasis < nbasis; ibasis++) {
+        double tmp = fabs(work_basis[ibasis]);
+        if (tmp > absmax_basis) absmax_basis = tmp;
+        rho_upper += tmp*dmmaxrow[ibasis];
+      }
+      rho_upper *= nbasis*absmax_basis;
+      if (rho_upper < epsilon) memset(work_basis, 0, nbasis*sizeof(double));
+    }
+  }
+  GB1DMGridFn::compute_block_from_dm(work_block, dm, nbasis, nblock, output, epsilon,
+                                     dmmaxrow);
+}
 
 
 /*
@@ -362,6 +589,15 @@ void GB1DMGridGradientFn::compute_fock_from_pot(double* pot, double* work_basis,
   }
 }
 
+long GB1DMGridGradientFn::get_dm_terms(const GB1DMGridTerm** terms) {
+  // Each component of the gradient is 2 sum_ab phi'_a dm_ab phi_b.
+  static const GB1DMGridTerm dm_terms[] = {
+    {0, 0, 1, 2.0}, {1, 0, 2, 2.0}, {2, 0, 3, 2.0}
+  };
+  *terms = dm_terms;
+  return 3;
+}
+
 
 /*
     GB1DMGridGGAFn
@@ -417,6 +653,15 @@ void GB1DMGridGGAFn::compute_fock_from_pot(double* pot, double* work_basis, long
   }
 }
 
+long GB1DMGridGGAFn::get_dm_terms(const GB1DMGridTerm** terms) {
+  // The density followed by the three components of its gradient.
+  static const GB1DMGridTerm dm_terms[] = {
+    {0, 0, 0, 1.0}, {1, 0, 1, 2.0}, {2, 0, 2, 2.0}, {3, 0, 3, 2.0}
+  };
+  *terms = dm_terms;
+  return 4;
+}
+
 
 /*
     GB1DMGridKineticFn
@@ -506,6 +751,15 @@ void GB1DMGridKineticFn::compute_fock_from_pot(double* pot, double* work_basis,
   }
 }
 
+long GB1DMGridKineticFn::get_dm_terms(const GB1DMGridTerm** terms) {
+  // The kinetic energy density is 0.5 sum_k sum_ab phi'_ak dm_ab phi'_bk.
+  static const GB1DMGridTerm dm_terms[] = {
+    {0, 0, 0, 0.5}, {0, 1, 1, 0.5}, {0, 2, 2, 0.5}
+  };
+  *terms = dm_terms;
+  return 3;
+}
+
 
 /*
     GB1DMGridHessianFn
@@ -652,14 +906,16 @@ void GB1DMGridHessianFn::compute_fock_from_pot(double* pot, double* work_basis,
                 +pot[3]*work_basis[ibasis0*10+7]
                 +pot[4]*work_basis[ibasis0*10+8]
                 +pot[5]*work_basis[ibasis0*10+9];
+    // The off-diagonal elements get a factor one half because the result is added to
+    // the Fock matrix twice, once transposed.
     double tmp_x = pot[0]*work_basis[ibasis0*10+1]
-                  +pot[1]*work_basis[ibasis0*10+2]
-                  +pot[2]*work_basis[ibasis0*10+3];
-    double tmp_y = pot[1]*work_basis[ibasis0*10+1]
+                  +0.5*pot[1]*work_basis[ibasis0*10+2]
+                  +0.5*pot[2]*work_basis[ibasis0*10+3];
+    double tmp_y = 0.5*pot[1]*work_basis[ibasis0*10+1]
                   +pot[3]*work_basis[ibasis0*10+2]
-                  +pot[4]*work_basis[ibasis0*10+3];
-    double tmp_z = pot[2]*work_basis[ibasis0*10+1]
-                  +pot[4]*work_basis[ibasis0*10+2]
+                  +0.5*pot[4]*work_basis[ibasis0*10+3];
+    double tmp_z = 0.5*pot[2]*work_basis[ibasis0*10+1]
+                  +0.5*pot[4]*work_basis[ibasis0*10+2]
                   +pot[5]*work_basis[ibasis0*10+3];
     for (long ibasis1=0; ibasis1 < nbasis; ibasis1++) {
       double result = tmp*work_basis[ibasis1*10]
@@ -672,6 +928,17 @@ void GB1DMGridHessianFn::compute_fock_from_pot(double* pot, double* work_basis,
   }
 }
 
+long GB1DMGridHessianFn::get_dm_terms(const GB1DMGridTerm** terms) {
+  // Each Hessian element is 2 sum_ab (phi''_a dm_ab phi_b + phi'_a dm_ab phi'_b).
+  static const GB1DMGridTerm dm_terms[] = {
+    {0, 0, 4, 2.0}, {0, 1, 1, 2.0}, {1, 0, 5, 2.0}, {1, 1, 2, 2.0},
+    {2, 0, 6, 2.0}, {2, 1, 3, 2.0}, {3, 0, 7, 2.0}, {3, 2, 2, 2.0},
+    {4, 0, 8, 2.0}, {4, 2, 3, 2.0}, {5, 0, 9, 2.0}, {5, 3, 3, 2.0}
+  };
+  *terms = dm_terms;
+  return 12;
+}
+
 
 /*
     GB1DMGridMGGAFn
@@ -808,6 +1075,18 @@ void GB1DMGridMGGAFn::compute_fock_from_pot(double* pot, double* work_basis, lon
   }
 }
 
+long GB1DMGridMGGAFn::get_dm_terms(const GB1DMGridTerm** terms) {
+  // Density, gradient, Laplacian (2 sum_ab (lapl phi_a) dm_ab phi_b plus 4 times
+  // the kinetic energy density) and kinetic energy density.
+  static const GB1DMGridTerm dm_terms[] = {
+    {0, 0, 0, 1.0}, {1, 0, 1, 2.0}, {2, 0, 2, 2.0}, {3, 0, 3, 2.0},
+    {4, 0, 4, 2.0}, {4, 1, 1, 2.0}, {4, 2, 2, 2.0}, {4, 3, 3, 2.0},
+    {5, 1, 1, 0.5}, {5, 2, 2, 0.5}, {5, 3, 3, 0.5}
+  };
+  *terms = dm_terms;
+  return 11;
+}
+
 
 /*
     GB2DMGridFn
@@ -912,9 +1191,7 @@ void GB2DMGridHartreeFn::add(double coeff, double alpha0, double alpha1,
 
   // Fill the work array with the Boys function values
   arg = gamma*(pc[0]*pc[0] + pc[1]*pc[1] + pc[2]*pc[2]);
-  for (long nu=abs(shell_type0)+abs(shell_type1); nu >= 0; nu--) {
-    work_boys[nu] = boys_function(nu, arg);
-  }
+  boys_function_array(abs(shell_type0) + abs(shell_type1), arg, work_boys);
 
   // Iterate over all combinations of Cartesian exponents
   i2p.reset(abs(shell_type0), abs(shell_type1));
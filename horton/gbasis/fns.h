@@ -69,6 +69,14 @@
 
     The above work flow is repeated for every grid point.
 
+    For the GB1DMGridFn classes, steps 1 to 3 are carried out for a block of grid points
+    (at most GB1_BLOCK_SIZE) before step 4. The basis function properties of the whole
+    block are stored component by component, such that step 4 becomes a handful of
+    matrix-matrix products (see `compute_block_from_dm` and `compute_fock_from_block`).
+    This is only possible because all these functions are bilinear in the basis
+    functions: each subclass describes its output as a short list of terms, see
+    `GB1DMGridTerm` and `get_dm_terms`.
+
 
     The Cartesian polynomials in the Gaussian primitives (and/or their derivatives) are
     computed only once for a given contraction when calling the `reset` method. This is
@@ -123,6 +131,9 @@
 #include "horton/gbasis/common.h"
 #include "horton/gbasis/iter_pow.h"
 
+//! The maximum number of grid points processed at once by GB1DMGridFn calculators.
+#define GB1_BLOCK_SIZE 128
+
 /** @brief
       Base class for grid calculators that require only a single loop over all basis
       functions.
@@ -350,6 +361,23 @@ class GB1ExpGridOrbGradientFn : public GB1ExpGridFn  {
 };
 
 
+/** @brief
+      One bilinear term in the output of a GB1DMGridFn calculator.
+
+    The term adds the following to component `ioutput` of the output at a grid point:
+
+        coeff * sum_ab work[a, iwork1] dm[a, b] work[b, iwork0]
+
+    where work[a, k] is component k of the work array of basis function a.
+  */
+typedef struct {
+  long ioutput;  //!< The output component to which the term contributes.
+  long iwork0;   //!< The work component contracted with the columns of the 1RDM.
+  long iwork1;   //!< The work component contracted with the rows of the 1RDM.
+  double coeff;  //!< The prefactor of the term.
+} GB1DMGridTerm;
+
+
 /** @brief
       Base class for GB1 grid calculators that use the first-order density matrix
       coefficients.
@@ -360,6 +388,81 @@ class GB1DMGridFn : public GB1GridFn  {
   GB1DMGridFn(long max_shell_type, long dim_work, long dim_output)
       : GB1GridFn(max_shell_type, dim_work, dim_output) {}
 
+  /** @brief
+        Get the list of bilinear terms that make up the output.
+
+      @param terms
+        Is set to a (static) array of terms.
+
+      @return
+        The number of terms. When zero, the block methods fall back to
+        compute_point_from_dm and compute_fock_from_pot.
+    */
+  virtual long get_dm_terms(const GB1DMGridTerm** terms) {
+    *terms = NULL;
+    return 0;
+  }
+
+  /** @brief
+        Return a new object of the same type, e.g. for use in another thread.
+
+      The caller is responsible for deleting the new object.
+    */
+  virtual GB1DMGridFn* clone() const = 0;
+
+  /** @brief
+        Compute the final results on a block of grid points.
+
+      @param work_block
+        Properties of basis functions computed for a block of grid points. Element
+        (k, ipoint, ibasis) is stored at position (k*nblock + ipoint)*nbasis + ibasis,
+        where k is the component of the work array. (size=dim_work*nblock*nbasis)
+
+      @param dm
+        The coefficients of the first-order density matrix. (size=nbasis*nbasis)
+
+      @param nbasis
+        The number of basis functions.
+
+      @param nblock
+        The number of grid points in the block.
+
+      @param output
+        The output array for the block of grid points. (size=nblock*dim_output)
+
+      @param epsilon
+        A cutoff value used to discard small contributions.
+
+      @param dmmaxrow
+        The maximum value of the density matrix on each row. (size=nbasis)
+    */
+  virtual void compute_block_from_dm(double* work_block, double* dm, long nbasis,
+                                     long nblock, double* output, double epsilon,
+                                     double* dmmaxrow);
+
+  /** @brief
+        Add contribution to Fock matrix from a block of grid points.
+
+      @param pots
+        The potential in each grid point of the block, already multiplied by the
+        integration weights. (size=nblock*dim_output)
+
+      @param work_block
+        Properties of the orbital basis in the block of grid points. (See
+        compute_block_from_dm for the layout.) (size=dim_work*nblock*nbasis)
+
+      @param nbasis
+        The number of basis functions.
+
+      @param nblock
+        The number of grid points in the block.
+
+      @param fock
+        The Fock matrix to which the result will be added. (size=nbasis*nbasis)
+    */
+  void compute_fock_from_block(double* pots, double* work_block, long nbasis,
+                               long nblock, double* fock);
+
   /** @brief
         Compute the final result on one grid point.
 
@@ -448,6 +551,25 @@ class GB1DMGridDensityFn : public GB1DMGridFn  {
   virtual void compute_fock_from_pot(double* pot, double* work_basis, long nbasis,
                                      double* fock);
 
+  //! Get the list of bilinear terms. (See base class for details.)
+  virtual long get_dm_terms(const GB1DMGridTerm** terms);
+
+  //! Return a new object of the same type. (See base class for details.)
+  virtual GB1DMGridFn* clone() const {
+    return new GB1DMGridDensityFn(get_max_shell_type());
+  }
+
+  /** @brief
+        Compute the density on a block of grid points. (See base class for details.)
+
+      When epsilon is positive, the basis functions are set to zero in grid points
+      where an upper bound to the density is below epsilon. These points get no
+      contribution to the output.
+    */
+  virtual void compute_block_from_dm(double* work_block, double* dm, long nbasis,
+                                     long nblock, double* output, double epsilon,
+                                     double* dmmaxrow);
+
  private:
   double poly_work[MAX_NCART_CUMUL];  //!< Work array with Cartesian polynomials.
   long offset;  //!< Offset for the polynomials for the density
@@ -510,6 +632,14 @@ class GB1DMGridGradientFn : public GB1DMGridFn  {
   virtual void compute_fock_from_pot(double* pot, double* work_basis, long nbasis,
                                      double* fock);
 
+  //! Get the list of bilinear terms. (See base class for details.)
+  virtual long get_dm_terms(const GB1DMGridTerm** terms);
+
+  //! Return a new object of the same type. (See base class for details.)
+  virtual GB1DMGridFn* clone() const {
+    return new GB1DMGridGradientFn(get_max_shell_type());
+  }
+
  protected:
   double poly_work[MAX_NCART_CUMUL_D];  //!< Work array with Cartesian polynomials.
   long offset;     //!< Offset for the polynomials for the density
@@ -549,6 +679,14 @@ class GB1DMGridGGAFn : public GB1DMGridGradientFn  {
   //! Add contribution to Fock matrix for one grid point. (See base class for details.)
   virtual void compute_fock_from_pot(double* pot, double* work_basis, long nbasis,
                                      double* fock);
+
+  //! Get the list of bilinear terms. (See base class for details.)
+  virtual long get_dm_terms(const GB1DMGridTerm** terms);
+
+  //! Return a new object of the same type. (See base class for details.)
+  virtual GB1DMGridFn* clone() const {
+    return new GB1DMGridGGAFn(get_max_shell_type());
+  }
 };
 
 
@@ -591,6 +729,14 @@ class GB1DMGridKineticFn : public GB1DMGridFn  {
   virtual void compute_fock_from_pot(double* pot, double* work_basis, long nbasis,
                                      double* fock);
 
+  //! Get the list of bilinear terms. (See base class for details.)
+  virtual long get_dm_terms(const GB1DMGridTerm** terms);
+
+  //! Return a new object of the same type. (See base class for details.)
+  virtual GB1DMGridFn* clone() const {
+    return new GB1DMGridKineticFn(get_max_shell_type());
+  }
+
  private:
   double poly_work[MAX_NCART_CUMUL_D];  //!< Work array with Cartesian polynomials.
   long offset;     //!< Offset for the polynomials for the density.
@@ -650,6 +796,14 @@ class GB1DMGridHessianFn : public GB1DMGridFn  {
   virtual void compute_fock_from_pot(double* pot, double* work_basis, long nbasis,
                                      double* fock);
 
+  //! Get the list of bilinear terms. (See base class for details.)
+  virtual long get_dm_terms(const GB1DMGridTerm** terms);
+
+  //! Return a new object of the same type. (See base class for details.)
+  virtual GB1DMGridFn* clone() const {
+    return new GB1DMGridHessianFn(get_max_shell_type());
+  }
+
  private:
   double poly_work[MAX_NCART_CUMUL_DD];  //!< Work array with Cartesian polynomials.
   long offset;     //!< Offset for the polynomials for the density.
@@ -707,6 +861,14 @@ class GB1DMGridMGGAFn : public GB1DMGridFn  {
   virtual void compute_fock_from_pot(double* pot, double* work_basis, long nbasis,
                                      double* fock);
 
+  //! Get the list of bilinear terms. (See base class for details.)
+  virtual long get_dm_terms(const GB1DMGridTerm** terms);
+
+  //! Return a new object of the same type. (See base class for details.)
+  virtual GB1DMGridFn* clone() const {
+    return new GB1DMGridMGGAFn(get_max_shell_type());
+  }
+
  private:
   double poly_work[MAX_NCART_CUMUL_DD];  //!< Work array with Cartesian polynomials.
   long offset;     //!< Offset for the polynomials for the density.
@@ -23,14 +23,21 @@
 #ifdef DEBUG
 #include <cstdio>
 #endif
+#include <algorithm>
+#include <atomic>
 #include <cmath>
 #include <cstdlib>
 #include <stdexcept>
 #include <cstdlib>
 #include <cstring>
+#include <limits>
+#include <vector>
 #include "horton/gbasis/gbasis.h"
+#include "horton/gbasis/cartpure.h"
 #include "horton/gbasis/common.h"
+#include "horton/gbasis/esp.h"
 #include "horton/gbasis/iter_gb.h"
+#include "horton/gbasis/parallel.h"
 using std::abs;
 
 /*
@@ -55,13 +62,15 @@ const double gob_pure_normalization(const double alpha, const long l) {
 
     The constructor assumes that the arrays are allocated externally and will
     not be deallocated prematurely. It is also assumed that the arrays are not
-    changed once the constructor is called.
+    changed once the constructor is called, except for the centers. The table of
+    primitive pairs is rebuilt by init_shell_pairs when the centers have changed.
 */
 
 GBasis::GBasis(const double* centers, const long* shell_map, const long* nprims,
                const long* shell_types, const double* alphas, const double* con_coeffs,
                const long ncenter, const long nshell, const long nprim_total) :
     nbasis(0), nscales(0), max_shell_type(0),
+    prim_pairs(NULL), shell_pair_offsets(NULL), shell_pair_magnitudes(NULL),
     centers(centers), shell_map(shell_map), nprims(nprims),
     shell_types(shell_types), alphas(alphas), con_coeffs(con_coeffs),
     ncenter(ncenter), nshell(nshell), nprim_total(nprim_total)
@@ -118,6 +127,13 @@ GBasis::GBasis(const double* centers, const long* shell_map, const long* nprims,
     // scales
     scales = new double[nscales];
     scales_offsets = new long[nprim_total];
+
+    // shell_extents: no screening until set_grid_tolerance is called.
+    shell_extents = new double[nshell];
+    grid_tolerance = 0.0;
+    for (long ishell=0; ishell < nshell; ishell++) {
+        shell_extents[ishell] = std::numeric_limits<double>::infinity();
+    }
 }
 
 GBasis::~GBasis() {
@@ -126,6 +142,10 @@ GBasis::~GBasis() {
     delete[] shell_lookup;
     delete[] scales;
     delete[] scales_offsets;
+    delete[] shell_extents;
+    delete[] prim_pairs;
+    delete[] shell_pair_offsets;
+    delete[] shell_pair_magnitudes;
 }
 
 void GBasis::init_scales() {
@@ -147,40 +167,551 @@ void GBasis::init_scales() {
     }
 }
 
+void GBasis::set_grid_tolerance(double tolerance) {
+    grid_tolerance = tolerance;
+    long oprim = 0;
+    for (long ishell=0; ishell < nshell; ishell++) {
+        if (tolerance <= 0) {
+            shell_extents[ishell] = std::numeric_limits<double>::infinity();
+            oprim += nprims[ishell];
+            continue;
+        }
+        // Upper bound for the basis functions and their first and second derivatives
+        // as a function of the distance to the center:
+        //     f(r) = sum_i |c_i| N_i r^l (1 + 2 alpha_i r)^2 exp(-alpha_i r^2)
+        // where N_i is the largest normalization constant of primitive i. This function
+        // decreases monotonically beyond rmin.
+        long l = abs(shell_types[ishell]);
+        double alpha_min = alphas[oprim];
+        for (long iprim=1; iprim < nprims[ishell]; iprim++) {
+            alpha_min = std::min(alpha_min, alphas[oprim + iprim]);
+        }
+        double rmin = sqrt((l + 2)/(2*alpha_min));
+        double rmax = rmin;
+        while (shell_bound(ishell, oprim, rmax) >= tolerance) rmax *= 2;
+        if (rmax > rmin) {
+            // Bisection, keeping f(rmin) >= tolerance > f(rmax).
+            rmin = 0.5*rmax;
+            for (long i=0; i < 30; i++) {
+                double r = 0.5*(rmin + rmax);
+                if (shell_bound(ishell, oprim, r) >= tolerance) {
+                    rmin = r;
+                } else {
+                    rmax = r;
+                }
+            }
+        }
+        shell_extents[ishell] = rmax;
+        oprim += nprims[ishell];
+    }
+}
+
+void GBasis::init_shell_pairs() {
+    // The centers can be modified after the construction of the basis, e.g. in a
+    // geometry optimization. The table is then rebuilt.
+    if (prim_pairs != NULL) {
+        if (std::equal(centers, centers + 3*ncenter, shell_pair_centers.begin())) return;
+        delete[] prim_pairs;
+        delete[] shell_pair_offsets;
+        delete[] shell_pair_magnitudes;
+    }
+    shell_pair_centers.assign(centers, centers + 3*ncenter);
+
+    // The pairs of primitives of the pair of shells (ishell0, ishell1), with
+    // ishell1 <= ishell0, start at shell_pair_offsets[ishell0*(ishell0 + 1)/2 + ishell1].
+    const long npair = (nshell*(nshell + 1))/2;
+    shell_pair_offsets = new long[npair + 1];
+    shell_pair_offsets[0] = 0;
+    long ipair = 0;
+    for (long ishell0=0; ishell0 < nshell; ishell0++) {
+        for (long ishell1=0; ishell1 <= ishell0; ishell1++) {
+            shell_pair_offsets[ipair + 1] = shell_pair_offsets[ipair] +
+                                            nprims[ishell0]*nprims[ishell1];
+            ipair++;
+        }
+    }
+
+    // The largest normalization constant of every primitive.
+    std::vector<double> scale_maxs(nprim_total, 0.0);
+    for (long ishell=0; ishell < nshell; ishell++) {
+        const long ncart = get_shell_nbasis(abs(shell_types[ishell]));
+        for (long iprim=prim_offsets[ishell]; iprim < prim_offsets[ishell] + nprims[ishell];
+             iprim++) {
+            const double* scales0 = get_scales(iprim);
+            for (long icart=0; icart < ncart; icart++) {
+                scale_maxs[iprim] = std::max(scale_maxs[iprim], fabs(scales0[icart]));
+            }
+        }
+    }
+
+    prim_pairs = new prim_pair_t[shell_pair_offsets[npair]];
+    shell_pair_magnitudes = new double[nshell*nshell];
+    prim_pair_t* pair = prim_pairs;
+    for (long ishell0=0; ishell0 < nshell; ishell0++) {
+        const double* r0 = centers + 3*shell_map[ishell0];
+        for (long ishell1=0; ishell1 <= ishell0; ishell1++) {
+            const double* r1 = centers + 3*shell_map[ishell1];
+            double magnitude = 0.0;
+            for (long iprim0=prim_offsets[ishell0];
+                 iprim0 < prim_offsets[ishell0] + nprims[ishell0]; iprim0++) {
+                for (long iprim1=prim_offsets[ishell1];
+                     iprim1 < prim_offsets[ishell1] + nprims[ishell1]; iprim1++) {
+                    compute_prim_pair(con_coeffs[iprim0]*con_coeffs[iprim1],
+                                      alphas[iprim0], r0, get_scales(iprim0),
+                                      alphas[iprim1], r1, get_scales(iprim1), pair);
+                    magnitude += fabs(pair->coeff)*pair->prefac*
+                                 pow(M_PI*pair->gamma_inv, 1.5)*
+                                 scale_maxs[iprim0]*scale_maxs[iprim1];
+                    pair++;
+                }
+            }
+            shell_pair_magnitudes[ishell0*nshell + ishell1] = magnitude;
+            shell_pair_magnitudes[ishell1*nshell + ishell0] = magnitude;
+        }
+    }
+}
+
+const prim_pair_t* GBasis::get_prim_pairs(long ishell0, long ishell1,
+                                          std::vector<prim_pair_t>* work) const {
+    if (ishell1 <= ishell0) {
+        return prim_pairs + shell_pair_offsets[(ishell0*(ishell0 + 1))/2 + ishell1];
+    }
+    // Copy the transposed pair and swap the primitives within each pair. The Gaussian
+    // product quantities do not depend on the order.
+    const prim_pair_t* pairs = prim_pairs + shell_pair_offsets[(ishell1*(ishell1 + 1))/2 +
+                                                               ishell0];
+    const long nprim0 = nprims[ishell0];
+    const long nprim1 = nprims[ishell1];
+    work->resize(nprim0*nprim1);
+    for (long iprim0=0; iprim0 < nprim0; iprim0++) {
+        for (long iprim1=0; iprim1 < nprim1; iprim1++) {
+            prim_pair_t& pair = (*work)[iprim0*nprim1 + iprim1];
+            pair = pairs[iprim1*nprim0 + iprim0];
+            std::swap(pair.alpha0, pair.alpha1);
+            std::swap(pair.scales0, pair.scales1);
+        }
+    }
+    return &(*work)[0];
+}
+
+double GBasis::shell_bound(long ishell, long oprim, double r) const {
+    long l = abs(shell_types[ishell]);
+    long ncart = get_shell_nbasis(l);
+    double result = 0.0;
+    for (long iprim=0; iprim < nprims[ishell]; iprim++) {
+        const double* scales0 = get_scales(oprim + iprim);
+        double scale_max = 0.0;
+        for (long icart=0; icart < ncart; icart++) {
+            scale_max = std::max(scale_max, fabs(scales0[icart]));
+        }
+        double alpha = alphas[oprim + iprim];
+        double tmp = 1 + 2*alpha*r;
+        result += fabs(con_coeffs[oprim + iprim])*scale_max*pow(r, l)*tmp*tmp*
+                  exp(-alpha*r*r);
+    }
+    return result;
+}
+
 void GBasis::compute_two_index(double* output, GB2Integral* integral) {
+    init_shell_pairs();
     IterGB2 iter = IterGB2(this);
     iter.update_shell();
     do {
         integral->reset(iter.shell_type0, iter.shell_type1, iter.r0, iter.r1);
-        iter.update_prim();
-        do {
-            integral->add(iter.con_coeff, iter.alpha0, iter.alpha1, iter.scales0, iter.scales1);
-        } while (iter.inc_prim());
+        if (shell_pair_magnitudes[iter.ishell0*nshell + iter.ishell1] > 0) {
+            // The iterator only visits pairs with ishell1 <= ishell0, which are in the
+            // table.
+            const prim_pair_t* pairs = get_prim_pairs(iter.ishell0, iter.ishell1, NULL);
+            const long npair = nprims[iter.ishell0]*nprims[iter.ishell1];
+            for (long ipair=0; ipair < npair; ipair++) {
+                integral->add_pair(pairs + ipair);
+            }
+        }
         integral->cart_to_pure();
         iter.store(integral->get_work(), output);
     } while (iter.inc_shell());
 }
 
-void GBasis::compute_four_index(double* output, GB4Integral* integral) {
+/*
+    Compute the integrals for the shell quartet at which the iterator is
+    positioned. The result is left in the work array of the integral object. The
+    table of primitive pairs of the basis must be initialized.
+*/
+static void compute_shell_quartet(const GBasis* gbasis, IterGB4* iter,
+                                  GB4Integral* integral) {
+    integral->reset(iter->shell_type0, iter->shell_type1, iter->shell_type2, iter->shell_type3,
+                    iter->r0, iter->r1, iter->r2, iter->r3);
+    // <01|23> is (02|13) in chemist's notation, such that (0, 2) and (1, 3) are the
+    // pairs of primitives. When one of them has a zero magnitude, all integrals are
+    // zero.
+    const long nshell = gbasis->nshell;
+    const double* magnitudes = gbasis->get_shell_pair_magnitudes();
+    if ((magnitudes[iter->ishell0*nshell + iter->ishell2] == 0) ||
+        (magnitudes[iter->ishell1*nshell + iter->ishell3] == 0)) {
+        return;
+    }
+    std::vector<prim_pair_t> work02, work13;
+    const prim_pair_t* pairs02 = gbasis->get_prim_pairs(iter->ishell0, iter->ishell2, &work02);
+    const prim_pair_t* pairs13 = gbasis->get_prim_pairs(iter->ishell1, iter->ishell3, &work13);
+    const long npair02 = gbasis->nprims[iter->ishell0]*gbasis->nprims[iter->ishell2];
+    const long npair13 = gbasis->nprims[iter->ishell1]*gbasis->nprims[iter->ishell3];
+    for (long ipair02=0; ipair02 < npair02; ipair02++) {
+        const prim_pair_t* pair02 = pairs02 + ipair02;
+        for (long ipair13=0; ipair13 < npair13; ipair13++) {
+            const prim_pair_t* pair13 = pairs13 + ipair13;
+            integral->add_pairs(pair02->coeff*pair13->coeff, pair02, pair13);
+        }
+    }
+    integral->cart_to_pure();
+}
+
+long GBasis::compute_four_index(double* output, GB4Integral* integral,
+                                double screening_threshold, long nthread, bool packed) {
+    if (nthread < 1) {
+        throw std::domain_error("The number of threads must be strictly positive.");
+    }
+    init_shell_pairs();
+
+    // Schwarz bounds are only needed when screening is requested.
+    double* bounds = NULL;
+    if (screening_threshold > 0) {
+        bounds = new double[nshell*nshell];
+        compute_shell_pair_bounds(bounds, integral);
+    }
+
+    // The work is distributed over the threads in units of pairs (ishell0, ishell1),
+    // with ishell1 <= ishell0. Each output element is written by exactly one quartet
+    // of shells, such that the result does not depend on the number of threads. Pairs
+    // with a large ishell0 contain the most quartets and are handed out first.
+    std::vector<long> pairs;
+    pairs.reserve(nshell*(nshell + 1));
+    for (long ishell0=nshell-1; ishell0 >= 0; ishell0--) {
+        for (long ishell1=ishell0; ishell1 >= 0; ishell1--) {
+            pairs.push_back(ishell0);
+            pairs.push_back(ishell1);
+        }
+    }
+    const long npair = pairs.size()/2;
+
+    // Each thread gets its own copy of the integral object. The first thread uses
+    // the one given as argument.
+    std::vector<GB4Integral*> integrals(nthread, integral);
+    for (long ithread=1; ithread < nthread; ithread++) {
+        integrals[ithread] = integral->clone();
+    }
+    std::vector<long> nskips(nthread, 0);
+    std::atomic<long> next_pair(0);
+
+    try {
+        run_in_threads(nthread, [&](long ithread) {
+            GB4Integral* my_integral = integrals[ithread];
+            IterGB4 iter = IterGB4(this);
+            long ipair;
+            while ((ipair = next_pair++) < npair) {
+                const long ishell0 = pairs[2*ipair];
+                const long ishell1 = pairs[2*ipair + 1];
+                // Same order of quartets as in IterGB4::inc_shell.
+                for (long ishell2=0; ishell2 <= ishell0; ishell2++) {
+                    const long max_ishell3 = (ishell0 == ishell1) ? ishell2 : ishell1;
+                    for (long ishell3=0; ishell3 <= max_ishell3; ishell3++) {
+                        iter.set_shells(ishell0, ishell1, ishell2, ishell3);
+                        // The quartet <01|23> corresponds to (02|13) in chemist's
+                        // notation.
+                        if ((bounds != NULL) &&
+                            (bounds[ishell0*nshell + ishell2]*
+                             bounds[ishell1*nshell + ishell3] < screening_threshold)) {
+                            // Only reset, such that zeros are written to the output.
+                            my_integral->reset(iter.shell_type0, iter.shell_type1,
+                                               iter.shell_type2, iter.shell_type3,
+                                               iter.r0, iter.r1, iter.r2, iter.r3);
+                            nskips[ithread]++;
+                        } else {
+                            compute_shell_quartet(this, &iter, my_integral);
+                        }
+                        if (packed) {
+                            iter.store_packed(my_integral->get_work(), output);
+                        } else {
+                            iter.store(my_integral->get_work(), output);
+                        }
+                    }
+                }
+            }
+        });
+    } catch (...) {
+        for (long ithread=1; ithread < nthread; ithread++) delete integrals[ithread];
+        delete[] bounds;
+        throw;
+    }
+
+    long nskip = 0;
+    for (long ithread=0; ithread < nthread; ithread++) {
+        nskip += nskips[ithread];
+        if (ithread > 0) delete integrals[ithread];
+    }
+    delete[] bounds;
+    return nskip;
+}
+
+long GBasis::compute_four_index_direct(GB4Integral* integral, const double* dm,
+                                       double* coulomb, double* exchange,
+                                       double screening_threshold, long nthread) {
+    if (nthread < 1) {
+        throw std::domain_error("The number of threads must be strictly positive.");
+    }
+    init_shell_pairs();
+    const long nbasis = get_nbasis();
+
+    // Density-weighted screening: the Schwarz bound is multiplied with the largest
+    // absolute density matrix element for each pair of shells.
+    double* bounds = NULL;
+    double* dmax = NULL;
+    if (screening_threshold > 0) {
+        bounds = new double[nshell*nshell];
+        compute_shell_pair_bounds(bounds, integral);
+        dmax = new double[nshell*nshell];
+        const long* basis_offsets = get_basis_offsets();
+        for (long ishell0=0; ishell0 < nshell; ishell0++) {
+            const long end0 = basis_offsets[ishell0] + get_shell_nbasis(shell_types[ishell0]);
+            for (long ishell1=0; ishell1 < nshell; ishell1++) {
+                const long end1 = basis_offsets[ishell1] + get_shell_nbasis(shell_types[ishell1]);
+                double tmp = 0.0;
+                for (long i0=basis_offsets[ishell0]; i0 < end0; i0++) {
+                    for (long i1=basis_offsets[ishell1]; i1 < end1; i1++) {
+                        tmp = std::max(tmp, fabs(dm[i0*nbasis + i1]));
+                    }
+                }
+                dmax[ishell0*nshell + ishell1] = tmp;
+            }
+        }
+    }
+
+    // Pairs (ishell0, ishell1) are distributed statically over the threads, such
+    // that the result is reproducible for a given number of threads. Each thread
+    // accumulates into its own arrays, which are summed at the end.
+    std::vector<long> pairs;
+    pairs.reserve(nshell*(nshell + 1));
+    for (long ishell0=nshell-1; ishell0 >= 0; ishell0--) {
+        for (long ishell1=ishell0; ishell1 >= 0; ishell1--) {
+            pairs.push_back(ishell0);
+            pairs.push_back(ishell1);
+        }
+    }
+    const long npair = pairs.size()/2;
+    std::vector<GB4Integral*> integrals(nthread, integral);
+    for (long ithread=1; ithread < nthread; ithread++) {
+        integrals[ithread] = integral->clone();
+    }
+    std::vector<long> nskips(nthread, 0);
+    std::vector<double> coulombs(coulomb == NULL ? 0 : nthread*nbasis*nbasis, 0.0);
+    std::vector<double> exchanges(exchange == NULL ? 0 : nthread*nbasis*nbasis, 0.0);
+
+    try {
+        run_in_threads(nthread, [&](long ithread) {
+            GB4Integral* my_integral = integrals[ithread];
+            double* my_coulomb = (coulomb == NULL) ? NULL : &coulombs[ithread*nbasis*nbasis];
+            double* my_exchange = (exchange == NULL) ? NULL : &exchanges[ithread*nbasis*nbasis];
+            IterGB4 iter = IterGB4(this);
+            for (long ipair=ithread; ipair < npair; ipair += nthread) {
+                const long ishell0 = pairs[2*ipair];
+                const long ishell1 = pairs[2*ipair + 1];
+                for (long ishell2=0; ishell2 <= ishell0; ishell2++) {
+                    const long max_ishell3 = (ishell0 == ishell1) ? ishell2 : ishell1;
+                    for (long ishell3=0; ishell3 <= max_ishell3; ishell3++) {
+                        if (bounds != NULL) {
+                            // All density matrix blocks that are contracted with this
+                            // quartet (or its symmetry-related copies).
+                            const double dmax_quartet = std::max(std::max(
+                                std::max(dmax[ishell0*nshell + ishell1],
+                                         dmax[ishell0*nshell + ishell2]),
+                                std::max(dmax[ishell0*nshell + ishell3],
+                                         dmax[ishell1*nshell + ishell2])),
+                                std::max(dmax[ishell1*nshell + ishell3],
+                                         dmax[ishell2*nshell + ishell3]));
+                            // <01|23> corresponds to (02|13) in chemist's notation.
+                            if (bounds[ishell0*nshell + ishell2]*bounds[ishell1*nshell + ishell3]*
+                                dmax_quartet < screening_threshold) {
+                                nskips[ithread]++;
+                                continue;
+                            }
+                        }
+                        iter.set_shells(ishell0, ishell1, ishell2, ishell3);
+                        compute_shell_quartet(this, &iter, my_integral);
+                        iter.contract(my_integral->get_work(), dm, my_coulomb, my_exchange);
+                    }
+                }
+            }
+        });
+    } catch (...) {
+        for (long ithread=1; ithread < nthread; ithread++) delete integrals[ithread];
+        delete[] bounds;
+        delete[] dmax;
+        throw;
+    }
+
+    // Sum the contributions of all threads, always in the same order.
+    long nskip = 0;
+    if (coulomb != NULL) memset(coulomb, 0, sizeof(double)*nbasis*nbasis);
+    if (exchange != NULL) memset(exchange, 0, sizeof(double)*nbasis*nbasis);
+    for (long ithread=0; ithread < nthread; ithread++) {
+        nskip += nskips[ithread];
+        for (long i=0; i < nbasis*nbasis; i++) {
+            if (coulomb != NULL) coulomb[i] += coulombs[ithread*nbasis*nbasis + i];
+            if (exchange != NULL) exchange[i] += exchanges[ithread*nbasis*nbasis + i];
+        }
+        if (ithread > 0) delete integrals[ithread];
+    }
+    delete[] bounds;
+    delete[] dmax;
+    return nskip;
+}
+
+void GBasis::compute_shell_pair_bounds(double* bounds, GB4Integral* integral) {
+    init_shell_pairs();
     IterGB4 iter = IterGB4(this);
-    iter.update_shell();
-    do {
-        integral->reset(iter.shell_type0, iter.shell_type1, iter.shell_type2, iter.shell_type3,
-                        iter.r0, iter.r1, iter.r2, iter.r3);
-        iter.update_prim();
-        do {
-            integral->add(iter.con_coeff, iter.alpha0, iter.alpha1, iter.alpha2, iter.alpha3,
-                          iter.scales0, iter.scales1, iter.scales2, iter.scales3);
-        } while (iter.inc_prim());
-        integral->cart_to_pure();
-        iter.store(integral->get_work(), output);
-    } while (iter.inc_shell());
+    for (long ishell0=0; ishell0 < nshell; ishell0++) {
+        for (long ishell2=0; ishell2 <= ishell0; ishell2++) {
+            // <aa|cc> in physicist's notation is (ac|ac) in chemist's notation.
+            iter.set_shells(ishell0, ishell0, ishell2, ishell2);
+            compute_shell_quartet(this, &iter, integral);
+            const double* work = integral->get_work();
+            const long n0 = get_shell_nbasis(iter.shell_type0);
+            const long n2 = get_shell_nbasis(iter.shell_type2);
+            double max_diag = 0.0;
+            for (long i0=0; i0 < n0; i0++) {
+                for (long i2=0; i2 < n2; i2++) {
+                    const double diag = fabs(work[((i0*n0 + i0)*n2 + i2)*n2 + i2]);
+                    if (diag > max_diag) max_diag = diag;
+                }
+            }
+            bounds[ishell0*nshell + ishell2] = sqrt(max_diag);
+            bounds[ishell2*nshell + ishell0] = sqrt(max_diag);
+        }
+    }
+}
+
+void GBasis::compute_three_center(double* output, GBasis* aux, GB4Integral* integral,
+                                  long nthread) {
+    if (nthread < 1) {
+        throw std::domain_error("The number of threads must be strictly positive.");
+    }
+    const long nbasis = get_nbasis();
+    const long* aux_basis_offsets = aux->get_basis_offsets();
+    const long* aux_prim_offsets = aux->get_prim_offsets();
+    // The fourth function is a constant: an s-type Gaussian with a zero exponent.
+    const double dummy_scale = 1.0;
+
+    // Each thread gets its own copy of the integral object and computes all
+    // integrals for the auxiliary shells it takes. Hence, every output element is
+    // written by one thread and the result does not depend on the number of threads.
+    std::vector<GB4Integral*> integrals(nthread, integral);
+    for (long ithread=1; ithread < nthread; ithread++) {
+        integrals[ithread] = integral->clone();
+    }
+    std::atomic<long> next_shell(0);
+
+    try {
+        run_in_threads(nthread, [&](long ithread) {
+            GB4Integral* my_integral = integrals[ithread];
+            long ishellp;
+            while ((ishellp = next_shell++) < aux->nshell) {
+                const long shell_typep = aux->shell_types[ishellp];
+                const double* rp = aux->centers + 3*aux->shell_map[ishellp];
+                const long np = get_shell_nbasis(shell_typep);
+                for (long ishell0=0; ishell0 < nshell; ishell0++) {
+                    const double* r0 = centers + 3*shell_map[ishell0];
+                    const long n0 = get_shell_nbasis(shell_types[ishell0]);
+                    for (long ishell1=0; ishell1 <= ishell0; ishell1++) {
+                        const double* r1 = centers + 3*shell_map[ishell1];
+                        const long n1 = get_shell_nbasis(shell_types[ishell1]);
+                        // (01|p) in chemist's notation is <0p|1x> in physicist's
+                        // notation, where x is the constant function.
+                        my_integral->reset(shell_types[ishell0], shell_typep,
+                                           shell_types[ishell1], 0, r0, rp, r1, rp);
+                        for (long iprim0=prim_offsets[ishell0];
+                             iprim0 < prim_offsets[ishell0] + nprims[ishell0]; iprim0++) {
+                            for (long iprim1=prim_offsets[ishell1];
+                                 iprim1 < prim_offsets[ishell1] + nprims[ishell1]; iprim1++) {
+                                for (long iprimp=aux_prim_offsets[ishellp];
+                                     iprimp < aux_prim_offsets[ishellp] + aux->nprims[ishellp];
+                                     iprimp++) {
+                                    my_integral->add(
+                                        con_coeffs[iprim0]*con_coeffs[iprim1]*
+                                        aux->con_coeffs[iprimp],
+                                        alphas[iprim0], aux->alphas[iprimp], alphas[iprim1],
+                                        0.0, get_scales(iprim0), aux->get_scales(iprimp),
+                                        get_scales(iprim1), &dummy_scale);
+                                }
+                            }
+                        }
+                        my_integral->cart_to_pure();
+                        const double* work = my_integral->get_work();
+                        for (long i0=0; i0 < n0; i0++) {
+                            const long ibasis0 = basis_offsets[ishell0] + i0;
+                            for (long ip=0; ip < np; ip++) {
+                                double* block = output +
+                                    (aux_basis_offsets[ishellp] + ip)*nbasis*nbasis;
+                                for (long i1=0; i1 < n1; i1++) {
+                                    const long ibasis1 = basis_offsets[ishell1] + i1;
+                                    const double value = work[(i0*np + ip)*n1 + i1];
+                                    block[ibasis0*nbasis + ibasis1] = value;
+                                    block[ibasis1*nbasis + ibasis0] = value;
+                                }
+                            }
+                        }
+                    }
+                }
+            }
+        });
+    } catch (...) {
+        for (long ithread=1; ithread < nthread; ithread++) delete integrals[ithread];
+        throw;
+    }
+
+    for (long ithread=1; ithread < nthread; ithread++) delete integrals[ithread];
+}
+
+void GBasis::compute_two_center(double* output, GB4Integral* integral) {
+    // The constant function x is used as in compute_three_center.
+    const double dummy_scale = 1.0;
+    for (long ishell0=0; ishell0 < nshell; ishell0++) {
+        const double* r0 = centers + 3*shell_map[ishell0];
+        const long n0 = get_shell_nbasis(shell_types[ishell0]);
+        for (long ishell1=0; ishell1 <= ishell0; ishell1++) {
+            const double* r1 = centers + 3*shell_map[ishell1];
+            const long n1 = get_shell_nbasis(shell_types[ishell1]);
+            // (0|1) = (0x|1x) in chemist's notation is <01|xx> in physicist's notation.
+            integral->reset(shell_types[ishell0], shell_types[ishell1], 0, 0, r0, r1, r0, r1);
+            for (long iprim0=prim_offsets[ishell0];
+                 iprim0 < prim_offsets[ishell0] + nprims[ishell0]; iprim0++) {
+                for (long iprim1=prim_offsets[ishell1];
+                     iprim1 < prim_offsets[ishell1] + nprims[ishell1]; iprim1++) {
+                    integral->add(con_coeffs[iprim0]*con_coeffs[iprim1],
+                                  alphas[iprim0], alphas[iprim1], 0.0, 0.0,
+                                  get_scales(iprim0), get_scales(iprim1),
+                                  &dummy_scale, &dummy_scale);
+                }
+            }
+            integral->cart_to_pure();
+            const double* work = integral->get_work();
+            for (long i0=0; i0 < n0; i0++) {
+                const long ibasis0 = basis_offsets[ishell0] + i0;
+                for (long i1=0; i1 < n1; i1++) {
+                    const long ibasis1 = basis_offsets[ishell1] + i1;
+                    output[ibasis0*nbasis + ibasis1] = work[i0*n1 + i1];
+                    output[ibasis1*nbasis + ibasis0] = work[i0*n1 + i1];
+                }
+            }
+        }
+    }
 }
 
 void GBasis::compute_grid_point1(double* output, double* point, GB1GridFn* grid_fn) {
     IterGB1 iter = IterGB1(this);
     iter.update_shell();
     do {
+        // Skip shells that do not reach the grid point.
+        double extent = shell_extents[iter.ishell0];
+        if (dist_sq(iter.r0, point) > extent*extent) continue;
         grid_fn->reset(iter.shell_type0, iter.r0, point);
         iter.update_prim();
         do {
@@ -191,6 +722,44 @@ void GBasis::compute_grid_point1(double* output, double* point, GB1GridFn* grid_
     } while (iter.inc_shell());
 }
 
+long GBasis::compute_grid_block1(double* output, long* basis_indexes, long nblock,
+                                 double* points, GB1GridFn* grid_fn) {
+    // Select the basis functions of the shells that reach at least one grid point.
+    long nsig = 0;
+    for (long ishell=0; ishell < nshell; ishell++) {
+        const double* r0 = centers + 3*shell_map[ishell];
+        double extent = shell_extents[ishell];
+        bool reach = false;
+        for (long ipoint=0; ipoint < nblock; ipoint++) {
+            if (dist_sq(r0, points + 3*ipoint) <= extent*extent) {
+                reach = true;
+                break;
+            }
+        }
+        if (!reach) continue;
+        long end = basis_offsets[ishell] + get_shell_nbasis(shell_types[ishell]);
+        for (long ibasis=basis_offsets[ishell]; ibasis < end; ibasis++) {
+            basis_indexes[nsig] = ibasis;
+            nsig++;
+        }
+    }
+
+    // Evaluate and store the results component by component.
+    long dim_work = grid_fn->get_dim_work();
+    std::vector<double> work_basis(nbasis*dim_work);
+    for (long ipoint=0; ipoint < nblock; ipoint++) {
+        std::fill(work_basis.begin(), work_basis.end(), 0.0);
+        compute_grid_point1(&work_basis[0], points + 3*ipoint, grid_fn);
+        for (long isig=0; isig < nsig; isig++) {
+            long ibasis = basis_indexes[isig];
+            for (long k=0; k < dim_work; k++) {
+                output[(k*nblock + ipoint)*nsig + isig] = work_basis[ibasis*dim_work + k];
+            }
+        }
+    }
+    return nsig;
+}
+
 double GBasis::compute_grid_point2(double* dm, double* point, GB2DMGridFn* grid_fn) {
     double result = 0.0;
     IterGB2 iter = IterGB2(this);
@@ -213,6 +782,7 @@ GOBasis::GOBasis(const double* centers, const long* shell_map, const long* nprim
     GBasis(centers, shell_map, nprims, shell_types, alphas, con_coeffs,
     ncenter, nshell, nprim_total) {
     init_scales();
+    set_grid_tolerance(1e-20);
 }
 
 const double GOBasis::normalization(const double alpha, const long* n) const {
@@ -255,158 +825,592 @@ void GOBasis::compute_multipole_moment(long* xyz, double* center, double* output
     compute_two_index(output, &integral);
 }
 
-void GOBasis::compute_electron_repulsion(double* output) {
+void GOBasis::compute_multipole_moments(long lmax, double* centers, long ncenter,
+                                        double* output) {
+    if (lmax < 0) {
+        throw std::domain_error("The order of the multipole moments can not be negative.");
+    }
+    init_shell_pairs();
+    const long nbasis = get_nbasis();
+
+    // The powers of x, y and z for every moment.
+    const long nmoment = ((lmax + 1)*(lmax + 2)*(lmax + 3))/6;
+    std::vector<long> powers(3*nmoment);
+    long imoment = 0;
+    for (long l=0; l <= lmax; l++) {
+        long n[3] = {l, 0, 0};
+        do {
+            std::copy(n, n + 3, &powers[3*imoment]);
+            imoment++;
+        } while (iter_pow1_inc(n));
+    }
+
+    // All moments for all centers are computed together, as one block of integrals
+    // for every pair of shells, with shape (nblock, n0, n1).
+    const long nblock = ncenter*nmoment;
+    const long max_ncart = get_shell_nbasis(get_max_shell_type());
+    std::vector<double> work_cart(nblock*max_ncart*max_ncart);
+    std::vector<double> work_pure(nblock*max_ncart*max_ncart);
+    // One-dimensional moment integrals for every center and Cartesian direction.
+    const long table_size = (get_max_shell_type() + 1)*(get_max_shell_type() + 1)*(lmax + 1);
+    std::vector<double> tables(ncenter*3*table_size);
+    IterPow2 i2p;
+
+    for (long ishell0=0; ishell0 < nshell; ishell0++) {
+        const long shell_type0 = shell_types[ishell0];
+        const double* r0 = this->centers + 3*shell_map[ishell0];
+        for (long ishell1=0; ishell1 <= ishell0; ishell1++) {
+            const long shell_type1 = shell_types[ishell1];
+            const double* r1 = this->centers + 3*shell_map[ishell1];
+            long n0 = get_shell_nbasis(abs(shell_type0));
+            long n1 = get_shell_nbasis(abs(shell_type1));
+            double* work = &work_cart[0];
+            double* other = &work_pure[0];
+            std::fill(work, work + nblock*n0*n1, 0.0);
+
+            if (get_shell_pair_magnitudes()[ishell0*nshell + ishell1] > 0) {
+                const long l0 = abs(shell_type0);
+                const long l1 = abs(shell_type1);
+                const long stride0 = (l1 + 1)*(lmax + 1);
+                const prim_pair_t* pairs = get_prim_pairs(ishell0, ishell1, NULL);
+                for (long ipair=0; ipair < nprims[ishell0]*nprims[ishell1]; ipair++) {
+                    const prim_pair_t* pair = pairs + ipair;
+                    for (long icenter=0; icenter < ncenter; icenter++) {
+                        for (long i=0; i < 3; i++) {
+                            compute_moment_table(
+                                l0, l1, lmax, pair->gpt_center[i] - r0[i],
+                                pair->gpt_center[i] - r1[i],
+                                pair->gpt_center[i] - centers[3*icenter + i],
+                                pair->gamma_inv, &tables[(3*icenter + i)*table_size]);
+                        }
+                    }
+                    const double pre = pair->coeff*pair->prefac;
+                    i2p.reset(l0, l1);
+                    do {
+                        const double factor = pre*pair->scales0[i2p.ibasis0]*
+                                              pair->scales1[i2p.ibasis1];
+                        for (long icenter=0; icenter < ncenter; icenter++) {
+                            const double* tx = &tables[3*icenter*table_size] +
+                                               i2p.n0[0]*stride0 + i2p.n1[0]*(lmax + 1);
+                            const double* ty = &tables[(3*icenter + 1)*table_size] +
+                                               i2p.n0[1]*stride0 + i2p.n1[1]*(lmax + 1);
+                            const double* tz = &tables[(3*icenter + 2)*table_size] +
+                                               i2p.n0[2]*stride0 + i2p.n1[2]*(lmax + 1);
+                            double* block = work + icenter*nmoment*n0*n1 + i2p.offset;
+                            for (imoment=0; imoment < nmoment; imoment++) {
+                                block[imoment*n0*n1] += factor*tx[powers[3*imoment]]*
+                                                        ty[powers[3*imoment + 1]]*
+                                                        tz[powers[3*imoment + 2]];
+                            }
+                        }
+                    } while (i2p.inc());
+                }
+            }
+
+            // Transform to pure functions where needed.
+            if (shell_type0 < -1) {
+                cart_to_pure_low(work, other, -shell_type0, nblock, n1);
+                std::swap(work, other);
+                n0 = get_shell_nbasis(shell_type0);
+            }
+            if (shell_type1 < -1) {
+                cart_to_pure_low(work, other, -shell_type1, nblock*n0, 1);
+                std::swap(work, other);
+                n1 = get_shell_nbasis(shell_type1);
+            }
+
+            // Store the block and its transpose.
+            const long ibasis0 = get_basis_offsets()[ishell0];
+            const long ibasis1 = get_basis_offsets()[ishell1];
+            for (long iblock=0; iblock < nblock; iblock++) {
+                double* out = output + iblock*nbasis*nbasis;
+                for (long i0=0; i0 < n0; i0++) {
+                    for (long i1=0; i1 < n1; i1++) {
+                        const double value = work[(iblock*n0 + i0)*n1 + i1];
+                        out[(ibasis0 + i0)*nbasis + ibasis1 + i1] = value;
+                        out[(ibasis1 + i1)*nbasis + ibasis0 + i0] = value;
+                    }
+                }
+            }
+        }
+    }
+}
+
+long GOBasis::compute_electron_repulsion(double* output, double screening_threshold,
+                                         long nthread, bool packed) {
   GB4ElectronRepulsionIntegralLibInt integral =
     GB4ElectronRepulsionIntegralLibInt(get_max_shell_type());
-  compute_four_index(output, &integral);
+  return compute_four_index(output, &integral, screening_threshold, nthread, packed);
 }
 
-void GOBasis::compute_erf_repulsion(double* output, double mu) {
+long GOBasis::compute_erf_repulsion(double* output, double mu, double screening_threshold,
+                                    long nthread, bool packed) {
     GB4ErfIntegralLibInt integral = GB4ErfIntegralLibInt(get_max_shell_type(), mu);
-    compute_four_index(output, &integral);
+    return compute_four_index(output, &integral, screening_threshold, nthread, packed);
 }
 
-void GOBasis::compute_gauss_repulsion(double* output, double c, double alpha) {
+long GOBasis::compute_gauss_repulsion(double* output, double c, double alpha,
+                                      double screening_threshold, long nthread,
+                                      bool packed) {
     GB4GaussIntegralLibInt integral = GB4GaussIntegralLibInt(get_max_shell_type(), c, alpha);
-    compute_four_index(output, &integral);
+    return compute_four_index(output, &integral, screening_threshold, nthread, packed);
 }
 
-void GOBasis::compute_ralpha_repulsion(double* output, double alpha) {
+long GOBasis::compute_ralpha_repulsion(double* output, double alpha,
+                                       double screening_threshold, long nthread,
+                                       bool packed) {
     GB4RAlphaIntegralLibInt integral = GB4RAlphaIntegralLibInt(get_max_shell_type(), alpha);
-    compute_four_index(output, &integral);
+    return compute_four_index(output, &integral, screening_threshold, nthread, packed);
 }
 
-void GOBasis::compute_grid1_exp(long nfn, double* coeffs, long npoint, double* points,
-                                long norb, long* iorbs, double* output) {
-    // The work array contains the basis functions evaluated at the grid point,
-    // and optionally some of its derivatives.
-    GB1ExpGridOrbitalFn grid_fn = GB1ExpGridOrbitalFn(get_max_shell_type(), nfn, iorbs, norb);
+long GOBasis::compute_electron_repulsion_direct(const double* dm, double* coulomb,
+                                                double* exchange,
+                                                double screening_threshold,
+                                                long nthread) {
+    GB4ElectronRepulsionIntegralLibInt integral =
+      GB4ElectronRepulsionIntegralLibInt(get_max_shell_type());
+    return compute_four_index_direct(&integral, dm, coulomb, exchange,
+                                     screening_threshold, nthread);
+}
 
-    long nwork = get_nbasis()*grid_fn.get_dim_work();
-    long dim_output = grid_fn.get_dim_output();
-    double* work_basis = new double[nwork];
+long GOBasis::compute_erf_repulsion_direct(const double* dm, double* coulomb,
+                                           double* exchange, double mu,
+                                           double screening_threshold, long nthread) {
+    GB4ErfIntegralLibInt integral = GB4ErfIntegralLibInt(get_max_shell_type(), mu);
+    return compute_four_index_direct(&integral, dm, coulomb, exchange,
+                                     screening_threshold, nthread);
+}
 
-    for (long ipoint=0; ipoint < npoint; ipoint++) {
-        // A) clear the basis functions.
-        memset(work_basis, 0, nwork*sizeof(double));
+long GOBasis::compute_gauss_repulsion_direct(const double* dm, double* coulomb,
+                                             double* exchange, double c, double alpha,
+                                             double screening_threshold, long nthread) {
+    GB4GaussIntegralLibInt integral = GB4GaussIntegralLibInt(get_max_shell_type(), c, alpha);
+    return compute_four_index_direct(&integral, dm, coulomb, exchange,
+                                     screening_threshold, nthread);
+}
 
-        // B) evaluate the basis functions in the current point.
-        compute_grid_point1(work_basis, points, &grid_fn);
+long GOBasis::compute_ralpha_repulsion_direct(const double* dm, double* coulomb,
+                                              double* exchange, double alpha,
+                                              double screening_threshold, long nthread) {
+    GB4RAlphaIntegralLibInt integral = GB4RAlphaIntegralLibInt(get_max_shell_type(), alpha);
+    return compute_four_index_direct(&integral, dm, coulomb, exchange,
+                                     screening_threshold, nthread);
+}
 
-        // C) Use the basis function results and the density matrix to evaluate
-        // the function at the grid point. The result is added to the output.
-        grid_fn.compute_point_from_exp(work_basis, coeffs, get_nbasis(), output);
+void GOBasis::compute_electron_repulsion_three_center(double* output, GOBasis* aux,
+                                                     long nthread) {
+    GB4ElectronRepulsionIntegralLibInt integral = GB4ElectronRepulsionIntegralLibInt(
+        std::max(get_max_shell_type(), aux->get_max_shell_type()));
+    compute_three_center(output, aux, &integral, nthread);
+}
 
-        // D) Prepare for next iteration
-        output += dim_output;
-        points += 3;
+void GOBasis::compute_electron_repulsion_two_center(double* output) {
+    GB4ElectronRepulsionIntegralLibInt integral =
+      GB4ElectronRepulsionIntegralLibInt(get_max_shell_type());
+    compute_two_center(output, &integral);
+}
+
+void GOBasis::compute_grid1_exp(long nfn, double* coeffs, long npoint, double* points,
+                                long norb, long* iorbs, double* output, long nthread) {
+    if (nthread < 1) {
+        throw std::domain_error("The number of threads must be strictly positive.");
     }
+    // Blocks of grid points are distributed statically over the threads.
+    const long nblock_total = (npoint + GB1_BLOCK_SIZE - 1)/GB1_BLOCK_SIZE;
+    run_in_threads(nthread, [&](long ithread) {
+        // The work array contains the basis functions evaluated at the grid point,
+        // and optionally some of its derivatives.
+        GB1ExpGridOrbitalFn grid_fn = GB1ExpGridOrbitalFn(get_max_shell_type(), nfn, iorbs,
+                                                          norb);
+        long nwork = get_nbasis()*grid_fn.get_dim_work();
+        long dim_output = grid_fn.get_dim_output();
+        std::vector<double> work_basis(nwork);
+
+        for (long iblock=ithread; iblock < nblock_total; iblock += nthread) {
+            long end = std::min((iblock + 1)*GB1_BLOCK_SIZE, npoint);
+            for (long ipoint=iblock*GB1_BLOCK_SIZE; ipoint < end; ipoint++) {
+                // A) clear the basis functions.
+                std::fill(work_basis.begin(), work_basis.end(), 0.0);
 
-    delete[] work_basis;
+                // B) evaluate the basis functions in the current point.
+                compute_grid_point1(&work_basis[0], points + 3*ipoint, &grid_fn);
+
+                // C) Use the basis function results and the orbital coefficients to
+                // evaluate the function at the grid point. The result is added to the
+                // output.
+                grid_fn.compute_point_from_exp(&work_basis[0], coeffs, get_nbasis(),
+                                               output + ipoint*dim_output);
+            }
+        }
+    });
 }
 
 void GOBasis::compute_grid1_grad_exp(long nfn, double* coeffs, long npoint,
-                                     double* points, long norb, long* iorbs, double* output) {
-    // The work array contains the basis functions evaluated at the grid point,
-    // and optionally some of its derivatives.
-    GB1ExpGridOrbGradientFn grid_fn = GB1ExpGridOrbGradientFn(get_max_shell_type(),
-                                                              nfn, iorbs, norb);
+                                     double* points, long norb, long* iorbs, double* output,
+                                     long nthread) {
+    if (nthread < 1) {
+        throw std::domain_error("The number of threads must be strictly positive.");
+    }
+    // Blocks of grid points are distributed statically over the threads.
+    const long nblock_total = (npoint + GB1_BLOCK_SIZE - 1)/GB1_BLOCK_SIZE;
+    run_in_threads(nthread, [&](long ithread) {
+        // The work array contains the basis functions evaluated at the grid point,
+        // and optionally some of its derivatives.
+        GB1ExpGridOrbGradientFn grid_fn = GB1ExpGridOrbGradientFn(get_max_shell_type(),
+                                                                  nfn, iorbs, norb);
+        long nwork = get_nbasis()*grid_fn.get_dim_work();
+        long dim_output = grid_fn.get_dim_output();
+        std::vector<double> work_basis(nwork);
 
-    long nwork = get_nbasis()*grid_fn.get_dim_work();
-    long dim_output = grid_fn.get_dim_output();
-    double* work_basis = new double[nwork];
+        for (long iblock=ithread; iblock < nblock_total; iblock += nthread) {
+            long end = std::min((iblock + 1)*GB1_BLOCK_SIZE, npoint);
+            for (long ipoint=iblock*GB1_BLOCK_SIZE; ipoint < end; ipoint++) {
+                // A) clear the basis functions.
+                std::fill(work_basis.begin(), work_basis.end(), 0.0);
 
-    for (long ipoint=0; ipoint < npoint; ipoint++) {
-        // A) clear the basis functions.
-        memset(work_basis, 0, nwork*sizeof(double));
+                // B) evaluate the basis functions in the current point.
+                compute_grid_point1(&work_basis[0], points + 3*ipoint, &grid_fn);
 
-        // B) evaluate the basis functions in the current point.
-        compute_grid_point1(work_basis, points, &grid_fn);
+                // C) Use the basis function results and the orbital coefficients to
+                // evaluate the function at the grid point. The result is added to the
+                // output.
+                grid_fn.compute_point_from_exp(&work_basis[0], coeffs, get_nbasis(),
+                                               output + ipoint*dim_output);
+            }
+        }
+    });
+}
 
-        // C) Use the basis function results and the density matrix to evaluate
-        // the function at the grid point. The result is added to the output.
-        grid_fn.compute_point_from_exp(work_basis, coeffs, get_nbasis(), output);
+void GOBasis::compute_grid1_dm(double* dm, long npoint, double* points,
+                               GB1DMGridFn* grid_fn, double* output,
+                               double epsilon, double* dmmaxrow, long nthread) {
+    if (nthread < 1) {
+        throw std::domain_error("The number of threads must be strictly positive.");
+    }
+    long nbasis = get_nbasis();
+    long nwork = nbasis*grid_fn->get_dim_work();
+    long dim_output = grid_fn->get_dim_output();
+    std::vector<GB1DMGridFn*> grid_fns(nthread, grid_fn);
+    for (long ithread=1; ithread < nthread; ithread++) {
+        grid_fns[ithread] = grid_fn->clone();
+    }
+
+    // Blocks of grid points are distributed statically over the threads. Each block
+    // writes to its own part of the output.
+    const long nblock_total = (npoint + GB1_BLOCK_SIZE - 1)/GB1_BLOCK_SIZE;
+    try {
+        run_in_threads(nthread, [&](long ithread) {
+            GB1DMGridFn* my_grid_fn = grid_fns[ithread];
+            // The work array contains the basis functions evaluated at a block of grid
+            // points, and optionally some of their derivatives.
+            std::vector<double> work_block(GB1_BLOCK_SIZE*nwork);
+            // Only the basis functions that are significant in a block are used,
+            // together with the corresponding block of the density matrix.
+            std::vector<long> basis_indexes(nbasis);
+            std::vector<double> dm_block(nbasis*nbasis);
+            std::vector<double> dmmaxrow_block(nbasis);
+
+            for (long iblock=ithread; iblock < nblock_total; iblock += nthread) {
+                long ipoint = iblock*GB1_BLOCK_SIZE;
+                long nblock = std::min(static_cast<long>(GB1_BLOCK_SIZE), npoint - ipoint);
+                double* my_output = output + ipoint*dim_output;
+
+                // A) evaluate the basis functions in the current block of points.
+                long nsig = compute_grid_block1(&work_block[0], &basis_indexes[0], nblock,
+                                                points + 3*ipoint, my_grid_fn);
 
-        // D) Prepare for next iteration
-        output += dim_output;
-        points += 3;
+                // B) Use the basis function results and the density matrix to evaluate
+                // the function in the block of grid points. The result is added to the
+                // output.
+                if (nsig == nbasis) {
+                    my_grid_fn->compute_block_from_dm(&work_block[0], dm, nbasis, nblock,
+                                                      my_output, epsilon, dmmaxrow);
+                } else if (nsig > 0) {
+                    for (long isig0=0; isig0 < nsig; isig0++) {
+                        long ibasis0 = basis_indexes[isig0];
+                        for (long isig1=0; isig1 < nsig; isig1++) {
+                            dm_block[isig0*nsig + isig1] =
+                                dm[ibasis0*nbasis + basis_indexes[isig1]];
+                        }
+                        if (dmmaxrow != NULL) dmmaxrow_block[isig0] = dmmaxrow[ibasis0];
+                    }
+                    my_grid_fn->compute_block_from_dm(
+                        &work_block[0], &dm_block[0], nsig, nblock, my_output, epsilon,
+                        (dmmaxrow == NULL) ? NULL : &dmmaxrow_block[0]);
+                }
+            }
+        });
+    } catch (...) {
+        for (long ithread=1; ithread < nthread; ithread++) delete grid_fns[ithread];
+        throw;
     }
+    for (long ithread=1; ithread < nthread; ithread++) delete grid_fns[ithread];
+}
 
-    delete[] work_basis;
+void GOBasis::compute_grid2_dm(double* dm, long npoint, double* points, double* output,
+                               double screening_threshold, long nthread) {
+    if (nthread < 1) {
+        throw std::domain_error("The number of threads must be strictly positive.");
+    }
+    if (screening_threshold > 0) {
+        compute_grid_hartree_screened(this, dm, npoint, points, output, screening_threshold,
+                                      nthread);
+        return;
+    }
+    // Blocks of grid points are distributed statically over the threads.
+    const long nblock_total = (npoint + GB1_BLOCK_SIZE - 1)/GB1_BLOCK_SIZE;
+    run_in_threads(nthread, [&](long ithread) {
+        // For the moment, it is only possible to compute the Hartree potential on
+        // a grid with this routine. Generalizations with electrical field and
+        // other things are for later.
+        GB2DMGridHartreeFn grid_fn = GB2DMGridHartreeFn(get_max_shell_type());
+
+        for (long iblock=ithread; iblock < nblock_total; iblock += nthread) {
+            long end = std::min((iblock + 1)*GB1_BLOCK_SIZE, npoint);
+            for (long ipoint=iblock*GB1_BLOCK_SIZE; ipoint < end; ipoint++) {
+                output[ipoint] += compute_grid_point2(dm, points + 3*ipoint, &grid_fn);
+            }
+        }
+    });
 }
 
-void GOBasis::compute_grid1_dm(double* dm, long npoint, double* points,
-                               GB1DMGridFn* grid_fn, double* output,
-                               double epsilon, double* dmmaxrow) {
-    // The work array contains the basis functions evaluated at the grid point,
-    // and optionally some of its derivatives.
-    long nwork = get_nbasis()*grid_fn->get_dim_work();
+void GOBasis::compute_grid1_fock(long npoint, double* points, double* weights, long pot_stride, double* pots, GB1DMGridFn* grid_fn, double* output, long nthread) {
+    if (nthread < 1) {
+        throw std::domain_error("The number of threads must be strictly positive.");
+    }
+    long nbasis = get_nbasis();
+    long nwork = nbasis*grid_fn->get_dim_work();
     long dim_output = grid_fn->get_dim_output();
-    double* work_basis = new double[nwork];
+    std::vector<GB1DMGridFn*> grid_fns(nthread, grid_fn);
+    for (long ithread=1; ithread < nthread; ithread++) {
+        grid_fns[ithread] = grid_fn->clone();
+    }
+    // The first thread adds directly to the output. The others accumulate into their
+    // own Fock matrix, which is added to the output at the end.
+    std::vector<double> focks((nthread - 1)*nbasis*nbasis, 0.0);
 
-    for (long ipoint=0; ipoint < npoint; ipoint++) {
-        // A) clear the basis functions.
-        memset(work_basis, 0, nwork*sizeof(double));
+    // Blocks of grid points are distributed statically over the threads.
+    const long nblock_total = (npoint + GB1_BLOCK_SIZE - 1)/GB1_BLOCK_SIZE;
+    try {
+        run_in_threads(nthread, [&](long ithread) {
+            GB1DMGridFn* my_grid_fn = grid_fns[ithread];
+            double* my_fock = (ithread == 0) ? output : &focks[(ithread - 1)*nbasis*nbasis];
+            // The work array contains the basis functions evaluated at a block of grid
+            // points, and optionally some of their derivatives.
+            std::vector<double> work_block(GB1_BLOCK_SIZE*nwork);
+            std::vector<double> work_pot(GB1_BLOCK_SIZE*dim_output);
+            // Only the basis functions that are significant in a block are used. Their
+            // contribution is first computed in a smaller Fock matrix.
+            std::vector<long> basis_indexes(nbasis);
+            std::vector<double> fock_block(nbasis*nbasis);
 
-        // B) evaluate the basis functions in the current point.
-        compute_grid_point1(work_basis, points, grid_fn);
-#ifdef DEBUG
-        for (int i=0; i<nwork; i++) printf("%f ", work_basis[i]);
-        printf("\n");
-#endif
+            for (long iblock=ithread; iblock < nblock_total; iblock += nthread) {
+                long ipoint = iblock*GB1_BLOCK_SIZE;
+                long nblock = std::min(static_cast<long>(GB1_BLOCK_SIZE), npoint - ipoint);
 
-        // C) Use the basis function results and the density matrix to evaluate
-        // the function at the grid point. The result is added to the output.
-        grid_fn->compute_point_from_dm(work_basis, dm, get_nbasis(), output, epsilon, dmmaxrow);
+                // A) evaluate the basis functions in the current block of points.
+                long nsig = compute_grid_block1(&work_block[0], &basis_indexes[0], nblock,
+                                                points + 3*ipoint, my_grid_fn);
 
-        // D) Prepare for next iteration
-        output += dim_output;
-        points += 3;
+                // B) Add the contribution from this block of grid points to the operator
+                for (long i=0; i < nblock; i++) {
+                    for (long j=dim_output-1; j >= 0; j--) {
+                        work_pot[i*dim_output + j] =
+                            weights[ipoint + i]*pots[(ipoint + i)*pot_stride + j];
+                    }
+                }
+                if (nsig == nbasis) {
+                    my_grid_fn->compute_fock_from_block(&work_pot[0], &work_block[0], nbasis,
+                                                        nblock, my_fock);
+                } else if (nsig > 0) {
+                    std::fill(fock_block.begin(), fock_block.begin() + nsig*nsig, 0.0);
+                    my_grid_fn->compute_fock_from_block(&work_pot[0], &work_block[0], nsig,
+                                                        nblock, &fock_block[0]);
+                    for (long isig0=0; isig0 < nsig; isig0++) {
+                        double* row = my_fock + basis_indexes[isig0]*nbasis;
+                        for (long isig1=0; isig1 < nsig; isig1++) {
+                            row[basis_indexes[isig1]] += fock_block[isig0*nsig + isig1];
+                        }
+                    }
+                }
+            }
+        });
+    } catch (...) {
+        for (long ithread=1; ithread < nthread; ithread++) delete grid_fns[ithread];
+        throw;
     }
 
-    delete[] work_basis;
+    // Sum the contributions of the other threads, always in the same order.
+    for (long ithread=1; ithread < nthread; ithread++) {
+        for (long i=0; i < nbasis*nbasis; i++) {
+            output[i] += focks[(ithread - 1)*nbasis*nbasis + i];
+        }
+        delete grid_fns[ithread];
+    }
 }
 
-void GOBasis::compute_grid2_dm(double* dm, long npoint, double* points, double* output) {
-    // For the moment, it is only possible to compute the Hartree potential on
-    // a grid with this routine. Generalizations with electrical field and
-    // other things are for later.
-    GB2DMGridHartreeFn grid_fn = GB2DMGridHartreeFn(get_max_shell_type());
+void GOBasis::compute_grid1_dm_multi(long ndm, double* dms, long npoint, double* points,
+                                     GB1DMGridFn* grid_fn, double* output, double epsilon,
+                                     double* dmmaxrows, long nthread) {
+    if (nthread < 1) {
+        throw std::domain_error("The number of threads must be strictly positive.");
+    }
+    long nbasis = get_nbasis();
+    long nwork = nbasis*grid_fn->get_dim_work();
+    long dim_output = grid_fn->get_dim_output();
+    std::vector<GB1DMGridFn*> grid_fns(nthread, grid_fn);
+    for (long ithread=1; ithread < nthread; ithread++) {
+        grid_fns[ithread] = grid_fn->clone();
+    }
 
-    for (long ipoint=0; ipoint < npoint; ipoint++) {
-        *output += compute_grid_point2(dm, points, &grid_fn);
-        output++;
-        points += 3;
+    // Blocks of grid points are distributed statically over the threads. Each block
+    // writes to its own part of the output.
+    const long nblock_total = (npoint + GB1_BLOCK_SIZE - 1)/GB1_BLOCK_SIZE;
+    try {
+        run_in_threads(nthread, [&](long ithread) {
+            GB1DMGridFn* my_grid_fn = grid_fns[ithread];
+            // The basis functions in a block of grid points are evaluated once and
+            // reused for all density matrices.
+            std::vector<double> work_block(GB1_BLOCK_SIZE*nwork);
+            std::vector<double> output_block(GB1_BLOCK_SIZE*dim_output);
+            std::vector<long> basis_indexes(nbasis);
+            std::vector<double> dm_block(nbasis*nbasis);
+            std::vector<double> dmmaxrow_block(nbasis);
+
+            for (long iblock=ithread; iblock < nblock_total; iblock += nthread) {
+                long ipoint = iblock*GB1_BLOCK_SIZE;
+                long nblock = std::min(static_cast<long>(GB1_BLOCK_SIZE), npoint - ipoint);
+
+                // A) evaluate the basis functions in the current block of points.
+                long nsig = compute_grid_block1(&work_block[0], &basis_indexes[0], nblock,
+                                                points + 3*ipoint, my_grid_fn);
+                if (nsig == 0) continue;
+
+                // B) Evaluate the function for each density matrix and add it to the
+                // output.
+                for (long idm=0; idm < ndm; idm++) {
+                    double* dm = dms + idm*nbasis*nbasis;
+                    double* dmmaxrow = (dmmaxrows == NULL) ? NULL : dmmaxrows + idm*nbasis;
+                    std::fill(output_block.begin(), output_block.begin() + nblock*dim_output,
+                              0.0);
+                    if (nsig == nbasis) {
+                        my_grid_fn->compute_block_from_dm(&work_block[0], dm, nbasis, nblock,
+                                                          &output_block[0], epsilon,
+                                                          dmmaxrow);
+                    } else {
+                        for (long isig0=0; isig0 < nsig; isig0++) {
+                            long ibasis0 = basis_indexes[isig0];
+                            for (long isig1=0; isig1 < nsig; isig1++) {
+                                dm_block[isig0*nsig + isig1] =
+                                    dm[ibasis0*nbasis + basis_indexes[isig1]];
+                            }
+                            if (dmmaxrow != NULL) dmmaxrow_block[isig0] = dmmaxrow[ibasis0];
+                        }
+                        my_grid_fn->compute_block_from_dm(
+                            &work_block[0], &dm_block[0], nsig, nblock, &output_block[0],
+                            epsilon, (dmmaxrow == NULL) ? NULL : &dmmaxrow_block[0]);
+                    }
+                    for (long i=0; i < nblock; i++) {
+                        double* my_output = output + ((ipoint + i)*ndm + idm)*dim_output;
+                        for (long j=0; j < dim_output; j++) {
+                            my_output[j] += output_block[i*dim_output + j];
+                        }
+                    }
+                }
+            }
+        });
+    } catch (...) {
+        for (long ithread=1; ithread < nthread; ithread++) delete grid_fns[ithread];
+        throw;
     }
+    for (long ithread=1; ithread < nthread; ithread++) delete grid_fns[ithread];
 }
 
-void GOBasis::compute_grid1_fock(long npoint, double* points, double* weights, long pot_stride, double* pots, GB1DMGridFn* grid_fn, double* output) {
-    // The work array contains the basis functions evaluated at the grid point,
-    // and optionally some of its derivatives.
-    long nwork = get_nbasis()*grid_fn->get_dim_work();
-    double* work_basis = new double[nwork];
+void GOBasis::compute_grid1_fock_multi(long nfock, long npoint, double* points,
+                                       double* weights, double* pots, GB1DMGridFn* grid_fn,
+                                       double* output, long nthread) {
+    if (nthread < 1) {
+        throw std::domain_error("The number of threads must be strictly positive.");
+    }
+    long nbasis = get_nbasis();
+    long nfock_size = nbasis*nbasis;
+    long nwork = nbasis*grid_fn->get_dim_work();
     long dim_output = grid_fn->get_dim_output();
-    double* work_pot = new double[dim_output];
+    std::vector<GB1DMGridFn*> grid_fns(nthread, grid_fn);
+    for (long ithread=1; ithread < nthread; ithread++) {
+        grid_fns[ithread] = grid_fn->clone();
+    }
+    // The first thread adds directly to the output. The others accumulate into their
+    // own Fock matrices, which are added to the output at the end.
+    std::vector<double> focks((nthread - 1)*nfock*nfock_size, 0.0);
 
-    for (long ipoint=0; ipoint < npoint; ipoint++) {
-        // A) clear the work array.
-        memset(work_basis, 0, nwork*sizeof(double));
+    // Blocks of grid points are distributed statically over the threads.
+    const long nblock_total = (npoint + GB1_BLOCK_SIZE - 1)/GB1_BLOCK_SIZE;
+    try {
+        run_in_threads(nthread, [&](long ithread) {
+            GB1DMGridFn* my_grid_fn = grid_fns[ithread];
+            double* my_focks = (ithread == 0) ? output :
+                               &focks[(ithread - 1)*nfock*nfock_size];
+            // The basis functions in a block of grid points are evaluated once and
+            // reused for all potentials.
+            std::vector<double> work_block(GB1_BLOCK_SIZE*nwork);
+            std::vector<double> work_pot(GB1_BLOCK_SIZE*dim_output);
+            std::vector<long> basis_indexes(nbasis);
+            std::vector<double> fock_block(nfock_size);
 
-        // B) evaluate the basis functions in the current point.
-        compute_grid_point1(work_basis, points, grid_fn);
+            for (long iblock=ithread; iblock < nblock_total; iblock += nthread) {
+                long ipoint = iblock*GB1_BLOCK_SIZE;
+                long nblock = std::min(static_cast<long>(GB1_BLOCK_SIZE), npoint - ipoint);
 
-        // C) Add the contribution from this grid point to the operator
-        for (long i=dim_output-1; i >= 0; i--) {
-            work_pot[i] = (*weights)*pots[i];
-        }
-        grid_fn->compute_fock_from_pot(work_pot, work_basis, get_nbasis(), output);
+                // A) evaluate the basis functions in the current block of points.
+                long nsig = compute_grid_block1(&work_block[0], &basis_indexes[0], nblock,
+                                                points + 3*ipoint, my_grid_fn);
+                if (nsig == 0) continue;
 
-        // D) Prepare for next iteration
-        points += 3;
-        weights++;
-        pots += pot_stride;
+                // B) Add the contribution from this block of grid points to each operator.
+                for (long ifock=0; ifock < nfock; ifock++) {
+                    for (long i=0; i < nblock; i++) {
+                        const double* pot = pots + ((ipoint + i)*nfock + ifock)*dim_output;
+                        for (long j=0; j < dim_output; j++) {
+                            work_pot[i*dim_output + j] = weights[ipoint + i]*pot[j];
+                        }
+                    }
+                    double* fock = my_focks + ifock*nfock_size;
+                    if (nsig == nbasis) {
+                        my_grid_fn->compute_fock_from_block(&work_pot[0], &work_block[0],
+                                                            nbasis, nblock, fock);
+                    } else {
+                        std::fill(fock_block.begin(), fock_block.begin() + nsig*nsig, 0.0);
+                        my_grid_fn->compute_fock_from_block(&work_pot[0], &work_block[0],
+                                                            nsig, nblock, &fock_block[0]);
+                        for (long isig0=0; isig0 < nsig; isig0++) {
+                            double* row = fock + basis_indexes[isig0]*nbasis;
+                            for (long isig1=0; isig1 < nsig; isig1++) {
+                                row[basis_indexes[isig1]] += fock_block[isig0*nsig + isig1];
+                            }
+                        }
+                    }
+                }
+            }
+        });
+    } catch (...) {
+        for (long ithread=1; ithread < nthread; ithread++) delete grid_fns[ithread];
+        throw;
     }
 
-    delete[] work_basis;
-    delete[] work_pot;
+    // Sum the contributions of the other threads, always in the same order.
+    for (long ithread=1; ithread < nthread; ithread++) {
+        for (long i=0; i < nfock*nfock_size; i++) {
+            output[i] += focks[(ithread - 1)*nfock*nfock_size + i];
+        }
+        delete grid_fns[ithread];
+    }
+}
+
+void GOBasis::compute_grid1_density_fock_multi(long npoint, double* points, double* weights,
+                                               long nop, double* pots, double* output,
+                                               long nthread) {
+    // The potentials of the density have the layout (npoint, nop, 1).
+    GB1DMGridDensityFn grid_fn = GB1DMGridDensityFn(get_max_shell_type());
+    compute_grid1_fock_multi(nop, npoint, points, weights, pots, &grid_fn, output, nthread);
 }
@@ -23,6 +23,7 @@
 #ifndef HORTON_GBASIS_GBASIS_H
 #define HORTON_GBASIS_GBASIS_H
 
+#include <vector>
 #include "horton/gbasis/ints.h"
 #include "horton/gbasis/fns.h"
 
@@ -39,8 +40,18 @@ class GBasis {
         long* scales_offsets;
         long* shell_lookup;
         double* scales;  // pre-computed normalization constants.
+        double* shell_extents;  // radius beyond which a shell is negligible on a grid.
+        double grid_tolerance;
         long nbasis, nscales;
         long max_shell_type;
+        // Table of pairs of primitive shells, only allocated by init_shell_pairs.
+        prim_pair_t* prim_pairs;
+        long* shell_pair_offsets;  // first primitive pair of every shell pair.
+        double* shell_pair_magnitudes;
+        std::vector<double> shell_pair_centers;  // centers used for the table of pairs.
+
+        // Upper bound for the basis functions of a shell at a distance r from its center.
+        double shell_bound(long ishell, long oprim, double r) const;
 
     public:
         // Arrays that fully describe the basis set.
@@ -58,9 +69,195 @@ class GBasis {
         virtual ~GBasis();
         virtual const double normalization(const double alpha, const long* n) const = 0;
         void init_scales();
+
+        /** @brief
+                Sets the tolerance for the screening of shells on grids.
+
+            For every shell, a radius is computed beyond which the basis functions and
+            their first and second derivatives are (approximately) below the tolerance.
+            Grid routines skip shells whose radius does not reach a grid point. This must
+            be called after init_scales.
+
+            @param tolerance
+                The tolerance. When not positive, screening is disabled.
+         */
+        void set_grid_tolerance(double tolerance);
+
+        /** @brief
+                Precomputes the Gaussian product quantities for all pairs of primitive
+                shells.
+
+            The table contains the pairs of shells (ishell0, ishell1) with
+            ishell1 <= ishell0. It is computed when this is called for the first time
+            and it is only recomputed when the centers have changed since then. It
+            takes memory proportional to nprim_total^2. The integral routines call this
+            before they start threads, because this method is not thread-safe. This
+            must be called after init_scales.
+         */
+        void init_shell_pairs();
+
+        /** @brief
+                The pairs of primitive shells for a pair of shells.
+
+            This must be called after init_shell_pairs.
+
+            @param ishell0
+                The first shell.
+
+            @param ishell1
+                The second shell.
+
+            @param work
+                When ishell1 > ishell0, the pairs are not in the table and they are
+                copied, with swapped primitives, into this vector.
+
+            @return
+                The nprims[ishell0]*nprims[ishell1] pairs, with the primitive of
+                ishell1 as the fastest index.
+         */
+        const prim_pair_t* get_prim_pairs(long ishell0, long ishell1,
+                                          std::vector<prim_pair_t>* work) const;
+
+        /** @brief
+                The magnitudes of all pairs of shells, shape (nshell, nshell).
+
+            The magnitude is the sum over all primitive pairs of the absolute value of
+            their overlap integral, for the largest normalization constants. When it
+            is zero, all integrals of the pair are zero due to underflow, and they
+            are skipped. This must be called after init_shell_pairs.
+         */
+        const double* get_shell_pair_magnitudes() const {return shell_pair_magnitudes;}
+
         void compute_two_index(double* output, GB2Integral* integral);
-        void compute_four_index(double* output, GB4Integral* integral);
+        long compute_four_index(double* output, GB4Integral* integral,
+                                double screening_threshold, long nthread, bool packed);
+
+        /** @brief
+                Computes Schwarz upper bounds for all pairs of shells.
+
+            The bound for a pair of shells (a, c) is the square root of the
+            largest diagonal integral (ac|ac) (chemist's notation) within that
+            pair. The product of two such bounds is an upper bound for the
+            absolute value of all integrals in a shell quartet, provided the
+            two-body operator is positive definite.
+
+            @param bounds
+                The output array with shape (nshell, nshell).
+
+            @param integral
+                The four-center integral for which the bounds are computed.
+         */
+        void compute_shell_pair_bounds(double* bounds, GB4Integral* integral);
+
+        /** @brief
+                Contracts four-center integrals with a density matrix, without
+                storing the integrals.
+
+            The integrals are recomputed for every shell quartet and immediately
+            contracted with the density matrix. The memory usage is therefore
+            proportional to nbasis^2.
+
+            @param integral
+                The four-center integral to be contracted.
+
+            @param dm
+                The density matrix with shape (nbasis, nbasis).
+
+            @param coulomb
+                Output array with shape (nbasis, nbasis) for the Coulomb-type
+                contraction: coulomb[a,c] = sum_bd <ab|cd> dm[b,d]. May be NULL.
+
+            @param exchange
+                Output array with shape (nbasis, nbasis) for the exchange-type
+                contraction: exchange[a,d] = sum_bc <ab|cd> dm[c,b]. May be NULL.
+
+            @param screening_threshold
+                Shell quartets are skipped when the product of their Schwarz
+                bound and the largest relevant density matrix element is below
+                this threshold. Screening is disabled when the threshold is not
+                positive.
+
+            @param nthread
+                The number of threads. The result depends (only through
+                rounding errors) on the number of threads.
+
+            @return
+                The number of skipped shell quartets.
+         */
+        long compute_four_index_direct(GB4Integral* integral, const double* dm,
+                                       double* coulomb, double* exchange,
+                                       double screening_threshold, long nthread);
+
+        /** @brief
+                Computes three-center integrals (ab|P) with an auxiliary basis.
+
+            The auxiliary function P takes the place of a product of two basis
+            functions. These integrals are computed as four-center integrals in
+            which the fourth function is a constant.
+
+            @param output
+                The output array with shape (naux, nbasis, nbasis), where naux
+                is the number of functions in the auxiliary basis.
+
+            @param aux
+                The auxiliary basis.
+
+            @param integral
+                The four-center integral that defines the two-body operator. Its
+                maximum shell type must be large enough for both basis sets.
+
+            @param nthread
+                The number of threads. The result does not depend on the number
+                of threads.
+         */
+        void compute_three_center(double* output, GBasis* aux, GB4Integral* integral,
+                                  long nthread);
+
+        /** @brief
+                Computes two-center integrals (P|Q) between the basis functions.
+
+            These are used as the metric in density fitting, with this basis as
+            the auxiliary basis.
+
+            @param output
+                The output array with shape (nbasis, nbasis).
+
+            @param integral
+                The four-center integral that defines the two-body operator.
+         */
+        void compute_two_center(double* output, GB4Integral* integral);
+
         void compute_grid_point1(double* output, double* point, GB1GridFn* grid_fn);
+
+        /** @brief
+                Evaluate the basis functions on a block of grid points.
+
+            Only the basis functions of shells that reach at least one grid point of
+            the block (see set_grid_tolerance) are included in the output.
+
+            @param output
+                The output array with shape (dim_work, nblock, nsig), where nsig is the
+                return value. It is overwritten. (At least dim_work*nblock*nbasis
+                elements must be allocated.)
+
+            @param basis_indexes
+                The indexes of the nsig basis functions included in the output.
+                (At least nbasis elements must be allocated.)
+
+            @param nblock
+                The number of grid points.
+
+            @param points
+                The Cartesian coordinates of the grid points, shape (nblock, 3).
+
+            @param grid_fn
+                The grid function that evaluates the basis functions.
+
+            @return
+                The number of basis functions included in the output, nsig.
+         */
+        long compute_grid_block1(double* output, long* basis_indexes, long nblock,
+                                 double* points, GB1GridFn* grid_fn);
         double compute_grid_point2(double* dm, double* point, GB2DMGridFn* grid_fn);
 
         const long get_nbasis() const {return nbasis;}
@@ -70,6 +267,8 @@ class GBasis {
         const long* get_prim_offsets() const {return prim_offsets;}
         const long* get_shell_lookup() const {return shell_lookup;}
         const double* get_scales(long iprim) const {return scales + scales_offsets[iprim];}
+        const double* get_shell_extents() const {return shell_extents;}
+        const double get_grid_tolerance() const {return grid_tolerance;}
 };
 
 
@@ -164,8 +363,25 @@ class GOBasis : public GBasis {
 
             @param output
                 The output array with the integrals.
+
+            @param screening_threshold
+                Shell quartets whose Schwarz bound is below this threshold are
+                skipped and their integrals are set to zero. Screening is
+                disabled when the threshold is not positive.
+
+            @param nthread
+                The number of threads used to compute the integrals. The
+                result does not depend on the number of threads.
+
+            @param packed
+                When true, the output is stored in the packed format of
+                packed.h instead of a dense array.
+
+            @return
+                The number of skipped shell quartets.
          */
-        void compute_electron_repulsion(double* output);
+        long compute_electron_repulsion(double* output, double screening_threshold,
+                                        long nthread, bool packed);
 
         /** @brief
                 Computes the ERF electron repulsion integrals.
@@ -175,8 +391,25 @@ class GOBasis : public GBasis {
 
             @param mu
                 The range-separation parameter.
+
+            @param screening_threshold
+                Shell quartets whose Schwarz bound is below this threshold are
+                skipped and their integrals are set to zero. Screening is
+                disabled when the threshold is not positive.
+
+            @param nthread
+                The number of threads used to compute the integrals. The
+                result does not depend on the number of threads.
+
+            @param packed
+                When true, the output is stored in the packed format of
+                packed.h instead of a dense array.
+
+            @return
+                The number of skipped shell quartets.
          */
-        void compute_erf_repulsion(double* output, double mu);
+        long compute_erf_repulsion(double* output, double mu, double screening_threshold,
+                                   long nthread, bool packed);
 
         /** @brief
                 Computes the Gaussian electron repulsion integrals.
@@ -189,8 +422,26 @@ class GOBasis : public GBasis {
 
             @param alpha
                 Exponential parameter of the gaussian.
+
+            @param screening_threshold
+                Shell quartets whose Schwarz bound is below this threshold are
+                skipped and their integrals are set to zero. Screening is
+                disabled when the threshold is not positive.
+
+            @param nthread
+                The number of threads used to compute the integrals. The
+                result does not depend on the number of threads.
+
+            @param packed
+                When true, the output is stored in the packed format of
+                packed.h instead of a dense array.
+
+            @return
+                The number of skipped shell quartets.
          */
-        void compute_gauss_repulsion(double* output, double c, double alpha);
+        long compute_gauss_repulsion(double* output, double c, double alpha,
+                                     double screening_threshold, long nthread,
+                                     bool packed);
 
         /** @brief
                 Computes the r^alpha electron repulsion integrals.
@@ -200,8 +451,84 @@ class GOBasis : public GBasis {
 
             @param alpha
                 The power of r in the potential.
+
+            @param screening_threshold
+                Shell quartets whose Schwarz bound is below this threshold are
+                skipped and their integrals are set to zero. Screening is
+                disabled when the threshold is not positive.
+
+            @param nthread
+                The number of threads used to compute the integrals. The
+                result does not depend on the number of threads.
+
+            @param packed
+                When true, the output is stored in the packed format of
+                packed.h instead of a dense array.
+
+            @return
+                The number of skipped shell quartets.
+         */
+        long compute_ralpha_repulsion(double* output, double alpha,
+                                      double screening_threshold, long nthread,
+                                      bool packed);
+
+        /** @brief
+                Contracts electron repulsion integrals with a density matrix,
+                see GBasis::compute_four_index_direct.
+         */
+        long compute_electron_repulsion_direct(const double* dm, double* coulomb,
+                                               double* exchange,
+                                               double screening_threshold,
+                                               long nthread);
+
+        /** @brief
+                Contracts ERF electron repulsion integrals with a density matrix,
+                see GBasis::compute_four_index_direct.
+
+            @param mu
+                The range-separation parameter.
+         */
+        long compute_erf_repulsion_direct(const double* dm, double* coulomb,
+                                          double* exchange, double mu,
+                                          double screening_threshold, long nthread);
+
+        /** @brief
+                Contracts Gaussian electron repulsion integrals with a density
+                matrix, see GBasis::compute_four_index_direct.
+
+            @param c
+                Coefficient of the gaussian.
+
+            @param alpha
+                Exponential parameter of the gaussian.
          */
-        void compute_ralpha_repulsion(double* output, double alpha);
+        long compute_gauss_repulsion_direct(const double* dm, double* coulomb,
+                                            double* exchange, double c, double alpha,
+                                            double screening_threshold, long nthread);
+
+        /** @brief
+                Contracts r^alpha electron repulsion integrals with a density
+                matrix, see GBasis::compute_four_index_direct.
+
+            @param alpha
+                The power of r in the potential.
+         */
+        long compute_ralpha_repulsion_direct(const double* dm, double* coulomb,
+                                             double* exchange, double alpha,
+                                             double screening_threshold, long nthread);
+
+        /** @brief
+                Computes three-center electron repulsion integrals, see
+                GBasis::compute_three_center.
+         */
+        void compute_electron_repulsion_three_center(double* output, GOBasis* aux,
+                                                     long nthread);
+
+        /** @brief
+                Computes two-center electron repulsion integrals, see
+                GBasis::compute_two_center.
+         */
+        void compute_electron_repulsion_two_center(double* output);
 
         /** @brief
                 Computes the (multipole) moment integrals.
@@ -217,8 +544,37 @@ class GOBasis : public GBasis {
          */
         void compute_multipole_moment(long* xyz, double* center, double* output);
 
+        /** @brief
+                Computes all Cartesian multipole moment integrals up to a given order,
+                for several centers, in one pass over all pairs of shells.
+
+            The moments are ordered as in horton.moments.get_cartesian_powers, starting
+            with the overlap for l=0. The one-dimensional Obara-Saika recursion is
+            carried out once per primitive pair, center and Cartesian direction.
+
+            @param lmax
+                The highest order of the moments.
+
+            @param centers
+                The locations around which the moment integrals are computed, shape
+                (ncenter, 3).
+
+            @param ncenter
+                The number of centers.
+
+            @param output
+                The output array with shape (ncenter, ncart_cumul(lmax), nbasis, nbasis).
+         */
+        void compute_multipole_moments(long lmax, double* centers, long ncenter,
+                                       double* output);
+
+        /** @brief
+                Computes molecular orbitals on a grid.
+
+            The arguments are the same as for compute_grid1_grad_exp.
+         */
         void compute_grid1_exp(long nfn, double* coeffs, long npoint, double* points,
-                               long norb, long* iorbs, double* output);
+                               long norb, long* iorbs, double* output, long nthread);
 
         /** @brief
                 Computes the gradient of the molecular orbital on a grid.
@@ -243,16 +599,218 @@ class GOBasis : public GBasis {
 
             @param output
                 The output array with the integrals.
+
+            @param nthread
+                The number of threads. Grid points are distributed over the threads.
      */
         void compute_grid1_grad_exp(long nfn, double* coeffs, long npoint,
-                                    double* points, long norb, long* iorbs, double* output);
+                                    double* points, long norb, long* iorbs, double* output,
+                                    long nthread);
+
+        /** @brief
+                Computes a function of the density matrix on a grid.
+
+            @param dm
+                The density matrix, shape (nbasis, nbasis).
+
+            @param npoint
+                The number of grid points.
+
+            @param points
+                The Cartesian coordinates of the grid points, shape (npoint, 3).
+
+            @param grid_fn
+                The function to be computed. Every additional thread uses a clone.
+
+            @param output
+                The results are added to this array, shape (npoint, dim_output).
+
+            @param epsilon
+                Allowed error on the density. (Ignored by most grid functions.)
+
+            @param dmmaxrow
+                The maximum absolute value of each row of the density matrix.
+
+            @param nthread
+                The number of threads. Blocks of grid points are distributed over the
+                threads. The result does not depend on the number of threads.
+         */
         void compute_grid1_dm(double* dm, long npoint, double* points,
                               GB1DMGridFn* grid_fn, double* output,
-                              double epsilon, double* dmmaxrow);
-        void compute_grid2_dm(double* dm, long npoint, double* points, double* output);
+                              double epsilon, double* dmmaxrow, long nthread);
+
+        /** @brief
+                Computes a function of several density matrices on the same grid.
+
+            The basis functions are evaluated only once for each block of grid points
+            and are then contracted with all density matrices. The result is the same
+            as ndm separate calls to compute_grid1_dm.
+
+            @param ndm
+                The number of density matrices.
+
+            @param dms
+                The density matrices, shape (ndm, nbasis, nbasis).
+
+            @param npoint
+                The number of grid points.
+
+            @param points
+                The Cartesian coordinates of the grid points, shape (npoint, 3).
+
+            @param grid_fn
+                The function to be computed. Every additional thread uses a clone.
+
+            @param output
+                The results are added to this array, shape (npoint, ndm, dim_output).
+
+            @param epsilon
+                Allowed error on the density. (Ignored by most grid functions.)
+
+            @param dmmaxrows
+                The maximum absolute value of each row of the density matrices, shape
+                (ndm, nbasis).
+
+            @param nthread
+                The number of threads. Blocks of grid points are distributed over the
+                threads. The result does not depend on the number of threads.
+         */
+        void compute_grid1_dm_multi(long ndm, double* dms, long npoint, double* points,
+                                    GB1DMGridFn* grid_fn, double* output, double epsilon,
+                                    double* dmmaxrows, long nthread);
+
+        /** @brief
+                Adds the Hartree potential of a density matrix on a grid.
+
+            @param dm
+                The density matrix, assumed to be symmetric, shape (nbasis, nbasis).
+
+            @param npoint
+                The number of grid points.
+
+            @param points
+                The Cartesian coordinates of the grid points, shape (npoint, 3).
+
+            @param output
+                The potential is added to this array, shape (npoint,).
+
+            @param screening_threshold
+                When zero, all shell pairs are evaluated directly. When positive, small
+                primitive pairs are neglected and multipole expansions are used for
+                distant shell pairs (see compute_grid_hartree_screened in esp.h).
+
+            @param nthread
+                The number of threads. The result does not depend on the number of
+                threads.
+         */
+        void compute_grid2_dm(double* dm, long npoint, double* points, double* output,
+                              double screening_threshold, long nthread);
+
+        /** @brief
+                Adds a Fock matrix contribution from a potential on a grid.
+
+            @param npoint
+                The number of grid points.
+
+            @param points
+                The Cartesian coordinates of the grid points, shape (npoint, 3).
+
+            @param weights
+                The integration weights, shape (npoint,).
+
+            @param pot_stride
+                The distance between the potentials of two consecutive grid points.
+
+            @param pots
+                The potentials, shape (npoint, pot_stride).
+
+            @param grid_fn
+                The function whose potential is given. Every additional thread uses a
+                clone.
+
+            @param output
+                The Fock matrix to which the result is added, shape (nbasis, nbasis).
+
+            @param nthread
+                The number of threads. Each thread accumulates its own Fock matrix, and
+                these are added to the output in a fixed order. The result depends
+                (only through rounding errors) on the number of threads.
+         */
         void compute_grid1_fock(long npoint, double* points, double* weights,
                                 long pot_stride, double* pots,
-                                GB1DMGridFn* grid_fn, double* output);
+                                GB1DMGridFn* grid_fn, double* output, long nthread);
+
+        /** @brief
+                Adds the Fock matrices of several potentials on the same grid.
+
+            The basis functions are evaluated only once for each block of grid points
+            and are then contracted with all potentials. The result is the same as
+            nfock separate calls to compute_grid1_fock.
+
+            @param nfock
+                The number of potentials and Fock matrices.
+
+            @param npoint
+                The number of grid points.
+
+            @param points
+                The Cartesian coordinates of the grid points, shape (npoint, 3).
+
+            @param weights
+                The integration weights, shape (npoint,).
+
+            @param pots
+                The potentials, shape (npoint, nfock, dim_output).
+
+            @param grid_fn
+                The function whose potentials are given. Every additional thread uses a
+                clone.
+
+            @param output
+                The Fock matrices to which the results are added, shape
+                (nfock, nbasis, nbasis).
+
+            @param nthread
+                The number of threads. Each thread accumulates its own Fock matrices,
+                and these are added to the output in a fixed order.
+         */
+        void compute_grid1_fock_multi(long nfock, long npoint, double* points,
+                                      double* weights, double* pots, GB1DMGridFn* grid_fn,
+                                      double* output, long nthread);
+
+        /** @brief
+                Adds the Fock matrices of several density potentials on the same grid.
+
+            The basis functions are evaluated only once for each block of grid points
+            and are then contracted with all potentials. The result is the same as
+            nop separate calls to compute_grid1_fock with a GB1DMGridDensityFn.
+
+            @param npoint
+                The number of grid points.
+
+            @param points
+                The Cartesian coordinates of the grid points, shape (npoint, 3).
+
+            @param weights
+                The integration weights, shape (npoint,).
+
+            @param nop
+                The number of potentials.
+
+            @param pots
+                The potentials, shape (npoint, nop).
+
+            @param output
+                The Fock matrices to which the results are added, shape
+                (nop, nbasis, nbasis).
+
+            @param nthread
+                The number of threads. Each thread accumulates its own Fock matrices,
+                and these are added to the output in a fixed order.
+         */
+        void compute_grid1_density_fock_multi(long npoint, double* points, double* weights,
+                                              long nop, double* pots, double* output,
+                                              long nthread);
 };
 
 #endif  // HORTON_GBASIS_GBASIS_H_
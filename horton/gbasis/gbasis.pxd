@@ -43,6 +43,9 @@ cdef extern from "horton/gbasis/gbasis.h":
         double* get_scales(long iprim)
         long* get_shell_lookup()
         long* get_basis_offsets()
+        double* get_shell_extents()
+        double get_grid_tolerance()
+        void set_grid_tolerance(double tolerance)
 
         # low-level compute routines
         void compute_grid_point1(double* output, double* point, fns.GB1DMGridFn* grid_fn)
@@ -59,13 +62,24 @@ cdef extern from "horton/gbasis/gbasis.h":
         void compute_erf_attraction(double* charges, double* centers, long ncharge, double* output, double mu)
         void compute_gauss_attraction(double* charges, double* centers, long ncharge, double* output, double c, double alpha)
         void compute_multipole_moment(long* xyz, double* center, double* output)
-        void compute_electron_repulsion(double* output)
-        void compute_erf_repulsion(double* output, double mu)
-        void compute_gauss_repulsion(double* output, double c, double alpha)
-        void compute_ralpha_repulsion(double* output, double alpha)
+        void compute_multipole_moments(long lmax, double* centers, long ncenter,
+                                       double* output) except +
+        long compute_electron_repulsion(double* output, double screening_threshold, long nthread, bint packed) except +
+        long compute_erf_repulsion(double* output, double mu, double screening_threshold, long nthread, bint packed) except +
+        long compute_gauss_repulsion(double* output, double c, double alpha, double screening_threshold, long nthread, bint packed) except +
+        long compute_ralpha_repulsion(double* output, double alpha, double screening_threshold, long nthread, bint packed) except +
+        long compute_electron_repulsion_direct(double* dm, double* coulomb, double* exchange, double screening_threshold, long nthread) except +
+        long compute_erf_repulsion_direct(double* dm, double* coulomb, double* exchange, double mu, double screening_threshold, long nthread) except +
+        long compute_gauss_repulsion_direct(double* dm, double* coulomb, double* exchange, double c, double alpha, double screening_threshold, long nthread) except +
+        long compute_ralpha_repulsion_direct(double* dm, double* coulomb, double* exchange, double alpha, double screening_threshold, long nthread) except +
+        void compute_electron_repulsion_three_center(double* output, GOBasis* aux, long nthread) except +
+        void compute_electron_repulsion_two_center(double* output) except +
 
-        void compute_grid1_exp(long nfn, double* coeffs, long npoint, double* points, long norb, long* iorbs, double* output)
-        void compute_grid1_grad_exp(long nfn, double* coeffs, long npoint, double* points, long norb, long* iorbs, double* output)
-        void compute_grid1_dm(double* dm, long npoint, double* points, fns.GB1DMGridFn* grid_fn, double* output, double epsilon, double* dmmaxrow)
-        void compute_grid2_dm(double* dm, long npoint, double* points, double* output)
-        void compute_grid1_fock(long npoint, double* points, double* weights, long pot_stride, double* pots, fns.GB1DMGridFn* grid_fn, double* output)
+        void compute_grid1_exp(long nfn, double* coeffs, long npoint, double* points, long norb, long* iorbs, double* output, long nthread) except +
+        void compute_grid1_grad_exp(long nfn, double* coeffs, long npoint, double* points, long norb, long* iorbs, double* output, long nthread) except +
+        void compute_grid1_dm(double* dm, long npoint, double* points, fns.GB1DMGridFn* grid_fn, double* output, double epsilon, double* dmmaxrow, long nthread) except +
+        void compute_grid1_dm_multi(long ndm, double* dms, long npoint, double* points, fns.GB1DMGridFn* grid_fn, double* output, double epsilon, double* dmmaxrows, long nthread) except +
+        void compute_grid2_dm(double* dm, long npoint, double* points, double* output, double screening_threshold, long nthread) except +
+        void compute_grid1_fock(long npoint, double* points, double* weights, long pot_stride, double* pots, fns.GB1DMGridFn* grid_fn, double* output, long nthread) except +
+        void compute_grid1_fock_multi(long nfock, long npoint, double* points, double* weights, double* pots, fns.GB1DMGridFn* grid_fn, double* output, long nthread) except +
+        void compute_grid1_density_fock_multi(long npoint, double* points, double* weights, long nop, double* pots, double* output, long nthread) except +
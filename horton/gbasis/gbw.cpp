@@ -19,12 +19,24 @@
 //--
 
 
+#include <atomic>
+#include <stdexcept>
 #include "horton/gbasis/gbw.h"
 #include "horton/gbasis/common.h"
+#include "horton/gbasis/parallel.h"
 
-GB4IntegralWrapper::GB4IntegralWrapper(GOBasis* gobasis, GB4Integral* gb4int) :
-    gobasis(gobasis), gb4int(gb4int)
+GB4IntegralWrapper::GB4IntegralWrapper(GOBasis* gobasis, GB4Integral* gb4int,
+                                       long nthread) :
+    gobasis(gobasis), nthread(nthread)
 {
+  if (nthread < 1) {
+    throw std::domain_error("The number of threads must be strictly positive.");
+  }
+  gobasis->init_shell_pairs();
+  gb4ints.push_back(gb4int);
+  for (long ithread = 1; ithread < nthread; ithread++) {
+    gb4ints.push_back(gb4int->clone());
+  }
   max_shell_size = get_shell_nbasis(gobasis->get_max_shell_type());
   slice_size = gobasis->get_nbasis()*gobasis->get_nbasis();
   /*
@@ -38,36 +50,38 @@ GB4IntegralWrapper::GB4IntegralWrapper(GOBasis* gobasis, GB4Integral* gb4int) :
 
 GB4IntegralWrapper::~GB4IntegralWrapper() {
   delete[] integrals;
+  for (long ithread = 1; ithread < nthread; ithread++) {
+    delete gb4ints[ithread];
+  }
 }
 
-void GB4IntegralWrapper::compute_shell(long ishell1, long ishell3)
+void GB4IntegralWrapper::compute_shell(GB4Integral* gb4int, long ishell0, long ishell1,
+                                       long ishell2, long ishell3)
 {
   // Configure the four-center integral with the right input for this
-  // quadruple of shells. (index0 and index2 are fixed.)
+  // quadruple of shells.
   gb4int->reset(gobasis->shell_types[ishell0], gobasis->shell_types[ishell1],
                 gobasis->shell_types[ishell2], gobasis->shell_types[ishell3],
                 gobasis->centers + gobasis->shell_map[ishell0]*3, gobasis->centers + gobasis->shell_map[ishell1]*3,
                 gobasis->centers + gobasis->shell_map[ishell2]*3, gobasis->centers + gobasis->shell_map[ishell3]*3);
 
-  // Quadruple loop over all primitives for these four shells.
-  for (long iprim0 = 0; iprim0 < gobasis->nprims[ishell0]; iprim0++) {
-    for (long iprim1 = 0; iprim1 < gobasis->nprims[ishell1]; iprim1++) {
-      for (long iprim2 = 0; iprim2 < gobasis->nprims[ishell2]; iprim2++) {
-        for (long iprim3 = 0; iprim3 < gobasis->nprims[ishell3]; iprim3++) {
-          gb4int->add(gobasis->con_coeffs[gobasis->get_prim_offsets()[ishell0] + iprim0]*
-                      gobasis->con_coeffs[gobasis->get_prim_offsets()[ishell1] + iprim1]*
-                      gobasis->con_coeffs[gobasis->get_prim_offsets()[ishell2] + iprim2]*
-                      gobasis->con_coeffs[gobasis->get_prim_offsets()[ishell3] + iprim3],
-                      gobasis->alphas[gobasis->get_prim_offsets()[ishell0] + iprim0],
-                      gobasis->alphas[gobasis->get_prim_offsets()[ishell1] + iprim1],
-                      gobasis->alphas[gobasis->get_prim_offsets()[ishell2] + iprim2],
-                      gobasis->alphas[gobasis->get_prim_offsets()[ishell3] + iprim3],
-                      gobasis->get_scales(gobasis->get_prim_offsets()[ishell0] + iprim0),
-                      gobasis->get_scales(gobasis->get_prim_offsets()[ishell1] + iprim1),
-                      gobasis->get_scales(gobasis->get_prim_offsets()[ishell2] + iprim2),
-                      gobasis->get_scales(gobasis->get_prim_offsets()[ishell3] + iprim3));
-        }
-      }
+  // <01|23> is (02|13) in chemist's notation. Loop over all pairs of primitives
+  // in both pairs of shells, unless one has only zero integrals.
+  const long nshell = gobasis->nshell;
+  const double* magnitudes = gobasis->get_shell_pair_magnitudes();
+  if ((magnitudes[ishell0*nshell + ishell2] == 0) ||
+      (magnitudes[ishell1*nshell + ishell3] == 0)) {
+    return;
+  }
+  std::vector<prim_pair_t> work02, work13;
+  const prim_pair_t* pairs02 = gobasis->get_prim_pairs(ishell0, ishell2, &work02);
+  const prim_pair_t* pairs13 = gobasis->get_prim_pairs(ishell1, ishell3, &work13);
+  const long npair02 = gobasis->nprims[ishell0]*gobasis->nprims[ishell2];
+  const long npair13 = gobasis->nprims[ishell1]*gobasis->nprims[ishell3];
+  for (long ipair02 = 0; ipair02 < npair02; ipair02++) {
+    for (long ipair13 = 0; ipair13 < npair13; ipair13++) {
+      gb4int->add_pairs(pairs02[ipair02].coeff*pairs13[ipair13].coeff,
+                        pairs02 + ipair02, pairs13 + ipair13);
     }
   }
 
@@ -75,6 +89,19 @@ void GB4IntegralWrapper::compute_shell(long ishell1, long ishell3)
   gb4int->cart_to_pure();
 }
 
+void GB4IntegralWrapper::run_shell_pairs(
+    const std::function<void(GB4Integral*, long, long)>& fn) {
+  // Pairs of shells are handed out one by one to the threads.
+  const long npair = gobasis->nshell*gobasis->nshell;
+  std::atomic<long> next_pair(0);
+  run_in_threads(nthread, [&](long ithread) {
+    long ipair;
+    while ((ipair = next_pair++) < npair) {
+      fn(gb4ints[ithread], ipair/gobasis->nshell, ipair%gobasis->nshell);
+    }
+  });
+}
+
 
 void GB4IntegralWrapper::select_2index(long index0, long index2,
                             long* pbegin0, long* pend0,
@@ -93,56 +120,51 @@ void GB4IntegralWrapper::select_2index(long index0, long index2,
 void GB4IntegralWrapper::compute() {
   // Double loop over second and fourth shell of the four-index object. The
   // entire range over these two indexes is included in the 2-index slices.
-  for (long ishell1 = 0; ishell1 < gobasis->nshell; ishell1++) {
-    for (long ishell3 = 0; ishell3 < gobasis->nshell; ishell3++) {
-      // Compute integrals for the given combination of shells.
-      compute_shell(ishell1, ishell3);
-
-      // Copy data from work array to ``integrals``, the temporary storage of
-      // this wrapper.
-      const double* tmp = gb4int->get_work();
-      const long n0 = get_shell_nbasis(gobasis->shell_types[ishell0]);
-      const long n1 = get_shell_nbasis(gobasis->shell_types[ishell1]);
-      const long n2 = get_shell_nbasis(gobasis->shell_types[ishell2]);
-      const long n3 = get_shell_nbasis(gobasis->shell_types[ishell3]);
-      for (long i0=0; i0<n0; i0++) {
-        for (long i1=0; i1<n1; i1++) {
-          for (long i2=0; i2<n2; i2++) {
-            for (long i3=0; i3<n3; i3++) {
-              integrals[((i0)*max_shell_size + i2)*slice_size +
-                        (i1+gobasis->get_basis_offsets()[ishell1])*gobasis->get_nbasis() +
-                        (i3+gobasis->get_basis_offsets()[ishell3])] = *tmp;
-              tmp++;
-            }
+  // Each pair of shells fills a different block of the slices.
+  run_shell_pairs([&](GB4Integral* gb4int, long ishell1, long ishell3) {
+    // Compute integrals for the given combination of shells.
+    compute_shell(gb4int, ishell0, ishell1, ishell2, ishell3);
+
+    // Copy data from work array to ``integrals``, the temporary storage of
+    // this wrapper.
+    const double* tmp = gb4int->get_work();
+    const long n0 = get_shell_nbasis(gobasis->shell_types[ishell0]);
+    const long n1 = get_shell_nbasis(gobasis->shell_types[ishell1]);
+    const long n2 = get_shell_nbasis(gobasis->shell_types[ishell2]);
+    const long n3 = get_shell_nbasis(gobasis->shell_types[ishell3]);
+    for (long i0=0; i0<n0; i0++) {
+      for (long i1=0; i1<n1; i1++) {
+        for (long i2=0; i2<n2; i2++) {
+          for (long i3=0; i3<n3; i3++) {
+            integrals[((i0)*max_shell_size + i2)*slice_size +
+                      (i1+gobasis->get_basis_offsets()[ishell1])*gobasis->get_nbasis() +
+                      (i3+gobasis->get_basis_offsets()[ishell3])] = *tmp;
+            tmp++;
           }
         }
       }
     }
-  }
+  });
 }
 
 void GB4IntegralWrapper::compute_diagonal(double* diagonal) {
   // Double loop over second and fourth shell of the four-index object. The
   // entire range over these two indexes is included in the 2-index slices.
-  for (long ishell1 = 0; ishell1 < gobasis->nshell; ishell1++) {
-    for (long ishell3 = 0; ishell3 < gobasis->nshell; ishell3++) {
-      // Compute integrals for the given combination of shells.
-      ishell0 = ishell1;
-      ishell2 = ishell3;
-      compute_shell(ishell1, ishell3);
-
-      // copy data from work array to the output array.
-      const double* tmp = gb4int->get_work();
-      const long n1 = get_shell_nbasis(gobasis->shell_types[ishell1]);
-      const long n3 = get_shell_nbasis(gobasis->shell_types[ishell3]);
-      for (long i1=0; i1<n1; i1++) {
-        for (long i3=0; i3<n3; i3++) {
-          diagonal[(i1+gobasis->get_basis_offsets()[ishell1])*gobasis->get_nbasis() +
-                   (i3+gobasis->get_basis_offsets()[ishell3])] = tmp[(n1*i1+i1)*n3*n3 + n3*i3+i3];
-        }
+  run_shell_pairs([&](GB4Integral* gb4int, long ishell1, long ishell3) {
+    // Compute integrals for the given combination of shells.
+    compute_shell(gb4int, ishell1, ishell1, ishell3, ishell3);
+
+    // copy data from work array to the output array.
+    const double* tmp = gb4int->get_work();
+    const long n1 = get_shell_nbasis(gobasis->shell_types[ishell1]);
+    const long n3 = get_shell_nbasis(gobasis->shell_types[ishell3]);
+    for (long i1=0; i1<n1; i1++) {
+      for (long i3=0; i3<n3; i3++) {
+        diagonal[(i1+gobasis->get_basis_offsets()[ishell1])*gobasis->get_nbasis() +
+                 (i3+gobasis->get_basis_offsets()[ishell3])] = tmp[(n1*i1+i1)*n3*n3 + n3*i3+i3];
       }
     }
-  }
+  });
 }
 
 double* GB4IntegralWrapper::get_2index_slice(long index0, long index2) {
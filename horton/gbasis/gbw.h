@@ -23,6 +23,8 @@
 #ifndef GBW_H
 #define GBW_H
 
+#include <functional>
+#include <vector>
 #include "horton/gbasis/gbasis.h"
 #include "horton/gbasis/ints.h"
 
@@ -34,7 +36,8 @@
 class GB4IntegralWrapper {
     private:
         GOBasis* gobasis;
-        GB4Integral* gb4int;
+        long nthread;
+        std::vector<GB4Integral*> gb4ints; // one per thread, the first is not owned.
         long max_shell_size;
         long slice_size;
         double* integrals;
@@ -46,10 +49,27 @@ class GB4IntegralWrapper {
 
         /**
             @brief
-                Compute four-center integrals for a quadruplet of shells
-                (defined by ishell0, ishell1, ishell2 and ishell3).
+                Compute four-center integrals for a quadruplet of shells.
+
+            @param gb4int
+                The four-center integral object to be used. The result is
+                stored in its work array.
+        */
+        void compute_shell(GB4Integral* gb4int, long ishell0, long ishell1,
+                           long ishell2, long ishell3);
+
+        /**
+            @brief
+                Call a function for all pairs of second and fourth shells,
+                distributed over the threads.
+
+            @param fn
+                The function receives the four-center integral object of the
+                thread, the second shell and the fourth shell as arguments.
+                Different pairs must write to different memory locations.
         */
-        void compute_shell(long ishell1, long ishell3);
+        void run_shell_pairs(
+            const std::function<void(GB4Integral*, long, long)>& fn);
     public:
         /**
             @brief
@@ -61,8 +81,13 @@ class GB4IntegralWrapper {
 
             @param gb4int
                 A definition/implementation of a four-center integral.
+
+            @param nthread
+                The number of threads used to compute integrals. For each
+                additional thread, a clone of gb4int is made. The results do
+                not depend on the number of threads.
         */
-        GB4IntegralWrapper(GOBasis* gobasis, GB4Integral* gb4int);
+        GB4IntegralWrapper(GOBasis* gobasis, GB4Integral* gb4int, long nthread);
         ~GB4IntegralWrapper();
 
         /**
@@ -71,6 +96,12 @@ class GB4IntegralWrapper {
         */
         long get_nbasis() {return gobasis->get_nbasis();}
 
+        /**
+            @brief
+                The number of threads used to compute integrals.
+        */
+        long get_nthread() {return nthread;}
+
         /**
             @brief
                 Select a pair of shells to which a pair of basis indexes belong.
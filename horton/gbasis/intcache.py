@@ -0,0 +1,174 @@
+# -*- coding: utf-8 -*-
+# HORTON: Helpful Open-source Research TOol for N-fermion systems.
+# Copyright (C) 2011-2017 The HORTON Development Team
+#
+# This file is part of HORTON.
+#
+# HORTON is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 3
+# of the License, or (at your option) any later version.
+#
+# HORTON is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, see <http://www.gnu.org/licenses/>
+#
+# --
+"""Persistent on-disk cache for Gaussian integrals."""
+
+
+import hashlib
+
+import numpy as np
+
+from horton.io.lockedh5 import LockedH5File
+from horton.log import log
+
+
+__all__ = ['IntegralCache']
+
+
+class IntegralCache(object):
+    """Stores integrals computed with a GOBasis in an HDF5 file.
+
+    Results are stored under a hash of the basis set, the name of the integral and its
+    parameters. The file is opened with LockedH5File, such that it can be shared by
+    several processes, also on different machines with a shared file system. The
+    integrals are computed while the file is closed. When two processes compute the
+    same integrals at the same time, the result of the first one is stored.
+
+    When the stored integrals exceed the given size, the least recently used ones are
+    removed. HDF5 does not always reuse the space of removed datasets, such that the
+    file itself can become larger than this limit. It can be compacted with h5repack.
+    """
+
+    # Arguments that do not affect the result of a computation.
+    ignored_kwargs = set(['nthread'])
+
+    def __init__(self, filename, max_size=2**30):
+        """
+        Parameters
+        ----------
+        filename : str
+            The HDF5 file with the cache. It is created when needed.
+        max_size : int
+            The maximum number of bytes of integrals stored in the file.
+        """
+        if max_size <= 0:
+            raise ValueError('The maximum size of the cache must be strictly positive.')
+        self.filename = filename
+        self.max_size = max_size
+
+    def get_key(self, obasis, name, **kwargs):
+        """Return the hash of the basis set, the integral name and its parameters.
+
+        Parameters
+        ----------
+        obasis : GOBasis
+            The orbital basis.
+        name : str
+            The name of the integral, see ``compute``.
+        kwargs
+            Parameters of the integral.
+        """
+        h = hashlib.sha1()
+        for array in (obasis.centers, obasis.shell_map, obasis.nprims, obasis.shell_types,
+                      obasis.alphas, obasis.con_coeffs):
+            _update_hash(h, array)
+        h.update(name)
+        for key in sorted(kwargs):
+            if key not in self.ignored_kwargs:
+                h.update(key)
+                _update_hash(h, kwargs[key])
+        return h.hexdigest()
+
+    def compute(self, obasis, name, **kwargs):
+        """Load integrals from the cache or compute and store them.
+
+        Parameters
+        ----------
+        obasis : GOBasis
+            The orbital basis.
+        name : str
+            The name of the integral. The method ``'compute_' + name`` of the orbital
+            basis is called, e.g. ``'electron_repulsion_cholesky'``.
+        kwargs
+            Keyword arguments passed on to the method. All of them, except ``nthread``,
+            are part of the key. Parameters that are not given take the default values
+            of the method.
+
+        Returns
+        -------
+        result : np.ndarray
+            The integrals.
+        """
+        if 'output' in kwargs or 'filename' in kwargs:
+            raise TypeError('The cache does not support the output and filename arguments.')
+        method = getattr(obasis, 'compute_' + name)
+        key = self.get_key(obasis, name, **kwargs)
+
+        # Look up the integrals and mark them as used.
+        with LockedH5File(self.filename, 'a') as f:
+            clock = f.attrs.get('clock', 0) + 1
+            f.attrs['clock'] = clock
+            grp = f.get(key)
+            if grp is not None:
+                if 'size' in grp.attrs:
+                    grp.attrs['last_used'] = clock
+                    if log.do_high:
+                        log('Loaded %s integrals from cache %s.' % (name, self.filename))
+                    return grp['value'][:]
+                # Remove an incomplete entry, e.g. after a crash.
+                del f[key]
+
+        # Compute without holding the lock.
+        result = method(**kwargs)
+        size = result.nbytes
+        if size > self.max_size:
+            return result
+
+        with LockedH5File(self.filename, 'a') as f:
+            if key in f:
+                # Another process stored the same integrals in the meantime.
+                return result
+            clock = f.attrs.get('clock', 0) + 1
+            f.attrs['clock'] = clock
+            self._evict(f, self.max_size - size)
+            grp = f.create_group(key)
+            grp['value'] = result
+            grp.attrs['name'] = name
+            grp.attrs['last_used'] = clock
+            # Written last, such that incomplete entries can be recognized.
+            grp.attrs['size'] = size
+            if log.do_high:
+                log('Stored %s integrals in cache %s.' % (name, self.filename))
+        return result
+
+    def _evict(self, f, max_size):
+        """Remove the least recently used entries until at most max_size bytes remain."""
+        entries = []
+        total = 0
+        for key, grp in f.iteritems():
+            size = grp.attrs.get('size')
+            if size is None:
+                continue
+            entries.append((grp.attrs['last_used'], key, size))
+            total += size
+        entries.sort()
+        for last_used, key, size in entries:
+            if total <= max_size:
+                break
+            del f[key]
+            total -= size
+
+
+def _update_hash(h, value):
+    """Add an array or a scalar to a hash object."""
+    value = np.ascontiguousarray(value)
+    h.update(value.dtype.str)
+    h.update(repr(value.shape))
+    h.update(value.tobytes())
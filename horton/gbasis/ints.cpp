@@ -18,6 +18,7 @@
 //
 //--
 
+#include <algorithm>
 #include <cmath>
 #include <cstdlib>
 #include <cstring>
@@ -48,6 +49,27 @@ using std::abs;
 */
 
 
+/*
+
+   Pairs of primitive shells
+
+*/
+
+
+void compute_prim_pair(double coeff, double alpha0, const double* r0, const double* scales0,
+                       double alpha1, const double* r1, const double* scales1,
+                       prim_pair_t* pair) {
+    pair->coeff = coeff;
+    pair->alpha0 = alpha0;
+    pair->alpha1 = alpha1;
+    pair->gamma_inv = 1.0/(alpha0 + alpha1);
+    pair->prefac = exp(-alpha0*alpha1*pair->gamma_inv*dist_sq(r0, r1));
+    compute_gpt_center(alpha0, r0, alpha1, r1, pair->gamma_inv, pair->gpt_center);
+    pair->scales0 = scales0;
+    pair->scales1 = scales1;
+}
+
+
 /*
 
    GB2Integral
@@ -78,6 +100,12 @@ void GB2Integral::reset(long _shell_type0, long _shell_type1, const double* _r0,
     memset(work_pure, 0, nwork*sizeof(double));
 }
 
+void GB2Integral::add(double coeff, double alpha0, double alpha1, const double* scales0, const double* scales1) {
+    prim_pair_t pair;
+    compute_prim_pair(coeff, alpha0, r0, scales0, alpha1, r1, scales1, &pair);
+    add_pair(&pair);
+}
+
 void GB2Integral::cart_to_pure() {
     /*
        The initial results are always stored in work_cart. The projection
@@ -114,13 +142,12 @@ void GB2Integral::cart_to_pure() {
 */
 
 
-void GB2OverlapIntegral::add(double coeff, double alpha0, double alpha1, const double* scales0, const double* scales1) {
-    double pre, gamma_inv;
-    double gpt_center[3];
-
-    gamma_inv = 1.0/(alpha0 + alpha1);
-    pre = coeff*exp(-alpha0*alpha1*gamma_inv*dist_sq(r0, r1));
-    compute_gpt_center(alpha0, r0, alpha1, r1, gamma_inv, gpt_center);
+void GB2OverlapIntegral::add_pair(const prim_pair_t* pair) {
+    const double gamma_inv = pair->gamma_inv;
+    const double pre = pair->coeff*pair->prefac;
+    const double* gpt_center = pair->gpt_center;
+    const double* scales0 = pair->scales0;
+    const double* scales1 = pair->scales1;
     i2p.reset(abs(shell_type0), abs(shell_type1));
     do {
         work_cart[i2p.offset] += pre*(
@@ -161,13 +188,17 @@ double kinetic_helper(double alpha0, double alpha1, long n0, long n1, double pa,
     return poly;
 }
 
-void GB2KineticIntegral::add(double coeff, double alpha0, double alpha1, const double* scales0, const double* scales1) {
-    double pre, gamma_inv, poly, fx0, fy0, fz0;
-    double gpt_center[3], pa[3], pb[3];
-
-    gamma_inv = 1.0/(alpha0 + alpha1);
-    pre = coeff*exp(-alpha0*alpha1*gamma_inv*dist_sq(r0, r1));
-    compute_gpt_center(alpha0, r0, alpha1, r1, gamma_inv, gpt_center);
+void GB2KineticIntegral::add_pair(const prim_pair_t* pair) {
+    double poly, fx0, fy0, fz0;
+    double pa[3], pb[3];
+
+    const double alpha0 = pair->alpha0;
+    const double alpha1 = pair->alpha1;
+    const double gamma_inv = pair->gamma_inv;
+    const double pre = pair->coeff*pair->prefac;
+    const double* gpt_center = pair->gpt_center;
+    const double* scales0 = pair->scales0;
+    const double* scales1 = pair->scales1;
     pa[0] = gpt_center[0] - r0[0];
     pa[1] = gpt_center[1] - r0[1];
     pa[2] = gpt_center[2] - r0[2];
@@ -201,7 +232,8 @@ GB2AttractionIntegral::GB2AttractionIntegral(long max_shell_type, double* charge
     work_g0 = new double[2*max_shell_type+1];
     work_g1 = new double[2*max_shell_type+1];
     work_g2 = new double[2*max_shell_type+1];
-    work_boys = new double[2*max_shell_type+1];
+    work_boys = new double[GB2_ATTRACTION_BLOCK_SIZE*(2*max_shell_type+1)];
+    work_args = new double[GB2_ATTRACTION_BLOCK_SIZE];
 }
 
 
@@ -210,17 +242,20 @@ GB2AttractionIntegral::~GB2AttractionIntegral() {
     delete[] work_g1;
     delete[] work_g2;
     delete[] work_boys;
+    delete[] work_args;
 }
 
 
-void GB2AttractionIntegral::add(double coeff, double alpha0, double alpha1, const double* scales0, const double* scales1) {
-    double pre, gamma, gamma_inv, arg;
-    double gpt_center[3], pa[3], pb[3], pc[3];
+void GB2AttractionIntegral::add_pair(const prim_pair_t* pair) {
+    double arg;
+    double pa[3], pb[3], pc[3];
 
-    gamma = alpha0 + alpha1;
-    gamma_inv = 1.0/gamma;
-    pre = 2*M_PI*gamma_inv*coeff*exp(-alpha0*alpha1*gamma_inv*dist_sq(r0, r1));
-    compute_gpt_center(alpha0, r0, alpha1, r1, gamma_inv, gpt_center);
+    const double gamma = pair->alpha0 + pair->alpha1;
+    const double gamma_inv = pair->gamma_inv;
+    const double pre = 2*M_PI*gamma_inv*pair->coeff*pair->prefac;
+    const double* gpt_center = pair->gpt_center;
+    const double* scales0 = pair->scales0;
+    const double* scales1 = pair->scales1;
     pa[0] = gpt_center[0] - r0[0];
     pa[1] = gpt_center[1] - r0[1];
     pa[2] = gpt_center[2] - r0[2];
@@ -228,42 +263,54 @@ void GB2AttractionIntegral::add(double coeff, double alpha0, double alpha1, cons
     pb[1] = gpt_center[1] - r1[1];
     pb[2] = gpt_center[2] - r1[2];
 
-    for (long icharge=0; icharge < ncharge; icharge++) {
-        // thrid center for the current charge
-        pc[0] = gpt_center[0] - centers[icharge*3  ];
-        pc[1] = gpt_center[1] - centers[icharge*3+1];
-        pc[2] = gpt_center[2] - centers[icharge*3+2];
-
-        // Fill the work array with the Boys function values
-        arg = gamma*(pc[0]*pc[0] + pc[1]*pc[1] + pc[2]*pc[2]);
-        // for (long nu=abs(shell_type0)+abs(shell_type1); nu>=0; nu--) {
-        //    work_boys[nu] = boys_function(nu, arg);
-        //}
-        /*
-           Laplace transform of the potential
-        */
-
-        int mmax = abs(shell_type0) + abs(shell_type1);
-        laplace_of_potential(gamma, arg, mmax, work_boys);
-
-        // Iterate over all combinations of Cartesian exponents
-        i2p.reset(abs(shell_type0), abs(shell_type1));
-        do {
-            // Fill the work arrays with the polynomials
-            nuclear_attraction_helper(work_g0, i2p.n0[0], i2p.n1[0], pa[0], pb[0], pc[0], gamma_inv);
-            nuclear_attraction_helper(work_g1, i2p.n0[1], i2p.n1[1], pa[1], pb[1], pc[1], gamma_inv);
-            nuclear_attraction_helper(work_g2, i2p.n0[2], i2p.n1[2], pa[2], pb[2], pc[2], gamma_inv);
-
-            // Take the product
-            arg = 0;
-            for (long i0=i2p.n0[0]+i2p.n1[0]; i0>=0; i0--)
-                for (long i1=i2p.n0[1]+i2p.n1[1]; i1>=0; i1--)
-                    for (long i2=i2p.n0[2]+i2p.n1[2]; i2>=0; i2--)
-                        arg += work_g0[i0]*work_g1[i1]*work_g2[i2]*work_boys[i0+i1+i2];
-
-            // Finally add to the work array, accounting for opposite charge of electron and nucleus
-            work_cart[i2p.offset] -= pre*scales0[i2p.ibasis0]*scales1[i2p.ibasis1]*arg*charges[icharge];
-        } while (i2p.inc());
+    const long mmax = abs(shell_type0) + abs(shell_type1);
+    for (long begin=0; begin < ncharge; begin += GB2_ATTRACTION_BLOCK_SIZE) {
+        const long end = std::min(begin + GB2_ATTRACTION_BLOCK_SIZE, ncharge);
+
+        // Laplace transform of the potential for a block of charges in one go.
+        for (long icharge=begin; icharge < end; icharge++) {
+            pc[0] = gpt_center[0] - centers[icharge*3  ];
+            pc[1] = gpt_center[1] - centers[icharge*3+1];
+            pc[2] = gpt_center[2] - centers[icharge*3+2];
+            work_args[icharge - begin] = gamma*(pc[0]*pc[0] + pc[1]*pc[1] + pc[2]*pc[2]);
+        }
+        laplace_of_potential_batch(gamma, end - begin, work_args, mmax, work_boys);
+
+        for (long icharge=begin; icharge < end; icharge++) {
+            // thrid center for the current charge
+            pc[0] = gpt_center[0] - centers[icharge*3  ];
+            pc[1] = gpt_center[1] - centers[icharge*3+1];
+            pc[2] = gpt_center[2] - centers[icharge*3+2];
+            const double* laplace = work_boys + (icharge - begin)*(mmax + 1);
+
+            // Iterate over all combinations of Cartesian exponents
+            i2p.reset(abs(shell_type0), abs(shell_type1));
+            do {
+                // Fill the work arrays with the polynomials
+                nuclear_attraction_helper(work_g0, i2p.n0[0], i2p.n1[0], pa[0], pb[0], pc[0], gamma_inv);
+                nuclear_attraction_helper(work_g1, i2p.n0[1], i2p.n1[1], pa[1], pb[1], pc[1], gamma_inv);
+                nuclear_attraction_helper(work_g2, i2p.n0[2], i2p.n1[2], pa[2], pb[2], pc[2], gamma_inv);
+
+                // Take the product
+                arg = 0;
+                for (long i0=i2p.n0[0]+i2p.n1[0]; i0>=0; i0--)
+                    for (long i1=i2p.n0[1]+i2p.n1[1]; i1>=0; i1--)
+                        for (long i2=i2p.n0[2]+i2p.n1[2]; i2>=0; i2--)
+                            arg += work_g0[i0]*work_g1[i1]*work_g2[i2]*laplace[i0+i1+i2];
+
+                // Finally add to the work array, accounting for opposite charge of electron and nucleus
+                work_cart[i2p.offset] -= pre*scales0[i2p.ibasis0]*scales1[i2p.ibasis1]*arg*charges[icharge];
+            } while (i2p.inc());
+        }
+    }
+}
+
+
+void GB2AttractionIntegral::laplace_of_potential_batch(double gamma, long narg,
+                                                       const double* args, long mmax,
+                                                       double* output) {
+    for (long iarg=0; iarg < narg; iarg++) {
+        laplace_of_potential(gamma, args[iarg], mmax, output + iarg*(mmax + 1));
     }
 }
 
@@ -274,6 +321,13 @@ void GB2NuclearAttractionIntegral::laplace_of_potential(double gamma, double arg
 }
 
 
+void GB2NuclearAttractionIntegral::laplace_of_potential_batch(double gamma, long narg,
+                                                              const double* args, long mmax,
+                                                              double* output) {
+  boys_function_batch(mmax, narg, args, output);
+}
+
+
 void GB2ErfAttractionIntegral::laplace_of_potential(double gamma, double arg, long mmax,
                                                     double* output) {
   double efac = mu*mu/(mu*mu + gamma);
@@ -286,6 +340,28 @@ void GB2ErfAttractionIntegral::laplace_of_potential(double gamma, double arg, lo
 }
 
 
+void GB2ErfAttractionIntegral::laplace_of_potential_batch(double gamma, long narg,
+                                                          const double* args, long mmax,
+                                                          double* output) {
+  const double efac = mu*mu/(mu*mu + gamma);
+  double scaled_args[GB2_ATTRACTION_BLOCK_SIZE];
+  for (long begin=0; begin < narg; begin += GB2_ATTRACTION_BLOCK_SIZE) {
+    const long end = std::min(begin + GB2_ATTRACTION_BLOCK_SIZE, narg);
+    for (long iarg=begin; iarg < end; iarg++) {
+      scaled_args[iarg - begin] = args[iarg]*efac;
+    }
+    boys_function_batch(mmax, end - begin, scaled_args, output + begin*(mmax + 1));
+  }
+  for (long iarg=0; iarg < narg; iarg++) {
+    double prefac = sqrt(efac);
+    for (long m=0; m <= mmax; m++) {
+      output[iarg*(mmax + 1) + m] *= prefac;
+      prefac *= efac;
+    }
+  }
+}
+
+
 void GB2GaussAttractionIntegral::laplace_of_potential(double gamma, double arg, long mmax,
                                                       double* output) {
   double afac = alpha/(gamma+alpha);
@@ -368,6 +444,49 @@ double moment_helper(long n0, long n1, long n2, double pa, double pb, double pc,
 }
 
 
+void compute_moment_table(long n0max, long n1max, long n2max, double pa, double pb,
+                          double pc, double gamma_inv, double* output) {
+    /*
+     The same recursion as in moment_helper, for all powers at once. The terms with
+     a power -1 are left out.
+    */
+    const double twogamma_inv = 0.5*gamma_inv;
+    const long stride1 = n2max + 1;
+    const long stride0 = (n1max + 1)*stride1;
+
+    // (0_A|R(0)|0_B) and Equation A8 for (0_A|R(mu + 1)|0_B):
+    output[0] = gb_overlap_int1d(0, 0, pa, pb, gamma_inv);
+    for (long n=0; n < n2max; n++) {
+        output[n+1] = pc*output[n];
+        if (n > 0) output[n+1] += twogamma_inv*n*output[n-1];
+    }
+
+    // Equation A7 for (0_A|R(mu)|b + 1):
+    for (long m=0; m < n1max; m++) {
+        for (long n=0; n <= n2max; n++) {
+            double tmp = pb*output[m*stride1 + n];
+            if (m > 0) tmp += twogamma_inv*m*output[(m-1)*stride1 + n];
+            if (n > 0) tmp += twogamma_inv*n*output[m*stride1 + n-1];
+            output[(m+1)*stride1 + n] = tmp;
+        }
+    }
+
+    // Equation A7 for (a + 1|R(mu)|b):
+    for (long l=0; l < n0max; l++) {
+        for (long m=0; m <= n1max; m++) {
+            for (long n=0; n <= n2max; n++) {
+                const long offset = l*stride0 + m*stride1 + n;
+                double tmp = pa*output[offset];
+                if (l > 0) tmp += twogamma_inv*l*output[offset - stride0];
+                if (m > 0) tmp += twogamma_inv*m*output[offset - stride1];
+                if (n > 0) tmp += twogamma_inv*n*output[offset - 1];
+                output[offset + stride0] = tmp;
+            }
+        }
+    }
+}
+
+
 GB2MomentIntegral::GB2MomentIntegral(long max_shell_type, long* xyz, double* center)
 : GB2Integral(max_shell_type), xyz(xyz), center(center) {
     if (xyz[0] + xyz[1] + xyz[2] < 0)
@@ -377,15 +496,14 @@ GB2MomentIntegral::GB2MomentIntegral(long max_shell_type, long* xyz, double* cen
 }
 
 
-void GB2MomentIntegral::add(double coeff, double alpha0, double alpha1,
-                            const double* scales0, const double* scales1) {
-    double pre, gamma_inv, twogamma_inv;
-    double gpt_center[3], pa[3], pb[3], pc[3];
+void GB2MomentIntegral::add_pair(const prim_pair_t* pair) {
+    double pa[3], pb[3], pc[3];
 
-    gamma_inv = 1.0/(alpha0 + alpha1);
-    twogamma_inv = 0.50/(alpha0 + alpha1);
-    pre = coeff*exp(-alpha0*alpha1*gamma_inv*dist_sq(r0, r1));
-    compute_gpt_center(alpha0, r0, alpha1, r1, gamma_inv, gpt_center);
+    const double twogamma_inv = 0.50*pair->gamma_inv;
+    const double pre = pair->coeff*pair->prefac;
+    const double* gpt_center = pair->gpt_center;
+    const double* scales0 = pair->scales0;
+    const double* scales1 = pair->scales1;
     pa[0] = gpt_center[0] - r0[0];
     pa[1] = gpt_center[1] - r0[1];
     pa[2] = gpt_center[2] - r0[2];
@@ -446,6 +564,15 @@ void GB4Integral::reset(
   memset(work_pure, 0, nwork*sizeof(double));
 }
 
+void GB4Integral::add(double coeff, double alpha0, double alpha1, double alpha2,
+                      double alpha3, const double* scales0, const double* scales1,
+                      const double* scales2, const double* scales3) {
+  prim_pair_t pair02, pair13;
+  compute_prim_pair(1.0, alpha0, r0, scales0, alpha2, r2, scales2, &pair02);
+  compute_prim_pair(1.0, alpha1, r1, scales1, alpha3, r3, scales3, &pair13);
+  add_pairs(coeff, &pair02, &pair13);
+}
+
 void GB4Integral::cart_to_pure() {
   /* The initial results are always stored in work_cart. The projection routine always
      outputs its result in work_pure. Once that is done, the pointers to both blocks are
@@ -513,7 +640,7 @@ void GB4Integral::cart_to_pure() {
 GB4IntegralLibInt::GB4IntegralLibInt(long max_shell_type)
     : GB4Integral(max_shell_type),
       libint_args{{0, NULL, 0.0}, {0, NULL, 0.0}, {0, NULL, 0.0}, {0, NULL, 0.0}},
-      order{0, 0, 0, 0}, ab{0.0, 0.0, 0.0}, cd{0.0, 0.0, 0.0}, ab2(0.0), cd2(0.0) {
+      order{0, 0, 0, 0}, ab{0.0, 0.0, 0.0}, cd{0.0, 0.0, 0.0} {
   libint2_init_eri(&erieval, max_shell_type, 0);
   erieval.contrdepth = 1;
 }
@@ -581,7 +708,7 @@ void GB4IntegralLibInt::reset(
     order[3] = tmp;
   }
 
-  /* Compute the distances squared of AB and CD.
+  /* Compute the relative vectors AB and CD.
      AB corresponds to libint_args[order[0]].r - libint_args[order[2]].r
      CD corresponds to libint_args[order[1]].r - libint_args[order[3]].r
   */
@@ -589,7 +716,6 @@ void GB4IntegralLibInt::reset(
   ab[0] = libint_args[order[0]].r[0] - libint_args[order[2]].r[0];
   ab[1] = libint_args[order[0]].r[1] - libint_args[order[2]].r[1];
   ab[2] = libint_args[order[0]].r[2] - libint_args[order[2]].r[2];
-  ab2 = ab[0] * ab[0] + ab[1] * ab[1] + ab[2] * ab[2];
 #if LIBINT2_DEFINED(eri, AB_x)
   erieval.AB_x[0] = ab[0];
 #endif
@@ -603,7 +729,6 @@ void GB4IntegralLibInt::reset(
   cd[0] = libint_args[order[1]].r[0] - libint_args[order[3]].r[0];
   cd[1] = libint_args[order[1]].r[1] - libint_args[order[3]].r[1];
   cd[2] = libint_args[order[1]].r[2] - libint_args[order[3]].r[2];
-  cd2 = cd[0] * cd[0] + cd[1] * cd[1] + cd[2] * cd[2];
 #if LIBINT2_DEFINED(eri, CD_x)
   erieval.CD_x[0] = cd[0];
 #endif
@@ -616,30 +741,32 @@ void GB4IntegralLibInt::reset(
 }
 
 
-void GB4IntegralLibInt::add(
-    double coeff, double alpha0, double alpha1, double alpha2, double alpha3,
-    const double* scales0, const double* scales1, const double* scales2, const double* scales3) {
+void GB4IntegralLibInt::add_pairs(double coeff, const prim_pair_t* pair02,
+                                  const prim_pair_t* pair13) {
   /*
       Store the arguments for libint such that they can be reordered
       conveniently.
   */
 
-  libint_args[0].alpha = alpha0;
-  libint_args[1].alpha = alpha1;
-  libint_args[2].alpha = alpha2;
-  libint_args[3].alpha = alpha3;
+  libint_args[0].alpha = pair02->alpha0;
+  libint_args[1].alpha = pair13->alpha0;
+  libint_args[2].alpha = pair02->alpha1;
+  libint_args[3].alpha = pair13->alpha1;
+
+  // The pairs in the order of libint: p = (order[0], order[2]) and
+  // q = (order[1], order[3]). The Gaussian product quantities do not depend on the
+  // order within a pair.
+  const bool swapped = (order[0] == 1) || (order[0] == 3);
+  const prim_pair_t* pair_p = swapped ? pair13 : pair02;
+  const prim_pair_t* pair_q = swapped ? pair02 : pair13;
 
   /*
-      Precompute some variables for libint. The approach here is not
-      super-efficient, but why bother...
+      Precompute some variables for libint.
   */
 
   const double gammap = libint_args[order[0]].alpha + libint_args[order[2]].alpha;
-  const double gammap_inv = 1.0/gammap;
-  double p[3];
-  compute_gpt_center(libint_args[order[0]].alpha, libint_args[order[0]].r,
-                     libint_args[order[2]].alpha, libint_args[order[2]].r,
-                     gammap_inv, p);
+  const double gammap_inv = pair_p->gamma_inv;
+  const double* p = pair_p->gpt_center;
   const double pa[3] = {
       p[0] - libint_args[order[0]].r[0],
       p[1] - libint_args[order[0]].r[1],
@@ -674,11 +801,8 @@ void GB4IntegralLibInt::add(
 #endif
 
   const double gammaq = libint_args[order[1]].alpha + libint_args[order[3]].alpha;
-  const double gammaq_inv = 1.0/gammaq;
-  double q[3];
-  compute_gpt_center(libint_args[order[1]].alpha, libint_args[order[1]].r,
-                     libint_args[order[3]].alpha, libint_args[order[3]].r,
-                     gammaq_inv, q);
+  const double gammaq_inv = pair_q->gamma_inv;
+  const double* q = pair_q->gpt_center;
   const double qc[3] = {
     q[0] - libint_args[order[1]].r[0],
     q[1] - libint_args[order[1]].r[1],
@@ -783,10 +907,8 @@ void GB4IntegralLibInt::add(
       Arguments for the kernel (using Boy's function or something else)
   */
 
-  const double k1 = exp(-libint_args[order[0]].alpha * libint_args[order[2]].alpha *
-                        ab2 * gammap_inv);
-  const double k2 = exp(-libint_args[order[1]].alpha * libint_args[order[3]].alpha *
-                        cd2 * gammaq_inv);
+  const double k1 = pair_p->prefac;
+  const double k2 = pair_q->prefac;
 #define PI_POW_3_2 5.5683279968317078
   const double pfac = PI_POW_3_2*k1*k2*eta_inv*sqrt(eta_inv)*coeff;
   const double rho = 1.0/(gammaq_inv + gammap_inv);
@@ -894,6 +1016,10 @@ end_boys:
       Actual computation of all the integrals in this shell-set by libint
   */
 
+  const double* scales0 = pair02->scales0;
+  const double* scales1 = pair13->scales0;
+  const double* scales2 = pair02->scales1;
+  const double* scales3 = pair13->scales1;
   if ((libint_args[0].am == 0) && (libint_args[1].am == 0) &&
       (libint_args[2].am == 0) && (libint_args[3].am == 0)) {
     work_cart[0] += erieval.LIBINT_T_SS_EREP_SS(0)[0] *
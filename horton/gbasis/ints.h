@@ -27,6 +27,59 @@
 #include "horton/gbasis/calc.h"
 #include "horton/gbasis/iter_pow.h"
 
+//! The number of charges for which GB2AttractionIntegral evaluates the potential at once.
+#define GB2_ATTRACTION_BLOCK_SIZE 64
+
+
+/** @brief
+        Quantities for a pair of primitive shells that do not depend on the operator.
+
+    These follow from the Gaussian product theorem. GBasis keeps a table of them for
+    all pairs of shells, such that they are not recomputed for every integral.
+  */
+typedef struct {
+  double coeff;           //!< Product of the contraction coefficients.
+  double alpha0;          //!< Exponent of primitive shell 0.
+  double alpha1;          //!< Exponent of primitive shell 1.
+  double gamma_inv;       //!< Inverse of the sum of both exponents.
+  double prefac;          //!< exp(-alpha0*alpha1*gamma_inv*|r0 - r1|^2)
+  double gpt_center[3];   //!< Gaussian product center.
+  const double* scales0;  //!< Normalization constants of primitive shell 0.
+  const double* scales1;  //!< Normalization constants of primitive shell 1.
+} prim_pair_t;
+
+
+/** @brief
+        Fill in the quantities for a pair of primitive shells.
+
+    @param coeff
+        Product of the contraction coefficients.
+
+    @param alpha0
+        The exponent of primitive shell 0.
+
+    @param r0
+        The center of primitive shell 0.
+
+    @param scales0
+        The normalization constants of primitive shell 0.
+
+    @param alpha1
+        The exponent of primitive shell 1.
+
+    @param r1
+        The center of primitive shell 1.
+
+    @param scales1
+        The normalization constants of primitive shell 1.
+
+    @param pair
+        The output.
+  */
+void compute_prim_pair(double coeff, double alpha0, const double* r0, const double* scales0,
+                       double alpha1, const double* r1, const double* scales1,
+                       prim_pair_t* pair);
+
 
 class GB2Integral : public GBCalculator {
     protected:
@@ -36,7 +89,35 @@ class GB2Integral : public GBCalculator {
     public:
         GB2Integral(long max_shell_type);
         void reset(long shell_type0, long shell_type1, const double* r0, const double* r1);
-        virtual void add(double coeff, double alpha0, double alpha1, const double* scales0, const double* scales1) = 0;
+        /** @brief
+                Add integrals for a pair of primitive shells to the work array.
+
+            This computes the Gaussian product quantities and calls add_pair.
+
+            @param coeff
+                Product of the contraction coefficients of the two primitives.
+
+            @param alpha0
+                The exponent of primitive shell 0.
+
+            @param alpha1
+                The exponent of primitive shell 1.
+
+            @param scales0
+                The normalization prefactors for basis functions in primitive shell 0
+
+            @param scales1
+                The normalization prefactors for basis functions in primitive shell 1
+          */
+        void add(double coeff, double alpha0, double alpha1, const double* scales0, const double* scales1);
+        /** @brief
+                Add integrals for a pair of primitive shells to the work array.
+
+            @param pair
+                The precomputed quantities of the pair, for the centers given to
+                the reset method.
+          */
+        virtual void add_pair(const prim_pair_t* pair) = 0;
         void cart_to_pure();
         const long get_shell_type0() const {return shell_type0;}
         const long get_shell_type1() const {return shell_type1;}
@@ -48,7 +129,7 @@ class GB2Integral : public GBCalculator {
 class GB2OverlapIntegral: public GB2Integral {
     public:
         GB2OverlapIntegral(long max_shell_type) : GB2Integral(max_shell_type) {};
-        virtual void add(double coeff, double alpha0, double alpha1, const double* scales0, const double* scales1);
+        virtual void add_pair(const prim_pair_t* pair);
 };
 
 /** @brief
@@ -57,7 +138,7 @@ class GB2OverlapIntegral: public GB2Integral {
 class GB2KineticIntegral: public GB2Integral {
     public:
         GB2KineticIntegral(long max_shell_type) : GB2Integral(max_shell_type) {};
-        virtual void add(double coeff, double alpha0, double alpha1, const double* scales0, const double* scales1);
+        virtual void add_pair(const prim_pair_t* pair);
 };
 
 /** @brief
@@ -73,6 +154,7 @@ class GB2AttractionIntegral: public GB2Integral {
         double* work_g1;    //!< Temporary array to store intermediate results.
         double* work_g2;    //!< Temporary array to store intermediate results.
         double* work_boys;  //!< Temporary array to store the laplace of the interaction potential.
+        double* work_args;  //!< Rescaled distances for a block of charges.
 
      public:
         /** @brief
@@ -85,25 +167,12 @@ class GB2AttractionIntegral: public GB2Integral {
         GB2AttractionIntegral(long max_shell_type, double* charges, double* centers, long ncharge);
         ~GB2AttractionIntegral();
         /** @brief
-          Add results for a combination of Cartesian primitive shells to the work array.
-
-         @param coeff
-             Product of the contraction coefficients of the four primitives.
+          Add results for a pair of primitive shells to the work array.
 
-         @param alpha0
-             The exponent of primitive shell 0.
-
-         @param alpha1
-             The exponent of primitive shell 1.
-
-         @param scales0
-            The normalization prefactors for basis functions in primitive shell 0
-
-         @param scales1
-            The normalization prefactors for basis functions in primitive shell 1
+         @param pair
+             The precomputed quantities of the pair.
         */
-        virtual void add(double coeff, double alpha0, double alpha1, const double* scales0,
-                         const double* scales1);
+        virtual void add_pair(const prim_pair_t* pair);
         /** @brief
           Evaluate the Laplace transform of the the potential applied to nuclear attraction terms.
 
@@ -132,6 +201,29 @@ class GB2AttractionIntegral: public GB2Integral {
              Output array. The size must be at least mmax + 1.
          */
         virtual void laplace_of_potential(double gamma, double arg, long mmax, double* output) = 0;
+
+        /** @brief
+          Evaluate the Laplace transform of the potential for many arguments.
+
+         The default implementation calls laplace_of_potential for every argument.
+
+         @param gamma
+             Sum of the exponents of the two gaussian functions involved in the integral.
+
+         @param narg
+             The number of arguments.
+
+         @param args
+             Rescaled distances between the two centers, shape (narg,).
+
+         @param mmax
+             Maximum derivative of the Laplace transform to be considered.
+
+         @param output
+             Output array, shape (narg, mmax + 1).
+         */
+        virtual void laplace_of_potential_batch(double gamma, long narg, const double* args,
+                                                long mmax, double* output);
 };
 
 /** @brief
@@ -168,6 +260,10 @@ class GB2NuclearAttractionIntegral : public GB2AttractionIntegral {
       See base class for more details.
     */
   virtual void laplace_of_potential(double gamma, double arg, long mmax, double* output);
+
+  //! Uses the batch evaluation of the Boys function. See base class for more details.
+  virtual void laplace_of_potential_batch(double gamma, long narg, const double* args,
+                                          long mmax, double* output);
 };
 
 /** @brief
@@ -208,6 +304,10 @@ class GB2ErfAttractionIntegral : public GB2AttractionIntegral {
     */
   virtual void laplace_of_potential(double gamma, double arg, long mmax, double* output);
 
+  //! Uses the batch evaluation of the Boys function. See base class for more details.
+  virtual void laplace_of_potential_batch(double gamma, long narg, const double* args,
+                                          long mmax, double* output);
+
   const double get_mu() const {return mu;}  //!< The range-separation parameter.
 
  private:
@@ -273,6 +373,41 @@ class GB2GaussAttractionIntegral : public GB2AttractionIntegral {
 };
 
 
+/** @brief
+        Compute all one-dimensional moment integrals of a primitive pair up to given
+        powers, with the Obara-Saika recursion.
+
+    The integrals are < (x - A)^a | (x - C)^k | (x - B)^b >, where the exponential
+    prefactor of the Gaussian product is left out.
+
+    @param n0max
+        The highest power a.
+
+    @param n1max
+        The highest power b.
+
+    @param n2max
+        The highest power k.
+
+    @param pa
+        The Gaussian product center minus A.
+
+    @param pb
+        The Gaussian product center minus B.
+
+    @param pc
+        The Gaussian product center minus C.
+
+    @param gamma_inv
+        The inverse of the sum of both exponents.
+
+    @param output
+        The output array with shape (n0max + 1, n1max + 1, n2max + 1).
+  */
+void compute_moment_table(long n0max, long n1max, long n2max, double pa, double pb,
+                          double pc, double gamma_inv, double* output);
+
+
 /** @brief
         Compute the (multipole) moment integrals in a Gaussian orbital basis.
         < gto_a | (x - C_x)^l (y - C_y)^m (z - C_z)^n | gto_b >.
@@ -300,23 +435,10 @@ class GB2MomentIntegral: public GB2Integral {
         /** @brief
                 Add integrals for a pair of primite shells to the current contraction.
 
-            @param coeff
-                The contraction coefficient for the current primitive.
-
-            @param alpha0
-                The exponent of the primitive shell 0.
-
-            @param alpha1
-                The exponent of the primitive shell 1.
-
-            @param scales0
-                The normalization constants for the basis functions in primitive shell 0.
-
-            @param scales1
-                The normalization constants for the basis functions in primitive shell 1.
+            @param pair
+                The precomputed quantities of the pair.
           */
-        virtual void add(double coeff, double alpha0, double alpha1,
-                         const double* scales0, const double* scales1);
+        virtual void add_pair(const prim_pair_t* pair);
 };
 
 
@@ -365,6 +487,8 @@ class GB4Integral : public GBCalculator {
   /** @brief
           Add results for a combination of Cartesian primitive shells to the work array.
 
+      This computes the Gaussian product quantities and calls add_pairs.
+
       @param coeff
           Product of the contraction coefficients of the four primitives.
 
@@ -392,9 +516,36 @@ class GB4Integral : public GBCalculator {
       @param scales3
           The normalization prefactors for basis functions in primitive shell 3
     */
-  virtual void add(double coeff, double alpha0, double alpha1, double alpha2,
-                   double alpha3, const double* scales0, const double* scales1,
-                   const double* scales2, const double* scales3) = 0;
+  void add(double coeff, double alpha0, double alpha1, double alpha2,
+           double alpha3, const double* scales0, const double* scales1,
+           const double* scales2, const double* scales3);
+
+  /** @brief
+          Add results for a combination of Cartesian primitive shells to the work array.
+
+      The four primitives are given as two pairs, for which the Gaussian product
+      quantities are already computed. (In chemist's notation, these are the bra and
+      ket pairs.) The coeff fields of the pairs are not used.
+
+      @param coeff
+          Product of the contraction coefficients of the four primitives.
+
+      @param pair02
+          The pair of primitive shells 0 and 2, for the centers r0 and r2.
+
+      @param pair13
+          The pair of primitive shells 1 and 3, for the centers r1 and r3.
+    */
+  virtual void add_pairs(double coeff, const prim_pair_t* pair02,
+                         const prim_pair_t* pair13) = 0;
+
+  /** @brief
+          Create a new object for the same operator, with its own work array.
+
+      This is used to compute integrals in several threads at the same time. The
+      caller is responsible for deleting the returned object.
+    */
+  virtual GB4Integral* clone() const = 0;
 
   //! Transform the results in the work array from Cartesian to pure functions where needed.
   void cart_to_pure();
@@ -448,9 +599,7 @@ class GB4IntegralLibInt : public GB4Integral {
 
       See base class for details.
     */
-  virtual void add(double coeff, double alpha0, double alpha1, double alpha2, double alpha3,
-                   const double* scales0, const double* scales1, const double* scales2,
-                   const double* scales3);
+  virtual void add_pairs(double coeff, const prim_pair_t* pair02, const prim_pair_t* pair13);
 
   /** @brief
           Evaluate the Laplace transform of the the potential.
@@ -490,8 +639,6 @@ class GB4IntegralLibInt : public GB4Integral {
   long order[4];                //!< Re-ordering of shells for compatibility with LibInt.
   double ab[3];                 //!< Relative vector from shell 2 to 0 (LibInt order).
   double cd[3];                 //!< Relative vector from shell 3 to 1 (LibInt order).
-  double ab2;                   //!< Norm squared of ab.
-  double cd2;                   //!< Norm squared of cd.
 };
 
 
@@ -511,6 +658,10 @@ class GB4ElectronRepulsionIntegralLibInt : public GB4IntegralLibInt {
   explicit GB4ElectronRepulsionIntegralLibInt(long max_shell_type)
       : GB4IntegralLibInt(max_shell_type) {}
 
+  virtual GB4Integral* clone() const {
+    return new GB4ElectronRepulsionIntegralLibInt(get_max_shell_type());
+  }
+
   /** @brief
           Evaluate the Laplace transform of the ordinary Coulomb potential.
 
@@ -542,6 +693,10 @@ class GB4ErfIntegralLibInt : public GB4IntegralLibInt {
   GB4ErfIntegralLibInt(long max_shell_type, double mu)
       : GB4IntegralLibInt(max_shell_type), mu(mu) {}
 
+  virtual GB4Integral* clone() const {
+    return new GB4ErfIntegralLibInt(get_max_shell_type(), mu);
+  }
+
   /** @brief
           Evaluate the Laplace transform of the long-range Coulomb potential.
           (The short-range part is damped away using an error function.) See (52) in
@@ -581,6 +736,10 @@ class GB4GaussIntegralLibInt : public GB4IntegralLibInt {
   GB4GaussIntegralLibInt(long max_shell_type, double c, double alpha)
       : GB4IntegralLibInt(max_shell_type), c(c), alpha(alpha) {}
 
+  virtual GB4Integral* clone() const {
+    return new GB4GaussIntegralLibInt(get_max_shell_type(), c, alpha);
+  }
+
   /** @brief
           Evaluate the Laplace transform of the Gaussian potential.
 
@@ -628,6 +787,10 @@ class GB4RAlphaIntegralLibInt : public GB4IntegralLibInt {
   GB4RAlphaIntegralLibInt(long max_shell_type, double alpha)
       : GB4IntegralLibInt(max_shell_type), alpha(alpha) {}
 
+  virtual GB4Integral* clone() const {
+    return new GB4RAlphaIntegralLibInt(get_max_shell_type(), alpha);
+  }
+
   /** @brief
           Evaluate the Laplace transform of the r^alpha potential. See Eq. (49) in
           Ahlrichs' paper.
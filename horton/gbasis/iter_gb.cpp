@@ -19,10 +19,12 @@
 //--
 
 
+#include <algorithm>
 #include <cstdlib>
 #include <cstring>
 #include "horton/gbasis/common.h"
 #include "horton/gbasis/iter_gb.h"
+#include "horton/gbasis/packed.h"
 using namespace std;
 
 
@@ -360,6 +362,22 @@ void IterGB4::update_shell() {
 }
 
 
+void IterGB4::set_shells(long _ishell0, long _ishell1, long _ishell2, long _ishell3) {
+    // Jump to an arbitrary quartet of shells, e.g. to visit them in a different
+    // order than the one imposed by inc_shell.
+    const long* prim_offsets = gbasis->get_prim_offsets();
+    ishell0 = _ishell0;
+    ishell1 = _ishell1;
+    ishell2 = _ishell2;
+    ishell3 = _ishell3;
+    oprim0 = prim_offsets[ishell0];
+    oprim1 = prim_offsets[ishell1];
+    oprim2 = prim_offsets[ishell2];
+    oprim3 = prim_offsets[ishell3];
+    update_shell();
+}
+
+
 int IterGB4::inc_prim() {
     // Increment primitive counters.
     if (iprim3 < nprim3-1) {
@@ -442,3 +460,92 @@ void IterGB4::store(const double *work, double *output) {
         }
     }
 }
+
+
+void IterGB4::store_packed(const double *work, double *output) {
+    // Only the canonical element of each set of symmetry-related copies is stored,
+    // see packed.h.
+    const long n0 = get_shell_nbasis(shell_type0);
+    const long n1 = get_shell_nbasis(shell_type1);
+    const long n2 = get_shell_nbasis(shell_type2);
+    const long n3 = get_shell_nbasis(shell_type3);
+    const double* tmp = work;
+    for (long i0=0; i0<n0; i0++) {
+        for (long i1=0; i1<n1; i1++) {
+            for (long i2=0; i2<n2; i2++) {
+                for (long i3=0; i3<n3; i3++) {
+                    // <01|23> in physicist's notation is (02|13) in chemist's notation.
+                    output[packed_index(i0 + ibasis0, i2 + ibasis2, i1 + ibasis1,
+                                        i3 + ibasis3)] = *tmp;
+                    tmp++;
+                }
+            }
+        }
+    }
+}
+
+
+void IterGB4::contract(const double* work, const double* dm, double* coulomb,
+                       double* exchange) {
+    // Contract the integrals of one shell quartet with a density matrix:
+    //   coulomb[a,c] += <ab|cd> dm[b,d]
+    //   exchange[a,d] += <ab|cd> dm[c,b]
+    // The symmetry-related copies of each element are the same as in the store
+    // method. All distinct copies must be included exactly once. Elements of the
+    // work array that are copies of each other are only processed once, i.e. for
+    // the copy with the (lexicographically) smallest index.
+    static const long perms[8][4] = {{0, 1, 2, 3}, {1, 0, 3, 2}, {2, 3, 0, 1},
+                                     {3, 2, 1, 0}, {0, 3, 2, 1}, {1, 2, 3, 0},
+                                     {2, 1, 0, 3}, {3, 0, 1, 2}};
+    const long begin[4] = {ibasis0, ibasis1, ibasis2, ibasis3};
+    const long n[4] = {get_shell_nbasis(shell_type0), get_shell_nbasis(shell_type1),
+                       get_shell_nbasis(shell_type2), get_shell_nbasis(shell_type3)};
+    const long nbasis = gbasis->get_nbasis();
+    const double* tmp = work;
+    long index[4];
+    long copies[8][4];
+    for (long i0=0; i0<n[0]; i0++) {
+        for (long i1=0; i1<n[1]; i1++) {
+            for (long i2=0; i2<n[2]; i2++) {
+                for (long i3=0; i3<n[3]; i3++) {
+                    index[0] = i0 + begin[0];
+                    index[1] = i1 + begin[1];
+                    index[2] = i2 + begin[2];
+                    index[3] = i3 + begin[3];
+                    bool canonical = true;
+                    for (long icopy=0; icopy<8; icopy++) {
+                        bool inside = true;
+                        for (long k=0; k<4; k++) {
+                            copies[icopy][k] = index[perms[icopy][k]];
+                            inside &= (copies[icopy][k] >= begin[k]) &&
+                                      (copies[icopy][k] < begin[k] + n[k]);
+                        }
+                        if (inside && std::lexicographical_compare(
+                                copies[icopy], copies[icopy] + 4, index, index + 4)) {
+                            canonical = false;
+                            break;
+                        }
+                    }
+                    if (canonical) {
+                        for (long icopy=0; icopy<8; icopy++) {
+                            // Skip duplicate copies.
+                            bool duplicate = false;
+                            for (long jcopy=0; jcopy<icopy; jcopy++) {
+                                duplicate |= std::equal(copies[icopy], copies[icopy] + 4,
+                                                        copies[jcopy]);
+                            }
+                            if (duplicate) continue;
+                            const long a = copies[icopy][0];
+                            const long b = copies[icopy][1];
+                            const long c = copies[icopy][2];
+                            const long d = copies[icopy][3];
+                            if (coulomb != NULL) coulomb[a*nbasis + c] += (*tmp)*dm[b*nbasis + d];
+                            if (exchange != NULL) exchange[a*nbasis + d] += (*tmp)*dm[c*nbasis + b];
+                        }
+                    }
+                    tmp++;
+                }
+            }
+        }
+    }
+}
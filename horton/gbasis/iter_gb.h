@@ -92,9 +92,13 @@ class IterGB4 {
 
         int inc_shell();
         void update_shell();
+        void set_shells(long ishell0, long ishell1, long ishell2, long ishell3);
         int inc_prim();
         void update_prim();
         void store(const double* work, double* output);
+        void store_packed(const double* work, double* output);
+        void contract(const double* work, const double* dm, double* coulomb,
+                      double* exchange);
 
         // 'public' iterator fields
         long shell_type0, shell_type1, shell_type2, shell_type3;
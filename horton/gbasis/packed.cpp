@@ -0,0 +1,130 @@
+// HORTON: Helpful Open-source Research TOol for N-fermion systems.
+// Copyright (C) 2011-2017 The HORTON Development Team
+//
+// This file is part of HORTON.
+//
+// HORTON is free software; you can redistribute it and/or
+// modify it under the terms of the GNU General Public License
+// as published by the Free Software Foundation; either version 3
+// of the License, or (at your option) any later version.
+//
+// HORTON is distributed in the hope that it will be useful,
+// but WITHOUT ANY WARRANTY; without even the implied warranty of
+// MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+// GNU General Public License for more details.
+//
+// You should have received a copy of the GNU General Public License
+// along with this program; if not, see <http://www.gnu.org/licenses/>
+//
+//--
+
+
+#include <stdexcept>
+#include <vector>
+#include "horton/gbasis/packed.h"
+#include "horton/gbasis/parallel.h"
+
+
+long get_packed_size(long nbasis) {
+    const long npair = nbasis*(nbasis + 1)/2;
+    return npair*(npair + 1)/2;
+}
+
+
+void pack_four_index(const double* dense, long nbasis, double* packed) {
+    long index = 0;
+    for (long p=0; p < nbasis; p++) {
+        for (long q=0; q <= p; q++) {
+            const long pq = p*(p + 1)/2 + q;
+            for (long r=0; r < nbasis; r++) {
+                for (long s=0; s <= r; s++) {
+                    if (r*(r + 1)/2 + s > pq) break;
+                    // (pq|rs) in chemist's notation is <pr|qs> in physicist's notation.
+                    packed[index] = dense[((p*nbasis + r)*nbasis + q)*nbasis + s];
+                    index++;
+                }
+            }
+        }
+    }
+}
+
+
+void unpack_four_index(const double* packed, long nbasis, double* dense) {
+    for (long a=0; a < nbasis; a++) {
+        for (long b=0; b < nbasis; b++) {
+            for (long c=0; c < nbasis; c++) {
+                for (long d=0; d < nbasis; d++) {
+                    *dense = packed[packed_index(a, c, b, d)];
+                    dense++;
+                }
+            }
+        }
+    }
+}
+
+
+void contract_packed(const double* packed, long nbasis, const double* dm,
+                     double* coulomb, double* exchange, long nthread) {
+    if (nthread < 1) {
+        throw std::domain_error("The number of threads must be strictly positive.");
+    }
+    const long nbasis2 = nbasis*nbasis;
+
+    // Each thread accumulates in its own arrays. The first thread directly writes
+    // into the output arrays. The rows p are distributed statically, such that the
+    // result is reproducible for a given number of threads.
+    std::vector<double> work(2*(nthread - 1)*nbasis2, 0.0);
+    run_in_threads(nthread, [&](long ithread) {
+        double* my_coulomb = coulomb;
+        double* my_exchange = exchange;
+        if (ithread > 0) {
+            if (my_coulomb != NULL) my_coulomb = &work[(2*ithread - 2)*nbasis2];
+            if (my_exchange != NULL) my_exchange = &work[(2*ithread - 1)*nbasis2];
+        }
+        for (long p=nbasis - 1 - ithread; p >= 0; p -= nthread) {
+            for (long q=0; q <= p; q++) {
+                const long pq = p*(p + 1)/2 + q;
+                const double* row = packed + pq*(pq + 1)/2;
+                // Distinct orderings of the first and the second pair.
+                const long pairs0[2][2] = {{p, q}, {q, p}};
+                const long npairs0 = (p == q) ? 1 : 2;
+                for (long r=0; r <= p; r++) {
+                    for (long s=0; s <= r; s++) {
+                        const long rs = r*(r + 1)/2 + s;
+                        if (rs > pq) break;
+                        const double value = row[rs];
+                        const long pairs1[2][2] = {{r, s}, {s, r}};
+                        const long npairs1 = (r == s) ? 1 : 2;
+                        // Loop over all distinct elements (ab|cd) equal to (pq|rs).
+                        for (long ipair0=0; ipair0 < npairs0; ipair0++) {
+                            for (long ipair1=0; ipair1 < npairs1; ipair1++) {
+                                for (long iswap=0; iswap < ((pq == rs) ? 1 : 2); iswap++) {
+                                    const long* first = iswap ? pairs1[ipair1] : pairs0[ipair0];
+                                    const long* second = iswap ? pairs0[ipair0] : pairs1[ipair1];
+                                    const long a = first[0];
+                                    const long b = first[1];
+                                    const long c = second[0];
+                                    const long d = second[1];
+                                    // (ab|cd) in chemist's notation is <ac|bd> in
+                                    // physicist's notation.
+                                    if (my_coulomb != NULL)
+                                        my_coulomb[a*nbasis + b] += value*dm[c*nbasis + d];
+                                    if (my_exchange != NULL)
+                                        my_exchange[a*nbasis + d] += value*dm[b*nbasis + c];
+                                }
+                            }
+                        }
+                    }
+                }
+            }
+        }
+    });
+
+    // Sum the contributions of the other threads, always in the same order.
+    for (long ithread=1; ithread < nthread; ithread++) {
+        for (long i=0; i < nbasis2; i++) {
+            if (coulomb != NULL) coulomb[i] += work[(2*ithread - 2)*nbasis2 + i];
+            if (exchange != NULL) exchange[i] += work[(2*ithread - 1)*nbasis2 + i];
+        }
+    }
+}
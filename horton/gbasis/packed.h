@@ -0,0 +1,109 @@
+// HORTON: Helpful Open-source Research TOol for N-fermion systems.
+// Copyright (C) 2011-2017 The HORTON Development Team
+//
+// This file is part of HORTON.
+//
+// HORTON is free software; you can redistribute it and/or
+// modify it under the terms of the GNU General Public License
+// as published by the Free Software Foundation; either version 3
+// of the License, or (at your option) any later version.
+//
+// HORTON is distributed in the hope that it will be useful,
+// but WITHOUT ANY WARRANTY; without even the implied warranty of
+// MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+// GNU General Public License for more details.
+//
+// You should have received a copy of the GNU General Public License
+// along with this program; if not, see <http://www.gnu.org/licenses/>
+//
+//--
+
+
+// UPDATELIBDOCTITLE: Packed storage of four-index objects with eight-fold symmetry
+
+#ifndef HORTON_GBASIS_PACKED_H_
+#define HORTON_GBASIS_PACKED_H_
+
+/*
+    In the packed storage, only the elements (pq|rs) (chemist's notation) with p >= q,
+    r >= s and pq >= rs are stored, where pq = p*(p+1)/2 + q is the index of a pair.
+    The element (pq|rs) has index pq*(pq+1)/2 + rs in the packed array. This saves a
+    factor of eight in memory for a real two-body operator.
+*/
+
+/** @brief
+        Returns the position of the element (ab|cd) (chemist's notation) in the packed
+        storage.
+ */
+inline long packed_index(long a, long b, long c, long d) {
+    const long ab = (a >= b) ? a*(a + 1)/2 + b : b*(b + 1)/2 + a;
+    const long cd = (c >= d) ? c*(c + 1)/2 + d : d*(d + 1)/2 + c;
+    return (ab >= cd) ? ab*(ab + 1)/2 + cd : cd*(cd + 1)/2 + ab;
+}
+
+/** @brief
+        Returns the number of elements in the packed storage.
+
+    @param nbasis
+        The number of basis functions.
+ */
+long get_packed_size(long nbasis);
+
+/** @brief
+        Converts a dense four-index object to the packed storage.
+
+    @param dense
+        The input array with shape (nbasis, nbasis, nbasis, nbasis), in physicist's
+        notation. It is assumed to have the eight-fold symmetry.
+
+    @param nbasis
+        The number of basis functions.
+
+    @param packed
+        The output array with get_packed_size(nbasis) elements.
+ */
+void pack_four_index(const double* dense, long nbasis, double* packed);
+
+/** @brief
+        Converts a packed four-index object to the dense storage.
+
+    @param packed
+        The input array with get_packed_size(nbasis) elements.
+
+    @param nbasis
+        The number of basis functions.
+
+    @param dense
+        The output array with shape (nbasis, nbasis, nbasis, nbasis), in physicist's
+        notation.
+ */
+void unpack_four_index(const double* packed, long nbasis, double* dense);
+
+/** @brief
+        Contracts a packed four-index object with a density matrix.
+
+    @param packed
+        The input array with get_packed_size(nbasis) elements.
+
+    @param nbasis
+        The number of basis functions.
+
+    @param dm
+        The density matrix with shape (nbasis, nbasis).
+
+    @param coulomb
+        Output array with shape (nbasis, nbasis) for the Coulomb-type contraction:
+        coulomb[a,c] = sum_bd <ab|cd> dm[b,d]. May be NULL.
+
+    @param exchange
+        Output array with shape (nbasis, nbasis) for the exchange-type contraction:
+        exchange[a,d] = sum_bc <ab|cd> dm[c,b]. May be NULL.
+
+    @param nthread
+        The number of threads. The result depends (only through rounding errors) on
+        the number of threads.
+ */
+void contract_packed(const double* packed, long nbasis, const double* dm,
+                     double* coulomb, double* exchange, long nthread);
+
+#endif  // HORTON_GBASIS_PACKED_H_
@@ -0,0 +1,66 @@
+// HORTON: Helpful Open-source Research TOol for N-fermion systems.
+// Copyright (C) 2011-2017 The HORTON Development Team
+//
+// This file is part of HORTON.
+//
+// HORTON is free software; you can redistribute it and/or
+// modify it under the terms of the GNU General Public License
+// as published by the Free Software Foundation; either version 3
+// of the License, or (at your option) any later version.
+//
+// HORTON is distributed in the hope that it will be useful,
+// but WITHOUT ANY WARRANTY; without even the implied warranty of
+// MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+// GNU General Public License for more details.
+//
+// You should have received a copy of the GNU General Public License
+// along with this program; if not, see <http://www.gnu.org/licenses/>
+//
+//--
+
+
+#include <exception>
+#include <stdexcept>
+#include <thread>
+#include <vector>
+#include "horton/gbasis/parallel.h"
+
+
+void run_in_threads(long nthread, const std::function<void(long)>& worker) {
+    if (nthread < 1) {
+        throw std::domain_error("The number of threads must be strictly positive.");
+    }
+    if (nthread == 1) {
+        worker(0);
+        return;
+    }
+
+    // Exceptions can not cross thread boundaries, so they are kept here and rethrown
+    // afterwards.
+    std::vector<std::exception_ptr> errors(nthread);
+    std::vector<std::thread> threads;
+    threads.reserve(nthread - 1);
+    for (long ithread=1; ithread < nthread; ithread++) {
+        threads.push_back(std::thread([&worker, &errors, ithread]() {
+            try {
+                worker(ithread);
+            } catch (...) {
+                errors[ithread] = std::current_exception();
+            }
+        }));
+    }
+    // The calling thread also does its share of the work.
+    try {
+        worker(0);
+    } catch (...) {
+        errors[0] = std::current_exception();
+    }
+    for (size_t i=0; i < threads.size(); i++) {
+        threads[i].join();
+    }
+    for (long ithread=0; ithread < nthread; ithread++) {
+        if (errors[ithread]) {
+            std::rethrow_exception(errors[ithread]);
+        }
+    }
+}
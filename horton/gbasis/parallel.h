@@ -0,0 +1,44 @@
+// HORTON: Helpful Open-source Research TOol for N-fermion systems.
+// Copyright (C) 2011-2017 The HORTON Development Team
+//
+// This file is part of HORTON.
+//
+// HORTON is free software; you can redistribute it and/or
+// modify it under the terms of the GNU General Public License
+// as published by the Free Software Foundation; either version 3
+// of the License, or (at your option) any later version.
+//
+// HORTON is distributed in the hope that it will be useful,
+// but WITHOUT ANY WARRANTY; without even the implied warranty of
+// MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+// GNU General Public License for more details.
+//
+// You should have received a copy of the GNU General Public License
+// along with this program; if not, see <http://www.gnu.org/licenses/>
+//
+//--
+
+// UPDATELIBDOCTITLE: Running work in several threads
+
+#ifndef HORTON_GBASIS_PARALLEL_H_
+#define HORTON_GBASIS_PARALLEL_H_
+
+#include <functional>
+
+/** @brief
+        Call a worker function in a number of threads and wait for all of them.
+
+    @param nthread
+        The number of threads. The worker is called nthread times, each time with a
+        different thread index. When nthread is one, no threads are started and the
+        worker is just called in the current thread.
+
+    @param worker
+        The function that does the work. It receives the thread index (from 0 to
+        nthread-1) as only argument. Work must be distributed by the worker itself,
+        e.g. with a shared atomic counter. If a worker raises an exception, it is
+        rethrown in the calling thread after all threads have finished.
+ */
+void run_in_threads(long nthread, const std::function<void(long)>& worker);
+
+#endif  // HORTON_GBASIS_PARALLEL_H_
@@ -24,6 +24,7 @@ import numpy as np
 from nose.tools import assert_raises
 
 from horton import *  # pylint: disable=wildcard-import,unused-wildcard-import
+from horton.test.common import numpy_seed
 
 
 def test_boys_functions():
@@ -524,3 +525,20 @@ def test_boys_array():
             output = boys_function_array(mmax, t)
             for m in xrange(mmax+1):
                 assert output[m] == boys_function(m, t)
+
+
+def test_boys_batch():
+    # Include arguments beyond the pre-computed tables, where the asymptotic form is used.
+    with numpy_seed():
+        ts = np.concatenate([np.random.uniform(0, 200, 500), [0.0, 30.0, 110.0]])
+    for mmax in xrange(get_max_shell_type()*4+1):
+        output = boys_function_array(mmax, ts)
+        assert output.shape == (len(ts), mmax+1)
+        for t, row in zip(ts, output):
+            expected = [boys_function(m, t) for m in xrange(mmax+1)]
+            np.testing.assert_allclose(row, expected, rtol=1e-12, atol=0)
+    assert boys_function_array(3, np.zeros(0)).shape == (0, 4)
+    with assert_raises(ValueError):
+        boys_function_array(3, np.array([1.0, -1.0]))
+    with assert_raises(ValueError):
+        boys_function_array(get_max_shell_type()*4+1, np.array([1.0]))
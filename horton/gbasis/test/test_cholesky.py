@@ -23,6 +23,7 @@ import numpy as np
 from nose.tools import assert_raises
 
 from horton import *  # pylint: disable=wildcard-import,unused-wildcard-import
+from horton.test.common import tmpdir
 
 
 def get_h2o_obasis():
@@ -61,6 +62,19 @@ def test_cholesky_coulomb():
     np.testing.assert_allclose(ref, chol, rtol=1e-5, atol=1e-8)
 
 
+def test_cholesky_coulomb_ccpvdz():
+    # Shells with d functions give several pivots per pair of shells.
+    mol = IOData.from_file(context.get_fn('test/water.xyz'))
+    obasis = get_gobasis(mol.coordinates, mol.numbers, 'cc-pvdz')
+    ref = obasis.compute_electron_repulsion()
+    for threshold in 1e-6, 1e-8:
+        vecs = obasis.compute_electron_repulsion_cholesky(threshold)
+        assert vecs.shape[1:] == (obasis.nbasis, obasis.nbasis)
+        chol = np.einsum('kac,kbd->abcd', vecs, vecs)
+        assert abs(np.einsum('aacc->ac', ref) - np.einsum('aacc->ac', chol)).max() < threshold
+        np.testing.assert_allclose(ref, chol, rtol=1e-5, atol=1e3*threshold)
+
+
 def test_cholesky_erf():
     obasis = get_h2o_obasis()
     mu = 1e4
@@ -87,3 +101,35 @@ def test_cholesky_ralpha():
     vecs = obasis.compute_ralpha_repulsion_cholesky(alpha)
     chol = np.einsum('kac,kbd->abcd', vecs, vecs)
     np.testing.assert_allclose(ref, chol, rtol=1e-5, atol=1e-8)
+
+
+def test_cholesky_nthread():
+    obasis = get_h2o_obasis()
+    ref = obasis.compute_electron_repulsion_cholesky(nthread=1)
+    for nthread in 2, 3:
+        vecs = obasis.compute_electron_repulsion_cholesky(nthread=nthread)
+        assert vecs.shape == ref.shape
+        assert (vecs == ref).all()
+
+
+def test_cholesky_file():
+    obasis = get_h2o_obasis()
+    ref = obasis.compute_electron_repulsion_cholesky()
+    with tmpdir('horton.gbasis.test.test_cholesky.test_cholesky_file') as dn:
+        fn = '%s/vecs.bin' % dn
+        vecs = obasis.compute_electron_repulsion_cholesky(filename=fn, nthread=2)
+        assert isinstance(vecs, np.memmap)
+        assert vecs.shape == ref.shape
+        assert (vecs == ref).all()
+        del vecs
+
+
+def test_cholesky_empty():
+    obasis = get_h2o_obasis()
+    # All diagonal elements are below the threshold, so no vectors are needed.
+    vecs = obasis.compute_electron_repulsion_cholesky(threshold=1e3)
+    assert vecs.shape == (0, obasis.nbasis, obasis.nbasis)
+    with tmpdir('horton.gbasis.test.test_cholesky.test_cholesky_empty') as dn:
+        fn = '%s/vecs.bin' % dn
+        vecs = obasis.compute_electron_repulsion_cholesky(threshold=1e3, filename=fn)
+        assert vecs.shape == (0, obasis.nbasis, obasis.nbasis)
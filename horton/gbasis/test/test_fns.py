@@ -25,7 +25,7 @@ from nose.plugins.attrib import attr
 from nose.tools import assert_raises
 
 from horton import *  # pylint: disable=wildcard-import,unused-wildcard-import
-from horton.test.common import check_delta
+from horton.test.common import check_delta, numpy_seed
 
 
 def check_functional_deriv(fn, comp, dm_method, fock_method):
@@ -918,3 +918,161 @@ def test_mgga_functional_deriv_4():
 
 def test_mgga_functional_deriv_5():
     check_mgga_functional_deriv('test/water_sto3g_hf_g03.fchk', 5)
+
+
+def test_grid_blocks():
+    # Grid points are processed in blocks. Results must not depend on how the points are
+    # distributed over blocks.
+    mol = IOData.from_file(context.get_fn('test/co_ccpv5z_pure_hf_g03.fchk'))
+    obasis = mol.obasis
+    dm_full = mol.get_dm_full()
+    with numpy_seed():
+        points = np.random.uniform(-3, 3, (301, 3))
+        weights = np.random.uniform(1, 2, 301)
+    methods = [
+        (obasis.compute_grid_density_dm, obasis.compute_grid_density_fock),
+        (obasis.compute_grid_gradient_dm, obasis.compute_grid_gradient_fock),
+        (obasis.compute_grid_gga_dm, obasis.compute_grid_gga_fock),
+        (obasis.compute_grid_kinetic_dm, obasis.compute_grid_kinetic_fock),
+        (obasis.compute_grid_hessian_dm, obasis.compute_grid_hessian_fock),
+        (obasis.compute_grid_mgga_dm, obasis.compute_grid_mgga_fock),
+    ]
+    for dm_method, fock_method in methods:
+        values = dm_method(dm_full, points)
+        with numpy_seed():
+            pots = np.random.uniform(-1, 1, values.shape)
+        fock = fock_method(points, weights, pots)
+        for npoint in 1, 7, 128, 129:
+            for begin in xrange(0, len(points), npoint):
+                end = begin + npoint
+                assert abs(dm_method(dm_full, points[begin:end]) - values[begin:end]).max() < 1e-10
+        fock_parts = np.zeros(fock.shape)
+        for begin in xrange(0, len(points), 7):
+            end = begin + 7
+            fock_method(points[begin:end], weights[begin:end], pots[begin:end], fock_parts)
+        assert abs(fock - fock_parts).max() < 1e-10
+        # All properties are linear in the density matrix, so the Fock matrix must
+        # reproduce the integral of the potential times the properties.
+        energy = np.dot(weights, (pots*values).reshape(len(points), -1).sum(axis=1))
+        assert abs(np.einsum('ab,ab', fock, dm_full) - energy) < 1e-8*abs(energy)
+
+
+def test_grid_nthread():
+    mol = IOData.from_file(context.get_fn('test/water_hfs_321g.fchk'))
+    obasis = mol.obasis
+    dm_full = mol.get_dm_full()
+    with numpy_seed():
+        points = np.random.uniform(-3, 3, (301, 3))
+        weights = np.random.uniform(1, 2, 301)
+    methods = [
+        (obasis.compute_grid_density_dm, obasis.compute_grid_density_fock),
+        (obasis.compute_grid_gga_dm, obasis.compute_grid_gga_fock),
+        (obasis.compute_grid_mgga_dm, obasis.compute_grid_mgga_fock),
+    ]
+    for dm_method, fock_method in methods:
+        values = dm_method(dm_full, points, nthread=1)
+        with numpy_seed():
+            pots = np.random.uniform(-1, 1, values.shape)
+        fock = fock_method(points, weights, pots, nthread=1)
+        for nthread in 2, 3, 8:
+            # Each point is computed by one thread, so the values are bitwise
+            # identical. The Fock matrix is a sum over thread contributions.
+            assert (dm_method(dm_full, points, nthread=nthread) == values).all()
+            np.testing.assert_allclose(fock_method(points, weights, pots, nthread=nthread),
+                                       fock, rtol=0, atol=1e-12*abs(fock).max())
+    iorbs = np.array([0, 1, 5])
+    orbs = obasis.compute_grid_orbitals_exp(mol.orb_alpha, points, iorbs, nthread=1)
+    hartree = obasis.compute_grid_hartree_dm(dm_full, points[:20], nthread=1)
+    for nthread in 2, 3:
+        assert (obasis.compute_grid_orbitals_exp(mol.orb_alpha, points, iorbs,
+                                                 nthread=nthread) == orbs).all()
+        assert (obasis.compute_grid_hartree_dm(dm_full, points[:20],
+                                               nthread=nthread) == hartree).all()
+    with assert_raises(ValueError):
+        obasis.compute_grid_density_dm(dm_full, points, nthread=0)
+    with assert_raises(ValueError):
+        obasis.compute_grid_gga_fock(points, weights, np.zeros((301, 4)), nthread=-1)
+
+
+def test_grid_density_fock_multi():
+    mol = IOData.from_file(context.get_fn('test/water_hfs_321g.fchk'))
+    obasis = mol.obasis
+    with numpy_seed():
+        points = np.random.uniform(-3, 3, (301, 3))
+        weights = np.random.uniform(1, 2, 301)
+        pots = np.random.uniform(-1, 1, (301, 5))
+    focks = obasis.compute_grid_density_fock_multi(points, weights, pots)
+    assert focks.shape == (5, obasis.nbasis, obasis.nbasis)
+    for iop in xrange(5):
+        fock = obasis.compute_grid_density_fock(points, weights, pots[:, iop])
+        assert (focks[iop] == fock).all()
+    # Results are added to the output.
+    obasis.compute_grid_density_fock_multi(points, weights, pots, focks, nthread=3)
+    np.testing.assert_allclose(focks, 2*obasis.compute_grid_density_fock_multi(
+        points, weights, pots), rtol=0, atol=1e-12*abs(focks).max())
+    with assert_raises(TypeError):
+        obasis.compute_grid_density_fock_multi(points, weights[:-1], pots)
+    with assert_raises(TypeError):
+        obasis.compute_grid_density_fock_multi(points, weights, pots, focks[:3])
+
+
+def test_grid_dm_fock_multi():
+    mol = IOData.from_file(context.get_fn('test/li_h_3-21G_hf_g09.fchk'))
+    obasis = mol.obasis
+    dms = np.array([mol.orb_alpha.to_dm(), mol.orb_beta.to_dm()])
+    with numpy_seed():
+        points = np.random.uniform(-3, 3, (301, 3))
+        weights = np.random.uniform(1, 2, 301)
+    methods = [
+        (obasis.compute_grid_density_dm, obasis.compute_grid_density_fock,
+         obasis.compute_grid_density_dm_multi, obasis.compute_grid_density_fock_multi),
+        (obasis.compute_grid_gga_dm, obasis.compute_grid_gga_fock,
+         obasis.compute_grid_gga_dm_multi, obasis.compute_grid_gga_fock_multi),
+        (obasis.compute_grid_mgga_dm, obasis.compute_grid_mgga_fock,
+         obasis.compute_grid_mgga_dm_multi, obasis.compute_grid_mgga_fock_multi),
+    ]
+    for dm_method, fock_method, dm_multi_method, fock_multi_method in methods:
+        values = dm_multi_method(dms, points, nthread=3)
+        assert values.shape[:2] == (301, 2)
+        with numpy_seed():
+            pots = np.random.uniform(-1, 1, values.shape)
+        focks = fock_multi_method(points, weights, pots, nthread=1)
+        assert focks.shape == (2, obasis.nbasis, obasis.nbasis)
+        for idm in xrange(2):
+            assert (values[:, idm] == dm_method(dms[idm], points)).all()
+            pot = np.ascontiguousarray(pots[:, idm])
+            assert (focks[idm] == fock_method(points, weights, pot, nthread=1)).all()
+        # Results are added to the output.
+        dm_multi_method(dms, points, values)
+        assert (values == 2*dm_multi_method(dms, points)).all()
+        with assert_raises(TypeError):
+            dm_multi_method(np.zeros((2, obasis.nbasis - 1, obasis.nbasis)), points)
+    with assert_raises(TypeError):
+        obasis.compute_grid_gga_fock_multi(points, weights, np.zeros((301, 2, 6)))
+    with assert_raises(TypeError):
+        obasis.compute_grid_gga_dm_multi(dms, points, np.zeros((301, 3, 4)))
+
+
+def test_grid_hartree_screened():
+    mol = IOData.from_file(context.get_fn('test/water_hfs_321g.fchk'))
+    obasis = mol.obasis
+    dm_full = mol.get_dm_full()
+    with numpy_seed():
+        points = np.random.uniform(-8, 8, (201, 3))
+    hartree = obasis.compute_grid_hartree_dm(dm_full, points)
+    for threshold in 1e-6, 1e-9, 1e-12:
+        screened = obasis.compute_grid_hartree_dm(dm_full, points,
+                                                  screening_threshold=threshold, nthread=1)
+        # The error of each approximation is below the threshold. A few of them may
+        # contribute at one point.
+        assert abs(screened - hartree).max() < 1e2*threshold
+        for nthread in 2, 3:
+            assert (obasis.compute_grid_hartree_dm(
+                dm_full, points, screening_threshold=threshold,
+                nthread=nthread) == screened).all()
+    esp = obasis.compute_grid_esp_dm(dm_full, mol.coordinates, mol.pseudo_numbers, points)
+    screened = obasis.compute_grid_esp_dm(dm_full, mol.coordinates, mol.pseudo_numbers,
+                                          points, screening_threshold=1e-10)
+    assert abs(screened - esp).max() < 1e-8
+    with assert_raises(ValueError):
+        obasis.compute_grid_hartree_dm(dm_full, points, screening_threshold=-1.0)
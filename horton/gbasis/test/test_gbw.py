@@ -68,6 +68,17 @@ def test_compute_diagonal():
     assert np.allclose(ref_diag, test_diag)
 
 
+def test_compute_diagonal_nthread():
+    obasis, er = get_h2o_er()
+
+    ref_diag = np.zeros((obasis.nbasis, obasis.nbasis))
+    compute_diagonal(obasis, ref_diag)
+    for nthread in 2, 3:
+        test_diag = np.zeros_like(ref_diag)
+        compute_diagonal(obasis, test_diag, nthread)
+        assert (ref_diag == test_diag).all()
+
+
 def test_get_2index_slice():
     obasis, er = get_h2o_er()
 
@@ -26,6 +26,7 @@ from nose.tools import assert_raises
 from nose.plugins.attrib import attr
 
 from horton import *  # pylint: disable=wildcard-import, unused-wildcard-import
+from horton.test.common import numpy_seed
 
 
 def test_shell_nbasis():
@@ -373,6 +374,47 @@ def test_grid_co_ccpv5z_pure_hf_esp_some_points():
     check_grid_esp('test/co_ccpv5z_pure_hf_g03.fchk', ref, 1e-5)
 
 
+def test_grid_tolerance():
+    mol = IOData.from_file(context.get_fn('test/water_hfs_321g.fchk'))
+    obasis = mol.obasis
+    dm_full = mol.get_dm_full()
+    assert obasis.grid_tolerance == 1e-20
+    assert (obasis.shell_extents > 0).all()
+    assert np.isfinite(obasis.shell_extents).all()
+    with numpy_seed():
+        points = np.random.uniform(-15, 15, (500, 3))
+        weights = np.random.uniform(1, 2, 500)
+        pots = np.random.uniform(-1, 1, (500, 4))
+    iorbs = np.array([0, 3, 4])
+
+    def compute():
+        return [
+            obasis.compute_grid_density_dm(dm_full, points),
+            obasis.compute_grid_gga_dm(dm_full, points),
+            obasis.compute_grid_orbitals_exp(mol.orb_alpha, points, iorbs),
+            obasis.compute_grid_gga_fock(points, weights, pots),
+        ]
+
+    results_default = compute()
+    obasis.grid_tolerance = 0.0
+    assert np.isinf(obasis.shell_extents).all()
+    results_ref = compute()
+    obasis.grid_tolerance = 1e-12
+    extents_loose = obasis.shell_extents
+    results_loose = compute()
+    for result_default, result_loose, result_ref in zip(
+            results_default, results_loose, results_ref):
+        assert abs(result_default - result_ref).max() < 1e-15
+        assert abs(result_loose - result_ref).max() < 1e-8
+    # Shells are skipped in the loose case.
+    distances = np.sqrt(((obasis.centers[obasis.shell_map, None] - points)**2).sum(axis=2))
+    assert (distances > extents_loose[:, None]).any()
+    # A subset keeps the tolerance.
+    assert obasis.get_subset([0, 1])[0].grid_tolerance == 1e-12
+    with assert_raises(ValueError):
+        obasis.grid_tolerance = -1.0
+
+
 def test_grid_two_index_ne():
     mol = IOData.from_file(context.get_fn('test/li_h_3-21G_hf_g09.fchk'))
     rtf = ExpRTransform(1e-3, 2e1, 100)
@@ -617,3 +659,321 @@ def check_normalization(number, basis):
 def test_normalization_ccpvdz():
     for number in xrange(1, 18+1):
         check_normalization(number, 'cc-pvdz')
+
+
+def get_water_dimer_obasis(distance=10.0):
+    """Return an STO-3G basis for two water molecules that are far apart."""
+    mol = IOData.from_file(context.get_fn('test/water.xyz'))
+    coordinates = np.concatenate([mol.coordinates, mol.coordinates + [0.0, 0.0, distance]])
+    numbers = np.concatenate([mol.numbers, mol.numbers])
+    return get_gobasis(coordinates, numbers, 'sto-3g')
+
+
+def test_integrals_distant_fragments():
+    # The overlap of the basis functions on both fragments underflows, such that the
+    # corresponding integrals are skipped. They must be exactly zero.
+    obasis = get_water_dimer_obasis(200.0)
+    mono = obasis.nbasis//2
+    fragments = np.arange(obasis.nbasis) >= mono
+    cross = fragments[:, None] != fragments
+    for compute in obasis.compute_overlap, obasis.compute_kinetic:
+        result = compute()
+        assert (result[cross] == 0.0).all()
+        assert abs(result[:mono, :mono]).max() > 0.1
+        np.testing.assert_allclose(result[:mono, :mono], result[mono:, mono:],
+                                   rtol=0, atol=1e-12)
+    eri = obasis.compute_electron_repulsion()
+    # <ab|cd> contains the products of a with c and of b with d.
+    assert (eri[cross[:, None, :, None] | cross[None, :, None, :]] == 0.0).all()
+    np.testing.assert_allclose(eri[:mono, :mono, :mono, :mono],
+                               eri[mono:, mono:, mono:, mono:], rtol=0, atol=1e-12)
+    # The Coulomb interaction between both fragments is not skipped.
+    np.testing.assert_allclose(eri[0, mono, 0, mono], 1.0/200.0, rtol=1e-2)
+
+
+def test_integrals_moved_center():
+    # The centers of a basis may be changed after the first integrals are computed.
+    mol = IOData.from_file(context.get_fn('test/water.xyz'))
+    obasis = get_gobasis(mol.coordinates, mol.numbers, '3-21g')
+    obasis.compute_overlap()
+    sa = ScreenedAttraction(obasis, np.zeros((1, 3)))
+    obasis.centers[1] += [0.1, -0.2, 0.3]
+    fresh = get_gobasis(obasis.centers.copy(), mol.numbers, '3-21g')
+    np.testing.assert_allclose(obasis.compute_overlap(), fresh.compute_overlap(),
+                               rtol=0, atol=1e-14)
+    np.testing.assert_allclose(obasis.compute_electron_repulsion(),
+                               fresh.compute_electron_repulsion(), rtol=0, atol=1e-12)
+    center = np.array([0.1, 0.2, 0.3])
+    np.testing.assert_allclose(obasis.compute_multipole_moments(2, center),
+                               fresh.compute_multipole_moments(2, center), rtol=0, atol=1e-12)
+    # The screened attraction integrals depend on the original centers.
+    with assert_raises(ValueError):
+        sa.compute(np.ones(1))
+
+
+def check_four_index_screening(compute):
+    """Compare screened four-center integrals with the unscreened ones.
+
+    Parameters
+    ----------
+    compute : function
+        Called as ``compute(obasis, screening_threshold)`` and returns a four-index
+        object.
+    """
+    obasis = get_water_dimer_obasis()
+    ref = compute(obasis, 0.0)
+    for threshold in 1e-12, 1e-6, 1e-3:
+        screened = compute(obasis, threshold)
+        # Skipped integrals are zero, all others are unaffected.
+        assert ((screened == ref) | (screened == 0.0)).all()
+        assert abs(screened - ref).max() < threshold
+    # Sufficiently many integrals should be skipped with a loose threshold.
+    assert (screened == 0.0).sum() > (ref == 0.0).sum()
+
+
+def test_electron_repulsion_screening():
+    check_four_index_screening(
+        lambda obasis, threshold: obasis.compute_electron_repulsion(
+            screening_threshold=threshold))
+
+
+def test_erf_repulsion_screening():
+    check_four_index_screening(
+        lambda obasis, threshold: obasis.compute_erf_repulsion(
+            2.0, screening_threshold=threshold))
+
+
+def test_gauss_repulsion_screening():
+    check_four_index_screening(
+        lambda obasis, threshold: obasis.compute_gauss_repulsion(
+            1.2, 0.5, screening_threshold=threshold))
+
+
+def test_ralpha_repulsion_screening():
+    check_four_index_screening(
+        lambda obasis, threshold: obasis.compute_ralpha_repulsion(
+            -1.5, screening_threshold=threshold))
+
+
+def test_four_index_nthread():
+    obasis = get_water_dimer_obasis(3.0)
+    for compute in (obasis.compute_electron_repulsion,
+                    lambda **kwargs: obasis.compute_erf_repulsion(2.0, **kwargs),
+                    lambda **kwargs: obasis.compute_gauss_repulsion(1.2, 0.5, **kwargs),
+                    lambda **kwargs: obasis.compute_ralpha_repulsion(-1.5, **kwargs)):
+        for threshold in 0.0, 1e-6:
+            ref = compute(screening_threshold=threshold, nthread=1)
+            for nthread in 2, 3, 8:
+                # The result must be bitwise identical.
+                assert (compute(screening_threshold=threshold, nthread=nthread) == ref).all()
+
+
+def test_four_index_nthread_invalid():
+    obasis = get_water_dimer_obasis()
+    with assert_raises(ValueError):
+        obasis.compute_electron_repulsion(nthread=0)
+    with assert_raises(ValueError):
+        obasis.compute_electron_repulsion_cholesky(nthread=-1)
+
+
+def check_four_index_direct(compute_dense, compute_direct):
+    """Compare integral-direct contractions with those of the dense integrals.
+
+    Parameters
+    ----------
+    compute_dense : function
+        Called as ``compute_dense(obasis)`` and returns the four-index object.
+    compute_direct : function
+        Called as ``compute_direct(obasis, dm, screening_threshold, nthread)`` and
+        returns the Coulomb and exchange contractions.
+    """
+    obasis = get_water_dimer_obasis(4.0)
+    ref = compute_dense(obasis)
+    with numpy_seed():
+        dm = np.random.uniform(-0.5, 0.5, (obasis.nbasis, obasis.nbasis))
+    dm = dm + dm.T
+    coulomb_ref = np.einsum('abcd,bd->ac', ref, dm)
+    exchange_ref = np.einsum('abcd,cb->ad', ref, dm)
+    for nthread in 1, 3:
+        coulomb, exchange = compute_direct(obasis, dm, 0.0, nthread)
+        np.testing.assert_allclose(coulomb, coulomb_ref, atol=1e-12)
+        np.testing.assert_allclose(exchange, exchange_ref, atol=1e-12)
+        # Each skipped quartet contributes at most a few times the threshold.
+        coulomb, exchange = compute_direct(obasis, dm, 1e-8, nthread)
+        np.testing.assert_allclose(coulomb, coulomb_ref, atol=1e-5)
+        np.testing.assert_allclose(exchange, exchange_ref, atol=1e-5)
+
+
+def test_electron_repulsion_direct():
+    check_four_index_direct(
+        lambda obasis: obasis.compute_electron_repulsion(),
+        lambda obasis, dm, threshold, nthread: obasis.compute_electron_repulsion_direct(
+            dm, screening_threshold=threshold, nthread=nthread))
+
+
+def test_erf_repulsion_direct():
+    check_four_index_direct(
+        lambda obasis: obasis.compute_erf_repulsion(2.0),
+        lambda obasis, dm, threshold, nthread: obasis.compute_erf_repulsion_direct(
+            dm, 2.0, screening_threshold=threshold, nthread=nthread))
+
+
+def test_gauss_repulsion_direct():
+    check_four_index_direct(
+        lambda obasis: obasis.compute_gauss_repulsion(1.2, 0.5),
+        lambda obasis, dm, threshold, nthread: obasis.compute_gauss_repulsion_direct(
+            dm, 1.2, 0.5, screening_threshold=threshold, nthread=nthread))
+
+
+def test_ralpha_repulsion_direct():
+    check_four_index_direct(
+        lambda obasis: obasis.compute_ralpha_repulsion(-1.5),
+        lambda obasis, dm, threshold, nthread: obasis.compute_ralpha_repulsion_direct(
+            dm, -1.5, screening_threshold=threshold, nthread=nthread))
+
+
+def test_electron_repulsion_three_center_exact():
+    # All products of the basis functions on a single center can be expanded exactly
+    # in the auxiliary basis, such that density fitting reproduces the four-center
+    # integrals.
+    centers = np.array([[0.1, -0.2, 0.3]])
+    obasis = GOBasis(centers, np.array([0, 0]), np.array([1, 1]), np.array([0, 1]),
+                     np.array([0.5, 1.5]), np.array([1.0, 1.0]))
+    aux = GOBasis(centers, np.array([0, 0, 0]), np.array([1, 1, 1]),
+                  np.array([0, 1, 2]), np.array([1.0, 2.0, 3.0]),
+                  np.array([1.0, 1.0, 1.0]))
+    ref = obasis.compute_electron_repulsion()
+    three_center = obasis.compute_electron_repulsion_three_center(aux)
+    assert three_center.shape == (aux.nbasis, obasis.nbasis, obasis.nbasis)
+    metric = aux.compute_electron_repulsion_two_center()
+    assert metric.shape == (aux.nbasis, aux.nbasis)
+    # The four-center integrals are stored in physicist's notation.
+    fitted = np.einsum('pab,pq,qcd->acbd', three_center, np.linalg.inv(metric),
+                       three_center)
+    np.testing.assert_allclose(fitted, ref, atol=1e-10)
+    vecs = obasis.compute_electron_repulsion_ri(aux)
+    np.testing.assert_allclose(np.einsum('kab,kcd->acbd', vecs, vecs), ref, atol=1e-10)
+
+
+def test_electron_repulsion_three_center_water():
+    mol = IOData.from_file(context.get_fn('test/water.xyz'))
+    obasis = get_gobasis(mol.coordinates, mol.numbers, 'sto-3g')
+    aux = get_gobasis(mol.coordinates, mol.numbers, 'cc-pvdz')
+    three_center = obasis.compute_electron_repulsion_three_center(aux, nthread=1)
+    assert (three_center == three_center.transpose(0, 2, 1)).all()
+    for nthread in 2, 3:
+        # The result must be bitwise identical.
+        assert (obasis.compute_electron_repulsion_three_center(aux, nthread=nthread) ==
+                three_center).all()
+    metric = aux.compute_electron_repulsion_two_center()
+    assert (metric == metric.T).all()
+    assert np.linalg.eigvalsh(metric).min() > 0
+    # With the Coulomb metric, the fitted Hartree energy is a lower bound.
+    ref = obasis.compute_electron_repulsion()
+    vecs = obasis.compute_electron_repulsion_ri(aux)
+    with numpy_seed():
+        for irep in xrange(5):
+            dm = np.random.uniform(-0.5, 0.5, (obasis.nbasis, obasis.nbasis))
+            dm = dm + dm.T
+            hartree_ref = np.einsum('abcd,ac,bd', ref, dm, dm)
+            hartree_ri = (np.einsum('kab,ab', vecs, dm)**2).sum()
+            assert hartree_ri <= hartree_ref + 1e-10
+            assert hartree_ri > 0.9*hartree_ref
+
+
+def test_electron_repulsion_three_center_invalid():
+    obasis = get_water_dimer_obasis()
+    with assert_raises(TypeError):
+        obasis.compute_electron_repulsion_three_center(
+            obasis, output=np.zeros((obasis.nbasis, obasis.nbasis, 1)))
+    with assert_raises(ValueError):
+        obasis.compute_electron_repulsion_three_center(obasis, nthread=0)
+
+
+def test_four_index_packed():
+    obasis = get_water_dimer_obasis(3.0)
+    assert get_packed_nbasis(get_packed_size(obasis.nbasis)) == obasis.nbasis
+    for compute in (obasis.compute_electron_repulsion,
+                    lambda **kwargs: obasis.compute_erf_repulsion(2.0, **kwargs),
+                    lambda **kwargs: obasis.compute_gauss_repulsion(1.2, 0.5, **kwargs),
+                    lambda **kwargs: obasis.compute_ralpha_repulsion(-1.5, **kwargs)):
+        for threshold in 0.0, 1e-6:
+            dense = compute(screening_threshold=threshold)
+            packed = compute(screening_threshold=threshold, nthread=3, packed=True)
+            assert packed.shape == (get_packed_size(obasis.nbasis),)
+            assert (packed == pack_four_index(dense)).all()
+            assert (unpack_four_index(packed) == dense).all()
+
+
+def test_four_index_packed_invalid():
+    obasis = get_water_dimer_obasis()
+    with assert_raises(TypeError):
+        obasis.compute_electron_repulsion(packed=True, output=np.zeros(10))
+    with assert_raises(TypeError):
+        obasis.compute_electron_repulsion(
+            output=np.zeros((obasis.nbasis,)*4)[:, :, :, ::-1])
+    with assert_raises(TypeError):
+        unpack_four_index(np.zeros(10))
+
+
+def test_contract_packed():
+    obasis = get_water_dimer_obasis(4.0)
+    dense = obasis.compute_electron_repulsion()
+    packed = pack_four_index(dense)
+    with numpy_seed():
+        # The density matrix does not need to be symmetric.
+        dm = np.random.uniform(-0.5, 0.5, (obasis.nbasis, obasis.nbasis))
+    coulomb_ref = np.einsum('abcd,bd->ac', dense, dm)
+    exchange_ref = np.einsum('abcd,cb->ad', dense, dm)
+    for nthread in 1, 3:
+        coulomb, exchange = contract_packed(packed, dm, nthread=nthread)
+        np.testing.assert_allclose(coulomb, coulomb_ref, atol=1e-12)
+        np.testing.assert_allclose(exchange, exchange_ref, atol=1e-12)
+    coulomb, exchange = contract_packed(packed, dm, exchange=False)
+    assert exchange is None
+    np.testing.assert_allclose(coulomb, coulomb_ref, atol=1e-12)
+    coulomb, exchange = contract_packed(packed, dm, coulomb=False)
+    assert coulomb is None
+    np.testing.assert_allclose(exchange, exchange_ref, atol=1e-12)
+
+
+def test_screened_attraction():
+    mol = IOData.from_file(context.get_fn('test/water.xyz'))
+    obasis = get_gobasis(mol.coordinates, mol.numbers, '6-31g*')
+    with numpy_seed():
+        # Point charges in a shell around the molecule, some of them close to it.
+        ncharge = 3000
+        directions = np.random.normal(0, 1, (ncharge, 3))
+        directions /= np.linalg.norm(directions, axis=1)[:, None]
+        radii = np.random.uniform(3.0, 60.0, ncharge)
+        coordinates = directions*radii[:, None]
+        sa = ScreenedAttraction(obasis, coordinates, threshold=1e-8)
+        assert sa.ncharge == ncharge
+        assert sa.ncell > 1
+        # The same object is used for different charges.
+        for _ in xrange(2):
+            charges = np.random.uniform(-1, 1, ncharge)
+            expected = obasis.compute_nuclear_attraction(coordinates, charges)
+            result = sa.compute(charges)
+            np.testing.assert_allclose(result, expected, atol=1e-6)
+            assert 0 < sa.nexact < ncharge*mol.natom
+            assert (sa.compute(charges, nthread=3) == result).all()
+    # Without charges, all integrals are zero.
+    assert (sa.compute(np.zeros(ncharge)) == 0).all()
+    assert sa.nexact == 0
+
+
+def test_screened_attraction_invalid():
+    obasis = get_water_dimer_obasis()
+    coordinates = np.zeros((5, 3))
+    with assert_raises(ValueError):
+        ScreenedAttraction(obasis, coordinates, threshold=0.0)
+    with assert_raises(ValueError):
+        ScreenedAttraction(obasis, coordinates, cell_size=-1.0)
+    with assert_raises(TypeError):
+        ScreenedAttraction(obasis, np.zeros((5, 2)))
+    sa = ScreenedAttraction(obasis, coordinates)
+    with assert_raises(TypeError):
+        sa.compute(np.zeros(4))
+    with assert_raises(ValueError):
+        sa.compute(np.zeros(5), nthread=0)
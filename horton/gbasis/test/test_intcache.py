@@ -0,0 +1,100 @@
+# -*- coding: utf-8 -*-
+# HORTON: Helpful Open-source Research TOol for N-fermion systems.
+# Copyright (C) 2011-2017 The HORTON Development Team
+#
+# This file is part of HORTON.
+#
+# HORTON is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 3
+# of the License, or (at your option) any later version.
+#
+# HORTON is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, see <http://www.gnu.org/licenses/>
+#
+# --
+
+
+import h5py as h5
+import numpy as np
+from nose.tools import assert_raises
+
+from horton import *  # pylint: disable=wildcard-import,unused-wildcard-import
+from horton.test.common import tmpdir
+
+
+def get_h2o_obasis(basis='sto-3g'):
+    mol = IOData.from_file(context.get_fn('test/water.xyz'))
+    return mol, get_gobasis(mol.coordinates, mol.numbers, basis)
+
+
+def test_integral_cache():
+    mol, obasis = get_h2o_obasis()
+    with tmpdir('horton.gbasis.test.test_intcache.test_integral_cache') as dn:
+        cache = IntegralCache('%s/ints.h5' % dn)
+        olp1 = cache.compute(obasis, 'overlap')
+        assert (olp1 == obasis.compute_overlap()).all()
+        olp2 = cache.compute(obasis, 'overlap')
+        assert (olp1 == olp2).all()
+        # Parameters are part of the key, nthread is not.
+        vecs1 = cache.compute(obasis, 'erf_repulsion_cholesky', mu=0.3)
+        vecs2 = cache.compute(obasis, 'erf_repulsion_cholesky', mu=0.3, nthread=2)
+        vecs3 = cache.compute(obasis, 'erf_repulsion_cholesky', mu=0.4)
+        assert (vecs1 == vecs2).all()
+        assert abs(vecs1 - vecs3).max() > 1e-3
+        na = cache.compute(obasis, 'nuclear_attraction', coordinates=mol.coordinates,
+                           charges=mol.pseudo_numbers)
+        np.testing.assert_equal(na, obasis.compute_nuclear_attraction(
+            mol.coordinates, mol.pseudo_numbers))
+        with h5.File('%s/ints.h5' % dn, 'r') as f:
+            assert len(f) == 4
+        # A different basis gives a different key.
+        obasis_other = get_gobasis(mol.coordinates, mol.numbers, '3-21g')
+        assert cache.get_key(obasis, 'overlap') != cache.get_key(obasis_other, 'overlap')
+        assert cache.get_key(obasis, 'overlap') == cache.get_key(get_h2o_obasis()[1], 'overlap')
+
+
+def test_integral_cache_eviction():
+    obasis = get_h2o_obasis()[1]
+    size = obasis.nbasis**2*8
+    with tmpdir('horton.gbasis.test.test_intcache.test_integral_cache_eviction') as dn:
+        fn = '%s/ints.h5' % dn
+        cache = IntegralCache(fn, 2*size)
+        key_olp = cache.get_key(obasis, 'overlap')
+        key_kin = cache.get_key(obasis, 'kinetic')
+        cache.compute(obasis, 'overlap')
+        cache.compute(obasis, 'kinetic')
+        cache.compute(obasis, 'overlap')
+        # The kinetic energy integrals are the least recently used.
+        cache.compute(obasis, 'erf_attraction', coordinates=obasis.centers,
+                      charges=np.ones(obasis.ncenter), mu=0.5)
+        with h5.File(fn, 'r') as f:
+            assert len(f) == 2
+            assert key_olp in f
+            assert key_kin not in f
+        # Results larger than the cache are not stored.
+        cache = IntegralCache(fn, size - 1)
+        cache.compute(obasis, 'kinetic')
+        with h5.File(fn, 'r') as f:
+            assert key_kin not in f
+        # Incomplete entries are recomputed.
+        with h5.File(fn, 'a') as f:
+            f.create_group(key_kin)
+        kin = IntegralCache(fn).compute(obasis, 'kinetic')
+        np.testing.assert_equal(kin, obasis.compute_kinetic())
+
+
+def test_integral_cache_exceptions():
+    obasis = get_h2o_obasis()[1]
+    with assert_raises(ValueError):
+        IntegralCache('foo.h5', 0)
+    cache = IntegralCache('foo.h5')
+    with assert_raises(TypeError):
+        cache.compute(obasis, 'overlap', output=np.zeros((obasis.nbasis, obasis.nbasis)))
+    with assert_raises(TypeError):
+        cache.compute(obasis, 'electron_repulsion_cholesky', filename='foo.bin')
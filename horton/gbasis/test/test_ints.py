@@ -4477,6 +4477,59 @@ def test_quadrupole_monosilicic_acid_hf_lan_g09():
     check_g09_quadrupole(context.get_fn('test/monosilicic_acid_hf_lan.fchk'))
 
 
+def check_multipole_moments(fn_fchk, lmax):
+    """Compare the batch of moment integrals with the ones computed separately.
+
+    Parameters
+    ----------
+    fn_fchk : str
+        The FCHK filename.
+    lmax : int
+        The highest order of the moments.
+    """
+    mol = IOData.from_file(fn_fchk)
+    obasis = mol.obasis
+    centers = np.array([[0.1, -0.2, 0.3], mol.coordinates[0]])
+    moments = obasis.compute_multipole_moments_centers(lmax, centers)
+    assert moments.shape == (2, get_ncart_cumul(lmax), obasis.nbasis, obasis.nbasis)
+    for icenter, center in enumerate(centers):
+        np.testing.assert_allclose(moments[icenter, 0], obasis.compute_overlap(),
+                                   rtol=0, atol=1e-12)
+        for imoment, xyz in enumerate(get_cartesian_powers(lmax)[1:]):
+            ref = obasis.compute_multipole_moment(xyz, center)
+            np.testing.assert_allclose(moments[icenter, imoment + 1], ref, rtol=0,
+                                       atol=1e-12*abs(ref).max())
+        single = obasis.compute_multipole_moments(lmax, center)
+        np.testing.assert_allclose(single, moments[icenter], rtol=0, atol=1e-15)
+
+
+def test_multipole_moments_water_sto3g_hf():
+    check_multipole_moments(context.get_fn('test/water_sto3g_hf_g03.fchk'), 3)
+
+
+def test_multipole_moments_water_ccpvdz_pure_hf():
+    check_multipole_moments(context.get_fn('test/water_ccpvdz_pure_hf_g03.fchk'), 2)
+
+
+def test_multipole_moments_co_ccpv5z_cart_hf():
+    check_multipole_moments(context.get_fn('test/co_ccpv5z_cart_hf_g03.fchk'), 1)
+
+
+def test_multipole_moments_output():
+    mol = IOData.from_file(context.get_fn('test/water_sto3g_hf_g03.fchk'))
+    obasis = mol.obasis
+    output = np.zeros((4, obasis.nbasis, obasis.nbasis))
+    result = obasis.compute_multipole_moments(1, np.zeros(3), output)
+    assert abs(output).max() > 0
+    assert (result == output).all()
+    with assert_raises(ValueError):
+        obasis.compute_multipole_moments(-1, np.zeros(3))
+    with assert_raises(TypeError):
+        obasis.compute_multipole_moments(2, np.zeros(3), output)
+    with assert_raises(TypeError):
+        obasis.compute_multipole_moments_centers(1, np.zeros((2, 2)))
+
+
 def check_g09_electron_repulsion(fn_fchk, check_g09_zeros=False):
     fn_log = fn_fchk[:-5] + '.log'
     mol = IOData.from_file(fn_fchk, fn_log)
@@ -161,7 +161,9 @@ class IOData(object):
             The total energy (electronic+nn)
 
        er
-            The electron repulsion four-index operator
+            The electron repulsion four-index operator. This is either a dense
+            array or a one-dimensional array with only the symmetry-unique
+            elements, see ``pack_four_index``.
 
        orb_alpha
             The alpha orbitals (coefficients, occupations and energies).
@@ -333,7 +335,14 @@ class IOData(object):
                     value[:] = value[permutation][:, permutation]
             er = result.get('er')
             if er is not None:
-                er[:] = er[permutation][:, permutation][:, :, permutation][:, :, :, permutation]
+                if er.ndim == 1:
+                    from horton.gbasis.cext import pack_four_index, unpack_four_index
+                    dense = unpack_four_index(er)
+                    dense[:] = dense[permutation][:, permutation]
+                    dense[:] = dense[:, :, permutation][:, :, :, permutation]
+                    pack_four_index(dense, er)
+                else:
+                    er[:] = er[permutation][:, permutation][:, :, permutation][:, :, :, permutation]
             orb_alpha = result.get('orb_alpha')
             if orb_alpha is not None:
                 orb_alpha.permute_basis(permutation)
@@ -352,10 +361,15 @@ class IOData(object):
                     value *= signs.reshape(-1, 1)
             er = result.get('er')
             if er is not None:
-                er *= signs
-                er *= signs.reshape(-1, 1)
-                er *= signs.reshape(-1, 1, 1)
-                er *= signs.reshape(-1, 1, 1, 1)
+                if er.ndim == 1:
+                    from horton.gbasis.cext import pack_four_index
+                    er *= pack_four_index(np.einsum('a,b,c,d->abcd', signs, signs, signs,
+                                                    signs))
+                else:
+                    er *= signs
+                    er *= signs.reshape(-1, 1)
+                    er *= signs.reshape(-1, 1, 1)
+                    er *= signs.reshape(-1, 1, 1, 1)
             orb_alpha = result.get('orb_alpha')
             if orb_alpha is not None:
                 orb_alpha.change_basis_signs(signs)
@@ -21,6 +21,7 @@
 
 
 import h5py as h5
+import numpy as np
 
 from horton import *  # pylint: disable=wildcard-import,unused-wildcard-import
 
@@ -46,3 +47,30 @@ def test_consistency_core():
         mol1.to_file(f)
         mol2 = IOData.from_file(f)
         compare_mols(mol1, mol2)
+
+
+def test_packed_er_file():
+    fn_fchk = context.get_fn('test/water_sto3g_hf_g03.fchk')
+    mol1 = IOData.from_file(fn_fchk)
+    er = mol1.obasis.compute_electron_repulsion()
+    mol1.er = mol1.obasis.compute_electron_repulsion(packed=True)
+    with tmpdir('horton.io.test.test_internal.test_packed_er_file') as dn:
+        fn_h5 = '%s/foo.h5' % dn
+        mol1.to_file(fn_h5)
+        mol2 = IOData.from_file(fn_h5)
+        assert (mol2.er == mol1.er).all()
+        np.testing.assert_equal(unpack_four_index(mol2.er), er)
+
+        # Permutations and sign changes of the basis functions are also applied to the
+        # packed four-index object.
+        nbasis = mol1.obasis.nbasis
+        mol1.permutation = np.arange(nbasis)[::-1].copy()
+        mol1.signs = np.ones(nbasis, int)
+        mol1.signs[::3] = -1
+        mol1.to_file(fn_h5)
+        mol2 = IOData.from_file(fn_h5)
+        mol1.er = er
+        mol1.to_file(fn_h5)
+        mol3 = IOData.from_file(fn_h5)
+        assert not (mol3.er == er).all()
+        np.testing.assert_equal(unpack_four_index(mol2.er), mol3.er)
@@ -41,4 +41,5 @@ from horton.meanfield.scf_oda import *
 from horton.meanfield.scf_cdiis import *
 from horton.meanfield.scf_ediis import *
 from horton.meanfield.scf_ediis2 import *
+from horton.meanfield.scf_newton import *
 from horton.meanfield.utils import *
@@ -36,6 +36,7 @@ class BeckeHartree(GridObservable):
     """Hartree term with numerical Becke-Poisson solver."""
 
     df_level = DF_LEVEL_LDA
+    local = False
 
     def __init__(self, lmax, label='hartree_becke'):
         self.lmax = lmax
@@ -21,6 +21,12 @@
 """Container for observables involving numerical integration"""
 
 
+import copy
+
+import numpy as np
+
+from horton.cache import Cache
+from horton.grid.base import IntGrid
 from horton.meanfield.observable import Observable
 from horton.utils import doc_inherit
 
@@ -44,7 +50,8 @@ DF_LEVEL_MGGA = 2
 class GridGroup(Observable):
     """Group of terms for the effective Hamiltonian that use numerical integration."""
 
-    def __init__(self, obasis, grid, grid_terms, label='grid_group', density_cutoff=1e-9):
+    def __init__(self, obasis, grid, grid_terms, label='grid_group', density_cutoff=1e-9,
+                 block_size=None):
         """Initialize a GridGroup instance.
 
         Parameters
@@ -62,11 +69,26 @@ class GridGroup(Observable):
             Whenever the density on a grid point falls below this threshold, all data for
             that grid point is set to zero. This is mainly relevant for functionals that
             use derivatives of the density or the orbitals, i.e. GGA and MGGA functionals.
+            When all grid terms are local (see ``GridObservable.local``), such grid points
+            are also left out of the evaluation of the grid terms and the Fock build.
+        block_size : int
+            When given, the grid is processed in blocks of this many points and no data on
+            the full grid is kept in the cache. This limits the memory usage for large
+            grids, at the cost of recomputing the grid data in every call to
+            ``add_fock`` and ``add_dot_hessian``. The energy is computed together with
+            the Fock matrices. This only works when all grid terms are local.
         """
+        if block_size is not None:
+            if block_size <= 0:
+                raise ValueError('The block size must be strictly positive.')
+            if not all(grid_term.local for grid_term in grid_terms):
+                raise ValueError('Only local grid terms can be evaluated in blocks of '
+                                 'grid points.')
         self.grid_terms = grid_terms
         self.obasis = obasis
         self.grid = grid
         self.density_cutoff = density_cutoff
+        self.block_size = block_size
         Observable.__init__(self, label)
 
     def _get_df_level(self):
@@ -85,6 +107,89 @@ class GridGroup(Observable):
 
     df_level = property(_get_df_level)
 
+    def _get_compact(self):
+        """Whether insignificant grid points are left out of the grid terms.
+
+        This is only possible when all grid terms are local, i.e. when grid points with
+        zero density do not contribute.
+        """
+        return self.density_cutoff > 0 and all(grid_term.local for grid_term in
+                                               self.grid_terms)
+
+    compact = property(_get_compact)
+
+    def _get_ncol(self):
+        """The number of columns in the grid data of one density matrix."""
+        if self.df_level == DF_LEVEL_LDA:
+            return 1
+        elif self.df_level == DF_LEVEL_GGA:
+            return 4
+        elif self.df_level == DF_LEVEL_MGGA:
+            return 6
+        else:
+            raise ValueError('Internal error: non-existent DF level.')
+
+    def _get_grid(self, cache):
+        """Return the grid passed to the grid terms.
+
+        Parameters
+        ----------
+        cache : Cache
+            Used to store intermediate results.
+
+        Returns
+        -------
+        grid : IntGrid
+            Either the full integration grid or a grid with only the significant points,
+            i.e. where one of the densities is not below ``density_cutoff``. The latter
+            is only used when ``compact`` is True and it is constructed in
+            ``_update_grid_basics_multi``.
+        """
+        if not self.compact:
+            return self.grid
+        indexes = cache.load('grid_indexes', default=None)
+        if indexes is None:
+            return self.grid
+        grid = cache.load('grid_compact', default=None)
+        if grid is None:
+            grid = IntGrid(self.grid.points[indexes], self.grid.weights[indexes])
+            cache.dump('grid_compact', grid)
+        return grid
+
+    def _get_cache(self, cache, delta=False):
+        """Return the cache in which the grid data of this group are stored.
+
+        When ``compact`` is True, the grid data only cover the significant grid points
+        of this group. They are kept in a separate cache, stored in ``cache`` under a
+        key with the label of the group, such that other grid groups sharing ``cache``
+        never pick them up. Otherwise, ``cache`` is returned.
+
+        Parameters
+        ----------
+        cache : Cache
+            The cache passed to the public methods, with the (changes in) density
+            matrices.
+        delta : bool
+            Set to True when the changes in density matrices are used. Grid data of
+            previous changes in density matrices are then discarded.
+        """
+        if not self.compact:
+            return cache
+        group_cache = cache.load('grid_cache_%s' % self.label, default=None)
+        if group_cache is None:
+            group_cache = Cache()
+            cache.dump('grid_cache_%s' % self.label, group_cache)
+        if delta:
+            # This marker is cleared together with the changes in density matrices.
+            if cache.load('grid_cache_delta_%s' % self.label, alloc=1, tags='d')[1]:
+                group_cache.clear(tags='d')
+        for prefix in '', 'delta_':
+            for select in 'alpha', 'beta':
+                key = '%sdm_%s' % (prefix, select)
+                if key in cache:
+                    group_cache[key] = cache[key]
+        return group_cache
+
     def _get_potentials(self, cache, label='pot', tags=None):
         """Get list of output arrays passed to ```GridObservable.add_pot```.
 
@@ -110,6 +215,65 @@ class GridGroup(Observable):
         """
         return self._get_potentials(cache, label='dot', tags='d')
 
+    def _iter_blocks(self, cache):
+        """Iterate over blocks of grid points, in case ``block_size`` is given.
+
+        Parameters
+        ----------
+        cache : Cache
+            Used to store intermediate results. Only the (changes in) density matrices
+            are taken from this cache.
+
+        Yields
+        ------
+        block_group : GridGroup
+            A copy of this grid group, with only the grid points of the current block.
+        block_cache : Cache
+            A new cache with the (changes in) density matrices, for the current block.
+        """
+        for begin in xrange(0, self.grid.size, self.block_size):
+            end = min(begin + self.block_size, self.grid.size)
+            block_group = copy.copy(self)
+            block_group.grid = IntGrid(self.grid.points[begin:end],
+                                       self.grid.weights[begin:end])
+            block_group.block_size = None
+            block_cache = Cache()
+            for prefix in '', 'delta_':
+                for select in 'alpha', 'beta':
+                    key = '%sdm_%s' % (prefix, select)
+                    if key in cache:
+                        block_cache[key] = cache[key]
+            yield block_group, block_cache
+
+    def _compute_blocks(self, cache, *focks):
+        """Compute the energy and optionally Fock matrices, one block of points at a time.
+
+        Parameters
+        ----------
+        cache : Cache
+            Used to store intermediate results. Only the energies are stored.
+        focks : list of np.ndarray, shape=(nbasis, nbasis), dtype=float
+            Fock matrices to which the contributions are added. When not given, only
+            the energy is computed.
+
+        Returns
+        -------
+        energy : float
+            The sum of the energies of the grid terms.
+        """
+        energies = np.zeros(len(self.grid_terms))
+        for block_group, block_cache in self._iter_blocks(cache):
+            block_group.compute_energy(block_cache)
+            for iterm, grid_term in enumerate(self.grid_terms):
+                energies[iterm] += block_cache['energy_%s' % grid_term.label]
+            if len(focks) > 0:
+                block_group.add_fock(block_cache, *focks)
+        for iterm, grid_term in enumerate(self.grid_terms):
+            cache['energy_%s' % grid_term.label] = energies[iterm]
+        result = energies.sum()
+        cache['energy_blocks_%s' % self.label] = result
+        return result
+
     def _update_grid_basics(self, cache, select, prefix='', tags=None):
         """Recompute a density, gradient, ... when not present in the cache.
 
@@ -127,35 +291,85 @@ class GridGroup(Observable):
             The tags to use for the cache when allocating the arrays. In case of changes
             in density matrices, this argument is typically equal to 'd'.
         """
+        ncol = self._get_ncol()
+        key = '%sall_%s' % (prefix, select)
+        if key not in cache and not (self.compact and 'grid_indexes' not in cache):
+            # A single density matrix is evaluated directly into the cache. The grid
+            # points, and therefore the shape of the result, are already known.
+            grid = self._get_grid(cache)
+            all_basics, new = cache.load(key, alloc=(grid.size, ncol), tags=tags)
+            dm = cache['%sdm_%s' % (prefix, select)]
+            if self.df_level == DF_LEVEL_LDA:
+                self.obasis.compute_grid_density_dm(dm, grid.points, all_basics[:, 0])
+            elif self.df_level == DF_LEVEL_GGA:
+                self.obasis.compute_grid_gga_dm(dm, grid.points, all_basics)
+            elif self.df_level == DF_LEVEL_MGGA:
+                self.obasis.compute_grid_mgga_dm(dm, grid.points, all_basics)
+        return self._update_grid_basics_multi(cache, [select], prefix, tags)[0]
+
+    def _update_grid_basics_multi(self, cache, selects, prefix='', tags=None):
+        """Recompute densities, gradients, ... of several density matrices at once.
+
+        The basis functions are evaluated only once on the grid for all density matrices
+        whose results are not present in the cache.
+
+        Parameters
+        ----------
+        cache : Cache
+            Used to store intermediate results.
+        selects : list of str
+            Any of 'alpha' and 'beta'.
+        prefix : str
+            See ``_update_grid_basics``.
+        tags : str
+            See ``_update_grid_basics``.
+
+        Returns
+        -------
+        all_basics : list of np.ndarray, shape=(npoint, ncol), dtype=float
+            The results for each item in ``selects``.
+        """
+        ncol = self._get_ncol()
+
         # Compute the density (and optionally derivatives, etc.) on all the grid
-        # points.
-        if self.df_level == DF_LEVEL_LDA:
-            all_basics, new = cache.load('%sall_%s' % (prefix, select),
-                                         alloc=(self.grid.size, 1), tags=tags)
-            if new:
-                dm = cache['%sdm_%s' % (prefix, select)]
-                self.obasis.compute_grid_density_dm(dm, self.grid.points, all_basics[:, 0])
-        elif self.df_level == DF_LEVEL_GGA:
-            all_basics, new = cache.load('%sall_%s' % (prefix, select),
-                                         alloc=(self.grid.size, 4), tags=tags)
-            if new:
-                dm = cache['%sdm_%s' % (prefix, select)]
-                self.obasis.compute_grid_gga_dm(dm, self.grid.points, all_basics)
-        elif self.df_level == DF_LEVEL_MGGA:
-            all_basics, new = cache.load('%sall_%s' % (prefix, select),
-                                         alloc=(self.grid.size, 6), tags=tags)
-            if new:
-                dm = cache['%sdm_%s' % (prefix, select)]
-                self.obasis.compute_grid_mgga_dm(dm, self.grid.points, all_basics)
-        else:
-            raise ValueError('Internal error: non-existent DF level.')
+        # points, for all density matrices at once.
+        keys = ['%sall_%s' % (prefix, select) for select in selects]
+        inew = [i for i, key in enumerate(keys) if key not in cache]
+        if len(inew) > 0:
+            # When the significant grid points are not known yet, the data are first
+            # computed on the full grid.
+            select_points = self.compact and 'grid_indexes' not in cache
+            grid = self._get_grid(cache)
+            dms = np.array([cache['%sdm_%s' % (prefix, selects[i])] for i in inew])
+            output = np.zeros((grid.size, len(inew), ncol))
+            if self.df_level == DF_LEVEL_LDA:
+                self.obasis.compute_grid_density_dm_multi(dms, grid.points,
+                                                          output[:, :, 0])
+            elif self.df_level == DF_LEVEL_GGA:
+                self.obasis.compute_grid_gga_dm_multi(dms, grid.points, output)
+            elif self.df_level == DF_LEVEL_MGGA:
+                self.obasis.compute_grid_mgga_dm_multi(dms, grid.points, output)
+            if select_points:
+                # Only keep the grid points where one of the densities is significant.
+                # These are determined once for every density update. Changes in
+                # density use the same points.
+                mask = (output[:, :, 0] >= self.density_cutoff).any(axis=1)
+                indexes = mask.nonzero()[0]
+                cache.dump('grid_indexes', indexes)
+                output = output[indexes]
+            for j, i in enumerate(inew):
+                all_basics_select, new = cache.load(keys[i], alloc=(len(output), ncol),
+                                                    tags=tags)
+                all_basics_select[:] = output[:, j]
+        all_basics = [cache[key] for key in keys]
 
         # Prune grid data where the density is lower than the threshold
         if self.density_cutoff > 0:
-            # The prefix is not used here to make sure the second-order
-            # derivatives are strictly consistent.
-            mask = cache['all_%s' % select][:, 0] < self.density_cutoff
-            all_basics[mask, :] = 0.0
+            for select, all_basics_select in zip(selects, all_basics):
+                # The prefix is not used here to make sure the second-order
+                # derivatives are strictly consistent.
+                mask = cache['all_%s' % select][:, 0] < self.density_cutoff
+                all_basics_select[mask, :] = 0.0
         return all_basics
 
     def _update_grid_data(self, cache):
@@ -195,22 +409,33 @@ class GridGroup(Observable):
         cache : Cache
             Used to store intermediate results.
         """
+        if self.block_size is not None:
+            # The energy may already be computed together with the Fock matrices.
+            result = cache.load('energy_blocks_%s' % self.label, default=None)
+            if result is None:
+                result = self._compute_blocks(cache)
+            return result
+
         # compute stuff on the grid that the grid_observables may use
-        self._update_grid_data(cache)
+        group_cache = self._get_cache(cache)
+        self._update_grid_data(group_cache)
+        grid = self._get_grid(group_cache)
 
         # compute energy terms and sum up
         result = 0.0
         for grid_term in self.grid_terms:
-            energy = grid_term.compute_energy(cache, self.grid)
+            energy = grid_term.compute_energy(group_cache, grid)
             cache['energy_%s' % grid_term.label] = energy
             result += energy
         return result
 
-    def _grid_fock_build(self, pots, *focks):
+    def _grid_fock_build(self, grid, pots, *focks):
         """Convert potential data into contributions to the Fock matrices.
 
         Parameters
         ----------
+        grid : IntGrid
+            The grid on which the potentials are given, see ``_get_grid``.
         pots : np.ndarray, dtype=float, shape(npoint, npot)
             Derivatives of the energy toward density, gradient, ... the number of columns
             depends on the DF level.
@@ -218,19 +443,36 @@ class GridGroup(Observable):
         focks : list of TwoIndex
             A list of Fock matrices.
         """
-        for ichannel in xrange(len(focks)):
+        if grid.size == 0:
+            return
+        if len(focks) == 1:
             if self.df_level == DF_LEVEL_LDA:
                 self.obasis.compute_grid_density_fock(
-                    self.grid.points, self.grid.weights,
-                    pots[ichannel][:, 0], focks[ichannel])
+                    grid.points, grid.weights, pots[0][:, 0], focks[0])
             elif self.df_level == DF_LEVEL_GGA:
                 self.obasis.compute_grid_gga_fock(
-                    self.grid.points, self.grid.weights,
-                    pots[ichannel], focks[ichannel])
+                    grid.points, grid.weights, pots[0], focks[0])
             elif self.df_level == DF_LEVEL_MGGA:
                 self.obasis.compute_grid_mgga_fock(
-                    self.grid.points, self.grid.weights,
-                    pots[ichannel], focks[ichannel])
+                    grid.points, grid.weights, pots[0], focks[0])
+            return
+
+        # With several Fock matrices, the basis functions are evaluated only once on
+        # the grid for all of them.
+        pots_all = np.zeros((grid.size, len(focks), pots[0].shape[1]))
+        for ichannel in xrange(len(focks)):
+            pots_all[:, ichannel] = pots[ichannel]
+        if self.df_level == DF_LEVEL_LDA:
+            focks_all = self.obasis.compute_grid_density_fock_multi(
+                grid.points, grid.weights, pots_all[:, :, 0])
+        elif self.df_level == DF_LEVEL_GGA:
+            focks_all = self.obasis.compute_grid_gga_fock_multi(
+                grid.points, grid.weights, pots_all)
+        elif self.df_level == DF_LEVEL_MGGA:
+            focks_all = self.obasis.compute_grid_mgga_fock_multi(
+                grid.points, grid.weights, pots_all)
+        for fock, fock_all in zip(focks, focks_all):
+            fock += fock_all
 
     def add_fock(self, cache, *focks):
         """Add contributions to the Fock matrix.
@@ -245,45 +487,59 @@ class GridGroup(Observable):
         focks : list of TwoIndex
             A list of Fock matrices.
         """
-        # A) Allocate arrays for the sum of the potentials that will be
+        if self.block_size is not None:
+            self._compute_blocks(cache, *focks)
+            return
+
+        # A) compute stuff on the grid that the grid_observables may use. This also
+        #    determines the grid points that are used in the following steps.
+        group_cache = self._get_cache(cache)
+        self._update_grid_data(group_cache)
+        grid = self._get_grid(group_cache)
+
+        # B) Allocate arrays for the sum of the potentials that will be
         #    computed in step C. If these were already computed, new will equal
         #    False
-        pots, new = self._get_potentials(cache)
+        pots, new = self._get_potentials(group_cache)
 
         if new:
-            # B) compute stuff on the grid that the grid_observables may use
-            self._update_grid_data(cache)
-
             # C) For every term: compute the derivative of the energy toward
             #    whatever is used as input (density, gradient, ...)
             for grid_term in self.grid_terms:
-                grid_term.add_pot(cache, self.grid, *pots)
+                grid_term.add_pot(group_cache, grid, *pots)
 
         # D) Pull the sum of all these dot products through the grid-Fock-build
         #    code.
-        self._grid_fock_build(pots, *focks)
+        self._grid_fock_build(grid, pots, *focks)
 
     @doc_inherit(Observable)
     def add_dot_hessian(self, cache, *outputs):
-        # A) Allocate arrays for the sum of the dot products that will be
+        if self.block_size is not None:
+            for block_group, block_cache in self._iter_blocks(cache):
+                block_group.add_dot_hessian(block_cache, *outputs)
+            return
+
+        # A) Compute the (changes in) density, gradient, ... based on what
+        #    is needed by the grid terms.
+        group_cache = self._get_cache(cache, delta=True)
+        self._update_grid_data(group_cache)
+        self._update_delta_grid_data(group_cache)
+        grid = self._get_grid(group_cache)
+
+        # B) Allocate arrays for the sum of the dot products that will be
         #    computed in step C. If these were already computed, new will equal
         #    False.
-        dots, new = self._get_dots(cache)
+        dots, new = self._get_dots(group_cache)
 
         if new:
-            # B) Compute the (changes in) density, gradient, ... based on what
-            #    is needed by the grid terms.
-            self._update_grid_data(cache)
-            self._update_delta_grid_data(cache)
-
             # C) For every term: compute the dot product of the kernel with the
             #    change in density, gradient, ...
             for grid_term in self.grid_terms:
-                grid_term.add_dot(cache, self.grid, *dots)
+                grid_term.add_dot(group_cache, grid, *dots)
 
         # D) Pull the sum of all these dot products through the grid-Fock-build
         #    code.
-        self._grid_fock_build(dots, *outputs)
+        self._grid_fock_build(grid, dots, *outputs)
 
 
 class RGridGroup(GridGroup):
@@ -292,7 +548,10 @@ class RGridGroup(GridGroup):
     When the ``compute`` and ``add_pot`` methods of
     :py:class:`GridObservable` instances are called, the following functions
     are pre-computed on the integration grid and stored in the cache in
-    contiguous arrays (as required by LibXC):
+    contiguous arrays (as required by LibXC). When ``compact`` is True, these
+    arrays only contain the significant grid points, whose indexes are stored
+    as ``grid_indexes`` in a separate cache of the grid group (see
+    ``_get_cache``):
 
     **When LDA, GGA or MGGA functionals are used:**
 
@@ -329,21 +588,22 @@ class RGridGroup(GridGroup):
 
     @doc_inherit(GridGroup)
     def _get_potentials(self, cache, label='pot', tags=None):
+        npoint = self._get_grid(cache).size
         if self.df_level == DF_LEVEL_LDA:
             lda_xxx_alpha, new = cache.load('lda_%s_total_alpha' % label,
-                                            alloc=self.grid.size, tags=tags)
+                                            alloc=npoint, tags=tags)
             if new:
                 lda_xxx_alpha[:] = 0.0
             return (lda_xxx_alpha.reshape(-1, 1),), new
         elif self.df_level == DF_LEVEL_GGA:
             gga_xxx_alpha, new = cache.load('gga_%s_total_alpha' % label,
-                                            alloc=(self.grid.size, 4), tags=tags)
+                                            alloc=(npoint, 4), tags=tags)
             if new:
                 gga_xxx_alpha[:] = 0.0
             return (gga_xxx_alpha,), new
         elif self.df_level == DF_LEVEL_MGGA:
             mgga_xxx_alpha, new = cache.load('mgga_%s_total_alpha' % label,
-                                             alloc=(self.grid.size, 6), tags=tags)
+                                             alloc=(npoint, 6), tags=tags)
             if new:
                 mgga_xxx_alpha[:] = 0.0
             return (mgga_xxx_alpha,), new
@@ -353,51 +613,59 @@ class RGridGroup(GridGroup):
     @doc_inherit(GridGroup)
     def _update_grid_data(self, cache):
         all_alpha = self._update_grid_basics(cache, 'alpha')
+        npoint = len(all_alpha)
         # Compute some derived quantities
         if self.df_level >= DF_LEVEL_LDA:
-            rho_full, new = cache.load('rho_full', alloc=self.grid.size)
+            rho_full, new = cache.load('rho_full', alloc=npoint)
             if new:
                 rho_full[:] = 2*all_alpha[:, 0]
         if self.df_level >= DF_LEVEL_GGA:
-            grad_rho_full, new = cache.load('grad_rho_full', alloc=(self.grid.size, 3))
+            grad_rho_full, new = cache.load('grad_rho_full', alloc=(npoint, 3))
             if new:
                 grad_rho_full[:] = all_alpha[:, 1:4]
                 grad_rho_full *= 2
-            sigma_full, new = cache.load('sigma_full', alloc=self.grid.size)
+            sigma_full, new = cache.load('sigma_full', alloc=npoint)
             if new:
                 sigma_full[:] = 4*(all_alpha[:, 1:4]**2).sum(axis=1)
         if self.df_level >= DF_LEVEL_MGGA:
-            lapl_full, new = cache.load('lapl_full', alloc=self.grid.size)
+            lapl_full, new = cache.load('lapl_full', alloc=npoint)
             if new:
                 lapl_full[:] = 2*all_alpha[:, 4]
-            tau_full, new = cache.load('tau_full', alloc=self.grid.size)
+            tau_full, new = cache.load('tau_full', alloc=npoint)
             if new:
                 tau_full[:] = 2*all_alpha[:, 5]
 
     @doc_inherit(GridGroup)
     def _update_delta_grid_data(self, cache):
         delta_all_alpha = self._update_grid_basics(cache, 'alpha', 'delta_', 'd')
+        npoint = len(delta_all_alpha)
         # Compute some derived quantities
         if self.df_level >= DF_LEVEL_LDA:
             delta_rho_full, new = cache.load('delta_rho_full',
-                                             alloc=self.grid.size, tags='d')
+                                             alloc=npoint, tags='d')
             if new:
                 delta_rho_full[:] = 2*delta_all_alpha[:, 0]
         if self.df_level >= DF_LEVEL_GGA:
             delta_grad_rho_full, new = cache.load('delta_grad_rho_full',
-                                                  alloc=(self.grid.size, 3), tags='d')
+                                                  alloc=(npoint, 3), tags='d')
             if new:
                 delta_grad_rho_full[:] = 2*delta_all_alpha[:, 1:4]
             delta_sigma_full, new = cache.load('delta_sigma_full',
-                                               alloc=self.grid.size, tags='d')
+                                               alloc=npoint, tags='d')
             if new:
                 grad_rho_full = cache['grad_rho_full']
                 delta_sigma_full[:] = 2*(delta_grad_rho_full*grad_rho_full).sum(axis=1)
 
     @doc_inherit(Observable)
     def add_dot_hessian(self, cache, output_alpha):
-        GridGroup.add_dot_hessian(self, cache, output_alpha)
-        output_alpha *= 0.5
+        if self.block_size is not None:
+            # Every block scales its own contribution.
+            GridGroup.add_dot_hessian(self, cache, output_alpha)
+            return
+        # Only the contribution of this group is scaled, not the other terms in output.
+        output = np.zeros(output_alpha.shape)
+        GridGroup.add_dot_hessian(self, cache, output)
+        output_alpha += 0.5*output
 
 
 class UGridGroup(GridGroup):
@@ -406,7 +674,10 @@ class UGridGroup(GridGroup):
     When the ``compute`` and ``add_pot`` methods of
     :py:class:`GridObservable` instances is called, the following functions
     are pre-computed on the integration grid and stored in the cache in
-    contiguous arrays (as required by LibXC):
+    contiguous arrays (as required by LibXC). When ``compact`` is True, these
+    arrays only contain the grid points where the alpha or the beta density is
+    significant, whose indexes are stored as ``grid_indexes`` in a separate
+    cache of the grid group (see ``_get_cache``):
 
     **When LDA, GGA or MGGA functionals are used:**
 
@@ -450,68 +721,77 @@ class UGridGroup(GridGroup):
 
     @doc_inherit(GridGroup)
     def _get_potentials(self, cache, label='pot', tags=None):
+        npoint = self._get_grid(cache).size
         if self.df_level == DF_LEVEL_LDA:
             lda_xxx_alpha, newa = cache.load('lda_%s_total_alpha' % label,
-                                             alloc=self.grid.size, tags=tags)
+                                             alloc=npoint, tags=tags)
             if newa:
                 lda_xxx_alpha[:] = 0.0
             lda_xxx_beta, newb = cache.load('lda_%s_total_beta' % label,
-                                            alloc=self.grid.size, tags=tags)
+                                            alloc=npoint, tags=tags)
             if newb:
                 lda_xxx_beta[:] = 0.0
             return (lda_xxx_alpha.reshape(-1, 1), lda_xxx_beta.reshape(-1, 1)), (newa or newb)
         elif self.df_level == DF_LEVEL_GGA:
             gga_xxx_alpha, newa = cache.load('gga_%s_total_alpha' % label,
-                                             alloc=(self.grid.size, 4), tags=tags)
+                                             alloc=(npoint, 4), tags=tags)
             if newa:
                 gga_xxx_alpha[:] = 0.0
             gga_xxx_beta, newb = cache.load('gga_%s_total_beta' % label,
-                                            alloc=(self.grid.size, 4), tags=tags)
+                                            alloc=(npoint, 4), tags=tags)
             if newb:
                 gga_xxx_beta[:] = 0.0
             return (gga_xxx_alpha, gga_xxx_beta), (newa or newb)
         elif self.df_level == DF_LEVEL_MGGA:
             mgga_xxx_alpha, newa = cache.load('mgga_%s_total_alpha' % label,
-                                              alloc=(self.grid.size, 6), tags=tags)
+                                              alloc=(npoint, 6), tags=tags)
             if newa:
                 mgga_xxx_alpha[:] = 0.0
             mgga_xxx_beta, newb = cache.load('mgga_%s_total_beta' % label,
-                                             alloc=(self.grid.size, 6), tags=tags)
+                                             alloc=(npoint, 6), tags=tags)
             if newb:
                 mgga_xxx_beta[:] = 0.0
             return (mgga_xxx_alpha, mgga_xxx_beta), (newa or newb)
         else:
             raise ValueError('Internal error: non-existent DF level.')
 
+    @doc_inherit(GridGroup)
+    def _update_grid_basics(self, cache, select, prefix='', tags=None):
+        # Both spin channels are always computed together, such that the significant
+        # grid points depend on both densities.
+        all_alpha, all_beta = self._update_grid_basics_multi(cache, ['alpha', 'beta'],
+                                                             prefix, tags)
+        return all_alpha if select == 'alpha' else all_beta
+
     @doc_inherit(GridGroup)
     def _update_grid_data(self, cache):
-        all_alpha = self._update_grid_basics(cache, 'alpha')
-        all_beta = self._update_grid_basics(cache, 'beta')
+        all_alpha, all_beta = self._update_grid_basics_multi(cache, ['alpha', 'beta'])
+        npoint = len(all_alpha)
         # Compute some derived quantities
         if self.df_level >= DF_LEVEL_LDA:
-            rho_full, new = cache.load('rho_full', alloc=self.grid.size)
+            rho_full, new = cache.load('rho_full', alloc=npoint)
             if new:
                 rho_full[:] = all_alpha[:, 0] + all_beta[:, 0]
-            rho_both, new = cache.load('rho_both', alloc=(self.grid.size, 2))
+            rho_both, new = cache.load('rho_both', alloc=(npoint, 2))
             if new:
                 rho_both[:, 0] = all_alpha[:, 0]
                 rho_both[:, 1] = all_beta[:, 0]
         if self.df_level >= DF_LEVEL_GGA:
-            grad_rho_full, new = cache.load('grad_rho_full', alloc=(self.grid.size, 3))
+            grad_rho_full, new = cache.load('grad_rho_full', alloc=(npoint, 3))
             if new:
                 grad_rho_full[:] = all_alpha[:, 1:4]
                 grad_rho_full += all_beta[:, 1:4]
-            sigma_all, new = cache.load('sigma_all', alloc=(self.grid.size, 3))
+            sigma_all, new = cache.load('sigma_all', alloc=(npoint, 3))
             if new:
                 sigma_all[:, 0] = (all_alpha[:, 1:4]**2).sum(axis=1)
                 sigma_all[:, 1] = (all_alpha[:, 1:4]*all_beta[:, 1:4]).sum(axis=1)
                 sigma_all[:, 2] = (all_beta[:, 1:4]**2).sum(axis=1)
         if self.df_level >= DF_LEVEL_MGGA:
-            lapl_both, new = cache.load('lapl_both', alloc=(self.grid.size, 2))
+            lapl_both, new = cache.load('lapl_both', alloc=(npoint, 2))
             if new:
                 lapl_both[:, 0] = all_alpha[:, 4]
                 lapl_both[:, 1] = all_beta[:, 4]
-            tau_both, new = cache.load('tau_both', alloc=(self.grid.size, 2))
+            tau_both, new = cache.load('tau_both', alloc=(npoint, 2))
             if new:
                 tau_both[:, 0] = all_alpha[:, 5]
                 tau_both[:, 1] = all_beta[:, 5]
@@ -521,6 +801,9 @@ class GridObservable(object):
     """Base class for contributions to the GridGroup object."""
 
     df_level = None
+    # Set to False when the contribution of a grid point also depends on the density in
+    # other points, or when points with zero density contribute.
+    local = True
 
     def __init__(self, label):
         """Initialize a GridObservable.
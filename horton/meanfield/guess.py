@@ -33,8 +33,9 @@ def guess_core_hamiltonian(overlap, core, *orbs):
 
     Parameters
     ----------
-    overlap : np.ndarray, shape=(nbasis, nbasis), dtype=float
-        The overlap operator.
+    overlap : np.ndarray, shape=(nbasis, nbasis), dtype=float or Orthogonalizer
+        The overlap operator. An Orthogonalizer can be given instead, see
+        ``Orbitals.from_fock``.
     core : np.ndarray, shape=(nbasis, nbasis), dtype=float
         The core Hamiltonian. operator that resembles a Fock operator is fine. Usually,
         one adds the kinetic energy and nuclear attraction integrals.
@@ -21,9 +21,13 @@
 """Utility functions for orbital modifications."""
 
 
+import os
+
+import h5py as h5
 import numpy as np
 
-from horton.log import timer
+from horton.log import log, timer
+from horton.meanfield.observable import iter_cholesky_blocks
 
 
 __all__ = ['four_index_transform', 'transform_integrals', 'split_core_active',
@@ -68,7 +72,13 @@ def _parse_four_index_transform_orbs(orb0, orb1, orb2, orb3):
     return orb0, orb1, orb2, orb3
 
 
-def four_index_transform(ao_integrals, orb0, orb1=None, orb2=None, orb3=None, method='tensordot'):
+# The default memory budget in bytes for the intermediate results of the blocked
+# four-index transformation.
+FOUR_INDEX_TRANSFORM_MEMORY = 2**30
+
+
+def four_index_transform(ao_integrals, orb0, orb1=None, orb2=None, orb3=None, method='tensordot',
+                         orb_slice=None, memory=None, scratch=None):
     """Perform four index transformation.
 
     Parameters
@@ -80,7 +90,24 @@ def four_index_transform(ao_integrals, orb0, orb1=None, orb2=None, orb3=None, me
     orb1, orb2, orb3
         Can be provided to transform each index differently.
     method
-        Either ``einsum`` or ``tensordot`` (default).
+        Either ``einsum``, ``tensordot`` (default) or ``blocked``. The latter is
+        explained in ``_four_index_transform_blocked``.
+    orb_slice
+        A slice object that selects the orbitals to be transformed in all four
+        sets, e.g. ``slice(0, ncore + nactive)``. When not given, all orbitals are
+        transformed.
+    memory
+        The maximum amount of memory in bytes for one block of intermediate results of
+        the ``blocked`` method, not counting the input, the output and the
+        half-transformed integrals. The default is ``FOUR_INDEX_TRANSFORM_MEMORY``.
+        A warning is printed when even the smallest block does not fit.
+    scratch
+        Only used by the ``blocked`` method: a string with the filename of a new hdf5
+        file, or a h5.File or h5.Group in which the half-transformed integrals are
+        stored temporarily. A file is removed afterwards, so existing files are
+        refused. When not given, they are kept in memory, which takes
+        about ``nbasis**4/2`` floats. The total memory usage of the intermediate
+        results is therefore only bounded by ``memory`` when ``scratch`` is given.
 
     Returns
     -------
@@ -88,25 +115,37 @@ def four_index_transform(ao_integrals, orb0, orb1=None, orb2=None, orb3=None, me
         A four-index array with the integrals in the MO basis.
     """
     # parse arguments
+    if method not in ('einsum', 'tensordot', 'blocked'):
+        raise ValueError('The method must either be \'einsum\', \'tensordot\' or \'blocked\'.')
     orb0, orb1, orb2, orb3 = _parse_four_index_transform_orbs(orb0, orb1, orb2, orb3)
+    if orb_slice is None:
+        orb_slice = slice(None)
+    coeffs0 = orb0.coeffs[:, orb_slice]
+    coeffs1 = orb1.coeffs[:, orb_slice]
+    coeffs2 = orb2.coeffs[:, orb_slice]
+    coeffs3 = orb3.coeffs[:, orb_slice]
     # actual transform
-    result = np.zeros(ao_integrals.shape)
     if method == 'einsum':
         # The order of the dot products is according to literature
         # conventions.
-        result[:] = np.einsum('sd,pqrs->pqrd', orb3.coeffs, ao_integrals, casting='no', order='C')
-        result[:] = np.einsum('rc,pqrd->pqcd', orb2.coeffs, result, casting='no', order='C')
-        result[:] = np.einsum('qb,pqcd->pbcd', orb1.coeffs, result, casting='no', order='C')
-        result[:] = np.einsum('pa,pbcd->abcd', orb0.coeffs, result, casting='no', order='C')
+        result = np.einsum('sd,pqrs->pqrd', coeffs3, ao_integrals, casting='no', order='C')
+        result = np.einsum('rc,pqrd->pqcd', coeffs2, result, casting='no', order='C')
+        result = np.einsum('qb,pqcd->pbcd', coeffs1, result, casting='no', order='C')
+        result = np.einsum('pa,pbcd->abcd', coeffs0, result, casting='no', order='C')
     elif method == 'tensordot':
         # because the way tensordot works, the order of the dot products is
         # not according to literature conventions.
-        result[:] = np.tensordot(ao_integrals, orb0.coeffs, axes=([0],[0]))
-        result[:] = np.tensordot(result, orb1.coeffs, axes=([0],[0]))
-        result[:] = np.tensordot(result, orb2.coeffs, axes=([0],[0]))
-        result[:] = np.tensordot(result, orb3.coeffs, axes=([0],[0]))
+        result = np.tensordot(ao_integrals, coeffs0, axes=([0],[0]))
+        result = np.tensordot(result, coeffs1, axes=([0],[0]))
+        result = np.tensordot(result, coeffs2, axes=([0],[0]))
+        result = np.tensordot(result, coeffs3, axes=([0],[0]))
     else:
-        raise ValueError('The method must either be \'einsum\' or \'tensordot\'.')
+        # The result is symmetrized without full-size temporaries. When all orbitals
+        # are the same, it is constructed symmetric.
+        symmetric = orb1 is orb0 and orb2 is orb0 and orb3 is orb0
+        return _four_index_transform_blocked(
+            ao_integrals, coeffs0, coeffs1, coeffs2, coeffs3, symmetric,
+            FOUR_INDEX_TRANSFORM_MEMORY if memory is None else memory, scratch)
     # Symmetrize the result
     result[:] = result + result.transpose(1,0,3,2)
     result[:] = result + result.transpose(2,3,0,1)
@@ -115,6 +154,154 @@ def four_index_transform(ao_integrals, orb0, orb1=None, orb2=None, orb3=None, me
     return result
 
 
+def _four_index_transform_blocked(ao_integrals, coeffs0, coeffs1, coeffs2, coeffs3,
+                                  symmetric, memory, scratch):
+    """Perform a four-index transformation in blocks with a bounded memory usage.
+
+    The transformation consists of two steps. First, the indexes p and r of the
+    integrals <pq|rs> are transformed for blocks of AO indexes q, giving the
+    half-transformed integrals H[ac, q, s]. Then the indexes q and s are transformed
+    for blocks of pairs ac. Only the half-transformed integrals are stored as a whole,
+    optionally in an hdf5 file.
+
+    When all orbitals are the same, only the pairs with a >= c and the AO indexes with
+    s <= q (within blocks) are computed, using the eight-fold symmetry of the
+    integrals. Otherwise, the result is symmetrized in the same way as in
+    ``four_index_transform``, with ``_symmetrize_four_index``.
+
+    Parameters
+    ----------
+    ao_integrals : np.ndarray, shape=(nbasis, nbasis, nbasis, nbasis)
+        The integrals in the AO basis, in physicists' notation. Only slices of this
+        array are accessed, such that it may also be an ``np.memmap`` or an
+        ``h5.Dataset``.
+    coeffs0, coeffs1, coeffs2, coeffs3 : np.ndarray, shape=(nbasis, norb)
+        The orbital coefficients for each index.
+    symmetric : bool
+        When True, all orbital coefficients are the same.
+    memory : int
+        The memory budget in bytes for one block of intermediate results. The
+        half-transformed integrals are not included.
+    scratch
+        A string with the filename of a new hdf5 file, or a h5.File or h5.Group, or
+        None.
+
+    Returns
+    -------
+    mo_integrals : np.ndarray, shape=(norb0, norb1, norb2, norb3)
+        The integrals in the MO basis.
+    """
+    nbasis = ao_integrals.shape[0]
+    norb0, norb1, norb2, norb3 = [c.shape[1] for c in (coeffs0, coeffs1, coeffs2, coeffs3)]
+    if memory <= 0:
+        raise ValueError('The memory budget must be strictly positive.')
+    # Indexes (a, c) of the pairs of orbitals for the first and the third index.
+    if symmetric:
+        pairs_a, pairs_c = np.tril_indices(norb0)
+    else:
+        pairs_a, pairs_c = np.indices((norb0, norb2)).reshape(2, -1)
+    npair = len(pairs_a)
+
+    # The number of AO indexes q and of pairs in one block of the two steps below.
+    nq = memory//(8*(nbasis**3 + norb0*nbasis**2 + 2*norb0*norb2*nbasis + npair*nbasis))
+    npair_block = memory//(8*(2*nbasis**2 + nbasis*norb1 + 2*norb1*norb3))
+    if (nq == 0 or npair_block == 0) and log.do_warning:
+        log.warn('The memory budget of %i bytes for the blocked four-index '
+                 'transformation is too small. It is exceeded by using the smallest '
+                 'possible blocks.' % memory)
+    nq = max(1, nq)
+    npair_block = max(1, npair_block)
+
+    # Storage for the half-transformed integrals.
+    f = None
+    if scratch is None:
+        half = np.zeros((npair, nbasis, nbasis))
+    else:
+        if isinstance(scratch, basestring):
+            # The file is removed afterwards, so it may not contain anything else.
+            if os.path.exists(scratch):
+                raise ValueError('The scratch file %s already exists.' % scratch)
+            f = h5.File(scratch, 'w')
+            grp = f
+        else:
+            grp = scratch
+        if 'four_index_half' in grp:
+            del grp['four_index_half']
+        half = grp.create_dataset('four_index_half', (npair, nbasis, nbasis), float,
+                                  chunks=(1, nbasis, nbasis))
+
+    try:
+        # A) Transform the first and the third index, for blocks of AO indexes q.
+        for q0 in xrange(0, nbasis, nq):
+            q1 = min(q0 + nq, nbasis)
+            # With the same orbitals, <pq|rs> = <ps|rq>, such that only s < q1 is
+            # needed.
+            ns = q1 if symmetric else nbasis
+            block = np.asarray(ao_integrals[:, q0:q1, :, :ns])
+            tmp = np.tensordot(coeffs0, block, axes=([0], [0]))
+            del block
+            tmp = np.tensordot(tmp, coeffs2, axes=([2], [0]))
+            # tmp has shape (norb0, q1 - q0, ns, norb2)
+            tmp = tmp[pairs_a, :, :, pairs_c]
+            half[:, q0:q1, :ns] = tmp
+            if symmetric:
+                half[:, :ns, q0:q1] = tmp.transpose(0, 2, 1)
+            del tmp
+
+        # B) Transform the second and the fourth index, for blocks of pairs.
+        result = np.zeros((norb0, norb1, norb2, norb3))
+        for k0 in xrange(0, npair, npair_block):
+            k1 = min(k0 + npair_block, npair)
+            tmp = np.tensordot(np.asarray(half[k0:k1]), coeffs1, axes=([1], [0]))
+            tmp = np.tensordot(tmp, coeffs3, axes=([1], [0]))
+            # tmp has shape (k1 - k0, norb1, norb3)
+            result[pairs_a[k0:k1], :, pairs_c[k0:k1], :] = tmp
+            if symmetric:
+                result[pairs_c[k0:k1], :, pairs_a[k0:k1], :] = tmp.transpose(0, 2, 1)
+            del tmp
+    finally:
+        if f is not None:
+            f.close()
+            os.remove(scratch)
+        elif scratch is not None:
+            del grp['four_index_half']
+    if not symmetric:
+        _symmetrize_four_index(result)
+    return result
+
+
+def _symmetrize_four_index(result):
+    """Average a four-index array over its eight-fold symmetry, in place.
+
+    This gives the same result as the symmetrization in ``four_index_transform``, but
+    each of the three steps averages pairs of slices, such that the temporary arrays
+    only have three indexes.
+
+    Parameters
+    ----------
+    result : np.ndarray, shape=(norb, norb, norb, norb)
+        The array to be symmetrized.
+    """
+    norb = result.shape[0]
+    for a in xrange(norb):
+        # <ab|cd> and <ba|dc>
+        tmp = result[a, a:] + result[a:, a].transpose(0, 2, 1)
+        tmp /= 2
+        result[a, a:] = tmp
+        result[a:, a] = tmp.transpose(0, 2, 1)
+    for a in xrange(norb):
+        # <ab|cd> and <cd|ab>
+        tmp = result[a, :, a:] + result[a:, :, a].transpose(2, 0, 1)
+        tmp /= 2
+        result[a, :, a:] = tmp
+        result[a:, :, a] = tmp.transpose(1, 2, 0)
+    for a in xrange(norb):
+        # <ab|cd> and <ad|cb>
+        tmp = result[a] + result[a].transpose(2, 1, 0)
+        tmp /= 2
+        result[a] = tmp
+
+
 @timer.with_section('Index Trans')
 def transform_integrals(one, two, method='tensordot', *orbs):
     """Transform integrals to MO basis.
@@ -160,7 +347,8 @@ def transform_integrals(one, two, method='tensordot', *orbs):
     return one_mo, two_mo
 
 
-def split_core_active(one, two, ecore, orb, ncore, nactive, indextrans='tensordot'):
+def split_core_active(one, two, ecore, orb, ncore, nactive, indextrans='tensordot',
+                      memory=None, scratch=None):
     """Reduce a Hamiltonian to an active space.
 
     Works only for restricted wavefunctions.
@@ -181,7 +369,9 @@ def split_core_active(one, two, ecore, orb, ncore, nactive, indextrans='tensordo
     nactive
         The number of active orbitals (int)
     indextrans
-        4-index transformation (str). One of ``tensordot``, ``einsum``
+        4-index transformation (str). One of ``tensordot``, ``einsum``, ``blocked``
+    memory, scratch
+        Only used by the ``blocked`` transformation, see ``four_index_transform``.
 
     Returns
     -------
@@ -201,12 +391,19 @@ def split_core_active(one, two, ecore, orb, ncore, nactive, indextrans='tensordo
     if nactive + ncore > one.shape[0]:
         raise ValueError('More active orbitals than basis functions.')
 
-    # Optional transformation to mo basis
+    # Optional transformation to mo basis. Only the core and active orbitals are
+    # needed.
+    norb = ncore + nactive
     if orb is None:
         one_mo = one
         two_mo = two
     else:
-        (one_mo,), (two_mo,) = transform_integrals(one, two, indextrans, orb)
+        with timer.section('Index Trans'):
+            coeffs = orb.coeffs[:, :norb]
+            one_mo = reduce(np.dot, [coeffs.T, one, coeffs])
+            two_mo = four_index_transform(two, orb, method=indextrans,
+                                          orb_slice=slice(0, norb), memory=memory,
+                                          scratch=scratch)
 
     # Core energy
     #   One body term
@@ -217,7 +414,6 @@ def split_core_active(one, two, ecore, orb, ncore, nactive, indextrans='tensordo
     ecore -= np.einsum('abba', two_mo[:ncore, :ncore, :ncore, :ncore])
 
     # Active space one-body integrals
-    norb = ncore + nactive
     one_mo_small = one_mo[ncore:norb, ncore:norb].copy()
     #   Direct part
     one_mo_small += 2*np.einsum('abcb->ac', two_mo[ncore:norb, :ncore, ncore:norb, :ncore])
@@ -230,7 +426,8 @@ def split_core_active(one, two, ecore, orb, ncore, nactive, indextrans='tensordo
     return one_mo_small, two_mo_small, ecore
 
 
-def four_index_transform_cholesky(ao_integrals, orb0, orb1=None, method='tensordot'):
+def four_index_transform_cholesky(ao_integrals, orb0, orb1=None, method='tensordot',
+                                  orb_slice=None):
     """Perform four index transformation on a Cholesky-decomposed four-index object.
 
     Parameters
@@ -243,16 +440,22 @@ def four_index_transform_cholesky(ao_integrals, orb0, orb1=None, method='tensord
         Can be provided to transform the second index differently.
     method
         Either ``einsum`` or ``tensordot`` (default).
+    orb_slice
+        A slice object that selects the orbitals to be transformed in both sets.
+        When not given, all orbitals are transformed.
     """
     if orb1 is None:
         orb1 = orb0
-    result = np.zeros(ao_integrals.shape)
+    if orb_slice is None:
+        orb_slice = slice(None)
+    coeffs0 = orb0.coeffs[:, orb_slice]
+    coeffs1 = orb1.coeffs[:, orb_slice]
     if method == 'einsum':
-        result = np.einsum('ai,kac->kic', orb0.coeffs, ao_integrals)
-        result = np.einsum('cj,kic->kij', orb1.coeffs, result)
+        result = np.einsum('ai,kac->kic', coeffs0, ao_integrals)
+        result = np.einsum('cj,kic->kij', coeffs1, result)
     elif method == 'tensordot':
-        result = np.tensordot(ao_integrals, orb0.coeffs, axes=([1],[0]))
-        result = np.tensordot(result, orb1.coeffs, axes=([1],[0]))
+        result = np.tensordot(ao_integrals, coeffs0, axes=([1],[0]))
+        result = np.tensordot(result, coeffs1, axes=([1],[0]))
     else:
         raise ValueError('The method must either be \'einsum\' or \'tensordot\'.')
     return result
@@ -333,30 +536,44 @@ def split_core_active_cholesky(one, two, ecore, orb, ncore, nactive, indextrans=
     if nactive + ncore > one.shape[0]:
         raise ValueError('More active orbitals than basis functions.')
 
-    # Optional transformation to mo basis
+    # Optional transformation to mo basis. Only the core and active orbitals are
+    # needed.
+    norb = ncore + nactive
     if orb is None:
         one_mo = one
-        two_mo = two
     else:
-        (one_mo,), (two_mo,) = transform_integrals_cholesky(one, two, indextrans, orb)
+        coeffs = orb.coeffs[:, :norb]
+        one_mo = reduce(np.dot, [coeffs.T, one, coeffs])
 
-    # Core energy
-    #   One body term
+    # The Cholesky vectors are processed in blocks. Each block is transformed to the
+    # core and active orbitals, after which its contributions to the core energy and
+    # the active space one-body integrals are added. The full transformed vectors
+    # are never stored, only their active block.
     ecore += 2*np.trace(one_mo[:ncore, :ncore])
-    #   Direct part
-    ecore += 2*np.einsum('xaa,xbb', two_mo[:, :ncore, :ncore], two_mo[:, :ncore, :ncore])
-    #   Exchange part
-    ecore -= np.einsum('xab,xba', two_mo[:, :ncore, :ncore], two_mo[:, :ncore, :ncore])
-
-    # Active space one-body integrals
-    norb = ncore + nactive
     one_mo_small = one_mo[ncore:norb, ncore:norb].copy()
-    #   Direct part
-    one_mo_small += 2*np.einsum('xac,xbb->ac', two_mo[:, ncore:norb, ncore:norb], two_mo[:, :ncore, :ncore])
-    #   Exchange part
-    one_mo_small -= np.einsum('xab,xbc->ac', two_mo[:, ncore:norb, :ncore], two_mo[:, :ncore, ncore:norb])
-
-    # Active space two-body integrals
-    two_mo_small = two_mo[:, ncore:norb, ncore:norb]
+    two_mo_small = np.zeros((two.shape[0], nactive, nactive))
+    begin = 0
+    for block in iter_cholesky_blocks(two):
+        if orb is None:
+            block_mo = block[:, :norb, :norb]
+        else:
+            with timer.section('Index Trans'):
+                block_mo = four_index_transform_cholesky(block, orb, orb, indextrans,
+                                                         slice(0, norb))
+        core = block_mo[:, :ncore, :ncore]
+        # Core energy
+        #   Direct part
+        ecore += 2*np.einsum('xaa,xbb', core, core)
+        #   Exchange part
+        ecore -= np.einsum('xab,xba', core, core)
+        # Active space one-body integrals
+        #   Direct part
+        one_mo_small += 2*np.einsum('xac,xbb->ac', block_mo[:, ncore:norb, ncore:norb], core)
+        #   Exchange part
+        one_mo_small -= np.einsum('xab,xbc->ac', block_mo[:, ncore:norb, :ncore],
+                                  block_mo[:, :ncore, ncore:norb])
+        # Active space two-body integrals
+        two_mo_small[begin:begin + len(block)] = block_mo[:, ncore:norb, ncore:norb]
+        begin += len(block)
 
     return one_mo_small, two_mo_small, ecore
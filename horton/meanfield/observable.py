@@ -23,11 +23,13 @@
 
 import numpy as np
 
+from horton.gbasis.cext import contract_packed
 from horton.utils import doc_inherit
 
 
 __all__ = [
     'compute_dm_full',
+    'IntegralDirectOperator',
     'Observable',
     'RTwoIndexTerm', 'UTwoIndexTerm',
     'RDirectTerm', 'UDirectTerm',
@@ -193,23 +195,155 @@ class UTwoIndexTerm(Observable):
         pass
 
 
+class IntegralDirectOperator(object):
+    """Four-center integrals that are recomputed every time they are contracted.
+
+    An instance of this class can be used instead of a dense four-index operator (or
+    its Cholesky decomposition) in the direct and exchange terms, e.g.
+    :py:class:`RDirectTerm` and :py:class:`RExchangeTerm`. The integrals are never
+    stored, such that the memory usage is only proportional to nbasis**2.
+
+    Both contractions are computed in one pass over the integrals. The result for the
+    last density matrix is kept, such that the direct and exchange terms of the same
+    density matrix only need one pass.
+
+    In incremental mode, the contractions of a new density matrix are obtained by
+    only contracting its difference with a previous density matrix. Because this
+    difference becomes small in the course of an SCF calculation, the
+    density-weighted screening then skips most of the shell quartets. To limit the
+    accumulation of screening errors, a full contraction is carried out periodically.
+    """
+
+    def __init__(self, obasis, kind='electron', screening_threshold=1e-12, nthread=None,
+                 incremental=False, rebuild_period=10, **kwargs):
+        """Initialize an IntegralDirectOperator instance.
+
+        Parameters
+        ----------
+        obasis : GOBasis
+            The Gaussian orbital basis set.
+        kind : str
+            The type of two-body operator: 'electron', 'erf', 'gauss' or 'ralpha'.
+            This selects the method ``compute_{kind}_repulsion_direct`` of obasis.
+        screening_threshold : float
+            The threshold for the density-weighted Schwarz screening of shell
+            quartets.
+        nthread : int
+            The number of threads. When not given, ``context.nthread`` is used.
+        incremental : bool
+            When True, only changes in the density matrix are contracted.
+        rebuild_period : int
+            In incremental mode, the maximum number of consecutive incremental updates
+            after which a full contraction is carried out.
+        kwargs
+            Parameters of the two-body operator, e.g. ``mu`` for 'erf'.
+        """
+        self.obasis = obasis
+        self.kind = kind
+        self.screening_threshold = screening_threshold
+        self.nthread = nthread
+        self.incremental = incremental
+        self.rebuild_period = rebuild_period
+        self.kwargs = kwargs
+        self._compute = getattr(obasis, 'compute_%s_repulsion_direct' % kind)
+        # List of (dm, (coulomb, exchange), nincrement) for recent density matrices.
+        # In incremental mode, a few of them are kept, e.g. such that the alpha, beta
+        # and spin-summed density matrices of an unrestricted calculation each have
+        # a reference from the previous SCF iteration.
+        self._references = []
+        self._nreference = 3 if incremental else 1
+
+    def _contract(self, dm):
+        """Return the Coulomb and exchange contractions, reusing previous results."""
+        for ref_dm, ref_result, _nincrement in self._references:
+            if np.array_equal(ref_dm, dm):
+                return ref_result
+        result = None
+        if self.incremental and len(self._references) > 0:
+            # Start from the closest reference density matrix.
+            iref = np.argmin([abs(ref[0] - dm).max() for ref in self._references])
+            ref_dm, ref_result, nincrement = self._references[iref]
+            if nincrement < self.rebuild_period:
+                delta_result = self._compute(
+                    dm - ref_dm, screening_threshold=self.screening_threshold,
+                    nthread=self.nthread, **self.kwargs)
+                result = (ref_result[0] + delta_result[0],
+                          ref_result[1] + delta_result[1])
+                nincrement += 1
+        if result is None:
+            result = self._compute(
+                np.ascontiguousarray(dm), screening_threshold=self.screening_threshold,
+                nthread=self.nthread, **self.kwargs)
+            nincrement = 0
+        self._references.append((dm.copy(), result, nincrement))
+        if len(self._references) > self._nreference:
+            del self._references[0]
+        return result
+
+    def contract_direct(self, dm):
+        """Return the direct-type contraction with a density matrix, see contract_direct."""
+        return self._contract(dm)[0].copy()
+
+    def contract_exchange(self, dm):
+        """Return the exchange-type contraction with a density matrix, see contract_exchange."""
+        return self._contract(dm)[1].copy()
+
+
+# The maximum number of elements in a block of Cholesky vectors that is processed at
+# once in contract_direct and contract_exchange. This limits the memory usage when the
+# vectors are stored in a file, see GOBasis.compute_electron_repulsion_cholesky.
+CHOLESKY_BLOCK_SIZE = 2**24
+
+
+def iter_cholesky_blocks(op):
+    """Iterate over blocks of Cholesky vectors.
+
+    Parameters
+    ----------
+    op : np.ndarray, shape=(nvec, nbasis, nbasis)
+        The Cholesky vectors. This may also be an ``np.memmap``, in which case only one
+        block at a time is loaded in memory.
+
+    Yields
+    ------
+    block : np.ndarray, shape=(nvec_block, nbasis, nbasis)
+        Consecutive blocks of vectors, with at most ``CHOLESKY_BLOCK_SIZE`` elements
+        (and at least one vector).
+    """
+    nvec_block = max(1, CHOLESKY_BLOCK_SIZE//(op.shape[1]*op.shape[2]))
+    for begin in xrange(0, op.shape[0], nvec_block):
+        yield np.asarray(op[begin:begin + nvec_block])
+
+
 def contract_direct(op, dm):
     """Perform an direct-type contraction with a four-index operator.
 
     Parameters
     ----------
     op : np.ndarray, shape=(nvec, nbasis, nbasis) or
-        The four-index operator or its Cholesky decomposition
+        The four-index operator or its Cholesky decomposition. The latter may be
+        stored in a file, see ``iter_cholesky_blocks``. Density-fitted vectors from
+        ``GOBasis.compute_electron_repulsion_ri`` have the same layout as Cholesky
+        vectors. A packed four-index operator (one-dimensional, see
+        ``pack_four_index``) and an IntegralDirectOperator are also supported.
     dm : np.ndarray, shape=(nbasis, nbasis)
         The density matrix
     """
-    if op.ndim == 3:
-        # Cholesky decomposition
-        tmp = np.tensordot(op, dm, axes=([(1,2),(1,0)]))
-        return np.tensordot(op, tmp, [0,0])
+    if isinstance(op, IntegralDirectOperator):
+        return op.contract_direct(dm)
+    elif op.ndim == 3:
+        # Cholesky decomposition, processed in blocks of vectors
+        result = np.zeros(dm.shape)
+        for block in iter_cholesky_blocks(op):
+            tmp = np.tensordot(block, dm, axes=([(1,2),(1,0)]))
+            result += np.tensordot(block, tmp, [0,0])
+        return result
     elif op.ndim == 4:
         # Normal case
         return np.einsum('abcd,bd->ac', op, dm)
+    elif op.ndim == 1:
+        # Packed storage of the symmetry-unique elements
+        return contract_packed(op, np.ascontiguousarray(dm), exchange=False)[0]
     else:
         raise NotImplementedError
 
@@ -224,7 +358,8 @@ class RDirectTerm(Observable):
         ----------
         op_alpha
             Expansion of two-body operator in basis of alpha orbitals. Same is used for
-            beta orbitals. Also a Cholesky decomposition of the operator is supported.
+            beta orbitals. Also a Cholesky decomposition of the operator or an
+            IntegralDirectOperator is supported.
         label : str
             A short string to identify the observable.
         """
@@ -273,7 +408,7 @@ class UDirectTerm(Observable):
         ----------
         op_alpha
             Expansion of two-body operator in basis of alpha orbitals. Also a Cholesky
-            decomposition of the operator is supported.
+            decomposition of the operator or an IntegralDirectOperator is supported.
         label : str
             A short string to identify the observable.
         op_beta
@@ -347,16 +482,28 @@ def contract_exchange(op, dm):
     Parameters
     ----------
     op : np.ndarray, shape=(nvec, nbasis, nbasis) or
-        The four-index operator or its Cholesky decomposition
+        The four-index operator or its Cholesky decomposition. The latter may be
+        stored in a file, see ``iter_cholesky_blocks``. Density-fitted vectors from
+        ``GOBasis.compute_electron_repulsion_ri`` have the same layout as Cholesky
+        vectors. A packed four-index operator (one-dimensional, see
+        ``pack_four_index``) and an IntegralDirectOperator are also supported.
     dm : np.ndarray, shape=(nbasis, nbasis)
         The density matrix
     """
-    if op.ndim == 3:
-        # Cholesky decomposition
-        tmp = np.tensordot(op, dm, axes=([1,1]))
-        return np.tensordot(op, tmp, ([0,2],[0,2]))
+    if isinstance(op, IntegralDirectOperator):
+        return op.contract_exchange(dm)
+    elif op.ndim == 3:
+        # Cholesky decomposition, processed in blocks of vectors
+        result = np.zeros(dm.shape)
+        for block in iter_cholesky_blocks(op):
+            tmp = np.tensordot(block, dm, axes=([1,1]))
+            result += np.tensordot(block, tmp, ([0,2],[0,2]))
+        return result
     elif op.ndim == 4:
         return np.einsum('abcd,cb->ad', op, dm)
+    elif op.ndim == 1:
+        # Packed storage of the symmetry-unique elements
+        return contract_packed(op, np.ascontiguousarray(dm), coulomb=False)[1]
     else:
         raise NotImplementedError
 
@@ -371,7 +518,8 @@ class RExchangeTerm(Observable):
         ----------
         op_alpha
             Expansion of two-body operator in basis of alpha orbitals. Same is used for
-            beta orbitals. Also a Cholesky decomposition of the operator is supported.
+            beta orbitals. Also a Cholesky decomposition of the operator or an
+            IntegralDirectOperator is supported.
         fraction : float
             Amount of exchange to be included (1.0 corresponds to 100%).
         label : str
@@ -424,7 +572,7 @@ class UExchangeTerm(Observable):
         ----------
         op_alpha
             Expansion of two-body operator in basis of alpha orbitals. Also a Cholesky
-            decomposition of the operator is supported.
+            decomposition of the operator or an IntegralDirectOperator is supported.
         label : str
             A short string to identify the observable.
         fraction : float
@@ -28,7 +28,7 @@ from horton.utils import check_type
 from horton.log import log
 
 
-__all__ = ['Orbitals']
+__all__ = ['Orbitals', 'Orthogonalizer']
 
 
 class Orbitals(object):
@@ -260,16 +260,24 @@ class Orbitals(object):
     def from_fock(self, fock, overlap):
         """Diagonalize a Fock matrix to obtain orbitals and energies.
 
-        This method updated the attributes ``coeffs`` and ``energies`` in-place.
+        This method updated the attributes ``coeffs`` and ``energies`` in-place. Only
+        the lowest ``nfn`` eigenpairs are computed.
 
         Parameters
         ----------
         fock : np.ndarray, shape=(nbasis, nbasis)
             The fock matrix.
-        overlap : np.ndarray, shape=(nbasis, nbasis)
-            The overlap matrix.
+        overlap : np.ndarray, shape=(nbasis, nbasis) or Orthogonalizer
+            The overlap matrix. When the same overlap matrix is used many times, pass
+            an Orthogonalizer instead, which avoids a factorization of the overlap
+            matrix in every call.
         """
-        evals, evecs = eigh(fock, overlap)
+        if isinstance(overlap, Orthogonalizer):
+            evals, evecs = overlap.diagonalize(fock, self.nfn)
+        elif self.nfn < self.nbasis:
+            evals, evecs = eigh(fock, overlap, eigvals=(0, self.nfn-1))
+        else:
+            evals, evecs = eigh(fock, overlap)
         self._energies[:] = evals[:self.nfn]
         self._coeffs[:] = evecs[:,:self.nfn]
 
@@ -288,8 +296,8 @@ class Orbitals(object):
             The fock matrix.
         dm : np.ndarray, shape=(nbasis, nbasis)
             The density matrix.
-        overlap : np.ndarray, shape=(nbasis, nbasis)
-            The overlap matrix.
+        overlap : np.ndarray, shape=(nbasis, nbasis) or Orthogonalizer
+            The overlap matrix, see ``from_fock``.
         epstol : float
             The threshold for recognizing degenerate energy levels. When two subsequent
             energy levels are separated by an orbital energy less than ``epstol``, they
@@ -302,6 +310,9 @@ class Orbitals(object):
         # Diagonalize the Fock Matrix
         self.from_fock(fock, overlap)
 
+        if isinstance(overlap, Orthogonalizer):
+            overlap = overlap.overlap
+
         # Build clusters of degenerate orbitals. Rely on the fact that the
         # energy levels are sorted (one way or the other).
         clusters = []
@@ -487,3 +498,88 @@ class Orbitals(object):
                 self.energies[index1], self.energies[index0]
             self.occupations[index0], self.occupations[index1] =\
                 self.occupations[index1], self.occupations[index0]
+
+
+class Orthogonalizer(object):
+    """Canonical orthogonalization of a basis set.
+
+    The overlap matrix is diagonalized once. Eigenvectors with an eigenvalue below a
+    threshold are discarded, which removes near-linear dependencies from the basis.
+    The remaining ones, scaled with the inverse square root of their eigenvalues,
+    transform the generalized eigenvalue problem of a Fock matrix into a standard one.
+    """
+
+    def __init__(self, overlap, eps=1e-10):
+        """Initialize an Orthogonalizer.
+
+        Parameters
+        ----------
+        overlap : np.ndarray, shape=(nbasis, nbasis)
+            The overlap matrix. A copy is kept.
+        eps : float
+            Eigenvectors of the overlap matrix with an eigenvalue below this threshold
+            are discarded.
+        """
+        if eps < 0:
+            raise ValueError('The threshold eps cannot be negative.')
+        self._overlap = overlap.copy()
+        evals, evecs = np.linalg.eigh(overlap)
+        mask = evals > eps
+        self._basis = evecs[:, mask]/np.sqrt(evals[mask])
+        if log.do_medium and not mask.all():
+            log('Orthogonalizer removed %i linear dependencies from the basis.'
+                % (~mask).sum())
+
+    def _get_nbasis(self):
+        """The number of basis functions."""
+        return self._overlap.shape[0]
+
+    nbasis = property(_get_nbasis)
+
+    def _get_nfn(self):
+        """The number of linearly independent functions."""
+        return self._basis.shape[1]
+
+    nfn = property(_get_nfn)
+
+    def _get_overlap(self):
+        """The overlap matrix."""
+        return self._overlap.view()
+
+    overlap = property(_get_overlap)
+
+    def _get_basis(self):
+        """The orthonormal functions, expanded in the basis, shape=(nbasis, nfn)."""
+        return self._basis.view()
+
+    basis = property(_get_basis)
+
+    def diagonalize(self, fock, neig=None):
+        """Compute the lowest eigenpairs of a Fock matrix.
+
+        Parameters
+        ----------
+        fock : np.ndarray, shape=(nbasis, nbasis)
+            The fock matrix.
+        neig : int
+            The number of eigenpairs to compute. When not given, all ``nfn`` eigenpairs
+            are computed. When it is smaller, only the requested ones are computed.
+
+        Returns
+        -------
+        evals : np.ndarray, shape=(neig,)
+            The eigenvalues, sorted from low to high.
+        evecs : np.ndarray, shape=(nbasis, neig)
+            The eigenvectors, normalized with respect to the overlap matrix.
+        """
+        if neig is None:
+            neig = self.nfn
+        elif neig > self.nfn:
+            raise ValueError('Only %i eigenpairs can be computed after removing '
+                             'linear dependencies, got neig=%i.' % (self.nfn, neig))
+        fock_ortho = np.dot(self._basis.T, np.dot(fock, self._basis))
+        if neig < self.nfn:
+            evals, evecs = eigh(fock_ortho, eigvals=(0, neig-1))
+        else:
+            evals, evecs = eigh(fock_ortho)
+        return evals, np.dot(self._basis, evecs)
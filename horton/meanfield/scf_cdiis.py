@@ -35,7 +35,8 @@ __all__ = ['CDIISSCFSolver']
 class CDIISSCFSolver(DIISSCFSolver):
     '''The Commmutatator (or Pulay) DIIS SCF solver [pulay1980]_'''
 
-    def __init__(self, threshold=1e-6, maxiter=128, nvector=6, skip_energy=False, prune_old_states=False):
+    def __init__(self, threshold=1e-6, maxiter=128, nvector=6, skip_energy=False,
+                 prune_old_states=False, nvirtual=None):
         '''
            **Optional arguments:**
 
@@ -56,9 +57,14 @@ class CDIISSCFSolver(DIISSCFSolver):
                 coefficient is zero. Pruning starts at the oldest state and stops
                 as soon as a state is encountered with a non-zero coefficient. Even
                 if some newer states have a zero coefficient.
+
+           nvirtual
+                The number of virtual orbitals to compute when diagonalizing a
+                Fock matrix. By default, all orbitals are computed.
         '''
         biblio.cite('pulay1980', 'the commutator DIIS SCF algorithm')
-        DIISSCFSolver.__init__(self, CDIISHistory, threshold, maxiter, nvector, skip_energy, prune_old_states)
+        DIISSCFSolver.__init__(self, CDIISHistory, threshold, maxiter, nvector, skip_energy,
+                               prune_old_states, nvirtual)
 
 
 class CDIISHistory(DIISHistory):
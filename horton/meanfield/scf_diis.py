@@ -27,7 +27,7 @@ from horton.log import log, timer
 from horton.exceptions import NoSCFConvergence
 from horton.meanfield.convergence import convergence_error_commutator
 from horton.meanfield.utils import compute_commutator, check_dm
-from horton.meanfield.orbitals import Orbitals
+from horton.meanfield.orbitals import Orbitals, Orthogonalizer
 
 
 __all__ = []
@@ -37,7 +37,8 @@ class DIISSCFSolver(object):
     '''Base class for all DIIS SCF solvers'''
     kind = 'dm' # input/output variable is the density matrix
 
-    def __init__(self, DIISHistoryClass, threshold=1e-6, maxiter=128, nvector=6, skip_energy=False, prune_old_states=False):
+    def __init__(self, DIISHistoryClass, threshold=1e-6, maxiter=128, nvector=6,
+                 skip_energy=False, prune_old_states=False, nvirtual=None):
         '''
            **Arguments:**
 
@@ -63,13 +64,23 @@ class DIISSCFSolver(object):
                 coefficient is zero. Pruning starts at the oldest state and stops
                 as soon as a state is encountered with a non-zero coefficient. Even
                 if some newer states have a zero coefficient.
+
+           nvirtual
+                When given, only the occupied orbitals and this number of virtual
+                orbitals are computed when diagonalizing a Fock matrix. The number
+                of occupied orbitals is derived from the initial density matrices.
+                This must be large enough for occupation models that may occupy
+                more orbitals, e.g. Fermi smearing.
         '''
+        if nvirtual is not None and nvirtual < 0:
+            raise ValueError('The number of virtual orbitals cannot be negative.')
         self.DIISHistoryClass = DIISHistoryClass
         self.threshold = threshold
         self.maxiter = maxiter
         self.nvector = nvector
         self.skip_energy = skip_energy
         self.prune_old_states = prune_old_states
+        self.nvirtual = nvirtual
         # Attributs where local variables of the __call__ method are stored:
         self._history = None
         self._focks = []
@@ -108,7 +119,10 @@ class DIISSCFSolver(object):
         # keep local variables as attributes for inspection/debugging by caller
         self._history = self.DIISHistoryClass(self.nvector, ham.ndm, ham.deriv_scale, overlap)
         self._focks = [np.zeros(overlap.shape) for i in xrange(ham.ndm)]
-        self._orbs = [Orbitals(overlap.shape[0]) for i in xrange(ham.ndm)]
+        # The overlap matrix is factorized only once.
+        orthogonalizer = Orthogonalizer(overlap)
+        self._orbs = [Orbitals(overlap.shape[0], self._get_nfn(orthogonalizer, dms[i]))
+                      for i in xrange(ham.ndm)]
 
         if log.do_medium:
             log('Starting restricted closed-shell %s-SCF' % self._history.name)
@@ -154,7 +168,7 @@ class DIISSCFSolver(object):
             # Take a regular SCF step using the current fock matrix. Then
             # construct a new density matrix and fock matrix.
             for i in xrange(ham.ndm):
-                self._orbs[i].from_fock(self._focks[i], overlap)
+                self._orbs[i].from_fock(self._focks[i], orthogonalizer)
             occ_model.assign(*self._orbs)
             for i in xrange(ham.ndm):
                 dms[i][:] = self._orbs[i].to_dm()
@@ -276,6 +290,13 @@ class DIISSCFSolver(object):
 
         return counter
 
+    def _get_nfn(self, orthogonalizer, dm):
+        '''Return the number of orbitals to compute for one density matrix.'''
+        if self.nvirtual is None:
+            return orthogonalizer.nfn
+        nocc = int(np.ceil(np.einsum('ab,ba', orthogonalizer.overlap, dm) - 1e-4))
+        return min(orthogonalizer.nfn, nocc + self.nvirtual)
+
     def error(self, ham, lf, overlap, *dms):
         return convergence_error_commutator(ham, lf, overlap, *dms)
 
@@ -0,0 +1,371 @@
+# -*- coding: utf-8 -*-
+# HORTON: Helpful Open-source Research TOol for N-fermion systems.
+# Copyright (C) 2011-2017 The HORTON Development Team
+#
+# This file is part of HORTON.
+#
+# HORTON is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 3
+# of the License, or (at your option) any later version.
+#
+# HORTON is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, see <http://www.gnu.org/licenses/>
+#
+# --
+"""Second-order SCF solver with a trust region."""
+
+
+import numpy as np
+from scipy.linalg import expm
+
+from horton.log import log, timer
+from horton.exceptions import NoSCFConvergence
+from horton.meanfield.convergence import convergence_error_commutator
+from horton.meanfield.orbitals import Orbitals, Orthogonalizer
+from horton.meanfield.utils import compute_commutator, check_dm
+
+
+__all__ = ['NewtonSCFSolver']
+
+
+class NewtonSCFSolver(object):
+    """Trust-region Newton SCF solver.
+
+    The orbitals are optimized with rotations between orbitals with different occupation
+    numbers. In every iteration, the Newton equations for the rotation angles are solved
+    approximately with the truncated conjugate gradient method of Steihaug, within a
+    trust region. The products of the orbital Hessian with trial vectors are computed
+    with ``EffHam.compute_dot_hessian``, such that the Hessian is never stored. A
+    diagonal approximation of the Hessian is used as preconditioner. The size of the
+    trust region is adapted with the ratio of the actual and the predicted change in
+    energy.
+
+    The occupation numbers are assigned once, to the orbitals of the first Fock matrix,
+    and are kept fixed during the optimization. This solver is therefore meant to be
+    used with occupation models like ``AufbauOccModel``. Far from convergence, it is
+    usually more efficient to start with a DIIS solver, see the ``presolver`` option.
+    """
+
+    kind = 'dm'  # input/output variable is the density matrix
+
+    def __init__(self, threshold=1e-6, maxiter=128, skip_energy=False, presolver=None,
+                 trust_radius=0.5, max_trust_radius=2.0, maxiter_cg=20):
+        """Initialize a NewtonSCFSolver.
+
+        Parameters
+        ----------
+        threshold : float
+            The convergence threshold for the commutator error.
+        maxiter : int
+            The maximum number of iterations, including those of the presolver. When set
+            to None, the SCF loop will go one until convergence is reached.
+        skip_energy : bool
+            When set to True, the final energy is not logged. (It is always computed by
+            this solver.)
+        presolver : SCFSolver
+            An SCF solver of kind 'dm', e.g. ``CDIISSCFSolver(threshold=1e-2)``. When
+            given, it is called first and the second-order steps start when its
+            threshold on the commutator error is reached, or when it runs out of
+            iterations.
+        trust_radius : float
+            The initial radius of the trust region, i.e. the maximum norm of the vector
+            of rotation angles in one step.
+        max_trust_radius : float
+            The upper limit for the radius of the trust region.
+        maxiter_cg : int
+            The maximum number of conjugate gradient iterations, i.e. products of the
+            Hessian with a vector, per SCF iteration.
+        """
+        if trust_radius <= 0:
+            raise ValueError('The trust radius must be strictly positive.')
+        if max_trust_radius < trust_radius:
+            raise ValueError('The maximum trust radius cannot be smaller than the initial one.')
+        if maxiter_cg <= 0:
+            raise ValueError('The number of conjugate gradient iterations must be strictly '
+                             'positive.')
+        if presolver is not None and presolver.kind != 'dm':
+            raise TypeError('The presolver must work with density matrices.')
+        self.threshold = threshold
+        self.maxiter = maxiter
+        self.skip_energy = skip_energy
+        self.presolver = presolver
+        self.trust_radius = trust_radius
+        self.max_trust_radius = max_trust_radius
+        self.maxiter_cg = maxiter_cg
+
+    @timer.with_section('SCF')
+    def __call__(self, ham, overlap, occ_model, *dms):
+        """Find a self-consistent set of density matrices.
+
+        Parameters
+        ----------
+        ham : EffHam
+            An effective Hamiltonian.
+        overlap : np.ndarray, shape=(nbasis, nbasis)
+            The overlap operator.
+        occ_model : OccModel
+            Model for the orbital occupations.
+        dm1, dm2, ... : np.ndarray, shape=(nbasis, nbasis)
+            The initial density matrices. The number of dms must match ham.ndm.
+
+        Returns
+        -------
+        counter : int
+            The number of iterations, including those of the presolver.
+        """
+        # Some type checking
+        if ham.ndm != len(dms):
+            raise TypeError('The number of initial density matrices does not match the '
+                            'Hamiltonian.')
+
+        # Check input density matrices.
+        for i in xrange(ham.ndm):
+            check_dm(dms[i], overlap)
+        occ_model.check_dms(overlap, *dms)
+
+        counter = 0
+        if self.presolver is not None:
+            try:
+                counter = self.presolver(ham, overlap, occ_model, *dms)
+            except NoSCFConvergence:
+                counter = self.presolver.maxiter
+
+        # Orbitals and occupation numbers from the Fock matrices of the initial density
+        # matrices.
+        orthogonalizer = Orthogonalizer(overlap)
+        focks = [np.zeros(overlap.shape) for i in xrange(ham.ndm)]
+        ham.reset(*dms)
+        ham.compute_fock(*focks)
+        orbs = [Orbitals(overlap.shape[0], orthogonalizer.nfn) for i in xrange(ham.ndm)]
+        for i in xrange(ham.ndm):
+            orbs[i].from_fock(focks[i], orthogonalizer)
+        occ_model.assign(*orbs)
+        for i in xrange(ham.ndm):
+            dms[i][:] = orbs[i].to_dm()
+        ham.reset(*dms)
+        energy = ham.compute_energy()
+        ham.compute_fock(*focks)
+        error = _compute_error(dms, focks, overlap)
+        # Pairs of orbitals that can be rotated.
+        masks = [orb.occupations[:, None] - orb.occupations > 1e-8 for orb in orbs]
+
+        if log.do_medium:
+            log('Starting trust-region Newton SCF solver. ndm=%i' % ham.ndm)
+            log.hline()
+            log('Iter         Error  CG        Radius                Energy       Change')
+            log.hline()
+            log('%4i %12.5e                   %20.13f' % (counter, error, energy))
+
+        radius = self.trust_radius
+        converged = error < self.threshold
+        while not converged and (self.maxiter is None or counter < self.maxiter):
+            # Take a step within the trust region.
+            gradient = self._compute_gradient(ham, orbs, focks, masks)
+            step, predicted, on_boundary, ncg = self._solve_trust_region(
+                ham, orbs, focks, masks, gradient, radius)
+
+            # Evaluate the energy and the Fock matrices after the step.
+            new_orbs = [orb.copy() for orb in orbs]
+            for i, rotation in enumerate(self._split(step, masks)):
+                new_orbs[i].coeffs[:] = np.dot(orbs[i].coeffs, expm(rotation))
+            new_dms = [orb.to_dm() for orb in new_orbs]
+            new_focks = [np.zeros(overlap.shape) for i in xrange(ham.ndm)]
+            ham.reset(*new_dms)
+            new_energy = ham.compute_energy()
+            ham.compute_fock(*new_focks)
+            new_error = _compute_error(new_dms, new_focks, overlap)
+            counter += 1
+
+            # Update the trust radius. Very small predicted changes in energy are
+            # dominated by rounding errors. Such steps are accepted when they reduce the
+            # commutator error.
+            if abs(predicted) < 1e-10:
+                accept = new_error < error
+            else:
+                ratio = (new_energy - energy)/predicted
+                if ratio < 0.25:
+                    radius = 0.25*np.linalg.norm(step)
+                elif ratio > 0.75 and on_boundary:
+                    radius = min(2*radius, self.max_trust_radius)
+                accept = ratio > 0.0
+
+            if log.do_medium:
+                log('%4i %12.5e  %2i  %12.5e  %20.13f  %11.4e%s' % (
+                    counter, new_error, ncg, radius, new_energy, new_energy - energy,
+                    '' if accept else ' rejected'))
+
+            if accept:
+                orbs = new_orbs
+                focks = new_focks
+                for i in xrange(ham.ndm):
+                    dms[i][:] = new_dms[i]
+                energy = new_energy
+                error = new_error
+                converged = error < self.threshold
+            else:
+                # Put the Hamiltonian back in the current state for the Hessian.
+                ham.reset(*dms)
+                if radius < 1e-10:
+                    break
+
+        if log.do_medium:
+            if converged:
+                log('%4i %12.5e (converged)' % (counter, error))
+            log.blank()
+
+        if not self.skip_energy:
+            if log.do_medium:
+                ham.log()
+
+        if not converged:
+            raise NoSCFConvergence
+
+        return counter
+
+    def _split(self, vector, masks):
+        """Convert a vector of rotation angles to antisymmetric matrices, one per channel."""
+        result = []
+        offset = 0
+        for mask in masks:
+            x = np.zeros(mask.shape)
+            size = mask.sum()
+            x[mask] = vector[offset:offset+size]
+            offset += size
+            result.append(x.T - x)
+        return result
+
+    def _compute_gradient(self, ham, orbs, focks, masks):
+        """Compute the derivative of the energy towards the rotation angles."""
+        result = []
+        for orb, fock, mask in zip(orbs, focks, masks):
+            fock_mo = np.dot(orb.coeffs.T, np.dot(fock, orb.coeffs))
+            occs = orb.occupations
+            grad = (2*ham.deriv_scale)*fock_mo*(occs[:, None] - occs)
+            result.append(grad[mask])
+        return np.concatenate(result)
+
+    def _compute_preconditioner(self, ham, orbs, focks, masks):
+        """Compute a diagonal approximation of the orbital Hessian."""
+        result = []
+        for orb, fock, mask in zip(orbs, focks, masks):
+            energies = np.einsum('ab,ai,bi->i', fock, orb.coeffs, orb.coeffs)
+            occs = orb.occupations
+            diag = (2*ham.deriv_scale)*(energies - energies[:, None])*(occs[:, None] - occs)
+            result.append(diag[mask])
+        result = np.concatenate(result)
+        # Keep the preconditioner positive, also when the diagonal is not.
+        return np.maximum(abs(result), 1e-2)
+
+    def _dot_hessian(self, ham, orbs, focks, masks, vector):
+        """Compute the product of the orbital Hessian with a vector of rotation angles.
+
+        The Hamiltonian must be reset with the current density matrices.
+        """
+        rotations = self._split(vector, masks)
+        commutators = []
+        delta_dms = []
+        for orb, rotation in zip(orbs, rotations):
+            occs = orb.occupations
+            # Change of the density matrix in the basis of the orbitals.
+            commutator = rotation*(occs - occs[:, None])
+            commutators.append(commutator)
+            delta_dms.append(np.dot(orb.coeffs, np.dot(commutator, orb.coeffs.T)))
+        ham.reset_delta(*delta_dms)
+        outputs = [np.zeros(dm.shape) for dm in delta_dms]
+        ham.compute_dot_hessian(*outputs)
+
+        result = []
+        scale = ham.deriv_scale
+        for orb, fock, mask, rotation, commutator, output in zip(
+                orbs, focks, masks, rotations, commutators, outputs):
+            occs = orb.occupations
+            fock_mo = np.dot(orb.coeffs.T, np.dot(fock, orb.coeffs))
+            # Second derivative of the energy towards the density matrix.
+            tmp = np.dot(orb.coeffs.T, np.dot(output, orb.coeffs))
+            grad = (scale*scale)*tmp*(occs[:, None] - occs)
+            # Second derivative of the density matrix towards the rotation angles.
+            fock_rot = np.dot(fock_mo, rotation) - np.dot(rotation, fock_mo)
+            tmp = np.dot(commutator, fock_mo) - np.dot(fock_mo, commutator)
+            tmp += fock_rot*(occs[:, None] - occs)
+            grad += (0.5*scale)*tmp
+            result.append((grad - grad.T)[mask])
+        return np.concatenate(result)
+
+    def _solve_trust_region(self, ham, orbs, focks, masks, gradient, radius):
+        """Minimize the quadratic model of the energy within the trust region.
+
+        The truncated conjugate gradient method of Steihaug is used, with the diagonal
+        preconditioner. It stops at the boundary of the trust region, when negative
+        curvature is found, or when the residual is small compared to the gradient.
+
+        Returns
+        -------
+        step : np.ndarray
+            The rotation angles.
+        predicted : float
+            The change in energy predicted by the quadratic model.
+        on_boundary : bool
+            True when the step ends on the boundary of the trust region.
+        ncg : int
+            The number of products of the Hessian with a vector.
+        """
+        precon = self._compute_preconditioner(ham, orbs, focks, masks)
+        step = np.zeros(gradient.shape)
+        residual = gradient.copy()
+        precon_residual = residual/precon
+        direction = -precon_residual
+        rz = np.dot(residual, precon_residual)
+        tolerance = min(0.1, np.sqrt(np.linalg.norm(gradient)))*np.linalg.norm(gradient)
+        on_boundary = False
+        ncg = 0
+        while ncg < self.maxiter_cg:
+            hd = self._dot_hessian(ham, orbs, focks, masks, direction)
+            ncg += 1
+            curvature = np.dot(direction, hd)
+            if curvature <= 0 or np.linalg.norm(step + (rz/curvature)*direction) >= radius:
+                # Follow the direction to the boundary, also when it has a negative
+                # curvature.
+                tau = _to_boundary(step, direction, radius)
+                step += tau*direction
+                residual += tau*hd
+                on_boundary = True
+                break
+            alpha = rz/curvature
+            step += alpha*direction
+            residual += alpha*hd
+            if np.linalg.norm(residual) < tolerance:
+                break
+            precon_residual = residual/precon
+            new_rz = np.dot(residual, precon_residual)
+            direction = -precon_residual + (new_rz/rz)*direction
+            rz = new_rz
+        # The residual is the gradient of the quadratic model at the step.
+        predicted = 0.5*np.dot(step, gradient + residual)
+        return step, predicted, on_boundary, ncg
+
+    def error(self, ham, overlap, *dms):
+        """See :py:func:`horton.meanfield.convergence.convergence_error_commutator`."""
+        return convergence_error_commutator(ham, overlap, *dms)
+
+
+def _compute_error(dms, focks, overlap):
+    """Return the commutator error for given density and Fock matrices."""
+    errorsq = 0.0
+    for dm, fock in zip(dms, focks):
+        commutator = compute_commutator(dm, fock, overlap)
+        errorsq += np.einsum('ab,ab', commutator, commutator)
+    return errorsq**0.5
+
+
+def _to_boundary(step, direction, radius):
+    """Return tau >= 0 such that the norm of step + tau*direction equals radius."""
+    a = np.dot(direction, direction)
+    b = 2*np.dot(step, direction)
+    c = np.dot(step, step) - radius*radius
+    return (-b + np.sqrt(b*b - 4*a*c))/(2*a)
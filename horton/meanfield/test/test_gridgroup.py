@@ -21,9 +21,11 @@
 """Test horton/meanfield/gridgroup.py."""
 
 
+import numpy as np
 from nose.tools import assert_raises
 
 from horton import *  # pylint: disable=wildcard-import,unused-wildcard-import
+from horton.meanfield.test.common import check_dot_hessian
 
 
 def test_gridgroup_density_cutoff():
@@ -77,3 +79,154 @@ def test_gridgroup_exceptions():
         ugg._update_grid_basics(cache, 'alpha')
     with assert_raises(ValueError):
         ugg._get_potentials(cache)
+
+
+def check_gridgroup_kwargs(GridGroup, grid_terms, dms, dot_hessian=False, **kwargs):
+    """Compare a GridGroup with the given keyword arguments to one on the full grid."""
+    # prepare some molecule
+    fn_fchk = context.get_fn('test/co_pbe_sto3g.fchk')
+    mol = IOData.from_file(fn_fchk)
+    grid = BeckeMolGrid(mol.coordinates, mol.numbers, mol.pseudo_numbers, random_rotate=False)
+    nbasis = mol.obasis.nbasis
+
+    results = []
+    for local in False, True:
+        # Non-local grid terms force the use of the full grid.
+        for grid_term in grid_terms:
+            grid_term.local = local
+        if local:
+            gg = GridGroup(mol.obasis, grid, grid_terms, **kwargs)
+        else:
+            gg = GridGroup(mol.obasis, grid, grid_terms)
+            assert not gg.compact
+        cache = Cache()
+        for select, dm in zip(['alpha', 'beta'], dms(mol)):
+            cache['dm_%s' % select] = dm
+            cache['delta_dm_%s' % select] = 0.1*dm.dot(dm)
+        focks = [np.zeros((nbasis, nbasis)) for dm in dms(mol)]
+        gg.add_fock(cache, *focks)
+        energy = gg.compute_energy(cache)
+        dots = []
+        if dot_hessian:
+            dots = [np.zeros((nbasis, nbasis)) for dm in dms(mol)]
+            gg.add_dot_hessian(cache, *dots)
+        results.append((energy, focks, dots))
+        if not local:
+            assert cache['rho_full'].size == grid.size
+        elif gg.block_size is not None:
+            # No grid data is stored.
+            assert 'rho_full' not in cache
+            # The energy can also be computed without Fock matrices.
+            cache.clear()
+            for select, dm in zip(['alpha', 'beta'], dms(mol)):
+                cache['dm_%s' % select] = dm
+            assert abs(gg.compute_energy(cache) - energy) < 1e-12
+        elif gg.compact:
+            # The compact grid is smaller and it is not in the shared cache.
+            assert 'rho_full' not in cache
+            assert gg._get_cache(cache)['rho_full'].size < grid.size
+    # All cases give the same result.
+    assert abs(results[0][0] - results[1][0]) < 1e-10
+    for fock0, fock1 in zip(results[0][1] + results[0][2], results[1][1] + results[1][2]):
+        np.testing.assert_allclose(fock0, fock1, atol=1e-10)
+
+
+def test_gridgroup_compact_restricted():
+    check_gridgroup_kwargs(RGridGroup, [RLibXCGGA('x_pbe'), RDiracExchange()],
+                           lambda mol: [mol.orb_alpha.to_dm()])
+
+
+def test_gridgroup_compact_unrestricted():
+    check_gridgroup_kwargs(UGridGroup, [ULibXCMGGA('c_tpss')],
+                           lambda mol: [mol.orb_alpha.to_dm(), 0.5*mol.orb_alpha.to_dm()])
+
+
+def test_gridgroup_blocks_restricted():
+    check_gridgroup_kwargs(RGridGroup, [RLibXCGGA('x_pbe')],
+                           lambda mol: [mol.orb_alpha.to_dm()], dot_hessian=True,
+                           block_size=1000)
+
+
+def test_gridgroup_blocks_unrestricted():
+    check_gridgroup_kwargs(UGridGroup, [ULibXCMGGA('c_tpss'), UDiracExchange()],
+                           lambda mol: [mol.orb_alpha.to_dm(), 0.5*mol.orb_alpha.to_dm()],
+                           block_size=1000)
+
+
+def test_gridgroup_dot_hessian_after_other_term():
+    # The contribution of a restricted grid group to the dot product of the Hessian is
+    # scaled by one half, but the contributions of preceding terms must be left as is.
+    fn_fchk = context.get_fn('test/co_pbe_sto3g.fchk')
+    mol = IOData.from_file(fn_fchk)
+    grid = BeckeMolGrid(mol.coordinates, mol.numbers, mol.pseudo_numbers, random_rotate=False)
+    er = mol.obasis.compute_electron_repulsion()
+    dm_alpha = mol.orb_alpha.to_dm()
+    delta_dm_alpha = 0.1*dm_alpha.dot(dm_alpha)
+
+    def compute_dot(terms):
+        ham = REffHam(terms)
+        ham.reset(dm_alpha)
+        ham.compute_fock(np.zeros(dm_alpha.shape))
+        ham.reset_delta(delta_dm_alpha)
+        dot = np.zeros(dm_alpha.shape)
+        ham.compute_dot_hessian(dot)
+        return dot
+
+    dot_direct = compute_dot([RDirectTerm(er, 'hartree')])
+    dot_grid = compute_dot([RGridGroup(mol.obasis, grid, [RLibXCLDA('x')])])
+    dot_both = compute_dot([RDirectTerm(er, 'hartree'),
+                            RGridGroup(mol.obasis, grid, [RLibXCLDA('x')])])
+    assert abs(dot_direct).max() > 1e-3
+    np.testing.assert_allclose(dot_both, dot_direct + dot_grid, rtol=0, atol=1e-12)
+    check_dot_hessian(REffHam([RDirectTerm(er, 'hartree'),
+                               RGridGroup(mol.obasis, grid, [RLibXCLDA('x')])]), dm_alpha)
+
+
+def test_gridgroup_compact_mixed():
+    # prepare some molecule
+    fn_fchk = context.get_fn('test/n2_hfs_sto3g.fchk')
+    mol = IOData.from_file(fn_fchk)
+    grid = BeckeMolGrid(mol.coordinates, mol.numbers, mol.pseudo_numbers, random_rotate=False,
+                        mode='keep')
+    dm_alpha = mol.orb_alpha.to_dm()
+    nbasis = mol.obasis.nbasis
+
+    def make_groups():
+        gg_compact = RGridGroup(mol.obasis, grid, [RLibXCLDA('x')], 'compact')
+        gg_full = RGridGroup(mol.obasis, grid, [RBeckeHartree(8)], 'full')
+        assert gg_compact.compact
+        assert not gg_full.compact
+        return gg_compact, gg_full
+
+    # Reference results, with each grid group in a separate effective Hamiltonian.
+    energy_ref = 0.0
+    fock_ref = np.zeros((nbasis, nbasis))
+    for gg in make_groups():
+        ham = REffHam([gg])
+        ham.reset(dm_alpha)
+        energy_ref += ham.compute_energy()
+        fock = np.zeros((nbasis, nbasis))
+        ham.compute_fock(fock)
+        fock_ref += fock
+
+    # Both groups share the cache of the effective Hamiltonian, in any order.
+    for reverse in False, True:
+        grid_groups = make_groups()
+        if reverse:
+            grid_groups = grid_groups[::-1]
+        ham = REffHam(grid_groups)
+        ham.reset(dm_alpha)
+        fock = np.zeros((nbasis, nbasis))
+        ham.compute_fock(fock)
+        assert abs(ham.compute_energy() - energy_ref) < 1e-10
+        np.testing.assert_allclose(fock, fock_ref, atol=1e-10)
+
+
+def test_gridgroup_blocks_exceptions():
+    fn_fchk = context.get_fn('test/co_pbe_sto3g.fchk')
+    mol = IOData.from_file(fn_fchk)
+    grid = BeckeMolGrid(mol.coordinates, mol.numbers, mol.pseudo_numbers, random_rotate=False)
+    with assert_raises(ValueError):
+        RGridGroup(mol.obasis, grid, [RLibXCLDA('x')], block_size=0)
+    with assert_raises(ValueError):
+        RGridGroup(mol.obasis, grid, [RBeckeHartree(4)], block_size=1000)
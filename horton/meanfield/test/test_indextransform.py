@@ -21,10 +21,15 @@
 
 
 import numpy as np
+import os
+import h5py as h5
 from nose.tools import assert_raises
 
 from horton import *  # pylint: disable=wildcard-import,unused-wildcard-import
-from horton.meanfield.indextransform import _parse_four_index_transform_orbs
+from horton.meanfield import observable
+from horton.test.common import numpy_seed, tmpdir
+from horton.meanfield.indextransform import _parse_four_index_transform_orbs, \
+    _four_index_transform_blocked
 
 def test_parse_index_transform_orbs():
     assert _parse_four_index_transform_orbs(0, 1, 2, 3) == (0, 1, 2, 3)
@@ -40,6 +45,10 @@ def test_exceptions():
         four_index_transform(np.zeros((4, 4, 4, 4)), 0, method='foo')
     with assert_raises(ValueError):
         four_index_transform_cholesky(np.zeros((2, 4, 4)), 0, method='foo')
+    orb = Orbitals(4)
+    orb.coeffs[:] = np.identity(4)
+    with assert_raises(ValueError):
+        four_index_transform(np.zeros((4, 4, 4, 4)), orb, method='blocked', memory=0)
     with assert_raises(ValueError):
         split_core_active(np.zeros((5, 5)), None, 0.0, None, -1, 3)
     with assert_raises(ValueError):
@@ -54,6 +63,59 @@ def test_exceptions():
         split_core_active_cholesky(np.zeros((5, 5)), None, 0.0, None, 3, 7)
 
 
+def test_four_index_transform_blocked():
+    mol = IOData.from_file(context.get_fn('test/water.xyz'))
+    obasis = get_gobasis(mol.coordinates, mol.numbers, '3-21g')
+    two = obasis.compute_electron_repulsion()
+    orb0 = Orbitals(obasis.nbasis)
+    orb1 = Orbitals(obasis.nbasis)
+    with numpy_seed():
+        orb0.coeffs[:] = np.random.uniform(-1, 1, orb0.coeffs.shape)
+        orb1.coeffs[:] = np.random.uniform(-1, 1, orb1.coeffs.shape)
+    for orbs in (orb0,), (orb0, orb1), (orb0, None, orb1), (orb0, orb1, orb1, orb0):
+        # All methods give the same result, also when the orbitals differ.
+        expected = four_index_transform(two, *orbs, method='tensordot')
+        result = four_index_transform(two, *orbs, method='einsum')
+        np.testing.assert_allclose(result, expected, rtol=0, atol=1e-8)
+        # A tiny memory budget, such that blocks of one row or pair are used.
+        for memory in 1, None:
+            result = four_index_transform(two, *orbs, method='blocked', memory=memory)
+            np.testing.assert_allclose(result, expected, rtol=0, atol=1e-8)
+        # Only a subset of the orbitals.
+        expected = four_index_transform(two, *orbs, orb_slice=slice(2, 7))
+        result = four_index_transform(two, *orbs, method='blocked', orb_slice=slice(2, 7))
+        np.testing.assert_allclose(result, expected, rtol=0, atol=1e-8)
+    # The eight-fold symmetric case is constructed symmetric, without an additional
+    # symmetrization.
+    result = four_index_transform(two, orb0, method='blocked')
+    coeffs = orb0.coeffs
+    direct = _four_index_transform_blocked(two, coeffs, coeffs, coeffs, coeffs, True, 2**30,
+                                           None)
+    assert (result == direct).all()
+    for axes in (1, 0, 3, 2), (2, 3, 0, 1), (0, 3, 2, 1):
+        np.testing.assert_allclose(result, result.transpose(axes), rtol=0, atol=1e-8)
+    # The eight-fold symmetric case agrees with the other methods.
+    expected = four_index_transform(two, orb0)
+    with tmpdir('horton.meanfield.test.test_indextransform.blocked') as dn:
+        fn = os.path.join(dn, 'scratch.h5')
+        result = four_index_transform(two, orb0, method='blocked', memory=2**16, scratch=fn)
+        np.testing.assert_allclose(result, expected, rtol=0, atol=1e-8)
+        # The scratch file is removed afterwards.
+        assert not os.path.isfile(fn)
+        # Existing files are not overwritten.
+        with open(fn, 'w') as f:
+            f.write('foo')
+        with assert_raises(ValueError):
+            four_index_transform(two, orb0, method='blocked', scratch=fn)
+        with open(fn) as f:
+            assert f.read() == 'foo'
+        os.remove(fn)
+        with h5.File(os.path.join(dn, 'other.h5'), 'w') as f:
+            result = four_index_transform(two, orb0, method='blocked', scratch=f)
+            np.testing.assert_allclose(result, expected, rtol=0, atol=1e-8)
+            assert len(f) == 0
+
+
 def helper_hf(olp, ecore, one, two, nocc):
     # Initial guess
     orb_alpha = Orbitals(olp.shape[0])
@@ -138,6 +200,14 @@ def check_core_active(mol, basis_str, ncore, nactive):
         np.identity(len(one_small)), ecore, one_small, two_small, nocc-ncore)
     np.testing.assert_almost_equal(energy1, energy2)
 
+    # B3) Get integrals for the active space, using the blocked transformation
+    one_small, two_small, ecore = split_core_active(
+        one, two, enucnuc, orb_alpha1, ncore, nactive, indextrans='blocked', memory=2**20)
+    # C3) Verify the RHF energy using the active space integrals
+    energy2, orb_alpha2 = helper_hf(
+        np.identity(len(one_small)), ecore, one_small, two_small, nocc-ncore)
+    np.testing.assert_almost_equal(energy1, energy2)
+
 
 def test_core_active_neon():
     mol = IOData(
@@ -244,6 +314,44 @@ def check_core_active_cholesky(mol, basis_str, ncore, nactive):
     np.testing.assert_almost_equal(energy1, energy2)
 
 
+def test_core_active_cholesky_blocks():
+    mol = IOData.from_file(context.get_fn('test/water.xyz'))
+    obasis, olp, kin, na, one, two_vecs, enucnuc = prepare_hf_cholesky(mol, '3-21g')
+    orb = Orbitals(obasis.nbasis)
+    with numpy_seed():
+        orb.coeffs[:] = np.random.uniform(-1, 1, orb.coeffs.shape)
+    ncore, nactive = 2, 6
+    norb = ncore + nactive
+    # Reference with the full set of transformed vectors.
+    two_mo = four_index_transform_cholesky(two_vecs, orb)
+    one_mo = reduce(np.dot, [orb.coeffs.T, one, orb.coeffs])
+    ecore_ref = 1.5 + 2*np.trace(one_mo[:ncore, :ncore]) + \
+        2*np.einsum('xaa,xbb', two_mo[:, :ncore, :ncore], two_mo[:, :ncore, :ncore]) - \
+        np.einsum('xab,xba', two_mo[:, :ncore, :ncore], two_mo[:, :ncore, :ncore])
+    one_small_ref = one_mo[ncore:norb, ncore:norb] + \
+        2*np.einsum('xac,xbb->ac', two_mo[:, ncore:norb, ncore:norb],
+                    two_mo[:, :ncore, :ncore]) - \
+        np.einsum('xab,xbc->ac', two_mo[:, ncore:norb, :ncore], two_mo[:, :ncore, ncore:norb])
+    with tmpdir('horton.meanfield.test.test_indextransform.cholesky_blocks') as dn:
+        vecs_file = obasis.compute_electron_repulsion_cholesky(filename='%s/vecs.bin' % dn)
+        # Use small blocks to test the blockwise transformation.
+        old_block_size = observable.CHOLESKY_BLOCK_SIZE
+        observable.CHOLESKY_BLOCK_SIZE = 3*obasis.nbasis**2
+        try:
+            one_small, two_small, ecore = split_core_active_cholesky(
+                one, vecs_file, 1.5, orb, ncore, nactive)
+        finally:
+            observable.CHOLESKY_BLOCK_SIZE = old_block_size
+        del vecs_file
+    np.testing.assert_allclose(one_small, one_small_ref)
+    np.testing.assert_allclose(two_small, two_mo[:, ncore:norb, ncore:norb])
+    np.testing.assert_allclose(ecore, ecore_ref)
+    # Transformation of a subset of the orbitals.
+    np.testing.assert_allclose(
+        four_index_transform_cholesky(two_vecs, orb, orb_slice=slice(1, 5)),
+        two_mo[:, 1:5, 1:5])
+
+
 def test_core_active_neon_cholesky():
     mol = IOData(
         coordinates=np.zeros((1, 3), float),
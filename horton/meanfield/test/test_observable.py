@@ -21,12 +21,17 @@
 """Unit tests for horton/meanfield/observable.py."""
 
 
+import numpy as np
+
 from horton import *  # pylint: disable=wildcard-import,unused-wildcard-import
+from horton.meanfield import observable
+from horton.meanfield.observable import contract_direct, contract_exchange
+from horton.test.common import numpy_seed, tmpdir
 from horton.meanfield.test.common import check_dot_hessian, \
     check_dot_hessian_polynomial, check_dot_hessian_cache
 
 
-def setup_rhf_case(cholesky=False):
+def setup_rhf_case(cholesky=False, direct=False, ri=False, packed=False):
     """Prepare datastructures for R-HF calculation on Water."""
     fn_fchk = context.get_fn('test/water_sto3g_hf_g03.fchk')
     mol = IOData.from_file(fn_fchk)
@@ -38,8 +43,13 @@ def setup_rhf_case(cholesky=False):
     mol.obasis.compute_nuclear_attraction(mol.coordinates, mol.pseudo_numbers, core)
     if cholesky:
         er = mol.obasis.compute_electron_repulsion_cholesky()
+    elif direct:
+        er = IntegralDirectOperator(mol.obasis)
+    elif ri:
+        aux = get_gobasis(mol.coordinates, mol.numbers, 'cc-pvtz')
+        er = mol.obasis.compute_electron_repulsion_ri(aux)
     else:
-        er = mol.obasis.compute_electron_repulsion()
+        er = mol.obasis.compute_electron_repulsion(packed=packed)
     terms = [
         RTwoIndexTerm(core, 'core'),
         RDirectTerm(er, 'hartree'),
@@ -80,7 +90,115 @@ def test_cache_dot_hessian_rhf_cholesky():
     check_dot_hessian_cache(ham, mol.dm_alpha)
 
 
-def setup_uhf_case(cholesky=False):
+def test_contract_cholesky_file():
+    mol, _olp, _core, _ham = setup_rhf_case()
+    vecs = mol.obasis.compute_electron_repulsion_cholesky()
+    direct = contract_direct(vecs, mol.dm_alpha)
+    exchange = contract_exchange(vecs, mol.dm_alpha)
+    with tmpdir('horton.meanfield.test.test_observable.test_contract_cholesky_file') as dn:
+        vecs_file = mol.obasis.compute_electron_repulsion_cholesky(
+            filename='%s/vecs.bin' % dn)
+        # Use small blocks to test the blockwise contraction.
+        old_block_size = observable.CHOLESKY_BLOCK_SIZE
+        observable.CHOLESKY_BLOCK_SIZE = 3*mol.obasis.nbasis**2
+        try:
+            np.testing.assert_allclose(contract_direct(vecs_file, mol.dm_alpha), direct)
+            np.testing.assert_allclose(contract_exchange(vecs_file, mol.dm_alpha), exchange)
+        finally:
+            observable.CHOLESKY_BLOCK_SIZE = old_block_size
+        del vecs_file
+
+
+def test_dot_hessian_rhf_fd_direct():
+    mol, _olp, _core, ham = setup_rhf_case(direct=True)
+    check_dot_hessian(ham, mol.dm_alpha)
+
+
+def test_cache_dot_hessian_rhf_direct():
+    mol, _olp, _core, ham = setup_rhf_case(direct=True)
+    check_dot_hessian_cache(ham, mol.dm_alpha)
+
+
+def test_fock_rhf_direct():
+    mol, _olp, _core, ham_ref = setup_rhf_case()
+    mol, _olp, _core, ham = setup_rhf_case(direct=True)
+    fock_ref = np.zeros(mol.dm_alpha.shape)
+    ham_ref.reset(mol.dm_alpha)
+    energy_ref = ham_ref.compute_energy()
+    ham_ref.compute_fock(fock_ref)
+    fock = np.zeros(mol.dm_alpha.shape)
+    ham.reset(mol.dm_alpha)
+    energy = ham.compute_energy()
+    ham.compute_fock(fock)
+    assert abs(energy - energy_ref) < 1e-10
+    np.testing.assert_allclose(fock, fock_ref, atol=1e-10)
+
+
+def test_dot_hessian_rhf_polynomial_ri():
+    mol, olp, core, ham = setup_rhf_case(ri=True)
+    check_dot_hessian_polynomial(olp, core, ham, [mol.orb_alpha])
+
+
+def test_dot_hessian_rhf_fd_ri():
+    mol, _olp, _core, ham = setup_rhf_case(ri=True)
+    check_dot_hessian(ham, mol.dm_alpha)
+
+
+def test_fock_rhf_ri():
+    mol, _olp, _core, ham_ref = setup_rhf_case()
+    mol, _olp, _core, ham = setup_rhf_case(ri=True)
+    ham_ref.reset(mol.dm_alpha)
+    energy_ref = ham_ref.compute_energy()
+    ham.reset(mol.dm_alpha)
+    energy = ham.compute_energy()
+    # The fitting error of the Hartree and exchange energies is small.
+    assert abs(energy - energy_ref) < 1e-2
+
+
+def test_dot_hessian_rhf_fd_packed():
+    mol, _olp, _core, ham = setup_rhf_case(packed=True)
+    check_dot_hessian(ham, mol.dm_alpha)
+
+
+def test_fock_rhf_packed():
+    mol, _olp, _core, ham_ref = setup_rhf_case()
+    mol, _olp, _core, ham = setup_rhf_case(packed=True)
+    fock_ref = np.zeros(mol.dm_alpha.shape)
+    ham_ref.reset(mol.dm_alpha)
+    energy_ref = ham_ref.compute_energy()
+    ham_ref.compute_fock(fock_ref)
+    fock = np.zeros(mol.dm_alpha.shape)
+    ham.reset(mol.dm_alpha)
+    energy = ham.compute_energy()
+    ham.compute_fock(fock)
+    assert abs(energy - energy_ref) < 1e-10
+    np.testing.assert_allclose(fock, fock_ref, atol=1e-10)
+
+
+def test_contract_direct_incremental():
+    mol, _olp, _core, _ham = setup_rhf_case()
+    er = mol.obasis.compute_electron_repulsion()
+    op = IntegralDirectOperator(mol.obasis, incremental=True, rebuild_period=3)
+    op_ref = IntegralDirectOperator(mol.obasis)
+    # Two interleaved series of density matrices, like alpha and beta in an
+    # unrestricted SCF, with more steps than the rebuild period.
+    dms = [mol.dm_alpha.copy(), 0.5*mol.dm_alpha]
+    with numpy_seed():
+        for i in xrange(10):
+            for dm in dms:
+                if i > 0:
+                    delta = np.random.normal(0, 1e-3, dm.shape)
+                    dm += delta + delta.T
+                direct = contract_direct(op, dm)
+                exchange = contract_exchange(op, dm)
+                np.testing.assert_allclose(direct, contract_direct(op_ref, dm), atol=1e-10)
+                np.testing.assert_allclose(exchange, contract_exchange(op_ref, dm),
+                                           atol=1e-10)
+                np.testing.assert_allclose(direct, contract_direct(er, dm), atol=1e-10)
+                np.testing.assert_allclose(exchange, contract_exchange(er, dm), atol=1e-10)
+
+
+def setup_uhf_case(cholesky=False, direct=False):
     """Prepare datastructures for UHF calculation."""
     fn_fchk = context.get_fn('test/h3_hfs_321g.fchk')
     mol = IOData.from_file(fn_fchk)
@@ -91,7 +209,10 @@ def setup_uhf_case(cholesky=False):
     olp = mol.obasis.compute_overlap()
     core = mol.obasis.compute_kinetic()
     mol.obasis.compute_nuclear_attraction(mol.coordinates, mol.pseudo_numbers, core)
-    er = mol.obasis.compute_electron_repulsion()
+    if direct:
+        er = IntegralDirectOperator(mol.obasis)
+    else:
+        er = mol.obasis.compute_electron_repulsion()
     terms = [
         UTwoIndexTerm(core, 'core'),
         UDirectTerm(er, 'hartree'),
@@ -130,3 +251,24 @@ def test_dot_hessian_uhf_fd_cholesky():
 def test_cache_dot_hessian_uhf_cholesky():
     mol, _olp, _core, ham = setup_uhf_case(True)
     check_dot_hessian_cache(ham, mol.dm_alpha, mol.dm_beta)
+
+
+def test_dot_hessian_uhf_fd_direct():
+    mol, _olp, _core, ham = setup_uhf_case(direct=True)
+    check_dot_hessian(ham, mol.dm_alpha, mol.dm_beta)
+
+
+def test_fock_uhf_direct():
+    mol, _olp, _core, ham_ref = setup_uhf_case()
+    mol, _olp, _core, ham = setup_uhf_case(direct=True)
+    focks_ref = [np.zeros(mol.dm_alpha.shape) for _i in xrange(2)]
+    ham_ref.reset(mol.dm_alpha, mol.dm_beta)
+    energy_ref = ham_ref.compute_energy()
+    ham_ref.compute_fock(*focks_ref)
+    focks = [np.zeros(mol.dm_alpha.shape) for _i in xrange(2)]
+    ham.reset(mol.dm_alpha, mol.dm_beta)
+    energy = ham.compute_energy()
+    ham.compute_fock(*focks)
+    assert abs(energy - energy_ref) < 1e-10
+    for fock, fock_ref in zip(focks, focks_ref):
+        np.testing.assert_allclose(fock, fock_ref, atol=1e-10)
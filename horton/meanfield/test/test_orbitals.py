@@ -201,6 +201,55 @@ def test_orbitals_from_fock():
         assert orb.error_eigen(fock, olp) < 1e-5
 
 
+def test_orbitals_from_fock_orthogonalizer():
+    with numpy_seed(1):
+        a = np.random.normal(0, 1, (5, 5))
+        fock = a+a.T
+        a = np.random.normal(0, 1, (5, 5))
+        olp = np.dot(a, a.T)
+    orth = Orthogonalizer(olp)
+    assert orth.nbasis == 5
+    assert orth.nfn == 5
+    np.testing.assert_almost_equal(np.dot(orth.basis.T, np.dot(olp, orth.basis)), np.identity(5))
+    orb1 = Orbitals(5)
+    orb1.from_fock(fock, olp)
+    orb2 = Orbitals(5)
+    orb2.from_fock(fock, orth)
+    assert orb2.error_eigen(fock, olp) < 1e-5
+    np.testing.assert_almost_equal(orb1.energies, orb2.energies)
+    # Only the lowest eigenpairs, with both drivers.
+    for overlap in olp, orth:
+        orb3 = Orbitals(5, 2)
+        orb3.from_fock(fock, overlap)
+        np.testing.assert_almost_equal(orb3.energies, orb1.energies[:2])
+        assert orb3.error_eigen(fock, olp) < 1e-5
+    # The overlap matrix is copied.
+    olp[:] = 0.0
+    orb2.from_fock(fock, orth)
+    np.testing.assert_almost_equal(orb1.energies, orb2.energies)
+    with assert_raises(ValueError):
+        Orthogonalizer(olp, eps=-1.0)
+
+
+def test_orthogonalizer_linear_dependencies():
+    with numpy_seed(2):
+        a = np.random.normal(0, 1, (5, 4))
+        olp = np.dot(a, a.T)
+        a = np.random.normal(0, 1, (5, 5))
+        fock = a+a.T
+    orth = Orthogonalizer(olp)
+    assert orth.nbasis == 5
+    assert orth.nfn == 4
+    np.testing.assert_almost_equal(np.dot(orth.basis.T, np.dot(olp, orth.basis)), np.identity(4))
+    orb = Orbitals(5, 4)
+    orb.from_fock(fock, orth)
+    orb.check_orthonormality(olp)
+    evals, evecs = orth.diagonalize(fock, 3)
+    np.testing.assert_almost_equal(evals, orb.energies[:3])
+    with assert_raises(ValueError):
+        Orbitals(5).from_fock(fock, orth)
+
+
 def test_orbitals_from_fock_and_dm():
     natom = 5
 
@@ -218,6 +267,7 @@ def test_orbitals_from_fock_and_dm():
     # Create orbitals that will be used to construct various density matrices
     orb = Orbitals(natom)
     orb.from_fock(fock, olp)
+    orth = Orthogonalizer(olp)
 
     # Checks for every case
     def check_case(orb0):
@@ -225,6 +275,9 @@ def test_orbitals_from_fock_and_dm():
         orb1 = Orbitals(natom)
         orb1.from_fock_and_dm(fock, dm, olp)
         np.testing.assert_almost_equal(orb0.occupations, orb1.occupations)
+        orb2 = Orbitals(natom)
+        orb2.from_fock_and_dm(fock, dm, orth)
+        np.testing.assert_almost_equal(orb0.occupations, orb2.occupations)
         assert orb1.error_eigen(fock, olp) < 1e-5
         sds = np.dot(olp, np.dot(dm, olp))
         orb1.energies[:] = orb1.occupations
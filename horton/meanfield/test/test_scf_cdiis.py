@@ -39,6 +39,12 @@ def test_lih_os_hf():
     check_lih_os_hf(CDIISSCFSolver(threshold=1e-7))
 
 
+def test_lih_os_hf_nvirtual():
+    check_lih_os_hf(CDIISSCFSolver(threshold=1e-7, nvirtual=2))
+    with assert_raises(ValueError):
+        CDIISSCFSolver(nvirtual=-1)
+
+
 def test_water_cs_hfs():
     check_water_cs_hfs(CDIISSCFSolver(threshold=1e-6))
 
@@ -0,0 +1,58 @@
+# -*- coding: utf-8 -*-
+# HORTON: Helpful Open-source Research TOol for N-fermion systems.
+# Copyright (C) 2011-2017 The HORTON Development Team
+#
+# This file is part of HORTON.
+#
+# HORTON is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 3
+# of the License, or (at your option) any later version.
+#
+# HORTON is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, see <http://www.gnu.org/licenses/>
+#
+# --
+
+
+from nose.tools import assert_raises
+
+from horton import *  # pylint: disable=wildcard-import,unused-wildcard-import
+from horton.meanfield.test.common import check_hf_cs_hf, check_lih_os_hf, \
+    check_co_cs_pbe
+
+
+def test_hf_cs_hf():
+    check_hf_cs_hf(NewtonSCFSolver(threshold=1e-7))
+
+
+def test_lih_os_hf():
+    check_lih_os_hf(NewtonSCFSolver(threshold=1e-7))
+
+
+def test_co_cs_pbe():
+    check_co_cs_pbe(NewtonSCFSolver(threshold=1e-5))
+
+
+def test_hf_cs_hf_presolver():
+    check_hf_cs_hf(NewtonSCFSolver(threshold=1e-7, presolver=CDIISSCFSolver(threshold=1e-2)))
+
+
+def test_lih_os_hf_presolver():
+    check_lih_os_hf(NewtonSCFSolver(threshold=1e-7, presolver=CDIISSCFSolver(threshold=1e-2)))
+
+
+def test_exceptions():
+    with assert_raises(ValueError):
+        NewtonSCFSolver(trust_radius=0.0)
+    with assert_raises(ValueError):
+        NewtonSCFSolver(trust_radius=1.0, max_trust_radius=0.5)
+    with assert_raises(ValueError):
+        NewtonSCFSolver(maxiter_cg=0)
+    with assert_raises(TypeError):
+        NewtonSCFSolver(presolver=PlainSCFSolver())
@@ -84,18 +84,16 @@ def wpart_slow_analysis(wpart, mol):
                 fill_pure_polynomials(work, wpart.lmax)
         at_weights = wpart.cache.load('at_weights', index)
 
-        # Convert the weight functions to AIM overlap operators.
-        counter = 0
+        # Convert the weight functions to AIM overlap operators, all in one pass over
+        # the grid.
+        pots = np.zeros((grid.size, npure), float)
+        pots[:, 0] = at_weights
+        if wpart.lmax > 0:
+            pots[:, 1:] = at_weights[:, None]*work
+        ops = mol.obasis.compute_grid_density_fock_multi(grid.points, grid.weights, pots)
         overlap_operators = {}
-        for l in xrange(wpart.lmax + 1):
-            for m in xrange(-l, l + 1):
-                if counter > 0:
-                    tmp = at_weights * work[:, counter - 1]
-                else:
-                    tmp = at_weights
-                op = mol.obasis.compute_grid_density_fock(grid.points, grid.weights, tmp)
-                overlap_operators['olp_%05i' % counter] = op
-                counter += 1
+        for counter in xrange(npure):
+            overlap_operators['olp_%05i' % counter] = ops[counter]
 
         wpart.cache.dump(('overlap_operators', index), overlap_operators)
 
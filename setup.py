@@ -383,8 +383,8 @@ ext_modules = [
         libraries=libint2_config['libraries'],
         extra_objects=libint2_config['extra_objects'],
         extra_compile_args=libint2_config['extra_compile_args'] +
-                           ['-std=c++11'],
-        extra_link_args=libint2_config['extra_link_args'],
+                           ['-std=c++11', '-pthread'],
+        extra_link_args=libint2_config['extra_link_args'] + ['-pthread'],
         language="c++"),
     Extension(
         "horton.grid.cext",